@@ -0,0 +1,79 @@
+# Script for 4dn-cloud-infra to run a task or command against many AWS accounts/environments concurrently.
+#
+# Each target is an AWS credentials directory, given either as a path or as an AWS credentials name
+# referring to ~/.aws_test.<aws-credentials-name>; by default all such directories. Targets are run
+# concurrently, each in its own explicit boto3 session (so not via the environment), and the results
+# are merged into a single table with the per-target timing and any error. For example:
+#
+#   fan-out --task kms-keys cgap-supertest cgap-devtest
+#   fan-out -- show-global-env-bucket
+#
+# A (command) following -- is run in a subprocess with its environment pointing only at each target's
+# credentials; if it outputs JSON (a dictionary or list of dictionaries) those are used as the rows.
+
+import argparse
+import sys
+import time
+from typing import Optional
+from ..utils.fan_out import command_task, fan_out, print_fan_out_results, resolve_fan_out_targets
+from ..utils.misc_utils import exit_with_no_action
+from ..utils.paths import InfraDirectories
+
+
+def _identity_task(aws, credentials) -> dict:
+    return {"user_arn": credentials.user_arn, "region": credentials.region}
+
+
+def _kms_keys_task(aws, credentials) -> list:
+    return [{"kms_key_id": kms_key_id} for kms_key_id in aws.get_customer_managed_kms_keys()]
+
+
+def _iam_roles_task(aws, credentials) -> list:
+    return [{"role_arn": role_arn} for role_arn in aws.find_iam_role_arns(".*")]
+
+
+FAN_OUT_TASKS = {
+    "identity": _identity_task,
+    "kms-keys": _kms_keys_task,
+    "iam-roles": _iam_roles_task,
+}
+
+
+def main(override_argv: Optional[list] = None) -> None:
+    """
+    Main entry point for this script. Parses command-line arguments, resolves the targets, and runs the fan-out.
+
+    :param override_argv: Raw command-line arguments for this invocation.
+    """
+    argp = argparse.ArgumentParser()
+    argp.add_argument("targets", nargs="*",
+                      help=f"AWS credentials directories, or names from {InfraDirectories.AWS_DIR}.<name>;"
+                           f" default is all of those.")
+    argp.add_argument("--aws-dir", required=False, default=InfraDirectories.AWS_DIR,
+                      help=f"Alternate base AWS directory to default: {InfraDirectories.AWS_DIR}.")
+    argp.add_argument("--task", required=False, choices=sorted(FAN_OUT_TASKS),
+                      help="Built-in task to run against each target; otherwise give a command after --.")
+    argp.add_argument("--timeout", required=False, type=float,
+                      help="Maximum seconds to allow a command to run for each target.")
+    argp.add_argument("--workers", required=False, type=int, default=8,
+                      help="Maximum number of targets to run at once.")
+    argv = sys.argv[1:] if override_argv is None else override_argv
+    # Split off any command ourselves, else argparse would take its arguments as targets.
+    command = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = argp.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+    if bool(args.task) == bool(command):
+        exit_with_no_action("Exactly one of --task or a command (after --) must be specified.")
+
+    targets = resolve_fan_out_targets(args.targets, args.aws_dir)
+    if not targets:
+        exit_with_no_action(f"No AWS credentials directories found: {args.aws_dir}.*")
+    task = FAN_OUT_TASKS[args.task] if args.task else command_task(command, timeout=args.timeout)
+
+    started = time.time()
+    results = fan_out(targets, task, max_workers=args.workers)
+    print_fan_out_results(results, time.time() - started)
+    exit(1 if any(result.error for result in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -73,6 +73,7 @@ from ...constants import Settings
 from ...names import Names
 from ..utils.args_utils import add_aws_credentials_args, validate_aws_credentials_args
 from ..utils.aws import Aws
+from ..utils.concurrent_resolver import ConcurrentResolver
 from ..utils.paths import (InfraDirectories)
 from ..utils.misc_utils import (get_json_config_file_value,
                                 exit_with_no_action,
@@ -127,6 +128,20 @@ def validate_and_get_rds_secret_name(rds_secret_name: str, aws_credentials_name:
     return rds_secret_name
 
 
+def get_federated_user_name_pattern(aws_credentials_name: str, config_file: str) -> str:
+    """
+    Returns the regular expression for the AWS federated user IAM name, using the same code that
+    4dn-cloud-infra code does, and the "s3.bucket.ecosystem" value in the given JSON config file.
+
+    :param aws_credentials_name: AWS credentials name (e.g. cgap-supertest).
+    :param config_file: Full path to the JSON config file.
+    :return: Regular expression for the AWS federated user IAM name.
+    """
+    # Had to refactor out from C4IAM.ecs_s3_iam_user() the Names.ecs_s3_iam_user_logical_id() function.
+    ecosystem = get_json_config_file_value(Settings.S3_BUCKET_ECOSYSTEM, config_file, DEFAULT_ECOSYSTEM)
+    return ".*" + Names.ecs_s3_iam_user_logical_id(None, aws_credentials_name, ecosystem)
+
+
 def validate_and_get_federated_user_name(federated_user_name: str,
                                          aws_credentials_name: str,
                                          config_file: str,
@@ -144,9 +159,7 @@ def validate_and_get_federated_user_name(federated_user_name: str,
     :return: AWS federated user IAM name.
     """
     if not federated_user_name:
-        # Had to refactor out from C4IAM.ecs_s3_iam_user() the Names.ecs_s3_iam_user_logical_id() function.
-        ecosystem = get_json_config_file_value(Settings.S3_BUCKET_ECOSYSTEM, config_file, DEFAULT_ECOSYSTEM)
-        federated_user_name_pattern = ".*" + Names.ecs_s3_iam_user_logical_id(None, aws_credentials_name, ecosystem)
+        federated_user_name_pattern = get_federated_user_name_pattern(aws_credentials_name, config_file)
         federated_user_name = aws.find_iam_user_name(federated_user_name_pattern)
         if not federated_user_name:
             exit_with_no_action(f"ERROR: AWS federated user cannot be determined.")
@@ -223,6 +236,45 @@ def validate_and_get_rds_host_and_password(rds_host: str, rds_password: str,
     return rds_host, rds_password
 
 
+def resolve_aws_lookups(aws: Aws,
+                        elasticsearch_server: str,
+                        federated_user_name: str,
+                        gac_secret_name: str,
+                        rds_secret_name: str,
+                        rds_host: str,
+                        rds_password: str,
+                        s3_access_key_id: str,
+                        s3_secret_access_key: str,
+                        s3_encrypt_key_id: str) -> ConcurrentResolver:
+    """
+    Does the AWS lookups needed by the validate_and_get_* functions, for the values not explicitly given,
+    concurrently (where independent), so that when these functions are then called one after another
+    (within Aws.shared_listings) they use these (shared) results rather than each doing its own lookups.
+    Any errors are left for those functions to (re)encounter and report. Prints the per-lookup latencies.
+    The GAC secret (to be updated later) and RDS secret (if needed) are fetched with a single batched call.
+
+    :return: ConcurrentResolver object containing the lookup results and timings.
+    """
+    resolver = ConcurrentResolver()
+    if not elasticsearch_server:
+        resolver.add("opensearch_endpoint", lambda: aws.get_elasticsearch_endpoint(aws.credentials_name))
+    secret_names = [gac_secret_name] + ([rds_secret_name] if not rds_host or not rds_password else [])
+    resolver.add("secrets", lambda: aws.get_secret_values(secret_names))
+    if not s3_encrypt_key_id and get_json_config_file_value("s3.bucket.encryption", aws.custom_config_file):
+        resolver.add("kms_keys", aws.get_customer_managed_kms_keys)
+    if not federated_user_name or not s3_access_key_id or not s3_secret_access_key:
+        # Both finding the federated user and creating its access key use the (one, shared) IAM index.
+        resolver.add("iam_index", aws.get_iam_index)
+    if not federated_user_name:
+        federated_user_name_pattern = get_federated_user_name_pattern(aws.credentials_name, aws.custom_config_file)
+        resolver.add("federated_user_name",
+                     lambda iam_index: aws.find_iam_user_name(federated_user_name_pattern),
+                     depends_on=["iam_index"])
+    resolver.resolve()
+    resolver.print_latency_report()
+    return resolver
+
+
 def gather_secrets_to_update(
         aws_access_key_id: str,
         aws_account_number: str,
@@ -268,6 +320,46 @@ def gather_secrets_to_update(
     PRINT(f"AWS global application config secret to update: {gac_secret_name}")
     PRINT(f"AWS RDS application config secret to update: {rds_secret_name}")
 
+    with aws.shared_listings():
+
+        # Do the AWS lookups we need up front, concurrently; those below then use their results.
+        resolve_aws_lookups(aws, elasticsearch_server, federated_user_name, gac_secret_name, rds_secret_name,
+                            rds_host, rds_password, s3_access_key_id, s3_secret_access_key, s3_encrypt_key_id)
+
+        secrets_to_update = gather_secrets_from_aws_lookups(aws,
+                                                            gac_secret_name,
+                                                            elasticsearch_server,
+                                                            federated_user_name,
+                                                            rds_secret_name,
+                                                            rds_host,
+                                                            rds_password,
+                                                            s3_access_key_id,
+                                                            s3_encrypt_key_id,
+                                                            s3_secret_access_key,
+                                                            show)
+
+    return gac_secret_name, secrets_to_update, aws
+
+
+def gather_secrets_from_aws_lookups(aws: Aws,
+                                    gac_secret_name: str,
+                                    elasticsearch_server: str,
+                                    federated_user_name: str,
+                                    rds_secret_name: str,
+                                    rds_host: str,
+                                    rds_password: str,
+                                    s3_access_key_id: str,
+                                    s3_encrypt_key_id: str,
+                                    s3_secret_access_key: str,
+                                    show: bool) -> dict:
+    """
+    Gathers and validates (one after another) the global application config secret values to update,
+    i.e. other than the given GAC secret name, from AWS (via the given Aws object) where not given.
+    Exits on error if these values cannot be determined.
+
+    :return: Dictionary of secret values to update.
+    """
+
     # Intialize the dictionary secrets to set, which we will collect here.
     secrets_to_update = {}
 
@@ -309,7 +401,7 @@ def gather_secrets_to_update(
     secrets_to_update[GacSecretKeyName.S3_AWS_ACCESS_KEY_ID] = s3_access_key_id
     secrets_to_update[GacSecretKeyName.S3_AWS_SECRET_ACCESS_KEY] = s3_secret_access_key
 
-    return gac_secret_name, secrets_to_update, aws
+    return secrets_to_update
 
 
 def summarize_secrets_to_update(gac_secret_name: str, secrets_to_update: dict, show: bool = False) -> None:
@@ -335,8 +427,8 @@ def summarize_secrets_to_update(gac_secret_name: str, secrets_to_update: dict, s
 
 def update_secrets(gac_secret_name: str, secrets_to_update: dict, aws: Aws, show: bool = False) -> None:
     """
-    Updates the given AWS global application config secret keys/values
-    in the AWS secrets manager (via the given Aws object).
+    Updates the given AWS global application config secret keys/values in the AWS secrets
+    manager (via the given Aws object), all at once, i.e. as a single new version of the secret.
     This is a command-line INTERACTIVE process (via Aws), prompting the user for confirmation.
 
     :param gac_secret_name: Global application config secret name.
@@ -347,8 +439,8 @@ def update_secrets(gac_secret_name: str, secrets_to_update: dict, aws: Aws, show
     summarize_secrets_to_update(gac_secret_name, secrets_to_update, show)
     if not yes_or_no("Do you want to go ahead and set these secrets in AWS?"):
         exit_with_no_action()
-    for secret_key_name, secret_key_value in secrets_to_update.items():
-        aws.update_secret_key_value(gac_secret_name, secret_key_name, secret_key_value, show)
+    aws.update_secret_key_values(gac_secret_name, secrets_to_update, show)
+    aws.get_secrets_cache().print_report()
 
 
 def setup_remaining_secrets(
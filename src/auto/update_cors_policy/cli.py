@@ -1,6 +1,7 @@
 # Script for 4dn-cloud-infra to update KMS key policy for Foursight.
 
 import argparse
+import io
 import json
 from typing import Optional
 from dcicutils.command_utils import yes_or_no
@@ -8,9 +9,11 @@ from dcicutils.misc_utils import PRINT
 from ...names import Names
 from ..utils.aws import Aws
 from ..utils.args_utils import add_aws_credentials_args, validate_aws_credentials_args
+from ..utils.cors_reconciler import apply_cors_changes, plan_cors_changes, print_cors_changes, select_bucket_names
 from ..utils.paths import InfraDirectories
 from ..utils.misc_utils import (
     exit_with_no_action,
+    get_exception_string,
     setup_and_action,
 )
 from ..utils.validate_utils import (
@@ -94,6 +97,27 @@ def get_relevant_cors_rule(cors_rules: list) -> Optional[list]:
     return None
 
 
+def read_cors_rules_file(cors_rules_file: str) -> list:
+    """
+    Returns the list of CORS rules from the given JSON file; which may contain either just this
+    list or an object (as used by aws s3api put-bucket-cors) with this list as its CORSRules.
+    Exits on error if this cannot be read.
+
+    :param cors_rules_file: Path to the JSON file containing the CORS rules.
+    :return: List of CORS rules.
+    """
+    try:
+        with io.open(cors_rules_file, "r") as f:
+            cors_rules = json.load(f)
+    except Exception as e:
+        exit_with_no_action(f"ERROR: Cannot read CORS rules file: {cors_rules_file}", get_exception_string(e))
+    if isinstance(cors_rules, dict):
+        cors_rules = cors_rules.get("CORSRules")
+    if not isinstance(cors_rules, list) or not cors_rules:
+        exit_with_no_action(f"ERROR: No CORS rules found in file: {cors_rules_file}")
+    return cors_rules
+
+
 def print_suggested_buckets(aws: Aws, aws_credentials_name: str) -> None:
 
     def print_suggested_bucket(bucket_name: str) -> None:
@@ -184,6 +208,68 @@ def update_cors_policy(
         aws.put_cors_rules(bucket_name, cors_rules)
 
 
+def reconcile_cors_policies(
+        aws_access_key_id: str,
+        aws_credentials_dir: str,
+        aws_credentials_name: str,
+        aws_region: str,
+        aws_secret_access_key: str,
+        aws_session_token,
+        bucket_names: Optional[list],
+        bucket_prefix: Optional[str],
+        bucket_tags: Optional[dict],
+        confirm: bool,
+        cors_rules: list,
+        custom_dir: str,
+        dry_run: bool,
+        show: bool,
+        workers: int) -> None:
+    """
+    Main logical entry point for this script for multiple S3 buckets. Selects the S3 buckets by name, prefix,
+    and/or tags, gets their current CORS rules (concurrently), and prints, confirms, and updates (concurrently)
+    just the buckets whose CORS rules differ from those amended with the given (desired) CORS rules.
+    """
+    PRINT(f"Reconciling 4dn-cloud-infra CORS policy rules for S3 buckets.")
+
+    with setup_and_action() as setup_and_action_state:
+
+        # Validate/get and print basic AWS credentials info.
+        aws = validate_and_get_aws_credentials(aws_credentials_name,
+                                               aws_credentials_dir,
+                                               custom_dir,
+                                               aws_access_key_id,
+                                               aws_secret_access_key,
+                                               aws_region,
+                                               aws_session_token,
+                                               show)
+
+        PRINT(f"Desired CORS rules for the S3 buckets:")
+        PRINT(json.dumps(cors_rules, indent=2))
+
+        bucket_names = select_bucket_names(aws, bucket_names, bucket_prefix, bucket_tags, max_workers=workers)
+        if not bucket_names:
+            exit_with_no_action("No S3 buckets found matching the given bucket names, prefix, or tags.")
+
+        cors_changes = plan_cors_changes(aws, bucket_names, cors_rules, max_workers=workers)
+        print_cors_changes(cors_changes)
+        if dry_run:
+            exit_with_no_action("Dry run; nothing updated.", status=0)
+        elif not any(cors_change.status == "update" for cors_change in cors_changes):
+            exit_with_no_action("Nothing to do.")
+
+        # Here we want to update the CORS rules. Confirm.
+        if confirm and not yes_or_no("Continue with update?"):
+            exit_with_no_action()
+
+        setup_and_action_state.note_action_start()
+
+        # Actually update the CORS rules in AWS for the (differing) buckets.
+        apply_cors_changes(aws, cors_changes, max_workers=workers)
+        print_cors_changes(cors_changes)
+        if any(cors_change.error for cors_change in cors_changes):
+            exit(1)
+
+
 def main(override_argv: Optional[list] = None) -> None:
     """
     Main entry point for this script. Parses command-line arguments and calls the main logical entry point.
@@ -198,27 +284,77 @@ def main(override_argv: Optional[list] = None) -> None:
                       dest="confirm", action="store_false",
                       help="Behave as if all confirmation questions were answered yes.")
     argp.add_argument("--bucket", required=False,
-                      dest="bucket_name",
-                      help="S3 encryption key ID.")
-    argp.add_argument("--url", required=True,
+                      dest="bucket_names", action="append",
+                      help="S3 bucket name; may be given more than once.")
+    argp.add_argument("--bucket-prefix", required=False,
+                      help="Select all S3 buckets whose names start with this prefix (e.g. environment name).")
+    argp.add_argument("--bucket-tag", required=False,
+                      dest="bucket_tags", action="append",
+                      help="Select S3 buckets with this tag, as key=value; may be given more than once.")
+    argp.add_argument("--url", required=False,
                       help="URL for which to enable CORS.")
+    argp.add_argument("--cors-rules", required=False,
+                      help="JSON file containing the (list of) desired CORS rules, instead of --url.")
+    argp.add_argument("--dry-run", action="store_true", required=False,
+                      help="Show the changes for the selected S3 buckets but do not update them.")
+    argp.add_argument("--workers", required=False, type=int, default=8,
+                      help="Maximum number of S3 buckets to get/update at once.")
     argp.add_argument("--show", action="store_true", required=False)
     argp.add_argument("--debug", action="store_true", required=False)
     args = argp.parse_args(override_argv)
     validate_aws_credentials_args(args)
 
-    update_cors_policy(
+    if bool(args.url) == bool(args.cors_rules):
+        exit_with_no_action("Exactly one of --url or --cors-rules must be specified.")
+    bucket_tags = {}
+    for bucket_tag in args.bucket_tags or []:
+        if "=" not in bucket_tag:
+            exit_with_no_action(f"Bucket tag must be of the form key=value: {bucket_tag}")
+        key, value = bucket_tag.split("=", 1)
+        bucket_tags[key] = value
+
+    if args.url and not args.bucket_prefix and not bucket_tags and not args.dry_run \
+            and len(args.bucket_names or []) <= 1:
+        update_cors_policy(
+            args.aws_access_key_id,
+            args.aws_credentials_dir,
+            args.aws_credentials_name,
+            args.aws_region,
+            args.aws_secret_access_key,
+            args.aws_session_token,
+            args.bucket_names[0] if args.bucket_names else None,
+            args.custom_dir,
+            args.debug,
+            args.show,
+            args.url)
+        return
+
+    # Never fall back to all S3 buckets in the account.
+    if not args.bucket_names and not args.bucket_prefix and not bucket_tags:
+        exit_with_no_action("At least one of --bucket, --bucket-prefix, or --bucket-tag must be specified.")
+
+    if args.cors_rules:
+        cors_rules = read_cors_rules_file(args.cors_rules)
+    else:
+        cors_rules = []
+        amend_cors_rules(cors_rules, args.url)
+
+    reconcile_cors_policies(
         args.aws_access_key_id,
         args.aws_credentials_dir,
         args.aws_credentials_name,
         args.aws_region,
         args.aws_secret_access_key,
         args.aws_session_token,
-        args.bucket_name,
+        args.bucket_names,
+        args.bucket_prefix,
+        bucket_tags,
+        args.confirm,
+        cors_rules,
         args.custom_dir,
-        args.debug,
+        args.dry_run,
         args.show,
-        args.url)
+        args.workers)
 
 
 if __name__ == "__main__":
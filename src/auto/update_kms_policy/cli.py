@@ -5,10 +5,16 @@ from typing import Optional
 from dcicutils.command_utils import yes_or_no
 from dcicutils.misc_utils import PRINT
 from ..utils.args_utils import add_aws_credentials_args, validate_aws_credentials_args
+from ..utils.kms_policy_reconciler import (
+    apply_kms_key_policy_changes,
+    plan_kms_key_policy_changes,
+    print_kms_key_policy_changes
+)
 from ..utils.paths import InfraDirectories
 from ..utils.misc_utils import (
     get_json_config_file_value,
-    exit_with_no_action
+    exit_with_no_action,
+    exit_with_partial_action
 )
 from ..utils.validate_utils import (
     validate_and_get_aws_credentials,
@@ -25,6 +31,7 @@ def update_kms_policy(
         aws_session_token,
         custom_dir: str,
         s3_encrypt_key_id: str,
+        all_keys: bool,
         show: bool,
         verbose: bool) -> None:
     """
@@ -42,15 +49,23 @@ def update_kms_policy(
                                            aws_session_token,
                                            show)
 
-    # Validate/get the S3 encryption key ID from KMS (iff s3.bucket.encryption is true in config file).
-    kms_key_id = validate_and_get_s3_encrypt_key_id(s3_encrypt_key_id, aws.custom_config_file, aws)
-    if not kms_key_id:
-        s3_bucket_encryption = get_json_config_file_value("s3.bucket.encryption", aws.custom_config_file)
-        if not s3_bucket_encryption:
-            exit_with_no_action("No KMS key found."
-                                "And encryption not enabled (via s3.bucket.encryption in config file).")
-        else:
-            exit_with_no_action("ERROR: No KMS key found.")
+    if all_keys:
+        # Reconcile the policies of all of the customer managed KMS keys (which have the statement below).
+        kms_key_ids = aws.get_customer_managed_kms_keys()
+        if not kms_key_ids:
+            exit_with_no_action("ERROR: No customer managed KMS keys found.")
+        PRINT(f"AWS customer managed KMS keys: {len(kms_key_ids)}")
+    else:
+        # Validate/get the S3 encryption key ID from KMS (iff s3.bucket.encryption is true in config file).
+        kms_key_id = validate_and_get_s3_encrypt_key_id(s3_encrypt_key_id, aws.custom_config_file, aws)
+        if not kms_key_id:
+            s3_bucket_encryption = get_json_config_file_value("s3.bucket.encryption", aws.custom_config_file)
+            if not s3_bucket_encryption:
+                exit_with_no_action("No KMS key found."
+                                    "And encryption not enabled (via s3.bucket.encryption in config file).")
+            else:
+                exit_with_no_action("ERROR: No KMS key found.")
+        kms_key_ids = [kms_key_id]
 
     # Get the ARNs for the Foursight roles.
     foursight_role_arn_pattern = ".*foursight.*"
@@ -63,35 +78,47 @@ def update_kms_policy(
     else:
         exit_with_no_action("No Foursight AWS IAM roles found.")
 
-    # Get the KMS policy JSON for the S3 encryption KMS key ID.
-    kms_key_policy_json = aws.get_kms_key_policy(kms_key_id)
-
-    # Get the principals for the KMS policy statement identified by the specified statement ID (sid).
+    # Get the KMS key policies (concurrently) and compute the changes needed for each for the Foursight
+    # roles to be among the principals for the policy statement identified by the statement ID (sid).
     kms_key_sid_pattern = "Allow use of the key"
-    kms_key_policy_principals = aws.get_kms_key_policy_principals(kms_key_policy_json, kms_key_sid_pattern)
+    kms_key_policy_changes = plan_kms_key_policy_changes(aws, kms_key_ids,
+                                                         {kms_key_sid_pattern: foursight_role_arns})
     if verbose:
-        PRINT(f"Principals for AWS KMS key: {kms_key_id}")
-        for kms_key_principal in sorted(kms_key_policy_principals):
-            PRINT(f"- {kms_key_principal}")
-
-    # Find the Foursight roles which are missing from the KMS specific policy.
-    foursight_roles_to_add = list(set(foursight_role_arns) - set(kms_key_policy_principals))
-    if foursight_roles_to_add:
-        PRINT(f"Foursight roles not currently present in KMS key principals: {kms_key_id}")
-        for foursight_role in foursight_roles_to_add:
-            PRINT(f"- {foursight_role}")
-    else:
-        PRINT(f"All Foursight roles already currently present in KMS key principals: {kms_key_id}")
+        for kms_key_policy_change in kms_key_policy_changes:
+            if kms_key_policy_change.policy:
+                kms_key_policy_principals = aws.get_kms_key_policy_principals(kms_key_policy_change.policy,
+                                                                              kms_key_sid_pattern)
+                PRINT(f"Principals for AWS KMS key: {kms_key_policy_change.key_id}")
+                for kms_key_principal in sorted(kms_key_policy_principals):
+                    PRINT(f"- {kms_key_principal}")
+    print_kms_key_policy_changes(kms_key_policy_changes)
+
+    kms_key_ids_to_update = [kms_key_policy_change.key_id
+                             for kms_key_policy_change in kms_key_policy_changes
+                             if kms_key_policy_change.diff and not kms_key_policy_change.error]
+    if not kms_key_ids_to_update:
+        PRINT(f"All Foursight roles already currently present in KMS key principals: {', '.join(kms_key_ids)}")
         exit_with_no_action("Nothing to do.")
 
-    # Here there are one or more Foursight roles missing from the KMS policy. Confirm update.
-    yes = yes_or_no(f"Update KMS policy with these roles for: {kms_key_id}?")
+    # Here there are one or more KMS key policies missing Foursight roles. Confirm update.
+    yes = yes_or_no(f"Update KMS policy with these roles for: {', '.join(kms_key_ids_to_update)}?")
     if not yes:
         exit_with_no_action()
 
-    # Here the user has confirmed update. Update the KMS key policy JSON (in place) and update in AWS.
-    aws.amend_kms_key_policy(kms_key_policy_json, kms_key_sid_pattern, foursight_roles_to_add)
-    aws.update_kms_key_policy(kms_key_id, kms_key_policy_json)
+    # Here the user has confirmed update. Update (only) the KMS key policies which differ in AWS.
+    kms_key_policy_changes_applied = apply_kms_key_policy_changes(aws, kms_key_policy_changes)
+    for kms_key_policy_change in kms_key_policy_changes_applied:
+        if kms_key_policy_change.updated:
+            PRINT(f"Updated KMS key policy: {kms_key_policy_change.key_id}")
+        else:
+            PRINT(f"ERROR: Cannot update policy for KMS key: {kms_key_policy_change.key_id}")
+            PRINT(f"       {kms_key_policy_change.update_error}")
+    kms_key_ids_failed = [kms_key_policy_change.key_id
+                          for kms_key_policy_change in kms_key_policy_changes_applied
+                          if not kms_key_policy_change.updated]
+    if kms_key_ids_failed:
+        exit_with_partial_action(f"Updated {len(kms_key_policy_changes_applied) - len(kms_key_ids_failed)}"
+                                 f" KMS key policies; failed to update: {', '.join(kms_key_ids_failed)}")
 
 
 def main(override_argv: Optional[list] = None) -> None:
@@ -111,6 +138,9 @@ def main(override_argv: Optional[list] = None) -> None:
     argp.add_argument("--s3-encrypt-key-id", required=False,
                       dest="s3_encrypt_key_id",
                       help="S3 encryption key ID.")
+    argp.add_argument("--all-keys", action="store_true", required=False,
+                      dest="all_keys",
+                      help="Update the policies of all customer managed KMS keys, not just the S3 encryption key.")
     argp.add_argument("--show", action="store_true", required=False)
     argp.add_argument("--verbose", action="store_true", required=False)
     args = argp.parse_args(override_argv)
@@ -125,6 +155,7 @@ def main(override_argv: Optional[list] = None) -> None:
         args.aws_session_token,
         args.custom_dir,
         args.s3_encrypt_key_id,
+        args.all_keys,
         args.show,
         args.verbose)
 
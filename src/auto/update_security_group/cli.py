@@ -0,0 +1,160 @@
+# Script for 4dn-cloud-infra to reconcile any (stack defined) AWS security group with a desired set of rules.
+#
+# The desired rules are given in a JSON file, containing an object with Ingress and/or Egress lists of rules,
+# each in the (IpPermissions) form passed to the boto3 ec2 authorize_security_group_{ingress/egress} functions.
+# For example:
+#
+#   { "Ingress": [ { "IpProtocol": "tcp", "FromPort": 443, "ToPort": 443,
+#                    "IpRanges": [ { "CidrIp": "10.0.0.0/16", "Description": "allows inbound traffic on 443" } ] } ],
+#     "Egress": [ { "IpProtocol": "-1", "IpRanges": [ { "CidrIp": "0.0.0.0/0" } ] } ] }
+#
+# The existing rules are read once, and just the missing rules are added (and, with --prune, the rules not in
+# the file are revoked, for the directions given), with a single batched call per direction.
+
+import argparse
+import io
+import json
+from typing import Optional
+from dcicutils.command_utils import yes_or_no
+from dcicutils.misc_utils import PRINT
+from ..utils.args_utils import add_aws_credentials_args, validate_aws_credentials_args
+from ..utils.misc_utils import exit_with_no_action, get_exception_string, setup_and_action
+from ..utils.paths import InfraDirectories
+from ..utils.security_group_reconciler import (
+    apply_security_group_changes,
+    plan_security_group_changes,
+    print_security_group_changes,
+)
+from ..utils.validate_utils import validate_and_get_aws_credentials
+
+
+def read_security_group_rules_file(rules_file: str) -> (Optional[list], Optional[list]):
+    """
+    Returns a tuple with the inbound (Ingress) and outbound (Egress) rules from the given JSON file;
+    either is None if not present in the file. Exits on error if this cannot be read.
+
+    :param rules_file: Path to the JSON file containing the security group rules.
+    :return: Tuple with the lists of inbound and outbound security group rules (as IpPermissions).
+    """
+    try:
+        with io.open(rules_file, "r") as f:
+            rules = json.load(f)
+    except Exception as e:
+        exit_with_no_action(f"ERROR: Cannot read security group rules file: {rules_file}", get_exception_string(e))
+    if not isinstance(rules, dict) or not (isinstance(rules.get("Ingress"), list) or
+                                           isinstance(rules.get("Egress"), list)):
+        exit_with_no_action(f"ERROR: No Ingress or Egress security group rules found in file: {rules_file}")
+    return rules.get("Ingress"), rules.get("Egress")
+
+
+def update_security_group(
+        aws_access_key_id: str,
+        aws_credentials_dir: str,
+        aws_credentials_name: str,
+        aws_region: str,
+        aws_secret_access_key: str,
+        aws_session_token: str,
+        confirm: bool,
+        custom_dir: str,
+        dry_run: bool,
+        force: bool,
+        prune: bool,
+        rules_file: str,
+        security_group_name: str,
+        show: bool
+) -> None:
+    """
+    Main logical entry point for this script.
+    Gathers, prints, confirms, and updates the rules for the given security group.
+    """
+    PRINT(f"Updating 4dn-cloud-infra security group rules: {security_group_name}")
+
+    inbound_rules, outbound_rules = read_security_group_rules_file(rules_file)
+
+    with setup_and_action() as setup_and_action_state:
+
+        # Validate/get and print basic AWS credentials info.
+        aws = validate_and_get_aws_credentials(aws_credentials_name,
+                                               aws_credentials_dir,
+                                               custom_dir,
+                                               aws_access_key_id,
+                                               aws_secret_access_key,
+                                               aws_region,
+                                               aws_session_token,
+                                               show)
+
+        security_group_id = aws.find_security_group_id(security_group_name)
+        if not security_group_id:
+            exit_with_no_action(f"Unable to determine security group ID from name: {security_group_name}")
+        PRINT(f"Target security group ID: {security_group_id}")
+
+        security_group_changes = plan_security_group_changes(security_group_id,
+                                                             aws.get_security_group_rules(security_group_id),
+                                                             inbound_rules,
+                                                             outbound_rules,
+                                                             prune=prune,
+                                                             replace_changed_descriptions=force)
+        print_security_group_changes(security_group_changes)
+        if dry_run:
+            exit_with_no_action("Dry run; nothing updated.", status=0)
+        elif not security_group_changes:
+            exit_with_no_action("Security group rules already as desired. Nothing to do.")
+
+        if confirm and not yes_or_no(f"Update these security group rules for security group ({security_group_id})?"):
+            exit_with_no_action()
+
+        setup_and_action_state.note_action_start()
+
+        created_rule_ids = apply_security_group_changes(aws, security_group_changes)
+        PRINT(f"Revoked security group ({security_group_id}) rules: {len(security_group_changes.rules_to_revoke)}")
+        PRINT(f"Created security group ({security_group_id}) rules: {', '.join(created_rule_ids) or 'None'}")
+
+
+def main(override_argv: Optional[list] = None) -> None:
+    """
+    Main entry point for this script. Parses command-line arguments and calls the main logical entry point.
+
+    :param override_argv: Raw command-line arguments for this invocation.
+    """
+    argp = argparse.ArgumentParser()
+    add_aws_credentials_args(argp)
+    argp.add_argument("--custom-dir", required=False, default=InfraDirectories.CUSTOM_DIR,
+                      help=f"Alternate custom config directory to default: {InfraDirectories.CUSTOM_DIR}.")
+    argp.add_argument("--dry-run", action="store_true", required=False,
+                      help="Show the changes for the security group but do not update it.")
+    argp.add_argument("--force", action="store_true", required=False,
+                      help="Force replace any existing security group rule whose description differs.")
+    argp.add_argument("--no-confirm", required=False,
+                      dest="confirm", action="store_false",
+                      help="Behave as if all confirmation questions were answered yes.")
+    argp.add_argument("--prune", action="store_true", required=False,
+                      help="Revoke existing rules not in the rules file (for the Ingress/Egress given there).")
+    argp.add_argument("--rules", required=True, dest="rules_file",
+                      help="JSON file containing the desired Ingress and/or Egress security group rules.")
+    argp.add_argument("--security-group-name", required=True,
+                      help="Name of the security group to update.")
+    argp.add_argument("--show", action="store_true", required=False,
+                      help="Show any senstive info in plaintext.")
+    args = argp.parse_args(override_argv)
+    validate_aws_credentials_args(args)
+
+    update_security_group(
+        args.aws_access_key_id,
+        args.aws_credentials_dir,
+        args.aws_credentials_name,
+        args.aws_region,
+        args.aws_secret_access_key,
+        args.aws_session_token,
+        args.confirm,
+        args.custom_dir,
+        args.dry_run,
+        args.force,
+        args.prune,
+        args.rules_file,
+        args.security_group_name,
+        args.show
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
 # Script for 4dn-cloud-infra to update the application security group for Sentieon.
 
 import argparse
-from botocore.exceptions import ClientError as Boto3ClientException
 from typing import Optional
 from dcicutils.command_utils import yes_or_no
 from dcicutils.misc_utils import PRINT
@@ -14,9 +13,13 @@ from ..utils.args_utils import (
 from ..utils.paths import InfraDirectories
 from ..utils.misc_utils import (
     exit_with_no_action,
-    print_exception,
     setup_and_action,
 )
+from ..utils.security_group_reconciler import (
+    apply_security_group_changes,
+    plan_security_group_changes,
+    print_security_group_changes,
+)
 from ..utils.validate_utils import (
     validate_and_get_aws_credentials,
 )
@@ -187,136 +190,6 @@ def validate_and_get_target_security_group_name(aws: Aws, security_group_name: s
     return security_group_name, security_group_id
 
 
-def summarize_security_group_rules_to_define(security_group_id: str, sentieon_ip_address: str) -> None:
-    """
-    Print a summary of the inbound/outbound rules to be defined.
-
-    :param security_group_id: Security group ID.
-    :param sentieon_ip_address: IP address of the Sentieon server.
-    """
-    inbound_security_group_rules_to_define = get_sentieon_compute_node_inbound_security_group_rules()
-    for rule in inbound_security_group_rules_to_define:
-        print(f"Inbound security group ({security_group_id}) rule to define:"
-              f" {Aws.get_security_group_rule_display_value(rule)}")
-    outbound_security_group_rules_to_define = \
-        get_sentieon_compute_node_outbound_security_group_rules(sentieon_ip_address)
-    for rule in outbound_security_group_rules_to_define:
-        print(f"Outbound security group ({security_group_id}) rule to define:"
-              f" {Aws.get_security_group_rule_display_value(rule)}")
-
-
-def print_duplicate_security_group_message(exception: Exception,
-                                           security_group_id: str,
-                                           security_group_rule: dict,
-                                           outbound: bool) -> bool:
-    """
-    If the given exception is for a boto3 duplicate security group rule creation, then
-    prints an error for this, with info about the given security group ID, security group
-    type (inbound or outbound), and security group rule, and returns True; otherwise returns False.
-
-    :param exception: Exception to examine for boto3 duplicate security group rule creation.
-    :param security_group_id: AWS security group ID.
-    :param security_group_rule: AWS security group rule.
-    :param outbound: True if related to outbound (egress) rule, otherwise inbound (ingress).
-    :return: True if the given exception is for a boto3 duplicate security rule creation, otherwise False.
-    """
-    if isinstance(exception, Boto3ClientException):
-        if exception.response:
-            error = exception.response.get("Error")
-            if error:
-                error_code = error.get("Code")
-                if error_code == "InvalidPermission.Duplicate":
-                    print(f"{'Outbound' if outbound else 'Inbound'} security group ({security_group_id}) rule"
-                          f" already exists: {Aws.get_security_group_rule_display_value(security_group_rule)}")
-                    return True
-    return False
-
-
-def update_inbound_security_group_rules(
-        aws: Aws,
-        security_group_id: str,
-        force: bool = False
-) -> None:
-    """
-    Adds the inbound security group rules to the given/named AWS target security group:
-
-    :param aws: Aws object.
-    :param security_group_id: Target AWS security group ID.
-    :param force: True to replace any existing security group rule before creation.
-    """
-
-    # Get the inbound security group rules to define.
-    rules = get_sentieon_compute_node_inbound_security_group_rules()
-
-    # Get a list of inbound security group rules for the given security group ID.
-    existing_rules = aws.get_inbound_security_group_rules(security_group_id)
-
-    for rule in rules:
-        existing_rule = aws.find_inbound_security_group_rule(existing_rules, rule)
-        if existing_rule:
-            existing_rule_id = existing_rule.get("SecurityGroupRuleId")
-            if force:
-                print(f"Removing existing inbound security group rule ({existing_rule_id}):"
-                      f" {Aws.get_security_group_rule_display_value(rule)}")
-                aws.delete_inbound_security_group_rule(security_group_id, existing_rule_id)
-            else:
-                print(f"Inbound security group rule ({existing_rule_id})"
-                      f" already exists: {Aws.get_security_group_rule_display_value(rule)} -> No action")
-                continue
-        try:
-            print(f"Creating inbound security"
-                  f" group ({security_group_id}) rule: {Aws.get_security_group_rule_display_value(rule)}", end="")
-            created_rule_id = aws.create_inbound_security_group_rule(security_group_id, rule)
-            print(f" -> {created_rule_id}")
-        except Exception as e:
-            if not print_duplicate_security_group_message(e, security_group_id, rule, outbound=False):
-                print_exception(e)
-
-
-def update_outbound_security_group_rules(
-        aws: Aws,
-        security_group_id: str,
-        sentieon_ip_address: str,
-        force: bool = False
-) -> None:
-    """
-    Adds the outbound security group rules to the given/named AWS target security group:
-
-    :param aws: Aws object.
-    :param security_group_id: Target AWS security group ID.
-    :param sentieon_ip_address: Sentieon server IP address.
-    :param force: True to replace any existing security group rule before creation.
-    """
-
-    # Get the outbound security group rules to define.
-    rules = get_sentieon_compute_node_outbound_security_group_rules(sentieon_ip_address)
-
-    # Get a list of outbound security group rules for the given security group ID.
-    existing_rules = aws.get_outbound_security_group_rules(security_group_id)
-
-    # See if any rules already exist for the rules to define.
-    for rule in rules:
-        existing_rule = aws.find_outbound_security_group_rule(existing_rules, rule)
-        if existing_rule:
-            existing_rule_id = existing_rule.get("SecurityGroupRuleId")
-            if force:
-                print(f"Removing existing outbound security group rule ({existing_rule_id}):"
-                      f" {Aws.get_security_group_rule_display_value(rule)}")
-                aws.delete_outbound_security_group_rule(security_group_id, existing_rule_id)
-            else:
-                print(f"Outbound security group rule ({existing_rule_id})"
-                      f" already exists: {Aws.get_security_group_rule_display_value(rule)} -> No action")
-                continue
-        try:
-            print(f"Creating outbound security"
-                  f" group ({security_group_id}) rule: {Aws.get_security_group_rule_display_value(rule)}", end="")
-            created_rule_id = aws.create_outbound_security_group_rule(security_group_id, rule)
-            print(f" -> {created_rule_id}")
-        except Exception as e:
-            if not print_duplicate_security_group_message(e, security_group_id, rule, outbound=False):
-                print_exception(e)
-
-
 def update_sentieon_security(
         aws_access_key_id: str,
         aws_credentials_dir: str,
@@ -360,8 +233,19 @@ def update_sentieon_security(
         # Validate/get and print the target security group name, and get associated security group ID.
         security_group_name, security_group_id = validate_and_get_target_security_group_name(aws, security_group_name)
 
+        # Read the existing security group rules (once) and determine which of the inbound/outbound
+        # rules to define need to be added (and, if forced, which to replace for changed descriptions).
+        security_group_changes = plan_security_group_changes(
+            security_group_id,
+            aws.get_security_group_rules(security_group_id),
+            get_sentieon_compute_node_inbound_security_group_rules(),
+            get_sentieon_compute_node_outbound_security_group_rules(sentieon_ip_address),
+            replace_changed_descriptions=force)
+
         # Print summary of security group rules to define.
-        summarize_security_group_rules_to_define(security_group_id, sentieon_ip_address)
+        print_security_group_changes(security_group_changes)
+        if not security_group_changes:
+            exit_with_no_action("All security group rules already exist. Nothing to do.")
 
         # Confirm with user before taking action.
         yes = yes_or_no(f"Define these security group rules for security group ({security_group_id})?")
@@ -371,11 +255,9 @@ def update_sentieon_security(
         # Start creating the inbound/outbound security group rules.
         setup_and_action_state.note_action_start()
 
-        # Update the inbound security group rules.
-        update_inbound_security_group_rules(aws, security_group_id, force)
-
-        # Update the outbound security group rules.
-        update_outbound_security_group_rules(aws, security_group_id, sentieon_ip_address, force)
+        # Update the inbound/outbound security group rules (in one batch per direction).
+        created_rule_ids = apply_security_group_changes(aws, security_group_changes)
+        print(f"Created security group ({security_group_id}) rules: {', '.join(created_rule_ids)}")
 
 
 def main(override_argv: Optional[list] = None) -> None:
@@ -389,7 +271,7 @@ def main(override_argv: Optional[list] = None) -> None:
     argp.add_argument("--custom-dir", required=False, default=InfraDirectories.CUSTOM_DIR,
                       help=f"Alternate custom config directory to default: {InfraDirectories.CUSTOM_DIR}.")
     argp.add_argument("--force", action="store_true", required=False,
-                      help="Force replace any existing security group rule.")
+                      help="Force replace any existing security group rule whose description differs.")
     argp.add_argument("--no-confirm", required=False,
                       dest="confirm", action="store_false",
                       help="Behave as if all confirmation questions were answered yes.")
@@ -1,18 +1,96 @@
-import boto3
 import botocore
+import concurrent.futures
+import contextlib
 import json
 import re
-from typing import Optional
+import threading
+import uuid
+from typing import Callable, Optional
 from dcicutils.cloudformation_utils import C4OrchestrationManager
 from dcicutils.command_utils import yes_or_no
 from dcicutils.misc_utils import get_error_message, ignored, PRINT
+from prettytable import PrettyTable
 from .aws_context import AwsContext
+from .iam_index import IamIndex
 from .misc_utils import (obfuscate, print_exception, should_obfuscate)
+from .secrets_cache import SecretsCache
 
 
 class Aws(AwsContext):
 
     _DEACTIVATED_SECRET_VALUE_PREFIX = "DEACTIVATED:"
+    # Staging label of the new secret version written by update_secret_key_values until AWSCURRENT is moved to it;
+    # private to us, so as not to disturb (the AWSPENDING label of) any rotation of the secret in progress.
+    _PENDING_SECRET_VERSION_STAGE = "C4PENDING"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._shared_listings = None
+        self._shared_listings_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def shared_listings(self):
+        """
+        Context manager within which the (read-only) AWS listings/lookups done by this object, i.e. of
+        OpenSearch domains and customer managed KMS keys, are each done just once and shared (including across
+        threads); e.g. for a discovery phase with many lookups done concurrently, or one after another, using
+        the same listings. Not to be used around code which changes these things. Secret values are always
+        shared (for a short time) via get_secrets_cache, and IAM users, roles, and access keys via get_iam_index.
+        """
+        self._shared_listings = {}
+        try:
+            yield
+        finally:
+            self._shared_listings = None
+
+    def _shared_listing(self, key: tuple, fetch: Callable):
+        """
+        Returns the result of the given fetch function, called just once per key within shared_listings
+        (concurrent callers for the same key wait for the one call); or just calls it if not within that.
+        """
+        shared_listings = self._shared_listings
+        if shared_listings is None:
+            return fetch()
+        with self._shared_listings_lock:
+            listing = shared_listings.get(key)
+            fetching = listing is None
+            if fetching:
+                listing = shared_listings[key] = concurrent.futures.Future()
+        if fetching:
+            try:
+                listing.set_result(fetch())
+            except Exception as e:
+                listing.set_exception(e)
+                with self._shared_listings_lock:
+                    # Not sharing failures; the next caller may try again.
+                    shared_listings.pop(key, None)
+        return listing.result()
+
+    def get_secrets_cache(self) -> SecretsCache:
+        """
+        Returns the SecretsCache of AWS secret values, created just once per session, i.e. per process
+        and AWS credentials, and shared by everything reading secrets, so that each secret is fetched
+        just once (or once per 20 secrets, if batched) per command, rather than each time it is used.
+
+        :return: SecretsCache object.
+        """
+        with super().establish_credentials():
+            return self.shared("secrets_cache", lambda: SecretsCache(self.client("secretsmanager")))
+
+    def _get_secret_value_json(self, secret_name: str) -> dict:
+        return json.loads(self.get_secrets_cache().get_entry(secret_name).secret_string)
+
+    def get_secret_values(self, secret_names: list) -> dict:
+        """
+        Returns a dictionary of the (JSON) values of the given secret names in the AWS secrets manager,
+        by secret name, fetching those not already cached with a single batched call; secrets which do
+        not exist are omitted. Use to get up front the secrets a command will need.
+
+        :param secret_names: List of AWS secret names.
+        :return: Dictionary of secret names to (JSON) secret values.
+        """
+        entries = self.get_secrets_cache().get_entries(secret_names)
+        return {secret_name: json.loads(entry.secret_string) for secret_name, entry in entries.items()}
 
     def get_secret_value(self, secret_name: str, secret_key_name: str) -> str:
         """
@@ -23,12 +101,9 @@ class Aws(AwsContext):
         :param secret_key_name: AWS secret key name.
         :return: Secret key value if found or None if not found.
         """
-        with super().establish_credentials():
-            secrets_manager = boto3.client("secretsmanager")
-            secret_values = secrets_manager.get_secret_value(SecretId=secret_name)
-            secret_values_json = json.loads(secret_values["SecretString"])
-            secret_key_value = secret_values_json.get(secret_key_name)
-            return secret_key_value
+        secret_values_json = self._get_secret_value_json(secret_name)
+        secret_key_value = secret_values_json.get(secret_key_name)
+        return secret_key_value
 
     def update_secret_key_value(self,
                                 secret_name: str,
@@ -41,6 +116,7 @@ class Aws(AwsContext):
         If the given secret key value is None then the given secret key will be "deactivated",
         where this means that its old value will be prepended with the string "DEACTIVATED:".
         This is a command-line INTERACTIVE process, prompting the user for info/confirmation.
+        See update_secret_key_values to update multiple secret key values at once.
 
         :param secret_name: AWS secret name.
         :param secret_key_name: AWS secret key name to update.
@@ -48,6 +124,25 @@ class Aws(AwsContext):
         :param show: True to show any displayed sensitive values in plaintext.
         :return: True if succeeded otherwise false.
         """
+        return bool(self.update_secret_key_values(secret_name, {secret_key_name: secret_key_value}, show))
+
+    def update_secret_key_values(self, secret_name: str, secret_key_values: dict, show: bool = False) -> list:
+        """
+        Updates the AWS secret values for the given secret key names/values within the given secret name,
+        with a single read of the secret and a single write of a new version of it. Each secret key value
+        is created, updated, or (if its given value is None) "deactivated", as in update_secret_key_value.
+        This is a command-line INTERACTIVE process, prompting the user for info/confirmation of each one.
+
+        The new version is written with (only) a private staging label, and the AWSCURRENT label then moved
+        to it from the version we read; AWS fails this move if the secret has been changed in the meantime (i.e.
+        if AWSCURRENT is no longer on the version we read), in which case nothing is updated, rather than
+        overwriting the change. Either way the private label is then removed from the new version.
+
+        :param secret_name: AWS secret name.
+        :param secret_key_values: Dictionary of AWS secret key names/values to update; see update_secret_key_value.
+        :param show: True to show any displayed sensitive values in plaintext.
+        :return: List of dictionaries (with key, action, old, new) describing the changes made; empty if none.
+        """
 
         def print_secret(prefix: str, name: str, key_name: str, key_value: str) -> None:
             if not key_value:
@@ -63,56 +158,128 @@ class Aws(AwsContext):
             else:
                 PRINT(f"{prefix} value of AWS secret {name}.{key_name}{suffix}: {key_value}")
 
-        PRINT()
+        def get_secret_key_action(secret_key_name: str, secret_key_value: str,
+                                  secret_key_value_current: str) -> (Optional[str], Optional[str]):
+            if secret_key_value is None:
+                # Deactivating secret key value.
+                if secret_key_value_current is None:
+                    PRINT(f"AWS secret {secret_name}.{secret_key_name} does not exist."
+                          f" Nothing to deactivate.")
+                    return None, None
+                print_secret("Current", secret_name, secret_key_name, secret_key_value_current)
+                if secret_key_value_current.startswith(self._DEACTIVATED_SECRET_VALUE_PREFIX):
+                    PRINT(f"AWS secret {secret_name}.{secret_key_name} is already deactivated."
+                          f" Nothing to do.")
+                    return None, None
+                return "deactivate", self._DEACTIVATED_SECRET_VALUE_PREFIX + secret_key_value_current
+            if secret_key_value_current is None:
+                # Creating new secret key value.
+                PRINT(f"AWS secret {secret_name}.{secret_key_name} does not yet exist.")
+                action = "create"
+            else:
+                # Updating existing secret key value.
+                print_secret("Current", secret_name, secret_key_name, secret_key_value_current)
+                action = "update"
+                if secret_key_value_current == secret_key_value:
+                    PRINT(f"New value of AWS secret ({secret_name}.{secret_key_name}) same as current one."
+                          f" Nothing to update.")
+                    return None, None
+            print_secret("New", secret_name, secret_key_name, secret_key_value)
+            return action, secret_key_value
+
+        changes = []
         with super().establish_credentials():
-            secrets_manager = boto3.client("secretsmanager")
+            secrets_manager = self.client("secretsmanager")
+            secrets_cache = self.get_secrets_cache()
             try:
-                # To update an individual secret key value we need to get the entire JSON
-                # associated with the given secret name, update the specific element for
-                # the given secret key name with the new given value, and write the updated
-                # JSON back as the secret value for the given secret name.
+                # To update individual secret key values we need to get the entire JSON associated
+                # with the given secret name, update the specific elements for the given secret key
+                # names with the new given values, and write the updated JSON back (once) as the
+                # secret value for the given secret name. This may be the (recently) cached value;
+                # if it is no longer current, the version stage move below fails, and nothing is lost.
                 try:
-                    secret_value = secrets_manager.get_secret_value(SecretId=secret_name)
+                    secret_value = secrets_cache.get_entry(secret_name)
                 except Exception:
                     PRINT(f"AWS secret name does not exist: {secret_name}")
-                    return False
-                secret_value_json = json.loads(secret_value["SecretString"])
-                secret_key_value_current = secret_value_json.get(secret_key_name)
-                if secret_key_value is None:
-                    # Deactivating secret key value.
-                    if secret_key_value_current is None:
-                        PRINT(f"AWS secret {secret_name}.{secret_key_name} does not exist."
-                              f" Nothing to deactivate.")
-                        return False
-                    print_secret("Current", secret_name, secret_key_name, secret_key_value_current)
-                    if secret_key_value_current.startswith(self._DEACTIVATED_SECRET_VALUE_PREFIX):
-                        PRINT(f"AWS secret {secret_name}.{secret_key_name} is already deactivated."
-                              f" Nothing to do.")
-                        return False
-                    secret_key_value = self._DEACTIVATED_SECRET_VALUE_PREFIX + secret_key_value_current
-                    action = "deactivate"
-                else:
-                    if secret_key_value_current is None:
-                        # Creating new secret key value.
-                        PRINT(f"AWS secret {secret_name}.{secret_key_name} does not yet exist.")
-                        action = "create"
-                    else:
-                        # Updating existing secret key value.
-                        print_secret("Current", secret_name, secret_key_name, secret_key_value_current)
-                        action = "update"
-                        if secret_key_value_current == secret_key_value:
-                            PRINT(f"New value of AWS secret ({secret_name}.{secret_key_name}) same as current one."
-                                  f" Nothing to update.")
-                            return False
-                    print_secret("New", secret_name, secret_key_name, secret_key_value)
-                yes = yes_or_no(f"Are you sure you want to {action} AWS secret {secret_name}.{secret_key_name}?")
-                if yes:
-                    secret_value_json[secret_key_name] = secret_key_value
-                    secrets_manager.update_secret(SecretId=secret_name, SecretString=json.dumps(secret_value_json))
-                    return True
+                    return changes
+                secret_value_json = json.loads(secret_value.secret_string)
+                for secret_key_name, secret_key_value in secret_key_values.items():
+                    PRINT()
+                    secret_key_value_current = secret_value_json.get(secret_key_name)
+                    action, secret_key_value = get_secret_key_action(secret_key_name, secret_key_value,
+                                                                     secret_key_value_current)
+                    if action and yes_or_no(f"Are you sure you want to {action}"
+                                            f" AWS secret {secret_name}.{secret_key_name}?"):
+                        secret_value_json[secret_key_name] = secret_key_value
+                        changes.append({"key": secret_key_name, "action": action,
+                                        "old": secret_key_value_current, "new": secret_key_value})
+                if not changes:
+                    PRINT(f"No changes to AWS secret: {secret_name}")
+                    return changes
+                self._print_secret_changes(secret_name, changes, show)
+                new_version_id = str(uuid.uuid4())
+                secrets_manager.put_secret_value(SecretId=secret_name,
+                                                 ClientRequestToken=new_version_id,
+                                                 SecretString=json.dumps(secret_value_json),
+                                                 VersionStages=[self._PENDING_SECRET_VERSION_STAGE])
+                try:
+                    secrets_manager.update_secret_version_stage(SecretId=secret_name,
+                                                                VersionStage="AWSCURRENT",
+                                                                MoveToVersionId=new_version_id,
+                                                                RemoveFromVersionId=secret_value.version_id)
+                    updated = True
+                except botocore.exceptions.ClientError as e:
+                    PRINT(f"AWS secret {secret_name} was changed since it was read"
+                          f" (version {secret_value.version_id}); NOT updated. Please try again.")
+                    print_exception(e)
+                    updated = False
+                secrets_cache.invalidate(secret_name)
+                try:
+                    # Leaves the new version either current, or unlabeled (so deprecated, and cleaned up by AWS).
+                    secrets_manager.update_secret_version_stage(SecretId=secret_name,
+                                                                VersionStage=self._PENDING_SECRET_VERSION_STAGE,
+                                                                RemoveFromVersionId=new_version_id)
+                except botocore.exceptions.ClientError as e:
+                    PRINT(f"Could not remove staging label {self._PENDING_SECRET_VERSION_STAGE}"
+                          f" from AWS secret {secret_name} version {new_version_id}.")
+                    print_exception(e)
+                if not updated:
+                    return []
+                PRINT(f"Updated AWS secret {secret_name} ({len(changes)} change(s)) to version: {new_version_id}")
+                return changes
             except Exception as e:
                 print_exception(e)
-            return False
+            return []
+
+    @staticmethod
+    def _print_secret_changes(secret_name: str, changes: list, show: bool = False) -> None:
+        """
+        Prints the given secret key value changes (from update_secret_key_values) as a table.
+        """
+        def display_value(key_name: str, key_value: Optional[str]) -> str:
+            if key_value is None:
+                return "<none>"
+            return obfuscate(key_value, show) if should_obfuscate(key_name) else key_value
+        table = PrettyTable()
+        table.field_names = ["Secret Key Name", "Action", "Old Value", "New Value"]
+        table.align = "l"
+        for change in changes:
+            table.add_row([change["key"], change["action"],
+                           display_value(change["key"], change["old"]), display_value(change["key"], change["new"])])
+        PRINT(f"Changes to AWS secret: {secret_name}")
+        PRINT(table)
+
+    def get_iam_index(self, refresh: bool = False) -> IamIndex:
+        """
+        Returns the IamIndex of the AWS IAM users, roles, managed policies, and user access keys,
+        built (with a single paginated get_account_authorization_details listing) just once per
+        session, i.e. per process and AWS credentials, and shared by everything using these.
+
+        :param refresh: True to rebuild the index even if already built.
+        :return: IamIndex object.
+        """
+        with super().establish_credentials():
+            return self.shared("iam_index", lambda: IamIndex.build(self.client("iam")), refresh)
 
     def find_iam_user_name(self, user_name_pattern: str) -> Optional[str]:
         """
@@ -122,14 +289,8 @@ class Aws(AwsContext):
         :param user_name_pattern: Regular expression for user name.
         :return: Matched user name or None if none found.
         """
-        with super().establish_credentials():
-            iam = boto3.resource("iam")
-            users = iam.users.all()
-            for user in users:
-                user_name = user.name
-                if re.match(user_name_pattern, user_name):
-                    return user_name
-        return None
+        user_names = self.get_iam_index().find_user_names(pattern=user_name_pattern)
+        return user_names[0] if user_names else None
 
     def get_customer_managed_kms_keys(self) -> list:
         """
@@ -137,23 +298,31 @@ class Aws(AwsContext):
 
         :return: List of customer managed KMS key IDs; empty list of none found.
         """
-        kms_keys = []
+        return list(self._shared_listing(("kms", "customer_managed_keys"), self._fetch_customer_managed_kms_keys))
+
+    def _fetch_customer_managed_kms_keys(self, max_workers: int = 8) -> list:
         with super().establish_credentials():
-            kms = boto3.client("kms")
-            for key in kms.list_keys()["Keys"]:
-                key_id = key["KeyId"]
+            kms = self.client("kms")
+
+            def is_customer_managed_kms_key(key_id: str) -> bool:
                 try:
                     key_description = kms.describe_key(KeyId=key_id)
                 except Exception as e:
                     PRINT(f"ERROR: Cannot get description of KMS Key ID (skipping): {key_id}")
                     PRINT(f"       {get_error_message(e)}")
-                    continue
+                    return False
                 key_metadata = key_description["KeyMetadata"]
                 key_manager = key_metadata["KeyManager"]
                 key_enabled = key_metadata.get("Enabled")
-                if key_manager == "CUSTOMER" and (key_enabled is None or key_enabled):
-                    kms_keys.append(key_id)
-        return kms_keys
+                return key_manager == "CUSTOMER" and (key_enabled is None or key_enabled)
+
+            # Describe the keys concurrently; one describe_key per key is what takes the time.
+            key_ids = [key["KeyId"] for key in kms.list_keys()["Keys"]]
+            if not key_ids:
+                return []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(key_ids))) as executor:
+                customer_managed = list(executor.map(is_customer_managed_kms_key, key_ids))
+            return [key_id for key_id, is_customer_managed in zip(key_ids, customer_managed) if is_customer_managed]
 
     def get_elasticsearch_endpoint(self, aws_credentials_name: str) -> Optional[str]:
         """
@@ -166,8 +335,9 @@ class Aws(AwsContext):
         with super().establish_credentials():
             # TODO: Get this name from somewhere in 4dn-cloud-infra.
             elasticsearch_instance_name = f"os-{aws_credentials_name}"
-            elasticsearch = boto3.client("opensearch")
-            domain_names = elasticsearch.list_domain_names()["DomainNames"]
+            elasticsearch = self.client("opensearch")
+            domain_names = self._shared_listing(("opensearch", "domain_names"),
+                                                lambda: elasticsearch.list_domain_names()["DomainNames"])
             domain_name = [domain_name for domain_name in domain_names
                            if domain_name["DomainName"] == elasticsearch_instance_name]
             if domain_name is None or len(domain_name) != 1:
@@ -197,37 +367,32 @@ class Aws(AwsContext):
         :return: Tuple containing the access key ID and associated secret.
         """
         with super().establish_credentials():
-            iam = boto3.resource("iam")
-            user = [user for user in iam.users.all() if user.name == user_name]
-            if not user or len(user) <= 0:
-                PRINT("AWS user not found for security access key pair creation: {user_name}")
+            iam_index = self.get_iam_index()
+            if not iam_index.get_user(user_name):
+                PRINT(f"AWS user not found for security access key pair creation: {user_name}")
                 return None, None
-            if len(user) > 1:
-                PRINT("Multiple AWS users found for security access key pair creation: {user_name}")
-                return None, None
-            user = user[0]
-            existing_keys = boto3.client("iam").list_access_keys(UserName=user.name)
+            existing_keys = iam_index.get_access_keys(user_name)
             if existing_keys:
-                existing_keys = existing_keys.get("AccessKeyMetadata")
-                if existing_keys and len(existing_keys) > 0:
-                    if len(existing_keys) == 1:
-                        PRINT(f"AWS IAM user ({user.name}) already has an access key defined:")
-                    else:
-                        PRINT(f"AWS IAM user ({user.name}) already has {len(existing_keys)} access keys defined:")
-                    for existing_key in existing_keys:
-                        existing_access_key_id = existing_key["AccessKeyId"]
-                        existing_access_key_create_date = existing_key["CreateDate"]
-                        PRINT(f"- {existing_access_key_id} (created:"
-                              f" {existing_access_key_create_date.astimezone().strftime('%Y-%m-%d %H:%M:%S')})")
-                    yes = yes_or_no("Do you still want to create a new access key?")
-                    if not yes:
-                        return None, None
-            yes = yes_or_no(f"Create AWS security access key pair for AWS IAM user: {user.name} ?")
+                if len(existing_keys) == 1:
+                    PRINT(f"AWS IAM user ({user_name}) already has an access key defined:")
+                else:
+                    PRINT(f"AWS IAM user ({user_name}) already has {len(existing_keys)} access keys defined:")
+                for existing_key in existing_keys:
+                    existing_access_key_id = existing_key["AccessKeyId"]
+                    existing_access_key_create_date = existing_key["CreateDate"]
+                    PRINT(f"- {existing_access_key_id} (created:"
+                          f" {existing_access_key_create_date.astimezone().strftime('%Y-%m-%d %H:%M:%S')})")
+                yes = yes_or_no("Do you still want to create a new access key?")
+                if not yes:
+                    return None, None
+            yes = yes_or_no(f"Create AWS security access key pair for AWS IAM user: {user_name} ?")
             if yes:
-                key_pair = user.create_access_key_pair()
-                PRINT(f"- Created AWS Access Key ID ({user.name}): {key_pair.id}")
-                PRINT(f"- Created AWS Secret Access Key ({user.name}): {obfuscate(key_pair.secret, show)}")
-                return key_pair.id, key_pair.secret
+                access_key = self.client("iam").create_access_key(UserName=user_name)["AccessKey"]
+                self.forget_shared("iam_index")
+                PRINT(f"- Created AWS Access Key ID ({user_name}): {access_key['AccessKeyId']}")
+                PRINT(f"- Created AWS Secret Access Key ({user_name}):"
+                      f" {obfuscate(access_key['SecretAccessKey'], show)}")
+                return access_key["AccessKeyId"], access_key["SecretAccessKey"]
             return None, None
 
     def find_iam_role_arns(self, role_arn_pattern: str) -> list:
@@ -238,15 +403,7 @@ class Aws(AwsContext):
         :param role_arn_pattern: Regular expression to match role ARNs.
         :return: List of matching AWS IAM role ARNs or empty list of none found.
         """
-        found_roles = []
-        with super().establish_credentials():
-            iam = boto3.client("iam")
-            roles = iam.list_roles()["Roles"]
-            for role in roles:
-                role_arn = role["Arn"]
-                if re.match(role_arn_pattern, role_arn):
-                    found_roles.append(role_arn)
-        return found_roles
+        return self.get_iam_index().find_role_arns(arn_pattern=role_arn_pattern)
 
     def get_kms_key_policy(self, key_id: str) -> dict:
         """
@@ -257,7 +414,7 @@ class Aws(AwsContext):
         :return: Policy for given KMS key ID or None if not found.
         """
         with super().establish_credentials():
-            kms = boto3.client("kms")
+            kms = self.client("kms")
             key_policy = kms.get_key_policy(KeyId=key_id, PolicyName="default")["Policy"]
             key_policy_json = json.loads(key_policy)
             return key_policy_json
@@ -310,21 +467,21 @@ class Aws(AwsContext):
         :param key_policy_json: JSON for the KMS key policy.
         """
         with super().establish_credentials():
-            kms = boto3.client("kms")
+            kms = self.client("kms")
             key_policy_string = json.dumps(key_policy_json)
             kms.put_key_policy(KeyId=key_id, Policy=key_policy_string, PolicyName="default")
 
-    def get_security_group_rules(self, security_group_id: str, outbound: bool) -> Optional[list]:
+    def get_security_group_rules(self, security_group_id: str, outbound: Optional[bool] = None) -> Optional[list]:
         """
-        Returns the list of inbound or outbound, depending on the give outbound flag,
+        Returns the list of inbound or outbound, depending on the give outbound flag (or both if None),
         AWS security group rules, for the given AWS security group ID; or None if none found.
 
         :param security_group_id: AWS security group ID.
-        :param outbound: True if outbound (egress) rules are desired, otherwise inbound (ingress).
+        :param outbound: True if outbound (egress) rules are desired, False if inbound (ingress), None if both.
         :return: List of inbound or outbound AWS security group rules for the given security group ID, or None.
         """
         with super().establish_credentials():
-            ec2 = boto3.client('ec2')
+            ec2 = self.client('ec2')
             security_group_rules_filter = [{"Name": "group-id", "Values": [security_group_id]}]
             security_group_rules = ec2.describe_security_group_rules(Filters=security_group_rules_filter)
             if not security_group_rules:
@@ -334,7 +491,7 @@ class Aws(AwsContext):
                 return None
             security_group_rules = [security_group_rule
                                     for security_group_rule in security_group_rules
-                                    if outbound == security_group_rule.get("IsEgress")]
+                                    if outbound is None or outbound == security_group_rule.get("IsEgress")]
             if not security_group_rules:
                 return None
             return security_group_rules
@@ -367,7 +524,7 @@ class Aws(AwsContext):
         :return: AWS security group ID for the given AWS security group name.
         """
         with super().establish_credentials():
-            ec2 = boto3.client('ec2')
+            ec2 = self.client('ec2')
             security_group_filter = [{"Name": "tag:Name", "Values": [security_group_name]}]
             security_groups = ec2.describe_security_groups(Filters=security_group_filter)
             if not security_groups:
@@ -387,7 +544,7 @@ class Aws(AwsContext):
         :return: Security group rule ID of the newly created inbound rule.
         """
         with super().establish_credentials():
-            ec2 = boto3.client('ec2')
+            ec2 = self.client('ec2')
             response = ec2.authorize_security_group_ingress(GroupId=security_group_id,
                                                             IpPermissions=[security_group_rule])
             return response["SecurityGroupRules"][0]["SecurityGroupRuleId"]
@@ -401,11 +558,42 @@ class Aws(AwsContext):
         :return: Security group rule ID of the newly created outbound rule.
         """
         with super().establish_credentials():
-            ec2 = boto3.client('ec2')
+            ec2 = self.client('ec2')
             response = ec2.authorize_security_group_egress(GroupId=security_group_id,
                                                            IpPermissions=[security_group_rule])
             return response["SecurityGroupRules"][0]["SecurityGroupRuleId"]
 
+    def authorize_security_group_rules(self, security_group_id: str, ip_permissions: list, outbound: bool) -> list:
+        """
+        Creates all of the given AWS inbound or outbound, depending on the given outbound flag, security group
+        rules (IpPermissions) for the given AWS security group ID, with a single authorize call.
+
+        :param security_group_id: AWS security group ID.
+        :param ip_permissions: List of AWS security group rules (as IpPermissions).
+        :param outbound: True if outbound (egress) rules, otherwise inbound (ingress).
+        :return: List of the security group rule IDs of the newly created rules.
+        """
+        with super().establish_credentials():
+            ec2 = self.client('ec2')
+            authorize = ec2.authorize_security_group_egress if outbound else ec2.authorize_security_group_ingress
+            response = authorize(GroupId=security_group_id, IpPermissions=ip_permissions)
+            return [rule["SecurityGroupRuleId"] for rule in response.get("SecurityGroupRules") or []]
+
+    def revoke_security_group_rules(self, security_group_id: str, security_group_rule_ids: list,
+                                    outbound: bool) -> None:
+        """
+        Deletes all of the AWS inbound or outbound, depending on the given outbound flag, security group
+        rules for the given security group ID and security group rule IDs, with a single revoke call.
+
+        :param security_group_id: AWS security group ID.
+        :param security_group_rule_ids: List of AWS security group rule IDs.
+        :param outbound: True if outbound (egress) rules, otherwise inbound (ingress).
+        """
+        with super().establish_credentials():
+            ec2 = self.client('ec2')
+            revoke = ec2.revoke_security_group_egress if outbound else ec2.revoke_security_group_ingress
+            revoke(GroupId=security_group_id, SecurityGroupRuleIds=security_group_rule_ids)
+
     def delete_inbound_security_group_rule(self, security_group_id: str, security_group_rule_id: str) -> None:
         """
         Deletes the AWS inbound security group rule for the given security group ID and security group rule ID.
@@ -414,7 +602,7 @@ class Aws(AwsContext):
         :param security_group_rule_id: AWS security group rule ID.
         """
         with super().establish_credentials():
-            ec2 = boto3.client('ec2')
+            ec2 = self.client('ec2')
             ec2.revoke_security_group_ingress(GroupId=security_group_id,
                                               SecurityGroupRuleIds=[security_group_rule_id])
 
@@ -426,7 +614,7 @@ class Aws(AwsContext):
         :param security_group_rule_id: AWS security group rule ID.
         """
         with super().establish_credentials():
-            ec2 = boto3.client('ec2')
+            ec2 = self.client('ec2')
             ec2.revoke_security_group_egress(GroupId=security_group_id,
                                              SecurityGroupRuleIds=[security_group_rule_id])
 
@@ -612,7 +800,8 @@ class Aws(AwsContext):
         :param stack_output_key_name: AWS stack output key name.
         :return: Value of the given AWS stack output key name of the given stack name, or None.
         """
-        with super().establish_credentials():
+        # C4OrchestrationManager uses the module level boto3 functions, so needs the environment set.
+        with super().establish_credentials(set_environ=True):
             # Using dcicutils.cloudformation_utils.find_stack_output here even though it looks
             # for the given stack output key name across all stacks, as this output key name
             # should be be unique across stacks. See discussion on Slack with Kent/Will/David
@@ -636,7 +825,7 @@ class Aws(AwsContext):
         :return: List of CORS rules for the given AWS S3 bucket name, or EMPTY list, or None.
         """
         with super().establish_credentials():
-            s3 = boto3.client('s3')
+            s3 = self.client('s3')
             try:
                 response = s3.get_bucket_cors(Bucket=bucket_name)
                 if response:
@@ -652,6 +841,35 @@ class Aws(AwsContext):
                     return []
         return None
 
+    def get_bucket_names(self) -> list:
+        """
+        Returns the names of all of the AWS S3 buckets (in the account).
+
+        :return: List of AWS S3 bucket names; empty list if none.
+        """
+        with super().establish_credentials():
+            s3 = self.client('s3')
+            return [bucket["Name"] for bucket in s3.list_buckets().get("Buckets") or []]
+
+    def get_bucket_tags(self, bucket_name: str) -> Optional[dict]:
+        """
+        Returns the tags for the given AWS S3 bucket name, as a dictionary of tag keys to values;
+        or an EMPTY dictionary if the bucket has no tags; or None if some other error occurred.
+
+        :param bucket_name: AWS S3 bucket name.
+        :return: Dictionary of tag keys/values for the given AWS S3 bucket name, or EMPTY dictionary, or None.
+        """
+        with super().establish_credentials():
+            s3 = self.client('s3')
+            try:
+                response = s3.get_bucket_tagging(Bucket=bucket_name)
+                return {tag["Key"]: tag["Value"] for tag in response.get("TagSet") or []}
+            except botocore.exceptions.ClientError as e:
+                error = e.response.get("Error")
+                if error and error.get("Code") == "NoSuchTagSet":
+                    return {}
+        return None
+
     def put_cors_rules(self, bucket_name: str, cors_rules: list) -> None:
         """
         Updates the AWS S3 bucket with the given CORS policy rules.
@@ -660,5 +878,5 @@ class Aws(AwsContext):
         :param cors_rules: List of AWS CORS rules to set for the given AWS S3 bucket.
         """
         with super().establish_credentials():
-            s3 = boto3.client('s3')
+            s3 = self.client('s3')
             s3.put_bucket_cors(Bucket=bucket_name, CORSConfiguration={"CORSRules": cors_rules})
@@ -1,10 +1,113 @@
 import boto3
+import botocore.credentials
+import botocore.session
+import configparser
 import contextlib
+import hashlib
 import os
+import threading
+from typing import Optional
 from dcicutils.misc_utils import PRINT
 from .misc_utils import obfuscate
 
 
+class AwsSessionCache:
+    """
+    Process-wide cache of established AWS credentials, keyed by AWS credentials directory
+    (or access key ID) and region. Each entry holds the explicit boto3 session for those
+    credentials and memoizes the caller identity, so that STS is called once per process
+    rather than once per AwsContext.establish_credentials, and the boto3 clients/resources
+    created for each service, since botocore client construction (loading and parsing the
+    service model) is slow. Entries are keyed on the modification times of the credentials/config
+    files so edits to them are picked up, and are not used if the boto3 module in use has
+    since been replaced (e.g. patched with a mock in tests).
+    """
+
+    _lock = threading.Lock()
+    _entries = {}
+    _key_locks = {}
+    hits = 0
+    misses = 0
+
+    class Entry:
+        def __init__(self, boto3_module, session, credentials) -> None:
+            self.boto3 = boto3_module
+            self.session = session
+            self.credentials = credentials
+            self._clients = {}
+            self._resources = {}
+            self._lock = threading.Lock()
+            self._shared = {}
+            self._shared_lock = threading.Lock()
+
+        def client(self, service_name: str):
+            # Creating clients from a (shared) boto3 session is not thread-safe, using them is; hence the lock.
+            with self._lock:
+                client = self._clients.get(service_name)
+                if client is None:
+                    client = self._clients[service_name] = self.session.client(service_name)
+                return client
+
+        def resource(self, service_name: str):
+            with self._lock:
+                resource = self._resources.get(service_name)
+                if resource is None:
+                    # The dcicutils.qa_utils.MockBoto3Session has no resource method (its MockBoto3 does).
+                    create_resource = getattr(self.session, "resource", None) or self.boto3.resource
+                    resource = self._resources[service_name] = create_resource(service_name)
+                return resource
+
+        def shared(self, name: str, create, refresh: bool = False):
+            """
+            Returns the object (e.g. an IamIndex) of the given name shared by all users of these credentials,
+            first creating it with the given create function (called with no arguments) if not yet created,
+            or if refresh is True. Concurrent callers wait for a single create.
+            """
+            with self._shared_lock:
+                if refresh or name not in self._shared:
+                    self._shared[name] = create()
+                return self._shared[name]
+
+        def forget(self, name: str) -> None:
+            with self._shared_lock:
+                self._shared.pop(name, None)
+
+    @classmethod
+    def _get(cls, key: tuple):
+        entry = cls._entries.get(key)
+        return entry if entry is not None and entry.boto3 is boto3 else None
+
+    @classmethod
+    def get_or_create(cls, key: tuple, create):
+        """
+        Returns the cached entry for the given key, or if none calls create to make one and caches it.
+        Concurrent callers for the same key wait for a single create rather than each calling STS.
+        """
+        with cls._lock:
+            entry = cls._get(key)
+            if entry:
+                cls.hits += 1
+                return entry
+            cls.misses += 1
+            key_lock = cls._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with cls._lock:
+                entry = cls._get(key)
+            if not entry:
+                entry = create()
+                with cls._lock:
+                    cls._entries[key] = entry
+            return entry
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._entries.clear()
+            cls._key_locks.clear()
+            cls.hits = 0
+            cls.misses = 0
+
+
 class AwsContext:
     """
     Class to setup the context for AWS credentials which do NOT rely on environment AT ALL.
@@ -19,13 +122,20 @@ class AwsContext:
 
         aws = AwsContext(your_aws_credentials_directory_or_access_key_id_and_secret_access_key)
         with aws.establish_credentials() as credentials:
-            do_something_with_boto3()
+            s3 = aws.client("s3")  # or credentials.session.client("s3")
+            do_something_with(s3)
             # if desired reference/use credentials values like so:
             aws_access_key_id = credentials.access_key_id
             aws_secret_access_key = credentials.secret_access_key
             aws_region = credentials.region
             aws_account_number = credentials.account_number
             aws_user_arn = credentials.user_arn
+
+    Credentials are established via an explicit boto3 session (credentials.session) and the
+    environment is left untouched, so any number of contexts (for the same or different
+    credentials) may be used concurrently from multiple threads. Code which still relies on
+    the module level boto3 functions (e.g. boto3.client) must opt into the environment
+    compatibility shim; see establish_credentials.
     """
 
     def __init__(self,
@@ -33,7 +143,8 @@ class AwsContext:
                  aws_access_key_id: str = None,
                  aws_secret_access_key: str = None,
                  aws_region: str = None,
-                 aws_session_token: str = None) -> None:
+                 aws_session_token: str = None,
+                 use_session_cache: bool = True) -> None:
         """
         Constructor which stores the given AWS credentials directory, and AWS access key ID
         and secret access key (and region) for use when establishing AWS credentials.
@@ -44,6 +155,7 @@ class AwsContext:
         :param aws_secret_access_key: AWS credentials secret access key.
         :param aws_region: AWS credentials region.
         :param aws_session_token: AWS session token. NOTE: Not yet tested at all.
+        :param use_session_cache: If True (default) reuse caller identity and clients via AwsSessionCache.
         """
         self._aws_access_key_id = aws_access_key_id
         self._aws_secret_access_key = aws_secret_access_key
@@ -51,12 +163,14 @@ class AwsContext:
         self._aws_session_token = aws_session_token
         self._aws_credentials_dir = aws_credentials_dir
         self._reset_boto3_default_session = True
+        self._use_session_cache = use_session_cache
+        self._session_entry = None
 
     class Credentials:
         def __init__(self,
                      credentials_dir: str, credentials_dir_symlink_target: str,
                      access_key_id: str, secret_access_key: str, region: str,
-                     account_number: str, user_arn: str) -> None:
+                     account_number: str, user_arn: str, session=None) -> None:
             self.credentials_dir = credentials_dir
             self.credentials_dir_symlink_target = credentials_dir_symlink_target
             self.access_key_id = access_key_id
@@ -64,29 +178,270 @@ class AwsContext:
             self.region = region
             self.account_number = account_number
             self.user_arn = user_arn
+            self.session = session
+
+    def _session_cache_key(self) -> tuple:
+        def digest(value: str) -> str:
+            return hashlib.sha256(value.encode("utf-8")).hexdigest() if value else None
+
+        def modified_time(path: str) -> float:
+            return os.path.getmtime(path) if os.path.isfile(path) else None
+
+        if self._aws_access_key_id and self._aws_secret_access_key:
+            return ("keys", self._aws_access_key_id, digest(self._aws_secret_access_key), self._aws_region)
+        elif self._aws_session_token:
+            return ("token", digest(self._aws_session_token), self._aws_region)
+        aws_credentials_dir = os.path.realpath(self._aws_credentials_dir)
+        return ("dir", aws_credentials_dir, self._aws_region,
+                modified_time(os.path.join(aws_credentials_dir, "credentials")),
+                modified_time(os.path.join(aws_credentials_dir, "config")))
+
+    @staticmethod
+    def _find_aws_file_section(aws_file: str, profile: str = "default") -> tuple:
+        """
+        Returns the name and (lower-cased) key/values of the given profile section of the given AWS credentials
+        or config file, or of its first section if it has no such profile; or (None, empty dict) if none.
+        """
+        if not os.path.isfile(aws_file):
+            return None, {}
+        config = configparser.ConfigParser()
+        config.read(aws_file)
+        sections = config.sections()
+        for section in (profile, f"profile {profile}"):
+            if section in sections:
+                break
+        else:
+            if not sections:
+                return None, {}
+            section = sections[0]
+        return section, {key.lower(): value for key, value in config[section].items()}
+
+    # The credential providers of the botocore provider chain which look outside the credentials directory,
+    # i.e. at environment variables, ~/.boto or /etc/boto.cfg, or the container/instance metadata services.
+    _ENVIRONMENT_CREDENTIAL_PROVIDERS = ["env", "assume-role-with-web-identity", "ec2-credentials-file",
+                                         "boto-config", "container-role", "iam-role"]
+
+    @staticmethod
+    def _create_botocore_session(aws_credentials_file: str, aws_config_file: str, profile: Optional[str]):
+        """
+        Returns a botocore session resolving credentials ONLY from the given credentials and config files,
+        for the given profile, so that profiles using role_arn/source_profile, SSO or credential_process
+        work too, and nothing is picked up from the environment when they yield no credentials (or if
+        there is no profile at all).
+        """
+        # Nor is the profile taken from the AWS_PROFILE (or AWS_DEFAULT_PROFILE) environment variable.
+        botocore_session = botocore.session.Session(session_vars={"profile": (None, None, None, None)})
+        botocore_session.set_config_variable("credentials_file", aws_credentials_file)
+        botocore_session.set_config_variable("config_file", aws_config_file)
+        if not profile:
+            botocore_session.register_component("credential_provider",
+                                                botocore.credentials.CredentialResolver(providers=[]))
+            return botocore_session
+        botocore_session.set_config_variable("profile", profile)
+        credential_resolver = botocore_session.get_component("credential_provider")
+        for provider in AwsContext._ENVIRONMENT_CREDENTIAL_PROVIDERS:
+            credential_resolver.remove(provider)
+        return botocore_session
+
+    def _session_kwargs(self) -> dict:
+        """
+        Returns the arguments for the explicit boto3.session.Session for our specified credentials.
+        """
+        if self._aws_access_key_id and self._aws_secret_access_key:
+            return {"aws_access_key_id": self._aws_access_key_id,
+                    "aws_secret_access_key": self._aws_secret_access_key,
+                    "aws_session_token": self._aws_session_token,
+                    "region_name": self._aws_region}
+        elif self._aws_session_token:
+            return {"aws_session_token": self._aws_session_token, "region_name": self._aws_region}
+        elif self._aws_credentials_dir:
+            aws_credentials_dir = self._aws_credentials_dir
+            if not os.path.isdir(aws_credentials_dir):
+                raise Exception(f"AWS credentials directory not found: {aws_credentials_dir}")
+            aws_credentials_file = os.path.join(aws_credentials_dir, "credentials")
+            aws_config_file = os.path.join(aws_credentials_dir, "config")
+            if not os.path.isfile(aws_credentials_file) and not os.path.isfile(aws_config_file):
+                raise Exception(f"AWS credentials file not found: {aws_credentials_file}")
+            credentials_section, aws_credentials = self._find_aws_file_section(aws_credentials_file)
+            config_section, aws_config = self._find_aws_file_section(aws_config_file)
+            profile = credentials_section or (config_section and config_section.replace("profile ", "", 1))
+            # The static keys (if any) are passed explicitly, otherwise the credentials are resolved (e.g. by
+            # assuming a role) from the files in the directory only; never from the environment.
+            return {"aws_access_key_id": aws_credentials.get("aws_access_key_id"),
+                    "aws_secret_access_key": aws_credentials.get("aws_secret_access_key"),
+                    "aws_session_token": aws_credentials.get("aws_session_token"),
+                    "region_name": self._aws_region or aws_config.get("region") or aws_credentials.get("region"),
+                    "aws_files": (aws_credentials_file, aws_config_file, profile)}
+        raise Exception(f"No AWS credentials specified.")
+
+    def _create_session(self, session_kwargs: dict):
+        """
+        Creates the explicit boto3 session for the given session arguments (see _session_kwargs).
+        """
+        session_kwargs = {key: value for key, value in session_kwargs.items() if value}
+        aws_files = session_kwargs.pop("aws_files", None)
+        if aws_files:
+            session_kwargs["botocore_session"] = self._create_botocore_session(*aws_files)
+        return boto3.session.Session(**session_kwargs)
+
+    def _create_session_entry(self, session_kwargs: dict) -> AwsSessionCache.Entry:
+        """
+        Creates the explicit boto3 session for our specified credentials and gets its caller identity.
+        """
+        session = self._create_session(session_kwargs)
+        session_credentials = session.get_credentials()
+        if not session_credentials:
+            raise Exception("AWS session credentials cannot be determined.")
+        caller_identity = session.client("sts").get_caller_identity()
+        if not caller_identity:
+            raise Exception("AWS caller identity cannot be determined.")
+        account_number = caller_identity["Account"]
+        user_arn = caller_identity["Arn"]
+
+        if not account_number:
+            raise Exception("AWS account number cannot be determined.")
+
+        aws_credentials_dir = aws_credentials_dir_symlink_target = None
+        if not (self._aws_access_key_id and self._aws_secret_access_key) and not self._aws_session_token:
+            aws_credentials_dir = self._aws_credentials_dir
+            aws_credentials_dir_symlink_target = (os.readlink(aws_credentials_dir)
+                                                  if os.path.islink(aws_credentials_dir) else None)
+        credentials = AwsContext.Credentials(credentials_dir=aws_credentials_dir,
+                                             credentials_dir_symlink_target=aws_credentials_dir_symlink_target,
+                                             access_key_id=session_credentials.access_key,
+                                             secret_access_key=session_credentials.secret_key,
+                                             region=session.region_name,
+                                             account_number=account_number,
+                                             user_arn=user_arn,
+                                             session=session)
+        return AwsSessionCache.Entry(boto3, session, credentials)
+
+    @property
+    def session(self):
+        """
+        Returns the explicit boto3 session for our credentials; establish_credentials must have been called.
+        """
+        if not self._session_entry:
+            raise Exception("AWS credentials not established; use within establish_credentials.")
+        return self._session_entry.session
+
+    def client(self, service_name: str):
+        """
+        Returns a boto3 client for the given service, for the credentials established by
+        establish_credentials; created once per process and credentials. Thread-safe.
+
+        :param service_name: AWS service name, e.g. "kms".
+        :return: boto3 client.
+        """
+        if not self._session_entry:
+            raise Exception("AWS credentials not established; use within establish_credentials.")
+        return self._session_entry.client(service_name)
+
+    def shared(self, name: str, create, refresh: bool = False):
+        """
+        Returns the object of the given name shared by all users of the credentials established by
+        establish_credentials (i.e. created once per process and credentials), first creating it with
+        the given create function if not yet created, or if refresh is True. Thread-safe.
+
+        :param name: Name of the shared object, e.g. "iam_index".
+        :param create: Function (with no arguments) to create the shared object.
+        :param refresh: True to (re)create the shared object even if already created.
+        :return: Shared object.
+        """
+        if not self._session_entry:
+            raise Exception("AWS credentials not established; use within establish_credentials.")
+        return self._session_entry.shared(name, create, refresh)
+
+    def forget_shared(self, name: str) -> None:
+        """
+        Forgets the shared object of the given name (see shared), e.g. after changing what it reflects.
+        """
+        if self._session_entry:
+            self._session_entry.forget(name)
+
+    def resource(self, service_name: str):
+        """
+        Returns a boto3 resource for the given service, for the credentials established by
+        establish_credentials; created once per process and credentials. Note that unlike
+        clients, boto3 resources are NOT thread-safe; do not share one across threads.
+
+        :param service_name: AWS service name, e.g. "iam".
+        :return: boto3 resource.
+        """
+        if not self._session_entry:
+            raise Exception("AWS credentials not established; use within establish_credentials.")
+        return self._session_entry.resource(service_name)
 
     @contextlib.contextmanager
-    def establish_credentials(self, display: bool = False, show: bool = False):
+    def establish_credentials(self, display: bool = False, show: bool = False, set_environ: bool = False):
         """
         Context manager to establish AWS credentials WITHOUT using environment, rather
         using the EXPLICITLY specified AWS credentials directory or the EXPLICITLY
         specified credentials values passed to the constructor of this object.
 
-        Implementation note: to do this we temporarily (for the life of the context
-        manager context) blow away any pertinent AWS credentials related environment variables,
-        and set them appropriately based on given EXPLICITLY specified credentials information.
+        Implementation note: to do this we build an explicit boto3 session from the given
+        EXPLICITLY specified credentials information (if given a credentials directory, on a
+        botocore session resolving credentials from its files only), which is available as the session
+        property of the yielded Credentials, and via the client/resource methods here.
+
+        If set_environ is True then, as a compatibility shim for code which still uses the
+        module level boto3 functions (e.g. dcicutils C4OrchestrationManager), we ALSO
+        temporarily (for the life of the context manager context) blow away any pertinent
+        AWS credentials related environment variables and set them from these credentials,
+        as resolved by the session (e.g. the temporary credentials of a role profile).
+        This mutates os.environ and so is NOT thread-safe; avoid it where possible.
 
         :param display: If True then PRINT summary of AWS credentials.
         :param show: If True and display True show in plaintext sensitive info for AWS credentials summary.
+        :param set_environ: If True then also set AWS credentials environment variables (NOT thread-safe).
         :return: Yields populated (nested class) Credentials object.
         """
 
+        session_kwargs = self._session_kwargs()
+        if self._use_session_cache:
+            # Reuse the session, caller identity and clients from an earlier context with these same credentials.
+            session_entry = AwsSessionCache.get_or_create(self._session_cache_key(),
+                                                          lambda: self._create_session_entry(session_kwargs))
+        else:
+            session_entry = self._create_session_entry(session_kwargs)
+        # Always the same entry for the same credentials, so harmless if set concurrently from multiple threads.
+        self._session_entry = session_entry
+        credentials = session_entry.credentials
+
+        if display:
+            if credentials.credentials_dir_symlink_target:
+                PRINT(f"Your AWS credentials directory (link): {credentials.credentials_dir}@ ->")
+                PRINT(f"Your AWS credentials directory (real): {credentials.credentials_dir_symlink_target}")
+            else:
+                PRINT(f"Your AWS credentials directory: {credentials.credentials_dir}")
+            PRINT(f"Your AWS access key: {credentials.access_key_id}")
+            PRINT(f"Your AWS access secret: {obfuscate(credentials.secret_access_key, show)}")
+            PRINT(f"Your AWS region: {credentials.region}")
+            PRINT(f"Your AWS account number: {credentials.account_number}")
+            PRINT(f"Your AWS account user ARN: {credentials.user_arn}")
+
+        if not set_environ:
+            # Yield pertinent AWS credentials info for caller in case they need/want them.
+            yield credentials
+            return
+
+        with self._environ_compatibility_shim(session_entry.session):
+            yield credentials
+
+    @contextlib.contextmanager
+    def _environ_compatibility_shim(self, session):
+        """
+        Temporarily (for the life of this context) unset/delete and override any AWS credentials
+        related environment variables with the credentials and region resolved by the given
+        (explicit) session, i.e. its frozen credentials (including any session token), which
+        works for any profile kind (e.g. role, SSO, credential_process). The credentials/config
+        file environment variables are left alone; environment credentials take precedence.
+        """
+
         def unset_environ(environment_variables: list) -> dict:
             saved_environment_variables = {}
             for environment_variable in environment_variables:
                 saved_environment_variables[environment_variable] = os.environ.pop(environment_variable, None)
-                if environment_variable.endswith("_FILE"):
-                    os.environ[environment_variable] = "/dev/null"
             return saved_environment_variables
 
         def restore_environ(saved_environment_variables: dict) -> None:
@@ -96,15 +451,14 @@ class AwsContext:
                 else:
                     os.environ.pop(saved_environ_key, None)
 
-        # Temporarily (for the life of this context) unset/delete (here) and
-        # override (below) any AWS credentials related environment variables.
+        frozen_credentials = session.get_credentials().get_frozen_credentials()
         saved_environ = unset_environ(["AWS_ACCESS_KEY_ID",
-                                       "AWS_CONFIG_FILE",
+                                       "AWS_DEFAULT_PROFILE",
                                        "AWS_DEFAULT_REGION",
+                                       "AWS_PROFILE",
                                        "AWS_REGION",
                                        "AWS_SECRET_ACCESS_KEY",
-                                       "AWS_SESSION_TOKEN",
-                                       "AWS_SHARED_CREDENTIALS_FILE"])
+                                       "AWS_SESSION_TOKEN"])
 
         # This reset of the boto3.DEFAULT_SESSION is to workaround an odd problem with boto3
         # caching a default session, even for bad or non-existent credentials. This problem
@@ -119,68 +473,14 @@ class AwsContext:
             boto3.DEFAULT_SESSION = None
             self._reset_boto3_default_session = False
         try:
-            # Setup AWS environment variables for our specified credentials.
-            aws_credentials_dir = aws_credentials_dir_symlink_target = None
-            if self._aws_access_key_id and self._aws_secret_access_key:
-                os.environ["AWS_ACCESS_KEY_ID"] = self._aws_access_key_id
-                os.environ["AWS_SECRET_ACCESS_KEY"] = self._aws_secret_access_key
-            elif self._aws_session_token:
-                os.environ["AWS_SESSION_TOKEN"] = self._aws_session_token
-            elif self._aws_credentials_dir:
-                aws_credentials_dir = self._aws_credentials_dir
-                if not os.path.isdir(aws_credentials_dir):
-                    raise Exception(f"AWS credentials directory not found: {aws_credentials_dir}")
-                aws_credentials_file = os.path.join(aws_credentials_dir, "credentials")
-                if not os.path.isfile(aws_credentials_file):
-                    raise Exception(f"AWS credentials file not found: {aws_credentials_file}")
-                os.environ["AWS_SHARED_CREDENTIALS_FILE"] = aws_credentials_file
-                aws_credentials_dir_symlink_target = (os.readlink(aws_credentials_dir)
-                                                      if os.path.islink(aws_credentials_dir) else None)
-            else:
-                raise Exception(f"No AWS credentials specified.")
-            if self._aws_region:
-                os.environ["AWS_DEFAULT_REGION"] = self._aws_region
-            else:
-                aws_config_file = os.path.join(self._aws_credentials_dir, "config")
-                if os.path.isfile(aws_config_file):
-                    os.environ["AWS_CONFIG_FILE"] = aws_config_file
-
-            # Setup AWS boto3 session/client to get basic AWS credentials info;
-            session = boto3.session.Session()
-            session_credentials = session.get_credentials()
-            if not session_credentials:
-                raise Exception("AWS session credentials cannot be determined.")
-            caller_identity = boto3.client("sts").get_caller_identity()
-            if not session_credentials:
-                raise Exception("AWS caller identity cannot be determined.")
-            account_number = caller_identity["Account"]
-            user_arn = caller_identity["Arn"]
-
-            if not account_number:
-                raise Exception("AWS account number cannot be determined.")
-
-            credentials = AwsContext.Credentials(credentials_dir=aws_credentials_dir,
-                                                 credentials_dir_symlink_target=aws_credentials_dir_symlink_target,
-                                                 access_key_id=session_credentials.access_key,
-                                                 secret_access_key=session_credentials.secret_key,
-                                                 region=session.region_name,
-                                                 account_number=account_number,
-                                                 user_arn=user_arn)
-            if display:
-                if aws_credentials_dir_symlink_target:
-                    PRINT(f"Your AWS credentials directory (link): {aws_credentials_dir}@ ->")
-                    PRINT(f"Your AWS credentials directory (real): {aws_credentials_dir_symlink_target}")
-                else:
-                    PRINT(f"Your AWS credentials directory: {aws_credentials_dir}")
-                PRINT(f"Your AWS access key: {credentials.access_key_id}")
-                PRINT(f"Your AWS access secret: {obfuscate(credentials.secret_access_key, show)}")
-                PRINT(f"Your AWS region: {credentials.region}")
-                PRINT(f"Your AWS account number: {credentials.account_number}")
-                PRINT(f"Your AWS account user ARN: {credentials.user_arn}")
-
-            # Yield pertinent AWS credentials info for caller in case they need/want them.
-            yield credentials
-
+            for environment_variable, value in (("AWS_ACCESS_KEY_ID", frozen_credentials.access_key),
+                                                ("AWS_SECRET_ACCESS_KEY", frozen_credentials.secret_key),
+                                                ("AWS_SESSION_TOKEN", frozen_credentials.token),
+                                                ("AWS_DEFAULT_REGION", session.region_name),
+                                                ("AWS_REGION", session.region_name)):
+                if value:
+                    os.environ[environment_variable] = value
+            yield
         finally:
             # Restore any deleted/modified AWS credentials related environment variables.
             restore_environ(saved_environ)
@@ -0,0 +1,111 @@
+# Module to run a set of (e.g. AWS) lookups, some of which depend on the results of others,
+# concurrently, each as soon as the lookups it depends on are done, and to report their latencies.
+
+import concurrent.futures
+import time
+from typing import Callable, Optional
+from dcicutils.misc_utils import PRINT
+from prettytable import PrettyTable
+from .misc_utils import get_exception_string
+
+
+class ConcurrentResolver:
+    """
+    Runs named lookups concurrently, respecting their dependencies. Usage like this:
+
+        resolver = ConcurrentResolver()
+        resolver.add("domains", lambda: list_domains())
+        resolver.add("endpoint", lambda domains: get_endpoint(domains), depends_on=["domains"])
+        resolver.add("users", lambda: list_users())
+        results = resolver.resolve()  # e.g. {"domains": [...], "endpoint": "...", "users": [...]}
+
+    Each lookup function is called with the results of the lookups it depends on as keyword arguments.
+    A lookup which raises an exception is recorded as failed (see errors) rather than raised, and
+    the lookups depending on it are skipped; its name is then not in the returned results.
+    """
+
+    class Lookup:
+        def __init__(self, name: str, function: Callable, depends_on: list) -> None:
+            self.name = name
+            self.function = function
+            self.depends_on = depends_on
+            self.started = None
+            self.duration = None
+            self.status = "pending"
+
+    def __init__(self, max_workers: int = 8) -> None:
+        self._max_workers = max_workers
+        self._lookups = {}
+        self.results = {}
+        self.errors = {}
+        self.duration = None
+
+    def add(self, name: str, function: Callable, depends_on: Optional[list] = None) -> None:
+        """
+        Adds the given named lookup function, depending on the given lookup names (already added), if any.
+        """
+        if name in self._lookups:
+            raise ValueError(f"Duplicate lookup: {name}")
+        for dependency in depends_on or []:
+            if dependency not in self._lookups:
+                raise ValueError(f"Unknown lookup dependency for {name}: {dependency}")
+        self._lookups[name] = ConcurrentResolver.Lookup(name, function, list(depends_on or []))
+
+    def _run(self, lookup: "ConcurrentResolver.Lookup", started: float):
+        lookup.started = time.time() - started
+        try:
+            return lookup.function(**{dependency: self.results[dependency] for dependency in lookup.depends_on})
+        finally:
+            lookup.duration = time.time() - started - lookup.started
+
+    def resolve(self) -> dict:
+        """
+        Runs all the added lookups, concurrently, each as soon as all of its dependencies have completed.
+
+        :return: Dictionary of lookup names to their results, for those which succeeded.
+        """
+        started = time.time()
+        remaining = dict(self._lookups)
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while remaining or running:
+                for lookup in list(remaining.values()):
+                    if any(self._lookups[dependency].status in ("failed", "skipped")
+                           for dependency in lookup.depends_on):
+                        lookup.status = "skipped"
+                        del remaining[lookup.name]
+                    elif all(dependency in self.results for dependency in lookup.depends_on):
+                        lookup.status = "running"
+                        running[executor.submit(self._run, lookup, started)] = lookup
+                        del remaining[lookup.name]
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    lookup = running.pop(future)
+                    try:
+                        self.results[lookup.name] = future.result()
+                        lookup.status = "done"
+                    except Exception as e:
+                        self.errors[lookup.name] = get_exception_string(e)
+                        lookup.status = "failed"
+        self.duration = time.time() - started
+        return self.results
+
+    def print_latency_report(self) -> None:
+        """
+        Prints a table of the lookups done by resolve, with their start offsets, durations, and statuses.
+        """
+        table = PrettyTable()
+        table.field_names = ["Lookup", "Depends On", "Started", "Seconds", "Status"]
+        table.align = "l"
+        for lookup in sorted(self._lookups.values(),
+                             key=lambda lookup: lookup.started if lookup.started is not None else float("inf")):
+            table.add_row([lookup.name, ", ".join(lookup.depends_on),
+                           f"{lookup.started:.3f}" if lookup.started is not None else "",
+                           f"{lookup.duration:.3f}" if lookup.duration is not None else "",
+                           self.errors.get(lookup.name, lookup.status)])
+        PRINT(table)
+        total = sum(lookup.duration for lookup in self._lookups.values() if lookup.duration is not None)
+        PRINT(f"Resolved {len(self.results)} of {len(self._lookups)} lookups in {self.duration or 0:.3f}s"
+              f" (one after another would be about {total:.3f}s).")
@@ -0,0 +1,171 @@
+# Module to reconcile the CORS policy rules of any number of AWS S3 buckets, selected by name, name
+# prefix (e.g. environment name), or tags, with a desired set of CORS rules; the current rules are read
+# concurrently, compared canonically, and only the buckets whose rules actually differ are updated.
+
+import concurrent.futures
+import copy
+import json
+from typing import List, Optional
+from dcicutils.misc_utils import PRINT
+from prettytable import PrettyTable
+from .aws import Aws
+from .misc_utils import get_exception_string
+
+
+class CorsBucketChange:
+    """
+    The (current) CORS rules for an S3 bucket, the CORS rules desired for it, the origins which
+    these add (per rule methods), and the status of its reconciliation (or the error doing so).
+    """
+    def __init__(self, bucket_name: str) -> None:
+        self.bucket_name = bucket_name
+        self.cors_rules = None
+        self.desired_cors_rules = None
+        self.added_origins = []
+        self.status = None
+        self.error = None
+
+    @property
+    def changed(self) -> bool:
+        return self.desired_cors_rules is not None and \
+            canonicalize_cors_rules(self.cors_rules) != canonicalize_cors_rules(self.desired_cors_rules)
+
+
+def canonicalize_cors_rules(cors_rules: Optional[list]) -> list:
+    """
+    Returns a canonical copy of the given CORS rules, for comparison, in which the (list) values of each rule
+    (e.g. AllowedOrigins) are sorted and deduplicated, and the rules themselves are sorted, as AWS applies
+    the first rule which matches a request, and these differences do not affect which rule that is.
+    """
+    def canonicalize(cors_rule: dict) -> dict:
+        return {key: sorted(set(value)) if isinstance(value, list) else value for key, value in cors_rule.items()}
+    return sorted((canonicalize(cors_rule) for cors_rule in cors_rules or []),
+                  key=lambda cors_rule: json.dumps(cors_rule, sort_keys=True, default=str))
+
+
+def get_desired_cors_rules(cors_rules: list, desired_cors_rules: list) -> list:
+    """
+    Returns a copy of the given CORS rules amended with the given desired CORS rules. For each desired
+    rule, if there is a "relevant" existing rule, i.e. one allowing (at least) all of its methods and
+    headers, then its origins are added to that rule (if not already present); otherwise it is added
+    as a new rule. Existing rules and origins are never removed; see update_cors_policy.amend_cors_rules.
+
+    :param cors_rules: List of (current) CORS rules.
+    :param desired_cors_rules: List of desired CORS rules.
+    :return: List of CORS rules amended with the desired CORS rules.
+    """
+    cors_rules = copy.deepcopy(cors_rules or [])
+    for desired_cors_rule in desired_cors_rules:
+        for cors_rule in cors_rules:
+            if all(set(desired_cors_rule.get(key) or []) <= set(cors_rule.get(key) or [])
+                   for key in ("AllowedMethods", "AllowedHeaders")):
+                allowed_origins = cors_rule.setdefault("AllowedOrigins", [])
+                allowed_origins.extend(origin for origin in desired_cors_rule.get("AllowedOrigins") or []
+                                       if origin not in allowed_origins)
+                break
+        else:
+            cors_rules.append(copy.deepcopy(desired_cors_rule))
+    return cors_rules
+
+
+def _get_cors_rules_origins(cors_rules: list) -> list:
+    """
+    Returns the list of (comma-separated allowed methods, allowed origin) tuples for the given CORS rules.
+    """
+    return [(",".join(sorted(cors_rule.get("AllowedMethods") or [])), origin)
+            for cors_rule in cors_rules for origin in cors_rule.get("AllowedOrigins") or []]
+
+
+def select_bucket_names(aws: Aws, bucket_names: Optional[list] = None, prefix: Optional[str] = None,
+                        tags: Optional[dict] = None, max_workers: int = 8) -> list:
+    """
+    Returns the names of the S3 buckets which are in the given bucket names list (if any), start with the
+    given prefix (if any), and have all of the given tags (dictionary of tag keys/values, if any); the tags
+    of the buckets are fetched concurrently. Selects no buckets (rather than all) if none of these is given.
+
+    :return: List of selected S3 bucket names, sorted.
+    """
+    if not bucket_names and not prefix and not tags:
+        return []
+    selected = sorted(set(bucket_names or [])) if bucket_names else aws.get_bucket_names()
+    if prefix:
+        selected = [bucket_name for bucket_name in selected if bucket_name.startswith(prefix)]
+    if tags and selected:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(selected))) as executor:
+            bucket_tags = list(executor.map(aws.get_bucket_tags, selected))
+        selected = [bucket_name for bucket_name, tags_for_bucket in zip(selected, bucket_tags)
+                    if tags_for_bucket and all(tags_for_bucket.get(key) == value for key, value in tags.items())]
+    return sorted(selected)
+
+
+def plan_cors_changes(aws: Aws, bucket_names: List[str], desired_cors_rules: list,
+                      max_workers: int = 8) -> List[CorsBucketChange]:
+    """
+    Gets the current CORS rules for the given S3 bucket names, concurrently, and returns, for each,
+    a CorsBucketChange with its current and desired CORS rules (see get_desired_cors_rules).
+
+    :return: List of CorsBucketChange objects, in the order of the given bucket names.
+    """
+    def plan(bucket_name: str) -> CorsBucketChange:
+        change = CorsBucketChange(bucket_name)
+        try:
+            change.cors_rules = aws.get_cors_rules(bucket_name)
+        except Exception as e:
+            change.status = "error"
+            change.error = get_exception_string(e)
+            return change
+        if change.cors_rules is None:
+            change.status = "not found"
+            return change
+        change.desired_cors_rules = get_desired_cors_rules(change.cors_rules, desired_cors_rules)
+        origins = _get_cors_rules_origins(change.cors_rules)
+        change.added_origins = [f"{methods} {origin}"
+                                for methods, origin in _get_cors_rules_origins(change.desired_cors_rules)
+                                if (methods, origin) not in origins]
+        change.status = "update" if change.changed else "unchanged"
+        return change
+
+    if not bucket_names:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(bucket_names))) as executor:
+        return list(executor.map(plan, bucket_names))
+
+
+def apply_cors_changes(aws: Aws, changes: List[CorsBucketChange], max_workers: int = 8) -> list:
+    """
+    Updates (puts) the desired CORS rules for each of the given changes which actually differ,
+    concurrently; buckets whose rules would not change are not touched at all. Updates the status
+    (and error) of each of these changes accordingly.
+
+    :return: List of the CorsBucketChange objects to be applied (whether or not successfully).
+    """
+    def apply(change: CorsBucketChange) -> None:
+        try:
+            aws.put_cors_rules(change.bucket_name, change.desired_cors_rules)
+            change.status = "updated"
+        except Exception as e:
+            change.status = "error"
+            change.error = get_exception_string(e)
+
+    changes = [change for change in changes if change.status == "update"]
+    if changes:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(changes))) as executor:
+            list(executor.map(apply, changes))
+    return changes
+
+
+def print_cors_changes(changes: List[CorsBucketChange]) -> None:
+    """
+    Prints a summary table of the given CORS bucket changes, with their statuses and the origins they add.
+    """
+    table = PrettyTable()
+    table.field_names = ["Bucket", "Status", "Origins Added"]
+    table.align = "l"
+    for change in changes:
+        status = f"error: {change.error}" if change.error else change.status
+        table.add_row([change.bucket_name, status, "\n".join(change.added_origins)])
+    PRINT(table)
+    counts = {}
+    for change in changes:
+        counts[change.status] = counts.get(change.status, 0) + 1
+    PRINT(f"S3 buckets: {len(changes)} ({', '.join(f'{status}: {count}' for status, count in sorted(counts.items()))})")
@@ -0,0 +1,183 @@
+# Module to run a given task against each of a number of AWS accounts/environments concurrently,
+# each in its own (explicit boto3 session based) AwsContext, and to merge the results into one table.
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import time
+from typing import Callable, List, Optional
+from dcicutils.misc_utils import PRINT
+from prettytable import PrettyTable
+from ..init_custom_dir.aws_credentials_info import AwsCredentialsInfo
+from .aws import Aws
+from .misc_utils import get_exception_string
+
+
+class FanOutTarget:
+    """
+    An AWS credentials directory to run against, and the (credentials/environment) name to report it as.
+    """
+    def __init__(self, name: str, aws_credentials_dir: str) -> None:
+        self.name = name
+        self.aws_credentials_dir = aws_credentials_dir
+
+
+class FanOutResult:
+    """
+    The result of running a task against a single FanOutTarget: the (structured) rows it returned,
+    or the error it raised, the account number (if credentials were established), and the duration.
+    """
+    def __init__(self, target: FanOutTarget) -> None:
+        self.target = target
+        self.account_number = None
+        self.rows = []
+        self.error = None
+        self.duration = 0.0
+
+
+def resolve_fan_out_targets(names_or_dirs: List[str], aws_dir: str = None) -> List[FanOutTarget]:
+    """
+    Returns the FanOutTargets for the given AWS credentials directories and/or AWS credentials
+    names, the latter referring to directories of the form ~/.aws_test.<aws-credentials-name>.
+    If none given then returns targets for all such directories which actually exist.
+
+    :param names_or_dirs: AWS credentials directory paths and/or AWS credentials names.
+    :param aws_dir: Alternate base AWS directory; default from InfraDirectories.AWS_DIR.
+    :return: List of FanOutTarget objects.
+    """
+    aws_credentials_info = AwsCredentialsInfo(aws_dir)
+    if not names_or_dirs:
+        names_or_dirs = sorted(aws_credentials_info.available_credentials_names)
+    targets = []
+    for name_or_dir in names_or_dirs:
+        if os.path.isdir(name_or_dir):
+            aws_credentials_dir = os.path.abspath(name_or_dir)
+            name = (aws_credentials_info._get_credentials_names_from_dir(aws_credentials_dir)
+                    or os.path.basename(aws_credentials_dir))
+        else:
+            name = name_or_dir
+            aws_credentials_dir = aws_credentials_info.get_credentials_dir(name)
+        targets.append(FanOutTarget(name, aws_credentials_dir))
+    return targets
+
+
+def _as_rows(value) -> list:
+    if value is None:
+        return []
+    elif isinstance(value, dict):
+        return [value]
+    elif isinstance(value, (str, bytes, int, float, bool)):
+        # E.g. a command outputting just a JSON number or string is a single row.
+        return [{"value": value}]
+    return [row if isinstance(row, dict) else {"value": row} for row in value]
+
+
+def run_fan_out_target(target: FanOutTarget, task: Callable) -> FanOutResult:
+    """
+    Runs the given task against the given target, within its own explicit session AwsContext, capturing
+    its rows (or error) and timing. The task is called with the Aws object and established Credentials,
+    and should return a dictionary, or a list of dictionaries, representing its (structured) results.
+
+    :param target: FanOutTarget to run against.
+    :param task: Callable taking (aws, credentials) and returning a dictionary or list of dictionaries.
+    :return: FanOutResult
+    """
+    result = FanOutResult(target)
+    started = time.time()
+    try:
+        aws = Aws(target.aws_credentials_dir)
+        with aws.establish_credentials() as credentials:
+            result.account_number = credentials.account_number
+            result.rows = _as_rows(task(aws, credentials))
+    except Exception as e:
+        result.error = get_exception_string(e)
+    result.duration = time.time() - started
+    return result
+
+
+def fan_out(targets: List[FanOutTarget], task: Callable, max_workers: int = 8) -> List[FanOutResult]:
+    """
+    Runs the given task against each of the given targets concurrently (see run_fan_out_target).
+    Since each target uses its own explicit boto3 session, and NOT the environment, the
+    targets are isolated from one another. Errors are captured per target, not raised.
+
+    :param targets: List of FanOutTarget objects.
+    :param task: Callable taking (aws, credentials) and returning a dictionary or list of dictionaries.
+    :param max_workers: Maximum number of targets to run at once.
+    :return: List of FanOutResult objects, in the same order as the given targets.
+    """
+    if not targets:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as executor:
+        return list(executor.map(lambda target: run_fan_out_target(target, task), targets))
+
+
+def command_task(command: List[str], timeout: Optional[float] = None) -> Callable:
+    """
+    Returns a fan-out task which runs the given (e.g. existing maintenance) command in a subprocess, with an
+    environment pointing only at the target's AWS credentials and config files, so that commands which use
+    the default boto3 session are isolated too. If the command outputs JSON (a dictionary or list of them)
+    those are the rows (any other JSON value is a single row of it); otherwise the row is the exit code and
+    the last line of output.
+
+    :param command: Command and arguments to run.
+    :param timeout: Maximum seconds to allow the command to run.
+    :return: Callable suitable to pass to fan_out.
+    """
+    def task(aws, credentials) -> list:
+        environ = {key: value for key, value in os.environ.items() if not key.startswith("AWS_")}
+        environ["AWS_SHARED_CREDENTIALS_FILE"] = os.path.join(credentials.credentials_dir, "credentials")
+        environ["AWS_CONFIG_FILE"] = os.path.join(credentials.credentials_dir, "config")
+        if credentials.region:
+            environ["AWS_DEFAULT_REGION"] = credentials.region
+        completed = subprocess.run(command, env=environ, capture_output=True, text=True, timeout=timeout)
+        if completed.returncode != 0:
+            output = (completed.stderr or completed.stdout).strip().splitlines()
+            raise Exception(f"Exit code {completed.returncode}: {output[-1] if output else ''}")
+        try:
+            return _as_rows(json.loads(completed.stdout))
+        except ValueError:
+            output = completed.stdout.strip().splitlines()
+            return {"exit_code": completed.returncode, "output": output[-1] if output else ""}
+    return task
+
+
+def merge_fan_out_results(results: List[FanOutResult]) -> (list, list):
+    """
+    Merges the rows of the given fan-out results into a single table, each row prefixed with its
+    target name, account number, duration, and error (if any); a failed target has a single row.
+
+    :param results: List of FanOutResult objects.
+    :return: Tuple of the list of column names and the list of rows (lists of values).
+    """
+    columns = []
+    for result in results:
+        for row in result.rows:
+            columns.extend(column for column in row if column not in columns)
+    header = ["name", "account", "seconds", "error"]
+    merged_rows = []
+    for result in results:
+        prefix = [result.target.name, result.account_number or "", f"{result.duration:.2f}", result.error or ""]
+        for row in result.rows or [{}]:
+            merged_rows.append(prefix + [row.get(column, "") for column in columns])
+    return header + columns, merged_rows
+
+
+def print_fan_out_results(results: List[FanOutResult], elapsed: float) -> None:
+    """
+    Prints the merged table of the given fan-out results (see merge_fan_out_results) and a summary line.
+
+    :param results: List of FanOutResult objects.
+    :param elapsed: Total (wall clock) seconds taken by the fan-out.
+    """
+    columns, rows = merge_fan_out_results(results)
+    table = PrettyTable()
+    table.field_names = columns
+    table.align = "l"
+    for row in rows:
+        table.add_row(row)
+    PRINT(table)
+    errors = sum(1 for result in results if result.error)
+    PRINT(f"Ran against {len(results)} target(s) in {elapsed:.2f}s"
+          f" (sequentially would be about {sum(result.duration for result in results):.2f}s); {errors} error(s).")
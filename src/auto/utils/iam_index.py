@@ -0,0 +1,176 @@
+# Module/class (IamIndex) for an in-memory index of the AWS IAM users, roles, managed policies,
+# and user access keys in an account, built with a single (paginated) get_account_authorization_details
+# listing, and queried by (regular expression) pattern, prefix, or tags without any further AWS calls;
+# except for the user access keys, listed per user when first needed.
+
+import bisect
+import concurrent.futures
+import re
+import threading
+from typing import Optional
+
+
+class IamIndex:
+    """
+    In-memory index of the AWS IAM users, roles, (customer) managed policies, and user access keys
+    of an account. Build with IamIndex.build(iam_client); or use Aws.get_iam_index(), which builds
+    this just once per session and shares it among the tools (KMS, secrets, Sentieon, ...) using it.
+
+    Users and roles are the dictionaries returned by get_account_authorization_details (UserDetailList
+    and RoleDetailList), with the user access keys (from list_access_keys, done for a user when its access
+    keys are first needed) added as AccessKeyMetadata.
+    Queries return these in the order listed by AWS. Usage like this:
+
+        iam_index = aws.get_iam_index()
+        iam_index.find_user_names(pattern=".*ApplicationS3Federator")
+        iam_index.find_role_arns(prefix="c4-foursight-", tags={"env": "cgap-supertest"})
+        iam_index.find_access_key_user_name("AKIA...")
+    """
+
+    AUTHORIZATION_DETAILS_FILTER = ["User", "Role", "LocalManagedPolicy"]
+
+    def __init__(self, users: list, roles: list, policies: Optional[list] = None,
+                 iam=None, max_workers: int = 8) -> None:
+        self._users = {user["UserName"]: user for user in users}
+        self._roles = {role["RoleName"]: role for role in roles}
+        self._policies = {policy["Arn"]: policy for policy in policies or []}
+        self._sorted_user_names = sorted(self._users)
+        self._sorted_role_names = sorted(self._roles)
+        self._user_tags = self._index_tags(self._users)
+        self._role_tags = self._index_tags(self._roles)
+        self._iam = iam
+        self._max_workers = max_workers
+        self._access_key_user_names = None
+        self._access_key_user_names_lock = threading.Lock()
+        self._policy_principals = {}
+        for principals in (self._users, self._roles):
+            for name, principal in principals.items():
+                for policy in principal.get("AttachedManagedPolicies") or []:
+                    self._policy_principals.setdefault(policy["PolicyArn"], []).append(principal["Arn"])
+
+    @classmethod
+    def build(cls, iam, include_access_keys: bool = False, max_workers: int = 8) -> "IamIndex":
+        """
+        Builds and returns an IamIndex from the given boto3 IAM client, with a (paginated)
+        get_account_authorization_details listing. The access keys of each user are listed
+        (with list_access_keys) when first needed; or now, for all users concurrently,
+        if include_access_keys is True.
+
+        :param iam: Boto3 IAM client.
+        :param include_access_keys: True to get the access keys of all users now.
+        :param max_workers: Maximum number of concurrent list_access_keys calls.
+        :return: IamIndex object.
+        """
+        users, roles, policies = [], [], []
+        paginator = iam.get_paginator("get_account_authorization_details")
+        for page in paginator.paginate(Filter=cls.AUTHORIZATION_DETAILS_FILTER):
+            users.extend(page.get("UserDetailList") or [])
+            roles.extend(page.get("RoleDetailList") or [])
+            policies.extend(page.get("Policies") or [])
+        iam_index = cls(users, roles, policies, iam=iam, max_workers=max_workers)
+        if include_access_keys:
+            iam_index._load_all_access_keys()
+        return iam_index
+
+    def _load_all_access_keys(self) -> None:
+        user_names = [name for name, user in self._users.items() if "AccessKeyMetadata" not in user]
+        if user_names and self._iam:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self._max_workers,
+                                                                       len(user_names))) as executor:
+                list(executor.map(self.get_access_keys, user_names))
+
+    @staticmethod
+    def _index_tags(principals: dict) -> dict:
+        tags = {}
+        for name, principal in principals.items():
+            for tag in principal.get("Tags") or []:
+                tags.setdefault((tag["Key"], tag["Value"]), set()).add(name)
+        return tags
+
+    @staticmethod
+    def _find(principals: dict, sorted_names: list, tag_index: dict,
+              pattern: Optional[str], arn_pattern: Optional[str], prefix: Optional[str], tags: Optional[dict]) -> list:
+        if prefix is not None:
+            # Names with the prefix are contiguous within the sorted names.
+            start = bisect.bisect_left(sorted_names, prefix)
+            end = start
+            while end < len(sorted_names) and sorted_names[end].startswith(prefix):
+                end += 1
+            names = set(sorted_names[start:end])
+        else:
+            names = None
+        for tag in (tags or {}).items():
+            tagged_names = tag_index.get(tag, set())
+            names = tagged_names if names is None else names & tagged_names
+        pattern = re.compile(pattern) if pattern else None
+        arn_pattern = re.compile(arn_pattern) if arn_pattern else None
+        return [principal for name, principal in principals.items()
+                if (names is None or name in names)
+                and (not pattern or pattern.match(name))
+                and (not arn_pattern or arn_pattern.match(principal["Arn"]))]
+
+    def find_users(self, pattern: Optional[str] = None, arn_pattern: Optional[str] = None,
+                   prefix: Optional[str] = None, tags: Optional[dict] = None) -> list:
+        """
+        Returns the users whose names match the given regular expression pattern, whose ARNs match the
+        given regular expression arn_pattern, whose names start with the given prefix, and which have
+        all of the given tags (dictionary of tag keys/values); any of which may be omitted.
+
+        :return: List of matching users (dictionaries, from get_account_authorization_details).
+        """
+        return self._find(self._users, self._sorted_user_names, self._user_tags, pattern, arn_pattern, prefix, tags)
+
+    def find_roles(self, pattern: Optional[str] = None, arn_pattern: Optional[str] = None,
+                   prefix: Optional[str] = None, tags: Optional[dict] = None) -> list:
+        """
+        Returns the roles matching the given criteria; see find_users.
+
+        :return: List of matching roles (dictionaries, from get_account_authorization_details).
+        """
+        return self._find(self._roles, self._sorted_role_names, self._role_tags, pattern, arn_pattern, prefix, tags)
+
+    def find_user_names(self, **kwargs) -> list:
+        return [user["UserName"] for user in self.find_users(**kwargs)]
+
+    def find_role_arns(self, **kwargs) -> list:
+        return [role["Arn"] for role in self.find_roles(**kwargs)]
+
+    def get_user(self, user_name: str) -> Optional[dict]:
+        return self._users.get(user_name)
+
+    def get_role(self, role_name: str) -> Optional[dict]:
+        return self._roles.get(role_name)
+
+    def get_policy(self, policy_arn: str) -> Optional[dict]:
+        return self._policies.get(policy_arn)
+
+    def get_access_keys(self, user_name: str) -> list:
+        """
+        Returns the access keys (AccessKeyMetadata, from list_access_keys) of the given user; empty if none.
+        Listed (with list_access_keys) for the user when first needed.
+        """
+        user = self._users.get(user_name)
+        if user is None:
+            return []
+        if "AccessKeyMetadata" not in user and self._iam:
+            access_keys = self._iam.list_access_keys(UserName=user_name)["AccessKeyMetadata"]
+            user.setdefault("AccessKeyMetadata", access_keys)
+        return user.get("AccessKeyMetadata") or []
+
+    def find_access_key_user_name(self, access_key_id: str) -> Optional[str]:
+        """
+        Returns the name of the user owning the given access key ID, or None if not found.
+        The first call lists the access keys of all users (not yet listed) concurrently.
+        """
+        with self._access_key_user_names_lock:
+            if self._access_key_user_names is None:
+                self._load_all_access_keys()
+                self._access_key_user_names = {access_key["AccessKeyId"]: name
+                                               for name in self._users for access_key in self.get_access_keys(name)}
+        return self._access_key_user_names.get(access_key_id)
+
+    def find_policy_principal_arns(self, policy_arn: str) -> list:
+        """
+        Returns the ARNs of the users and roles to which the given managed policy ARN is attached.
+        """
+        return list(self._policy_principals.get(policy_arn, []))
@@ -0,0 +1,174 @@
+# Module to reconcile the policies of any number of AWS KMS keys with the principals desired for
+# their statements (identified by statement ID, i.e. Sid, pattern); the key policies are read
+# concurrently, and only those keys whose (canonicalized) policy actually differs are updated.
+
+import concurrent.futures
+import copy
+import json
+import re
+from typing import List, Optional
+from dcicutils.misc_utils import PRINT
+from .aws import Aws
+from .misc_utils import get_exception_string
+
+
+class KmsKeyPolicyChange:
+    """
+    The (current) policy for a KMS key, the policy desired for it, and the (JSON-patch-style)
+    differences between them; or the error getting its policy. And once applied, whether the
+    desired policy was put (updated), or the error doing so (update_error).
+    """
+    def __init__(self, key_id: str) -> None:
+        self.key_id = key_id
+        self.policy = None
+        self.desired_policy = None
+        self.diff = []
+        self.error = None
+        self.updated = False
+        self.update_error = None
+
+
+def canonicalize_kms_key_policy(policy: dict) -> dict:
+    """
+    Returns a canonical copy of the given KMS key policy, for comparison, in which lists of plain values
+    (e.g. principals, actions) are sorted and deduplicated, and single principals are made into lists,
+    as AWS treats these as equivalent, e.g. "Principal": {"AWS": "arn"} and "Principal": {"AWS": ["arn"]}.
+    """
+    def canonicalize(value, in_principal: bool = False):
+        if isinstance(value, dict):
+            return {key: canonicalize(item, in_principal=in_principal or key == "Principal")
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            if all(not isinstance(item, (dict, list)) for item in value):
+                return sorted(set(value), key=str)
+            return [canonicalize(item) for item in value]
+        if in_principal and isinstance(value, str) and value != "*":
+            return [value]
+        return value
+    return {key: canonicalize(value) for key, value in policy.items()}
+
+
+def diff_kms_key_policies(policy: dict, desired_policy: dict, path: str = "") -> list:
+    """
+    Returns the JSON-patch-style (RFC 6902) list of operations, i.e. dictionaries with op, path, and value,
+    to get from the given (canonicalized) policy to the given desired (canonicalized) policy.
+    Lists of plain values are treated as sets, so their differences are given as adds and removes.
+    """
+    if isinstance(policy, dict) and isinstance(desired_policy, dict):
+        diff = []
+        for key in policy:
+            if key not in desired_policy:
+                diff.append({"op": "remove", "path": f"{path}/{key}", "value": policy[key]})
+            else:
+                diff.extend(diff_kms_key_policies(policy[key], desired_policy[key], f"{path}/{key}"))
+        for key in desired_policy:
+            if key not in policy:
+                diff.append({"op": "add", "path": f"{path}/{key}", "value": desired_policy[key]})
+        return diff
+    if isinstance(policy, list) and isinstance(desired_policy, list):
+        if all(not isinstance(item, (dict, list)) for item in policy + desired_policy):
+            return ([{"op": "remove", "path": f"{path}/{index}", "value": item}
+                     for index, item in enumerate(policy) if item not in desired_policy] +
+                    [{"op": "add", "path": f"{path}/-", "value": item}
+                     for item in desired_policy if item not in policy])
+        if len(policy) == len(desired_policy):
+            diff = []
+            for index, (item, desired_item) in enumerate(zip(policy, desired_policy)):
+                diff.extend(diff_kms_key_policies(item, desired_item, f"{path}/{index}"))
+            return diff
+    if policy != desired_policy:
+        return [{"op": "replace", "path": path or "/", "value": desired_policy}]
+    return []
+
+
+def get_desired_kms_key_policy(policy: dict, desired_principals: dict) -> Optional[dict]:
+    """
+    Returns a copy of the given KMS key policy with the AWS principals of each of its statements
+    whose statement ID (Sid) matches a pattern in the given desired_principals dictionary including
+    the principals listed there for that pattern; principals already present are kept. Returns None
+    if no statement in the policy matches any of the given patterns.
+
+    :param policy: JSON for a KMS key policy.
+    :param desired_principals: Dictionary of statement ID (Sid) patterns to lists of AWS principal ARNs.
+    :return: Desired KMS key policy or None if no matching statements.
+    """
+    desired_policy = copy.deepcopy(policy)
+    matched = False
+    for statement in desired_policy.get("Statement") or []:
+        for sid_pattern, principals in desired_principals.items():
+            if re.match(sid_pattern, statement.get("Sid") or ""):
+                statement_principals = statement.setdefault("Principal", {}).get("AWS") or []
+                if isinstance(statement_principals, str):
+                    statement_principals = [statement_principals]
+                statement["Principal"]["AWS"] = sorted(set(statement_principals) | set(principals))
+                matched = True
+    return desired_policy if matched else None
+
+
+def plan_kms_key_policy_changes(aws: Aws, key_ids: List[str], desired_principals: dict,
+                                max_workers: int = 8) -> List[KmsKeyPolicyChange]:
+    """
+    Gets the policies of the given KMS key IDs, concurrently, and returns, for each of these which has a
+    statement matching any of the statement ID patterns in the given desired_principals dictionary (see
+    get_desired_kms_key_policy), a KmsKeyPolicyChange with its current and desired policies and their
+    differences (empty if no update is needed); or with the error getting its policy.
+
+    :return: List of KmsKeyPolicyChange objects, in the order of the given key IDs.
+    """
+    def plan(key_id: str) -> Optional[KmsKeyPolicyChange]:
+        change = KmsKeyPolicyChange(key_id)
+        try:
+            change.policy = aws.get_kms_key_policy(key_id)
+        except Exception as e:
+            change.error = get_exception_string(e)
+            return change
+        change.desired_policy = get_desired_kms_key_policy(change.policy, desired_principals)
+        if not change.desired_policy:
+            return None
+        change.diff = diff_kms_key_policies(canonicalize_kms_key_policy(change.policy),
+                                            canonicalize_kms_key_policy(change.desired_policy))
+        return change
+
+    if not key_ids:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(key_ids))) as executor:
+        return [change for change in executor.map(plan, key_ids) if change]
+
+
+def apply_kms_key_policy_changes(aws: Aws, changes: List[KmsKeyPolicyChange], max_workers: int = 8) -> list:
+    """
+    Updates (puts) the desired policy for each of the given KMS key policy changes which has
+    differences, concurrently; keys whose policy would not change are not touched at all.
+    Sets updated (or update_error) for each of these changes accordingly; a failure to
+    update one key does not stop the others being updated.
+
+    :return: List of the KmsKeyPolicyChange objects to be applied (whether or not successfully).
+    """
+    def apply(change: KmsKeyPolicyChange) -> None:
+        try:
+            aws.update_kms_key_policy(change.key_id, change.desired_policy)
+            change.updated = True
+        except Exception as e:
+            change.update_error = get_exception_string(e)
+
+    changes = [change for change in changes if change.diff and not change.error]
+    if changes:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(changes))) as executor:
+            list(executor.map(apply, changes))
+    return changes
+
+
+def print_kms_key_policy_changes(changes: List[KmsKeyPolicyChange]) -> None:
+    """
+    Prints the (JSON-patch-style) differences for each of the given KMS key policy changes.
+    """
+    for change in changes:
+        if change.error:
+            PRINT(f"ERROR: Cannot get policy for KMS key (skipping): {change.key_id}")
+            PRINT(f"       {change.error}")
+        elif change.diff:
+            PRINT(f"KMS key policy changes for: {change.key_id}")
+            for operation in change.diff:
+                PRINT(f"  {json.dumps(operation)}")
+        else:
+            PRINT(f"KMS key policy already up to date: {change.key_id}")
@@ -0,0 +1,251 @@
+# Module/class (SecretsCache) for a read-through cache of AWS secrets manager secret values, shared by
+# everything using the same AWS credentials within a process (see Aws.get_secrets_cache); several secrets
+# needed at once are fetched with a single batch_get_secret_value call, and the cached values are kept
+# (by secret ARN/name and VersionId) for a short time, after which describe_secret is used to check they
+# are still current (which, unlike getting the value, needs no decryption) before fetching them again.
+
+import concurrent.futures
+import threading
+import time
+from typing import Callable, List, Optional
+from dcicutils.misc_utils import PRINT
+from prettytable import PrettyTable
+
+
+class SecretsCache:
+    """
+    Read-through cache of AWS secrets manager secret values. Usage like this:
+
+        secrets_cache = aws.get_secrets_cache()
+        secrets_cache.get_entries(["C4DatastoreCgapSupertestApplicationConfiguration", "C4DatastoreRDSSecret"])
+        secrets_cache.get_entry("C4DatastoreCgapSupertestApplicationConfiguration").secret_string
+        secrets_cache.print_report()
+
+    Secret values are cached for ttl_seconds; after that, if revalidate is True, the cached value is used
+    (for another ttl_seconds) if describe_secret says its VersionId is still the current (AWSCURRENT) one,
+    otherwise it is fetched again. Concurrent callers for the same secret wait for a single fetch.
+    Failures (e.g. secret not found) are not cached.
+    """
+
+    class Entry:
+        def __init__(self, secret_id: str, secret_value: dict) -> None:
+            self.secret_id = secret_id
+            self.arn = secret_value.get("ARN")
+            self.name = secret_value.get("Name")
+            self.version_id = secret_value.get("VersionId")
+            self.secret_string = secret_value.get("SecretString")
+            self.fetched = time.monotonic()
+
+        @property
+        def keys(self) -> list:
+            return [key for key in dict.fromkeys([self.secret_id, self.arn, self.name]) if key]
+
+    # The maximum number of secrets AWS allows in a single batch_get_secret_value SecretIdList.
+    BATCH_SIZE = 20
+
+    def __init__(self, secrets_manager, ttl_seconds: float = 60, revalidate: bool = True,
+                 max_workers: int = 8) -> None:
+        """
+        :param secrets_manager: Boto3 secrets manager client.
+        :param ttl_seconds: Number of seconds for which cached secret values are used without checking.
+        :param revalidate: True to check (with describe_secret) if expired secret values are still current.
+        :param max_workers: Maximum number of concurrent get_secret_value calls, if not batched.
+        """
+        self._secrets_manager = secrets_manager
+        self._ttl_seconds = ttl_seconds
+        self._revalidate = revalidate
+        self._max_workers = max_workers
+        self._entries = {}
+        self._fetching = {}
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @property
+    def calls(self) -> dict:
+        """
+        Returns a dictionary of the number of AWS calls made by this cache, by AWS operation name.
+        """
+        with self._lock:
+            return {operation: len(latencies) for operation, latencies in self._latencies.items()}
+
+    def get_entry(self, secret_id: str) -> "SecretsCache.Entry":
+        """
+        Returns the (cached) entry for the given secret ID (name or ARN), fetching it if not cached;
+        raises the exception (e.g. secret not found) from fetching it if it cannot be fetched.
+        """
+        entries, errors = self._get_entries([secret_id])
+        if secret_id not in entries:
+            raise errors.get(secret_id) or KeyError(secret_id)
+        return entries[secret_id]
+
+    def get_entries(self, secret_ids: List[str]) -> dict:
+        """
+        Returns a dictionary of the (cached) entries for the given secret IDs (names or ARNs), by secret ID;
+        those not cached are fetched with a single batch_get_secret_value call (per 20 secrets). Secrets which
+        cannot be fetched (e.g. not found) are omitted.
+        """
+        return self._get_entries(secret_ids)[0]
+
+    def _get_entries(self, secret_ids: List[str]) -> (dict, dict):
+        entries, errors, waiting, fetching = {}, {}, {}, []
+        for secret_id in dict.fromkeys(secret_ids):
+            entry = self._get_cached_entry(secret_id)
+            with self._lock:
+                if entry:
+                    self.hits += 1
+                    entries[secret_id] = entry
+                elif secret_id in self._fetching:
+                    # Being fetched by another caller; wait for that.
+                    self.hits += 1
+                    waiting[secret_id] = self._fetching[secret_id]
+                else:
+                    self.misses += 1
+                    self._fetching[secret_id] = concurrent.futures.Future()
+                    fetching.append(secret_id)
+        if fetching:
+            fetched, errors = self._fetch(fetching)
+            with self._lock:
+                for secret_id in fetching:
+                    future = self._fetching.pop(secret_id)
+                    entry = fetched.get(secret_id)
+                    if entry:
+                        for key in entry.keys:
+                            self._entries[key] = entry
+                        entries[secret_id] = entry
+                        future.set_result(entry)
+                    else:
+                        errors.setdefault(secret_id, KeyError(secret_id))
+                        future.set_exception(errors[secret_id])
+        for secret_id, future in waiting.items():
+            try:
+                entries[secret_id] = future.result()
+            except Exception as e:
+                errors[secret_id] = e
+        return entries, errors
+
+    def _get_cached_entry(self, secret_id: str) -> Optional["SecretsCache.Entry"]:
+        with self._lock:
+            entry = self._entries.get(secret_id)
+        if not entry:
+            return None
+        if time.monotonic() - entry.fetched < self._ttl_seconds:
+            return entry
+        if self._revalidate and self.is_fresh(secret_id):
+            return entry
+        self.invalidate(secret_id)
+        return None
+
+    def is_fresh(self, secret_id: str) -> bool:
+        """
+        Returns True if the cached value for the given secret ID is (still) its current (AWSCURRENT)
+        version, according to describe_secret, in which case it is used for another ttl_seconds;
+        otherwise (or if not cached) returns False.
+        """
+        with self._lock:
+            entry = self._entries.get(secret_id)
+        if not entry or not entry.version_id:
+            return False
+        with self._lock:
+            self.revalidations += 1
+        try:
+            secret = self._call("describe_secret", self._secrets_manager.describe_secret,
+                                SecretId=entry.arn or secret_id)
+        except Exception:
+            return False
+        stages = (secret.get("VersionIdsToStages") or {}).get(entry.version_id) or []
+        if "AWSCURRENT" not in stages:
+            return False
+        entry.fetched = time.monotonic()
+        return True
+
+    def invalidate(self, secret_id: Optional[str] = None) -> None:
+        """
+        Removes the given secret ID (e.g. after updating it) from this cache; or all secrets if None.
+        """
+        with self._lock:
+            if secret_id is None:
+                self._entries.clear()
+            else:
+                entry = self._entries.get(secret_id)
+                for key in entry.keys if entry else [secret_id]:
+                    self._entries.pop(key, None)
+
+    def _fetch(self, secret_ids: List[str]) -> (dict, dict):
+        """
+        Fetches the given secret IDs, batched where more than one, and returns a tuple containing a dictionary
+        of the fetched entries and a dictionary of the exceptions for those not fetched, both by secret ID.
+        If batch_get_secret_value is not available (or not permitted) falls back to getting each separately.
+        """
+        entries, errors = {}, {}
+        batch_get_secret_value = getattr(self._secrets_manager, "batch_get_secret_value", None)
+        if len(secret_ids) == 1 or not batch_get_secret_value:
+            unbatched = list(secret_ids)
+            batches = []
+        else:
+            unbatched = []
+            batches = [secret_ids[index:index + self.BATCH_SIZE]
+                       for index in range(0, len(secret_ids), self.BATCH_SIZE)]
+        for batch in batches:
+            try:
+                kwargs = {"SecretIdList": batch}
+                while True:
+                    response = self._call("batch_get_secret_value", batch_get_secret_value, **kwargs)
+                    for secret_value in response.get("SecretValues") or []:
+                        for secret_id in batch:
+                            if secret_id in (secret_value.get("Name"), secret_value.get("ARN")):
+                                entries[secret_id] = SecretsCache.Entry(secret_id, secret_value)
+                    for error in response.get("Errors") or []:
+                        errors[error.get("SecretId")] = KeyError(f"{error.get('SecretId')}: {error.get('ErrorCode')}"
+                                                                 f" {error.get('Message') or ''}".strip())
+                    if not response.get("NextToken"):
+                        break
+                    kwargs["NextToken"] = response["NextToken"]
+            except Exception:
+                unbatched.extend(secret_id for secret_id in batch if secret_id not in entries)
+
+        def fetch(secret_id: str) -> None:
+            try:
+                secret_value = self._call("get_secret_value", self._secrets_manager.get_secret_value,
+                                          SecretId=secret_id)
+                entries[secret_id] = SecretsCache.Entry(secret_id, secret_value)
+            except Exception as e:
+                errors[secret_id] = e
+
+        if unbatched:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self._max_workers,
+                                                                       len(unbatched))) as executor:
+                list(executor.map(fetch, unbatched))
+        return entries, errors
+
+    def _call(self, operation: str, function: Callable, **kwargs) -> dict:
+        started = time.time()
+        try:
+            return function(**kwargs)
+        finally:
+            with self._lock:
+                self._latencies.setdefault(operation, []).append(time.time() - started)
+
+    def print_report(self) -> None:
+        """
+        Prints a table of the AWS calls made by this cache, with their counts and latencies, and its hit rate.
+        """
+        table = PrettyTable()
+        table.field_names = ["Secrets Manager Call", "Count", "Total Seconds", "Average Seconds", "Max Seconds"]
+        table.align = "l"
+        with self._lock:
+            latencies = {operation: list(latencies) for operation, latencies in self._latencies.items()}
+        for operation, operation_latencies in sorted(latencies.items()):
+            table.add_row([operation, len(operation_latencies), f"{sum(operation_latencies):.3f}",
+                           f"{sum(operation_latencies) / len(operation_latencies):.3f}",
+                           f"{max(operation_latencies):.3f}"])
+        PRINT(table)
+        PRINT(f"Secrets cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate),"
+              f" {self.revalidations} revalidations.")
@@ -0,0 +1,177 @@
+# Module to reconcile the rules of any AWS security group with a desired (declarative) set of inbound
+# (ingress) and outbound (egress) rules. The existing rules are read once (describe_security_group_rules),
+# the minimal sets of rules to add and to revoke are computed, and these are applied with (at most) a
+# single batched revoke and a single batched authorize call per direction.
+
+from typing import List, Optional
+from dcicutils.misc_utils import PRINT
+from .aws import Aws
+
+
+# Keys of the (single) peer, i.e. source or destination, of a rule as returned by describe_security_group_rules.
+_SECURITY_GROUP_RULE_PEER_KEYS = ["CidrIpv4", "CidrIpv6", "ReferencedGroupId", "PrefixListId"]
+
+
+class SecurityGroupChanges:
+    """
+    The rules to add to, and to revoke from, an AWS security group, to reconcile it with its desired rules.
+    The rules to add are (flattened) rules as from flatten_ip_permissions; and the rules to revoke are
+    existing rules as returned by describe_security_group_rules (so have a SecurityGroupRuleId).
+    """
+    def __init__(self, security_group_id: str) -> None:
+        self.security_group_id = security_group_id
+        self.rules_to_add = []
+        self.rules_to_revoke = []
+        self.rules_unchanged = []
+
+    def __bool__(self) -> bool:
+        return bool(self.rules_to_add or self.rules_to_revoke)
+
+
+def flatten_ip_permissions(ip_permissions: list, outbound: bool) -> list:
+    """
+    Returns the given AWS security group rules, in the (IpPermissions) form passed to the boto3 ec2
+    authorize_security_group_{ingress/egress} functions, each of which may have any number of peers
+    (IpRanges, Ipv6Ranges, UserIdGroupPairs, PrefixListIds), as a list of rules in the (flat) form returned
+    by the boto3 ec2 describe_security_group_rules function, i.e. one per peer, with CidrIpv4 et cetera.
+
+    :param ip_permissions: List of AWS security group rules (as IpPermissions).
+    :param outbound: True if outbound (egress) rules, otherwise inbound (ingress).
+    :return: List of (flat) AWS security group rules.
+    """
+    rules = []
+    for ip_permission in ip_permissions or []:
+        peers = [(peer_key, peer.get(peer_value_key), peer)
+                 for peers_key, peer_key, peer_value_key in (("IpRanges", "CidrIpv4", "CidrIp"),
+                                                             ("Ipv6Ranges", "CidrIpv6", "CidrIpv6"),
+                                                             ("UserIdGroupPairs", "ReferencedGroupId", "GroupId"),
+                                                             ("PrefixListIds", "PrefixListId", "PrefixListId"))
+                 for peer in ip_permission.get(peers_key) or []]
+        for peer_key, peer_value, peer in peers:
+            rules.append({
+                "IsEgress": outbound,
+                "IpProtocol": ip_permission.get("IpProtocol"),
+                "FromPort": ip_permission.get("FromPort"),
+                "ToPort": ip_permission.get("ToPort"),
+                peer_key: peer_value,
+                "Description": peer.get("Description") or ""
+            })
+    return rules
+
+
+def get_security_group_rule_key(rule: dict) -> tuple:
+    """
+    Returns a (hashable) key identifying the given (flat) AWS security group rule, i.e. its direction,
+    protocol, ports, and peer; but not its description, as AWS considers rules differing only by that
+    duplicates. All protocols (-1) means all ports, however (or whether) these were given.
+    """
+    ip_protocol = str(rule.get("IpProtocol")).lower()
+    if ip_protocol == "-1":
+        from_port, to_port = -1, -1
+    else:
+        from_port, to_port = rule.get("FromPort"), rule.get("ToPort")
+    referenced_group_id = rule.get("ReferencedGroupId") or (rule.get("ReferencedGroupInfo") or {}).get("GroupId")
+    peer = tuple(referenced_group_id if key == "ReferencedGroupId" else rule.get(key)
+                 for key in _SECURITY_GROUP_RULE_PEER_KEYS)
+    return bool(rule.get("IsEgress")), ip_protocol, from_port, to_port, peer
+
+
+def to_ip_permission(rule: dict) -> dict:
+    """
+    Returns the given (flat) AWS security group rule in the (IpPermissions) form passed
+    to the boto3 ec2 authorize_security_group_{ingress/egress} functions.
+    """
+    ip_permission = {key: rule[key] for key in ("IpProtocol", "FromPort", "ToPort") if rule.get(key) is not None}
+    description = {"Description": rule["Description"]} if rule.get("Description") else {}
+    if rule.get("CidrIpv4"):
+        ip_permission["IpRanges"] = [dict(CidrIp=rule["CidrIpv4"], **description)]
+    elif rule.get("CidrIpv6"):
+        ip_permission["Ipv6Ranges"] = [dict(CidrIpv6=rule["CidrIpv6"], **description)]
+    elif rule.get("ReferencedGroupId"):
+        ip_permission["UserIdGroupPairs"] = [dict(GroupId=rule["ReferencedGroupId"], **description)]
+    elif rule.get("PrefixListId"):
+        ip_permission["PrefixListIds"] = [dict(PrefixListId=rule["PrefixListId"], **description)]
+    return ip_permission
+
+
+def plan_security_group_changes(security_group_id: str,
+                                existing_rules: Optional[list],
+                                inbound_ip_permissions: Optional[list],
+                                outbound_ip_permissions: Optional[list],
+                                prune: bool = False,
+                                replace_changed_descriptions: bool = False) -> SecurityGroupChanges:
+    """
+    Returns the minimal changes (SecurityGroupChanges) needed to reconcile the given existing rules of the given
+    AWS security group (as returned by describe_security_group_rules) with the given desired inbound and outbound
+    rules (as IpPermissions). Desired rules which do not exist are added. If prune is True, existing rules which
+    are not desired are revoked; only in the direction(s) for which desired rules are given (i.e. not None).
+    If replace_changed_descriptions is True, existing rules whose description differs from the desired rule's
+    are revoked and added again (with the desired description); otherwise these are left as they are.
+
+    :return: SecurityGroupChanges object containing the rules to add and to revoke.
+    """
+    changes = SecurityGroupChanges(security_group_id)
+    desired_rules = {}
+    for ip_permissions, outbound in ((inbound_ip_permissions, False), (outbound_ip_permissions, True)):
+        for rule in flatten_ip_permissions(ip_permissions, outbound):
+            desired_rules.setdefault(get_security_group_rule_key(rule), rule)
+    pruned_directions = set()
+    if prune:
+        if inbound_ip_permissions is not None:
+            pruned_directions.add(False)
+        if outbound_ip_permissions is not None:
+            pruned_directions.add(True)
+    existing_keys = set()
+    for existing_rule in existing_rules or []:
+        key = get_security_group_rule_key(existing_rule)
+        desired_rule = desired_rules.get(key)
+        if desired_rule is None or key in existing_keys:
+            if bool(existing_rule.get("IsEgress")) in pruned_directions:
+                changes.rules_to_revoke.append(existing_rule)
+            continue
+        existing_keys.add(key)
+        if replace_changed_descriptions and \
+                (existing_rule.get("Description") or "") != (desired_rule.get("Description") or ""):
+            changes.rules_to_revoke.append(existing_rule)
+            changes.rules_to_add.append(desired_rule)
+        else:
+            changes.rules_unchanged.append(existing_rule)
+    changes.rules_to_add.extend(rule for key, rule in desired_rules.items() if key not in existing_keys)
+    return changes
+
+
+def apply_security_group_changes(aws: Aws, changes: SecurityGroupChanges) -> List[str]:
+    """
+    Applies the given security group changes, with (at most) a single batched revoke call, and then a single
+    batched authorize call, per direction (inbound/outbound); revoking first so replaced rules can be re-added.
+
+    :return: List of the security group rule IDs of the newly created rules.
+    """
+    created_rule_ids = []
+    for outbound in (False, True):
+        rule_ids = [rule["SecurityGroupRuleId"]
+                    for rule in changes.rules_to_revoke if bool(rule.get("IsEgress")) == outbound]
+        if rule_ids:
+            aws.revoke_security_group_rules(changes.security_group_id, rule_ids, outbound)
+    for outbound in (False, True):
+        ip_permissions = [to_ip_permission(rule)
+                          for rule in changes.rules_to_add if bool(rule.get("IsEgress")) == outbound]
+        if ip_permissions:
+            created_rule_ids.extend(aws.authorize_security_group_rules(changes.security_group_id,
+                                                                       ip_permissions, outbound))
+    return created_rule_ids
+
+
+def print_security_group_changes(changes: SecurityGroupChanges) -> None:
+    """
+    Prints the given security group changes, i.e. the rules to revoke, to add, and those unchanged.
+    """
+    def print_rules(rules: list, action: str) -> None:
+        for rule in rules:
+            direction = "Outbound" if rule.get("IsEgress") else "Inbound"
+            rule_id = f" ({rule['SecurityGroupRuleId']})" if rule.get("SecurityGroupRuleId") else ""
+            PRINT(f"{direction} security group ({changes.security_group_id}) rule{rule_id} {action}:"
+                  f" {Aws.get_security_group_rule_display_value(rule)}")
+    print_rules(changes.rules_unchanged, "already exists -> No action")
+    print_rules(changes.rules_to_revoke, "to revoke")
+    print_rules(changes.rules_to_add, "to add")
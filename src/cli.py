@@ -10,6 +10,8 @@ import tempfile
 from dcicutils.misc_utils import ignored, PRINT  # , file_contents, override_environ
 from .constants import Settings
 from .info.aws_util import AWSUtil
+from .info.dedupe_analyzer import DuplicateContentAnalyzer
+from .info.storage_analytics import StorageDistributionAnalyzer
 from .base import lookup_stack_creator, ConfigManager
 from .exceptions import CLIException
 from .part import C4Account
@@ -379,6 +381,8 @@ class C4Client:
         upload = args.upload
         versioned = args.versioned
         s3 = args.s3
+        dedupe = args.dedupe
+        distribution = args.distribution
 
         aws_util = AWSUtil()
         if upload and versioned:
@@ -390,6 +394,16 @@ class C4Client:
         if s3:
             logger.info('Generating s3 buckets info summary tsv at {}...'.format(aws_util.BUCKET_SUMMARY_FILENAME))
             aws_util.generate_s3_bucket_summary_tsv(dry_run=False)
+        if dedupe:
+            analyzer = DuplicateContentAnalyzer(aws_util=aws_util)
+            for bucket in dedupe:
+                logger.info('Generating duplicate content tsv for {}...'.format(bucket))
+                analyzer.generate_duplicate_content_tsv(bucket, prefix=args.prefix)
+        if distribution:
+            for bucket in distribution:
+                logger.info('Generating size/age distribution and transition savings tsvs for {}...'.format(bucket))
+                analyzer = StorageDistributionAnalyzer(aws_util=aws_util)
+                analyzer.generate_storage_distribution_tsvs(bucket, prefix=args.prefix, inventory_files=args.inventory)
 
 
 def cli():
@@ -473,6 +487,14 @@ def cli():
     parser_info = subparsers.add_parser('info', help='Generate informational summaries for 4DN accounts')
     parser_info.add_argument('--s3', action='store_true', help='Generate S3 buckets cost summary')
     parser_info.add_argument('--versioned', action='store_true', help='Generate versioned S3 buckets cost summary')
+    parser_info.add_argument('--dedupe', action='append', metavar='BUCKET', default=[],
+                             help='Generate a duplicate content summary for the given bucket (may be repeated)')
+    parser_info.add_argument('--distribution', action='append', metavar='BUCKET', default=[],
+                             help='Generate object size/age histograms and lifecycle transition savings for the given'
+                                  ' bucket (may be repeated)')
+    parser_info.add_argument('--inventory', action='append', metavar='FILE', default=[],
+                             help='Read --distribution objects from these S3 Inventory CSV files instead of listing')
+    parser_info.add_argument('--prefix', default=None, help='Restrict per-bucket summaries to this key prefix')
     # TODO add summaries of other aws info types
     parser_info.add_argument('--all', action='store_true', help='Generate all cost summary spreadsheets')
     parser_info.add_argument('--upload', action='store_true', help='Upload spreadsheets to Google Sheets')
@@ -0,0 +1,295 @@
+import argparse
+import boto3
+import concurrent.futures
+import json
+import random
+import time
+
+from typing import Dict, List, Optional, Tuple
+from botocore.exceptions import ClientError
+from dcicutils import ff_utils
+from dcicutils.misc_utils import PRINT
+from ..exceptions import FileObjectCopyError
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_PART_WORKERS = 32
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 1.0
+TRANSIENT_ERROR_CODES = ('SlowDown', 'InternalError', 'ServiceUnavailable', 'RequestTimeout', 'Throttling', '500',
+                         '503')
+# the metadata entry of a copy recording the ETag of its source, by which a copy can be known to be done
+SOURCE_ETAG_METADATA = 'source-etag'
+# the (S3 additional) checksum algorithm of the copies, by which they are verified against their sources
+CHECKSUM_ALGORITHM = 'SHA256'
+CHECKSUM_FIELD = 'ChecksumSHA256'
+# the most parts get_object_attributes lists at once
+MAX_LISTED_PARTS = 1000
+# headers that a copy replacing the metadata of its source (or a multipart copy) must carry over itself
+PRESERVED_HEAD_FIELDS = ('ContentType', 'ContentEncoding', 'ContentDisposition', 'ContentLanguage', 'CacheControl')
+# the health page entries naming the bucket of the file items of each type
+FILE_BUCKET_HEALTH_ENTRIES = {'file_fastq': 'file_upload_bucket', 'file_processed': 'processed_file_bucket'}
+
+
+class CopyStatus:
+    COPIED = 'copied'
+    UNVERIFIED = 'copied, not verified'
+    ALREADY_COPIED = 'already copied'
+    FAILED = 'failed'
+
+
+def with_retries(fn, *args, **kwargs):
+    """ Calls the given s3 client method, retrying transient failures with (jittered, exponential) backoff """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return fn(*args, **kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code', '')
+            if attempt == MAX_ATTEMPTS or not code.startswith(TRANSIENT_ERROR_CODES):
+                raise
+        time.sleep(BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.0))
+
+
+def resolve_file_objects(files: Dict[str, List[dict]], source_key: dict, destination_key: dict) -> List[Tuple]:
+    """ Returns the (source bucket, key, destination bucket) of the S3 objects of the given file items (by item
+        type, as written by fetch_file_items), i.e. of each file and its extra files, whose key is
+        <uuid>/<accession>.<extension of its file format>; the buckets are those the health pages of the
+        source and destination environments name.
+    """
+    source_health = ff_utils.get_health_page(key=source_key)
+    destination_health = ff_utils.get_health_page(key=destination_key)
+    extensions = {}
+
+    def extension(file_format):
+        if file_format not in extensions:
+            extensions[file_format] = ff_utils.get_metadata(file_format, key=source_key)['standard_file_extension']
+        return extensions[file_format]
+
+    objects = []
+    for item_type, items in files.items():
+        health_entry = FILE_BUCKET_HEALTH_ENTRIES.get(item_type)
+        if not health_entry:
+            PRINT(f'Skipping the {len(items)} {item_type} items, not knowing their bucket.')
+            continue
+        for item in items:
+            for file_format in [item['file_format']] + [extra['file_format'] for extra in item.get('extra_files', [])]:
+                objects.append((source_health[health_entry], f'{item["uuid"]}/{item["accession"]}.'
+                                                             f'{extension(file_format)}',
+                                destination_health[health_entry]))
+    return objects
+
+
+class FileObjectCopier:
+    """ Copies S3 objects between buckets server-side, in parallel: objects uploaded in one go (so of up to 5 GiB)
+        with a copy_object each, objects uploaded in parts in the same parts, copied in parallel (upload_part_copy).
+        Each copy is made with a SHA256 (S3 additional) checksum, and verified by its size and its checksum (of
+        its content, or of its parts' checksums) if its source has one too; else by its ETag (the MD5 of its
+        content, or of its parts' MD5s), unless either is SSE-KMS encrypted (so its ETag is not an MD5), in which
+        case only its size is verified, and it is reported as not verified. Failed requests are retried; a failed
+        multipart copy is left in progress, so that copying it again (skipping objects already copied) resumes
+        it, reusing the parts already copied, unless its source has been modified since it began.
+    """
+
+    def __init__(self, s3, workers: int = DEFAULT_WORKERS, part_workers: int = DEFAULT_PART_WORKERS):
+        self.s3 = s3
+        self.workers = workers
+        self.part_workers = part_workers
+        self.part_executor = None
+
+    def head(self, bucket: str, key: str, part_number: Optional[int] = None) -> Optional[dict]:
+        """ Returns the head, with its checksum (if any), of the given object (or of the given part of it),
+            or None if there is none
+        """
+        try:
+            return with_retries(self.s3.head_object, Bucket=bucket, Key=key, ChecksumMode='ENABLED',
+                                **({'PartNumber': part_number} if part_number else {}))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def list_part_sizes(self, bucket: str, key: str) -> Dict[int, int]:
+        """ Returns the sizes of the parts of the given object by number, as get_object_attributes lists them,
+            i.e. only for objects uploaded with (S3 additional) checksums, and only if permitted
+        """
+        sizes, part_number_marker = {}, 0
+        try:
+            while True:
+                object_parts = with_retries(self.s3.get_object_attributes, Bucket=bucket, Key=key,
+                                            ObjectAttributes=['ObjectParts'], MaxParts=MAX_LISTED_PARTS,
+                                            PartNumberMarker=part_number_marker).get('ObjectParts') or {}
+                sizes.update((part['PartNumber'], part['Size']) for part in object_parts.get('Parts', []))
+                if not object_parts.get('IsTruncated'):
+                    return sizes
+                part_number_marker = object_parts['NextPartNumberMarker']
+        except ClientError as e:
+            PRINT(f'Cannot list the parts of s3://{bucket}/{key}, getting their heads instead: {e}')
+            return {}
+
+    def get_part_sizes(self, bucket: str, key: str, head: dict) -> List[int]:
+        """ Returns the sizes of the parts the given object (with the given head) was uploaded in: as listed
+            (see list_part_sizes), in a request per thousand parts, or else from the heads of the parts, got in
+            parallel
+        """
+        part_numbers = range(1, int(head['ETag'].strip('"').split('-')[1]) + 1)
+        sizes = self.list_part_sizes(bucket, key)
+        if set(sizes) != set(part_numbers):
+            futures = [self.part_executor.submit(self.head, bucket, key, part_number) for part_number in part_numbers]
+            return [future.result()['ContentLength'] for future in futures]
+        return [sizes[part_number] for part_number in part_numbers]
+
+    def find_upload(self, bucket: str, key: str, since) -> Tuple[Optional[str], Dict[int, dict]]:
+        """ Returns the id of a multipart upload of the given key in progress, if any, and its parts by number;
+            uploads begun before the given (last modified) time of the source, so maybe of another version of
+            it, are aborted rather than resumed
+        """
+        uploads = with_retries(self.s3.list_multipart_uploads, Bucket=bucket, Prefix=key).get('Uploads', [])
+        for upload in uploads:
+            if upload['Key'] != key:
+                continue
+            if upload['Initiated'] < since:
+                with_retries(self.s3.abort_multipart_upload, Bucket=bucket, Key=key, UploadId=upload['UploadId'])
+                continue
+            parts = with_retries(self.s3.list_parts, Bucket=bucket, Key=key,
+                                 UploadId=upload['UploadId']).get('Parts', [])
+            return upload['UploadId'], {part['PartNumber']: part for part in parts}
+        return None, {}
+
+    def copy_part(self, source_bucket: str, key: str, bucket: str, upload_id: str, part_number: int, start: int,
+                  size: int, source_etag: str) -> dict:
+        """ Copies the given byte range of the source object as the given part, returning its ETag and checksum """
+        result = with_retries(self.s3.upload_part_copy, Bucket=bucket, Key=key, UploadId=upload_id,
+                              PartNumber=part_number, CopySource={'Bucket': source_bucket, 'Key': key},
+                              CopySourceRange=f'bytes={start}-{start + size - 1}', CopySourceIfMatch=source_etag)
+        return result['CopyPartResult']
+
+    @staticmethod
+    def copy_args(head: dict) -> dict:
+        """ Returns the arguments for a copy of the object with the given head: its headers and metadata,
+            with the ETag of the source in it
+        """
+        args = {field: head[field] for field in PRESERVED_HEAD_FIELDS if head.get(field)}
+        args['Metadata'] = dict(head.get('Metadata') or {}, **{SOURCE_ETAG_METADATA: head['ETag'].strip('"')})
+        return args
+
+    def copy_multipart(self, source_bucket: str, key: str, bucket: str, head: dict) -> None:
+        """ Copies the given object in the same parts it was uploaded in, in parallel, resuming a multipart upload
+            of it in progress (see find_upload), if any.
+        """
+        upload_id, uploaded = self.find_upload(bucket, key, since=head['LastModified'])
+        if not upload_id:
+            upload_id = with_retries(self.s3.create_multipart_upload, Bucket=bucket, Key=key,
+                                     ChecksumAlgorithm=CHECKSUM_ALGORITHM, **self.copy_args(head))['UploadId']
+        parts, futures = {}, {}
+        start = 0
+        for part_number, size in enumerate(self.get_part_sizes(source_bucket, key, head), start=1):
+            if uploaded.get(part_number, {}).get('Size') == size:
+                parts[part_number] = uploaded[part_number]
+            else:
+                futures[part_number] = self.part_executor.submit(self.copy_part, source_bucket, key, bucket,
+                                                                 upload_id, part_number, start, size, head['ETag'])
+            start += size
+        for part_number, future in futures.items():
+            parts[part_number] = future.result()
+        with_retries(self.s3.complete_multipart_upload, Bucket=bucket, Key=key, UploadId=upload_id,
+                     MultipartUpload={'Parts': [dict({'PartNumber': part_number, 'ETag': parts[part_number]['ETag']},
+                                                     **({CHECKSUM_FIELD: parts[part_number][CHECKSUM_FIELD]}
+                                                        if parts[part_number].get(CHECKSUM_FIELD) else {}))
+                                                for part_number in sorted(parts)]})
+
+    def copy(self, source_bucket: str, key: str, bucket: str) -> Tuple[str, int]:
+        """ Copies the given object (see FileObjectCopier), unless already copied, i.e. there is a copy of it
+            of the same size, recording its ETag (see SOURCE_ETAG_METADATA). Returns the status of the copy (which
+            is UNVERIFIED if only its size could be verified) and the bytes copied; raises FileObjectCopyError if
+            the copy does not verify.
+        """
+        head = self.head(source_bucket, key)
+        if head is None:
+            raise FileObjectCopyError(f'No such object s3://{source_bucket}/{key}')
+        size, source_etag = head['ContentLength'], head['ETag'].strip('"')
+        copied = self.head(bucket, key)
+        if (copied and copied['ContentLength'] == size
+                and (copied.get('Metadata') or {}).get(SOURCE_ETAG_METADATA) == source_etag):
+            return CopyStatus.ALREADY_COPIED, 0
+        if '-' in source_etag:
+            self.copy_multipart(source_bucket, key, bucket, head)
+        else:
+            with_retries(self.s3.copy_object, Bucket=bucket, Key=key, MetadataDirective='REPLACE',
+                         CopySource={'Bucket': source_bucket, 'Key': key}, CopySourceIfMatch=head['ETag'],
+                         ChecksumAlgorithm=CHECKSUM_ALGORITHM, **self.copy_args(head))
+        copied = self.head(bucket, key)
+        if not copied or copied['ContentLength'] != size:
+            raise FileObjectCopyError(f'Copy of s3://{source_bucket}/{key} to s3://{bucket}/{key} does not verify'
+                                      f' (size {copied and copied["ContentLength"]}, expected {size})')
+        if head.get(CHECKSUM_FIELD):
+            verified_by, value, expected = (f'{CHECKSUM_ALGORITHM} checksum', copied.get(CHECKSUM_FIELD),
+                                            head[CHECKSUM_FIELD])
+        elif 'aws:kms' not in (head.get('ServerSideEncryption'), copied.get('ServerSideEncryption')):
+            verified_by, value, expected = 'ETag', copied['ETag'], head['ETag']
+        else:
+            # the ETags of SSE-KMS objects are not MD5s of their content, so cannot be compared between objects
+            return CopyStatus.UNVERIFIED, size
+        if value != expected:
+            raise FileObjectCopyError(f'Copy of s3://{source_bucket}/{key} to s3://{bucket}/{key} does not verify'
+                                      f' ({verified_by} {value}, expected {expected})')
+        return CopyStatus.COPIED, size
+
+    def copy_all(self, objects: List[Tuple]) -> Dict[str, int]:
+        """ Copies the given (source bucket, key, destination bucket) objects in parallel, reporting failures.
+            Returns the number of objects by status.
+        """
+        counts = {CopyStatus.COPIED: 0, CopyStatus.UNVERIFIED: 0, CopyStatus.ALREADY_COPIED: 0, CopyStatus.FAILED: 0}
+        copied_bytes = 0
+        started = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.part_workers) as self.part_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.copy, *obj): obj for obj in objects}
+            for future in concurrent.futures.as_completed(futures):
+                source_bucket, key, bucket = futures[future]
+                try:
+                    status, size = future.result()
+                except Exception as e:
+                    status, size = CopyStatus.FAILED, 0
+                    PRINT(f'Failed to copy s3://{source_bucket}/{key} to s3://{bucket}/{key}: {e}')
+                if status == CopyStatus.UNVERIFIED:
+                    PRINT(f'Copied s3://{source_bucket}/{key} to s3://{bucket}/{key} verifying only its size:'
+                          f' its source has no {CHECKSUM_ALGORITHM} checksum, and as SSE-KMS encrypted its ETag'
+                          f' is not the MD5 of its content.')
+                counts[status] += 1
+                copied_bytes += size
+        seconds = time.time() - started
+        PRINT(f'Copied {counts[CopyStatus.COPIED] + counts[CopyStatus.UNVERIFIED]} objects'
+              f' ({copied_bytes / 2 ** 30:.2f} GiB) in {seconds:.1f}s'
+              f' ({copied_bytes / 2 ** 20 / max(seconds, 1e-6):.1f} MiB/s), {counts[CopyStatus.UNVERIFIED]}'
+              f' not verified, {counts[CopyStatus.ALREADY_COPIED]} already copied, {counts[CopyStatus.FAILED]}'
+              f' failed.')
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Copies the S3 objects of the file items cloned (by fetch-file-items) from one environment to'
+                    ' another, server-side and in parallel. Objects already copied are skipped, so it can be'
+                    ' rerun to resume a failed copy.')
+    parser.add_argument('files', help='JSON file of the file items cloned (the fetch-file-items --outfile)')
+    parser.add_argument('--keyfile', default='.cgap-keys.json', help='path to keyfile')
+    parser.add_argument('--keyname-from', default='cgap', help='Name of key in keyfile of the source environment')
+    parser.add_argument('--keyname-to', required=True, help='Name of key in keyfile of the destination environment')
+    parser.add_argument('--workers', help=f'Number of objects to copy in parallel (default {DEFAULT_WORKERS})',
+                        type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--part-workers', help=f'Number of parts to copy in parallel'
+                                               f' (default {DEFAULT_PART_WORKERS})',
+                        type=int, default=DEFAULT_PART_WORKERS)
+    args = parser.parse_args()
+    with open(args.keyfile) as keyfile:
+        keys = json.load(keyfile)
+    with open(args.files) as files:
+        objects = resolve_file_objects(json.load(files), keys[args.keyname_from], keys[args.keyname_to])
+    PRINT(f'Copying {len(objects)} objects.')
+    counts = FileObjectCopier(boto3.client('s3'), workers=args.workers,
+                              part_workers=args.part_workers).copy_all(objects)
+    exit(1 if counts[CopyStatus.FAILED] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,105 @@
 import argparse
 import boto3
+import concurrent.futures
+import time
 
-from dcicutils.ecs_utils import CGAP_ECS_REGION
+from typing import List, Optional
+from botocore.exceptions import ClientError, WaiterError
+from dcicutils.ecs_utils import COMMON_REGION
 from dcicutils.misc_utils import PRINT
+from ..exceptions import RollingDeployError
+
+
+# services are redeployed in waves, each of the services whose names contain (case-insensitively) any of the
+# given keywords, in order; the services matching none of them are redeployed in a last wave of their own
+DEFAULT_WAVES = [['indexer', 'ingester'], ['portal']]
+DEFAULT_WORKERS = 8
+DEFAULT_WAITER_DELAY = 15
+DEFAULT_WAITER_MAX_ATTEMPTS = 60
+MAX_WAITER_SERVICES = 10  # the maximum number of services describe_services (and so its waiters) accepts
 
 
 def list_clusters(client):
     """ Uses ECSUtils to get cluster information. """
-    return client.list_clusters().get('clusterArns', [])
+    return [cluster for page in client.get_paginator('list_clusters').paginate()
+            for cluster in page.get('clusterArns', [])]
+
+
+def list_services(client, cluster) -> List[str]:
+    """ Returns the ARNs of all the services of the given cluster (all pages of them). """
+    return [service for page in client.get_paginator('list_services').paginate(cluster=cluster)
+            for service in page.get('serviceArns', [])]
+
+
+def parse_waves(waves: str) -> List[List[str]]:
+    """ Parses waves given as semicolon separated waves of comma separated keywords, e.g. indexer,ingester;portal """
+    parsed = [[keyword.strip().lower() for keyword in wave.split(',') if keyword.strip()] for wave in waves.split(';')]
+    if not parsed or not all(parsed):
+        raise RollingDeployError(f'Invalid waves {waves} - must be semicolon separated waves of comma separated'
+                                 f' service name keywords, e.g. indexer,ingester;portal')
+    return parsed
+
 
+def group_into_waves(services: List[str], waves: Optional[List[List[str]]] = None) -> List[List[str]]:
+    """ Groups the given service ARNs into waves, each of the services matching (see DEFAULT_WAVES) the keywords
+        of the given waves not already in an earlier wave, followed by a wave of the rest; empty waves are dropped.
+    """
+    remaining = list(services)
+    grouped = []
+    for keywords in (waves if waves is not None else DEFAULT_WAVES):
+        wave = [service for service in remaining
+                if any(keyword.lower() in service.split('/')[-1].lower() for keyword in keywords)]
+        remaining = [service for service in remaining if service not in wave]
+        grouped.append(wave)
+    grouped.append(remaining)
+    return [wave for wave in grouped if wave]
 
-def kick_cluster_update(client, cluster):
-    """ Triggers a cluster update, forcing new deployments of all services. """
-    services = client.list_services(cluster=cluster).get('serviceArns', [])
-    for service in services:
-        client.update_service(cluster=cluster, service=service,
-                              forceNewDeployment=True)
+
+def update_wave(client, cluster, services: List[str], workers: int = DEFAULT_WORKERS) -> None:
+    """ Forces new deployments of the given services of the given cluster, concurrently. """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(workers, len(services)), 1)) as executor:
+        for future in [executor.submit(client.update_service, cluster=cluster, service=service,
+                                       forceNewDeployment=True)
+                       for service in services]:
+            future.result()
+
+
+def wait_for_wave(client, cluster, services: List[str], delay: int = DEFAULT_WAITER_DELAY,
+                  max_attempts: int = DEFAULT_WAITER_MAX_ATTEMPTS) -> None:
+    """ Waits for the given services of the given cluster to be stable, i.e. running just their desired count of
+        tasks of their new deployment, with a services_stable waiter per MAX_WAITER_SERVICES of them.
+    """
+    waiter = client.get_waiter('services_stable')
+    for i in range(0, len(services), MAX_WAITER_SERVICES):
+        waiter.wait(cluster=cluster, services=services[i:i + MAX_WAITER_SERVICES],
+                    WaiterConfig={'Delay': delay, 'MaxAttempts': max_attempts})
+
+
+def kick_cluster_update(client, cluster, waves: Optional[List[List[str]]] = None, workers: int = DEFAULT_WORKERS,
+                        delay: int = DEFAULT_WAITER_DELAY,
+                        max_attempts: int = DEFAULT_WAITER_MAX_ATTEMPTS) -> List[float]:
+    """ Triggers a rolling cluster update, forcing new deployments of all services, wave by wave (see
+        group_into_waves): the services of each wave are updated concurrently, and must be stable before the
+        next wave is started. Raises RollingDeployError, leaving later waves alone, if a wave fails.
+        Returns the duration of each wave, in seconds.
+    """
+    grouped = group_into_waves(list_services(client, cluster), waves)
+    durations = []
+    for n, wave in enumerate(grouped, start=1):
+        names = ', '.join(service.split('/')[-1] for service in wave)
+        PRINT(f'Redeploying wave {n} of {len(grouped)} in {cluster}: {names}')
+        started = time.time()
+        try:
+            update_wave(client, cluster, wave, workers=workers)
+            wait_for_wave(client, cluster, wave, delay=delay, max_attempts=max_attempts)
+        except (ClientError, WaiterError) as e:
+            raise RollingDeployError(f'Wave {n} of {len(grouped)} in {cluster} ({names}) failed after'
+                                     f' {time.time() - started:.1f}s - not redeploying later waves: {e}')
+        durations.append(time.time() - started)
+        PRINT(f'Wave {n} of {len(grouped)} in {cluster} stable after {durations[-1]:.1f}s.')
+    PRINT(f'Redeployed {sum(map(len, grouped))} services in {cluster} in {len(grouped)} waves'
+          f' ({sum(durations):.1f}s).')
+    return durations
 
 
 def main():
@@ -25,10 +109,17 @@ def main():
     parser.add_argument('--kick', action='store_true', default=False,
                         help='pass this option to kick the deployment task')
     parser.add_argument('--env', help='name of ECS cluster to trigger deployment')
+    parser.add_argument('--waves', help='Semicolon separated waves of comma separated service name keywords to'
+                                        ' redeploy in order, the rest last (default'
+                                        f' {";".join(",".join(wave) for wave in DEFAULT_WAVES)})',
+                        type=str, default=None)
+    parser.add_argument('--workers', help=f'Number of concurrent service updates per wave (default {DEFAULT_WORKERS})',
+                        type=int, default=DEFAULT_WORKERS)
     args = parser.parse_args()
 
     # XXX: replace logic with ECSUtils
-    client = boto3.client('ecs', region_name=CGAP_ECS_REGION)
+    session = boto3.session.Session(region_name=COMMON_REGION)
+    client = session.client('ecs')
     if args.list:
         PRINT(list_clusters(client))
         exit(0)
@@ -36,7 +127,12 @@ def main():
         if not args.env:
             PRINT('No env specified!')
             exit(1)
-        kick_cluster_update(client, args.env)
+        try:
+            kick_cluster_update(client, args.env, waves=parse_waves(args.waves) if args.waves else None,
+                                workers=args.workers)
+        except RollingDeployError as e:
+            PRINT(str(e))
+            exit(1)
     else:
         PRINT('No action option specified - exiting.')
         exit(0)
@@ -0,0 +1,213 @@
+import argparse
+import boto3
+import collections
+import concurrent.futures
+import logging
+
+from botocore.exceptions import ClientError
+from dcicutils.misc_utils import PRINT
+from ..info.aws_util import AWSUtil
+from ..info.pricing_calculator import PricingCalculator
+
+
+logger = logging.getLogger(__name__)
+
+# copy_object only handles objects up to 5 GiB, beyond that we need a (managed) multipart copy
+MAX_COPY_OBJECT_SIZE = 5 * 2 ** 30
+# objects in these classes must be restored before they can be copied, so we leave them alone
+ARCHIVED_STORAGE_CLASSES = ('GLACIER', 'DEEP_ARCHIVE')
+# headers that a multipart copy does not carry over on its own
+PRESERVED_HEAD_FIELDS = ('Metadata', 'ContentType', 'ContentEncoding', 'ContentDisposition', 'ContentLanguage',
+                         'CacheControl')
+DEFAULT_WORKERS = 16
+HOURS_PER_MONTH = 730
+
+
+class ObjectStatus:
+    MIGRATED = 'migrated'
+    WOULD_MIGRATE = 'would migrate'
+    ALREADY_ENABLED = 'already enabled'
+    ARCHIVED = 'skipped (archived)'
+    FAILED = 'failed'
+
+
+def estimate_kms_requests(object_count, bucket_key_object_count=0, reads_per_object=1.0, writes_per_object=0.0,
+                          requesters=1, bucket_key_lifetime_hours=1.0, period_hours=HOURS_PER_MONTH):
+    """ Estimates the KMS requests made over period_hours for a bucket of object_count SSE-KMS objects, of which
+        bucket_key_object_count already use a bucket key. Returns (before, after), where after assumes every object
+        has been migrated to use the bucket key.
+
+        Without a bucket key every object GET is a kms:Decrypt and every PUT a kms:GenerateDataKey. With one, S3 reuses
+        a bucket-level key per requester for a limited time, so KMS is called about once per requester per
+        bucket_key_lifetime_hours for each of reads and writes (and never more often than without the bucket key).
+        The lifetime is not published by AWS, so treat the result as an order-of-magnitude estimate.
+
+        :param object_count: number of SSE-KMS objects in the bucket
+        :param bucket_key_object_count: number of those objects that already use a bucket key
+        :param reads_per_object: expected GETs per object over the period
+        :param writes_per_object: expected PUTs per object over the period
+        :param requesters: number of distinct IAM principals (roles/users) accessing the bucket
+        :param bucket_key_lifetime_hours: how long S3 reuses a bucket-level key for a requester
+        :param period_hours: length of the period to estimate, a month by default
+    """
+    def unamortized(n):
+        return n * (reads_per_object + writes_per_object)
+
+    def amortized(n):
+        if not n:
+            return 0
+        operations = (reads_per_object > 0) + (writes_per_object > 0)
+        return min(unamortized(n), requesters * operations * period_hours / bucket_key_lifetime_hours)
+
+    before = unamortized(object_count - bucket_key_object_count) + amortized(bucket_key_object_count)
+    after = amortized(object_count)
+    return before, after
+
+
+class BucketKeyMigration:
+    """ Enables S3 Bucket Keys on a KMS-encrypted bucket and re-encrypts its existing objects in place (by copying
+        each object onto itself) so that they pick up the bucket key. Objects are processed by a thread pool with at
+        most 2 * workers copies in flight, so the listing is streamed rather than held in memory.
+
+        Note that on a versioned bucket each copy creates a new version; the old versions (still encrypted without
+        the bucket key) remain until our noncurrent version lifecycle rules expire them.
+    """
+
+    def __init__(self, s3=None, session=None, workers=DEFAULT_WORKERS, dry_run=True):
+        self.s3 = s3 or (session or boto3).client('s3')
+        self.aws_util = AWSUtil(session=session)
+        self.workers = workers
+        self.dry_run = dry_run
+        self.failures = []
+
+    def get_kms_encryption_rule(self, bucket):
+        """ Returns the default aws:kms ServerSideEncryptionRule for the given bucket, or None if it has none. """
+        try:
+            rules = self.s3.get_bucket_encryption(Bucket=bucket)['ServerSideEncryptionConfiguration']['Rules']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ServerSideEncryptionConfigurationNotFoundError':
+                return None
+            raise
+        for rule in rules:
+            if rule.get('ApplyServerSideEncryptionByDefault', {}).get('SSEAlgorithm') == 'aws:kms':
+                return rule
+        return None
+
+    def ensure_bucket_key_enabled(self, bucket):
+        """ Enables the bucket key on the default KMS encryption rule of the given bucket, if needed.
+            Returns the rule, or None if the bucket is not KMS-encrypted by default. """
+        rule = self.get_kms_encryption_rule(bucket)
+        if rule is None:
+            PRINT(f'{bucket} has no default aws:kms encryption, skipping.')
+            return None
+        if rule.get('BucketKeyEnabled'):
+            PRINT(f'{bucket} already has the bucket key enabled.')
+        elif self.dry_run:
+            PRINT(f'Would enable the bucket key on {bucket}.')
+        else:
+            self.s3.put_bucket_encryption(Bucket=bucket, ServerSideEncryptionConfiguration={
+                'Rules': [dict(rule, BucketKeyEnabled=True)]
+            })
+            PRINT(f'Enabled the bucket key on {bucket}.')
+        return rule
+
+    def copy_onto_itself(self, bucket, key, head, kms_key_id):
+        """ Re-encrypts the given object with the bucket key by copying it onto itself, preserving its storage class
+            and metadata. Objects over MAX_COPY_OBJECT_SIZE use a managed multipart copy, which relies on the bucket
+            default for the bucket key (the bucket key setting is not an allowed transfer argument). """
+        copy_source = {'Bucket': bucket, 'Key': key}
+        extra_args = {'ServerSideEncryption': 'aws:kms'}
+        if kms_key_id:
+            extra_args['SSEKMSKeyId'] = kms_key_id
+        if head.get('StorageClass'):  # head_object omits StorageClass for STANDARD
+            extra_args['StorageClass'] = head['StorageClass']
+        if head['ContentLength'] <= MAX_COPY_OBJECT_SIZE:
+            self.s3.copy_object(Bucket=bucket, Key=key, CopySource=copy_source, MetadataDirective='COPY',
+                                BucketKeyEnabled=True, **extra_args)
+        else:
+            for field in PRESERVED_HEAD_FIELDS:
+                if head.get(field):
+                    extra_args[field] = head[field]
+            self.s3.copy(copy_source, bucket, key, ExtraArgs=extra_args)
+
+    def migrate_object(self, bucket, key, kms_key_id):
+        """ Migrates a single object if it does not already use the bucket key, returning an ObjectStatus. """
+        try:
+            head = self.s3.head_object(Bucket=bucket, Key=key)
+            if head.get('ServerSideEncryption') == 'aws:kms' and head.get('BucketKeyEnabled'):
+                return ObjectStatus.ALREADY_ENABLED
+            if head.get('StorageClass') in ARCHIVED_STORAGE_CLASSES:
+                return ObjectStatus.ARCHIVED
+            if self.dry_run:
+                return ObjectStatus.WOULD_MIGRATE
+            self.copy_onto_itself(bucket, key, head, kms_key_id)
+            return ObjectStatus.MIGRATED
+        except ClientError as e:
+            logger.error(f'Could not migrate s3://{bucket}/{key}: {e}')
+            self.failures.append((bucket, key, str(e)))
+            return ObjectStatus.FAILED
+
+    def migrate_bucket(self, bucket, prefix=None):
+        """ Enables the bucket key on the given bucket and migrates its objects (optionally restricted to prefix).
+            Returns a Counter of ObjectStatus values, or None if the bucket is not KMS-encrypted by default. """
+        rule = self.ensure_bucket_key_enabled(bucket)
+        if rule is None:
+            return None
+        kms_key_id = rule['ApplyServerSideEncryptionByDefault'].get('KMSMasterKeyID')
+        counts = collections.Counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            for obj in self.aws_util.iter_objects(bucket, prefix=prefix, client=self.s3):
+                if len(pending) >= 2 * self.workers:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    counts.update(future.result() for future in done)
+                pending.add(executor.submit(self.migrate_object, bucket, obj['Key'], kms_key_id))
+            counts.update(future.result() for future in concurrent.futures.as_completed(pending))
+        return counts
+
+
+def print_kms_estimate(bucket, counts, reads_per_object, writes_per_object, requesters):
+    """ Prints the before/after monthly KMS request estimate for a migrated (or to be migrated) bucket. """
+    object_count = sum(n for status, n in counts.items() if status != ObjectStatus.ARCHIVED)
+    before, after = estimate_kms_requests(object_count,
+                                          bucket_key_object_count=counts[ObjectStatus.ALREADY_ENABLED],
+                                          reads_per_object=reads_per_object,
+                                          writes_per_object=writes_per_object,
+                                          requesters=requesters)
+    PRINT(f'{bucket}: {dict(counts)}')
+    PRINT(f'  Estimated monthly KMS requests before: {before:,.0f}'
+          f' ({PricingCalculator.float_to_usd(PricingCalculator.kms_requests_to_cost(before))})'
+          f', after: {after:,.0f}'
+          f' ({PricingCalculator.float_to_usd(PricingCalculator.kms_requests_to_cost(after))})')
+
+
+def main():
+    """ Enables S3 Bucket Keys on the given buckets and re-encrypts their objects to use them. """
+    parser = argparse.ArgumentParser(
+        description='Enables S3 Bucket Keys on KMS-encrypted buckets and re-encrypts existing objects in place'
+                    ' to use them. Runs as a dry run (reporting counts and KMS request estimates) unless --confirm.')
+    parser.add_argument('buckets', nargs='+', help='buckets to migrate')
+    parser.add_argument('--prefix', default=None, help='only migrate objects under this key prefix')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='number of concurrent copies')
+    parser.add_argument('--reads-per-object', type=float, default=1.0,
+                        help='expected GETs per object per month, for the KMS request estimate')
+    parser.add_argument('--writes-per-object', type=float, default=0.0,
+                        help='expected PUTs per object per month, for the KMS request estimate')
+    parser.add_argument('--requesters', type=int, default=5,
+                        help='distinct IAM principals accessing each bucket, for the KMS request estimate')
+    parser.add_argument('--confirm', action='store_true', default=False,
+                        help='actually enable the bucket keys and copy objects, otherwise this is a dry run')
+    args = parser.parse_args()
+
+    migration = BucketKeyMigration(session=boto3.session.Session(), workers=args.workers, dry_run=not args.confirm)
+    for bucket in args.buckets:
+        counts = migration.migrate_bucket(bucket, prefix=args.prefix)
+        if counts is not None:
+            print_kms_estimate(bucket, counts, args.reads_per_object, args.writes_per_object, args.requesters)
+    for bucket, key, error in migration.failures:
+        PRINT(f'FAILED s3://{bucket}/{key}: {error}')
+    exit(1 if migration.failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,13 @@
 import argparse
+import boto3
+import concurrent.futures
+import datetime
+import json
+import os
+import requests
+import time
+
+from typing import List, Optional
 from dcicutils.misc_utils import PRINT
 from dcicutils.ff_utils import get_health_page
 from dcicutils.creds_utils import CGAPKeyManager
@@ -14,6 +23,13 @@ VERSION_ENTRIES = [
     'utils_version',
 ]
 
+# the pages fetched (concurrently, for all environments) for the fleet status
+FLEET_PAGES = ['/health', '/counts', '/indexing_status']
+FLEET_COLUMNS = ['env', 'version', 'color', 'es index', 'queue', 'db/es counts', 'response']
+DEFAULT_TIMEOUT = 10
+DEFAULT_WORKERS = 16
+DEFAULT_WATCH_SECONDS = 30
+
 
 def echo_env_status(keyfile_override: str) -> None:
     """ Reads ~/.cgap-keys.json, navigates to the health pages and reports structured
@@ -34,12 +50,127 @@ def echo_env_status(keyfile_override: str) -> None:
             PRINT(f'    * {version_entry} --> {health.get(version_entry)}')
 
 
+def get_global_env_bucket_envs(global_env_bucket: str, s3=None) -> dict:
+    """ Returns the environments of the public URL table of the main.ecosystem entry of the given GLOBAL_ENV_BUCKET
+        (see assure_global_env_bucket), as a dictionary mapping each name to (credentials-less) keys file style
+        auth information, i.e. just its 'server'.
+    """
+    s3 = s3 or boto3.client('s3')
+    ecosystem = json.loads(s3.get_object(Bucket=global_env_bucket, Key='main.ecosystem')['Body'].read())
+    return {entry['name']: {'server': entry['url']} for entry in ecosystem.get('public_url_table', [])}
+
+
+def fetch_page(entries: dict, page: str, timeout: float = DEFAULT_TIMEOUT) -> (dict, float):
+    """ Returns the JSON of the given page of the environment with the given (keys file style) auth information,
+        and the time it took to respond, in seconds. A 'timeout' of the auth information overrides the given one.
+    """
+    auth = (entries['key'], entries['secret']) if entries.get('key') else None
+    started = time.time()
+    response = requests.get(f'{entries["server"].rstrip("/")}{page}', auth=auth,
+                            timeout=entries.get('timeout', timeout), headers={'Accept': 'application/json'})
+    response.raise_for_status()
+    return response.json(), time.time() - started
+
+
+def summarize_env_status(env: str, pages: dict) -> dict:
+    """ Returns the fleet status row of the given environment from its fetched pages, i.e. by page either the
+        (JSON, seconds) it was fetched in or the exception fetching it raised.
+    """
+    health, health_seconds = pages['/health'] if not isinstance(pages['/health'], Exception) else ({}, None)
+    counts = pages['/counts'][0] if not isinstance(pages['/counts'], Exception) else {}
+    indexing_status = (pages['/indexing_status'][0]
+                       if not isinstance(pages['/indexing_status'], Exception) else {})
+    identity = f'{health.get("identity") or ""} {env}'.lower()
+    color = 'blue' if 'blue' in identity else 'green' if 'green' in identity else '-'
+    # e.g. "DB: 1234 ES: 1230 < ES has 4 fewer items"
+    totals = (counts.get('db_es_total') or '').split()
+    db_es_counts = f'{totals[1]}/{totals[3]}' if len(totals) >= 4 else '-'
+    queue = sum(value for key, value in indexing_status.items()
+                if key.endswith(('_waiting', '_inflight')) and isinstance(value, int))
+    errors = [f'{page}: {result}' for page, result in pages.items() if isinstance(result, Exception)]
+    return {
+        'env': env,
+        'version': health.get('project_version') or '-',
+        'color': color,
+        'es index': health.get('namespace') or '-',
+        'queue': str(queue) if indexing_status else '-',
+        'db/es counts': db_es_counts,
+        'response': f'{health_seconds:.2f}s' if health_seconds is not None else 'DOWN',
+        'errors': errors,
+    }
+
+
+def get_fleet_status(envs: dict, timeout: float = DEFAULT_TIMEOUT, workers: int = DEFAULT_WORKERS) -> List[dict]:
+    """ Fetches the FLEET_PAGES of all the given environments (by name, keys file style auth information),
+        concurrently, each with the given timeout (unless the environment has its own, see fetch_page), returning
+        the status row (see summarize_env_status) of each.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(workers, len(envs) * len(FLEET_PAGES)), 1)) \
+            as executor:
+        futures = {(env, page): executor.submit(fetch_page, entries, page, timeout=timeout)
+                   for env, entries in envs.items() for page in FLEET_PAGES}
+        rows = []
+        for env in envs:
+            pages = {}
+            for page in FLEET_PAGES:
+                try:
+                    pages[page] = futures[env, page].result()
+                except Exception as e:
+                    pages[page] = e
+            rows.append(summarize_env_status(env, pages))
+    return rows
+
+
+def render_fleet_status(rows: List[dict]) -> str:
+    """ Renders the given fleet status rows as a compact table, followed by any errors fetching their pages """
+    widths = {column: max([len(column)] + [len(row[column]) for row in rows]) for column in FLEET_COLUMNS}
+    lines = ['  '.join(column.ljust(widths[column]) for column in FLEET_COLUMNS).rstrip(),
+             '  '.join('-' * widths[column] for column in FLEET_COLUMNS)]
+    lines.extend('  '.join(row[column].ljust(widths[column]) for column in FLEET_COLUMNS).rstrip() for row in rows)
+    lines.extend(f'! {row["env"]} {error}' for row in rows for error in row['errors'])
+    return '\n'.join(lines)
+
+
+def echo_fleet_status(envs: dict, timeout: float = DEFAULT_TIMEOUT, workers: int = DEFAULT_WORKERS,
+                      watch: Optional[float] = None) -> None:
+    """ Reports the fleet status of the given environments (see get_fleet_status), and if watch is given
+        keeps refreshing it every watch seconds (until interrupted).
+    """
+    while True:
+        rows = get_fleet_status(envs, timeout=timeout, workers=workers)
+        PRINT(f'Fleet status at {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}:')
+        PRINT(render_fleet_status(rows))
+        if not watch:
+            return
+        try:
+            time.sleep(watch)
+        except KeyboardInterrupt:
+            return
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Echos version information from ~/.cgap-keys.json or override file.')
     parser.add_argument('--keyfile', help='Pass to override default keyfile', type=str)
+    parser.add_argument('--fleet', help='Report the status of all environments (of the keyfile, or of the global'
+                                        ' env bucket if given) as a table, fetched concurrently',
+                        action='store_true', default=False)
+    parser.add_argument('--global-env-bucket', help='Read the environments for --fleet from this GLOBAL_ENV_BUCKET'
+                                                    ' (default the GLOBAL_ENV_BUCKET environment variable, if --fleet'
+                                                    ' and no --keyfile)', type=str, default=None)
+    parser.add_argument('--timeout', help=f'Timeout for each request of --fleet (default {DEFAULT_TIMEOUT})',
+                        type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--watch', help=f'Refresh the --fleet status every this many seconds'
+                                        f' (default {DEFAULT_WATCH_SECONDS})',
+                        type=float, nargs='?', const=DEFAULT_WATCH_SECONDS, default=None)
     args = parser.parse_args()
-    echo_env_status(args.keyfile)
+    if args.fleet or args.watch:
+        global_env_bucket = args.global_env_bucket or (not args.keyfile and os.environ.get('GLOBAL_ENV_BUCKET'))
+        envs = (get_global_env_bucket_envs(global_env_bucket) if global_env_bucket
+                else CGAPKeyManager(keys_file=args.keyfile).get_keydicts())
+        echo_fleet_status(envs, timeout=args.timeout, watch=args.watch)
+    else:
+        echo_env_status(args.keyfile)
 
 
 if __name__ == '__main__':
@@ -1,22 +1,49 @@
 from dcicutils import ff_utils
 import argparse
+import concurrent.futures
 import json
+import os
+import random
+import re
 import sys
+import threading
+import time
 
 
 EPILOG = __doc__
 
 
 class FastqFetcher:
+    """ Fetches the metadata of the fastq and cram files of a case from one environment, and posts them to
+        another, with a bounded pool of workers: the file metadata is fetched concurrently, then the files posted
+        concurrently (without their file relations), each file's relations being patched as soon as it and the
+        files it relates to are posted. Transient failures are retried with backoff, and the posts and patches
+        done recorded in a journal, so that a failed clone can be resumed.
+    """
 
     remove_fields = ['schema_version', 'date_created', 'last_modified', 'submitted_by', 'quality_metric']
 
-    def __init__(self, case_accession, old_env_key, new_env_key=None, write=True, outfile='files.json'):
+    DEFAULT_WORKERS = 8
+    MAX_ATTEMPTS = 4
+    BACKOFF_SECONDS = 2.0
+    # ff_utils (having retried a bit itself) raises plain exceptions, so which are transient is told by the message
+    TRANSIENT_ERROR = re.compile(r'Bad status code for \w+ request for \S+: (429|5\d\d)\b|Error with \w+ request')
+    CONFLICT_ERROR = re.compile(r'Bad status code for POST request for \S+: 409\b')
+
+    def __init__(self, case_accession, old_env_key, new_env_key=None, write=True, outfile='files.json',
+                 workers=DEFAULT_WORKERS, journal_file=None, resume=False):
         self.case_accession = case_accession
         self.old_env_key = old_env_key
         self.new_env_key = new_env_key
         self.write = write
         self.outfile = outfile
+        self.workers = workers
+        self.journal_file = journal_file or f'fetch-file-items-{case_accession}.journal'
+        self.journal = set()
+        self.journal_lock = threading.Lock()
+        if resume and os.path.exists(self.journal_file):
+            with open(self.journal_file) as fp:
+                self.journal = {line.strip() for line in fp if line.strip()}
         self.case_metadata = ff_utils.get_metadata(f'/cases/{self.case_accession}/', key=self.old_env_key)
         self.sample_ids = [
             sample['@id'] for sample in self.case_metadata.get('sample_processing', {}).get('samples', [{}])
@@ -30,7 +57,7 @@ class FastqFetcher:
         self.get_files_from_samples()
         self.get_file_json()
         print(f'Found {len(self.json_out["file_fastq"])} fastq files, '
-              f'{len(self.json_out["file_fastq"])} cram files')
+              f'{len(self.json_out["file_processed"])} cram files')
         if self.write:
             print(f'Writing json data to {self.outfile}')
             self.write_json()
@@ -39,30 +66,83 @@ class FastqFetcher:
         else:
             print('No posts performed.')
 
+    @classmethod
+    def with_retries(cls, fn, *args, **kwargs):
+        """ Calls the given ff_utils function, retrying transient failures (see TRANSIENT_ERROR) with backoff """
+        for attempt in range(1, cls.MAX_ATTEMPTS + 1):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == cls.MAX_ATTEMPTS or not cls.TRANSIENT_ERROR.search(str(e)):
+                    raise
+                time.sleep(cls.BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.0))
+
+    def record(self, entry):
+        """ Records the given post or patch (e.g. 'post <uuid>') as done, in the journal """
+        with self.journal_lock:
+            self.journal.add(entry)
+            with open(self.journal_file, 'a') as fp:
+                fp.write(f'{entry}\n')
+
     def get_files_from_samples(self):
-        for sample_id in self.sample_ids:
-            sample = ff_utils.get_metadata(sample_id + '?frame=object', key=self.old_env_key)
-            self.fastq_files.extend(sample.get('files', []))
-            self.cram_files.extend(sample.get('cram_files', []))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            samples = executor.map(lambda sample_id: self.with_retries(
+                ff_utils.get_metadata, sample_id + '?frame=object', key=self.old_env_key), self.sample_ids)
+            for sample in samples:
+                self.fastq_files.extend(sample.get('files', []))
+                self.cram_files.extend(sample.get('cram_files', []))
+
+    def get_file_metadata(self, file_id):
+        file_metadata = self.with_retries(ff_utils.get_metadata, file_id + '?frame=raw', key=self.old_env_key)
+        for field in self.remove_fields:
+            if field in file_metadata:
+                del file_metadata[field]
+        return file_metadata
 
     def get_file_json(self):
-        for fastq in self.fastq_files:
-            fastq_metadata = ff_utils.get_metadata(fastq + '?frame=raw', key=self.old_env_key)
-            for field in self.remove_fields:
-                if field in fastq_metadata:
-                    del fastq_metadata[field]
-            self.json_out['file_fastq'].append(fastq_metadata)
-        for cram in self.cram_files:
-            cram_metadata = ff_utils.get_metadata(cram + '?frame=raw', key=self.old_env_key)
-            for field in self.remove_fields:
-                if field in cram_metadata:
-                    del cram_metadata[field]
-            self.json_out['file_processed'].append(cram_metadata)
+        started = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self.json_out['file_fastq'].extend(executor.map(self.get_file_metadata, self.fastq_files))
+            self.json_out['file_processed'].extend(executor.map(self.get_file_metadata, self.cram_files))
+        self.report_rate('fetched', len(self.fastq_files) + len(self.cram_files), started)
+
+    @staticmethod
+    def report_rate(done, n, started):
+        seconds = time.time() - started
+        print(f'{n} files {done} in {seconds:.1f}s ({n / max(seconds, 1e-6):.1f} items/s)')
 
     def write_json(self):
         with open(self.outfile, 'w') as json_file:
             json.dump(self.json_out, json_file, indent=4)
 
+    def post_file(self, item_type, post_body):
+        """ Posts the given file, returning True if it is posted (or was already there), False otherwise """
+        if f'post {post_body["uuid"]}' in self.journal:
+            return True
+        try:
+            resp = self.with_retries(ff_utils.post_metadata, post_body, item_type, key=self.new_env_key)
+        except Exception as e:
+            if not self.CONFLICT_ERROR.search(str(e)):
+                return False
+        else:
+            if resp['status'] != 'success':
+                return False
+        self.record(f'post {post_body["uuid"]}')
+        return True
+
+    def patch_file(self, uuid, patch_body):
+        """ Patches the relations of the given file, returning True if it is patched, False otherwise """
+        if f'patch {uuid}' in self.journal:
+            return True
+        try:
+            resp = self.with_retries(ff_utils.patch_metadata, patch_body, uuid, key=self.new_env_key)
+        except Exception:
+            return False
+        if resp['status'] != 'success':
+            return False
+        self.record(f'patch {uuid}')
+        return True
+
     def post_files(self):
         results_dict = {
             'post': {
@@ -71,44 +151,59 @@ class FastqFetcher:
             },
             'patch': {'success': 0, 'fail': 0},
         }
+        if self.journal:
+            print(f'Resuming, skipping the {len(self.journal)} posts and patches in {self.journal_file}')
+        elif os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        started = time.time()
 
-        # Posting files (without file relations)
-        print('Posting file metadata...')
+        # Posting files (without file relations), and patching the file relations of each file as soon as
+        # it and the files it relates to (of those being posted) are posted
+        print('Posting file metadata and patching file relations...')
         related_files = {}
+        depends_on = {}
         for k, v in self.json_out.items():
             for item in v:
-                post_body = {k: v for k, v in item.items() if k != 'related_files'}
                 related_files[item['uuid']] = {
                     'related_files': item.get('related_files')
                 }
-                try:
-                    resp = ff_utils.post_metadata(post_body, k, key=self.new_env_key)
-                except Exception:
-                    results_dict['post'][k]['fail'] += 1
-                else:
-                    if resp['status'] == 'success':
-                        results_dict['post'][k]['success'] += 1
-                    else:
-                        results_dict['post'][k]['fail'] += 1
+                depends_on[item['uuid']] = {item['uuid']} | {
+                    related_file.get('file') for related_file in item.get('related_files') or []}
+        posted, failed = set(), set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            posts = {}
+            for k, v in self.json_out.items():
+                for item in v:
+                    post_body = {k: v for k, v in item.items() if k != 'related_files'}
+                    posts[executor.submit(self.post_file, k, post_body)] = (k, item['uuid'])
+            patches = {}
+
+            def submit_ready_patches():
+                for uuid, dependencies in list(depends_on.items()):
+                    dependencies = dependencies & set(related_files)  # (only those being posted)
+                    if dependencies <= posted | failed:
+                        del depends_on[uuid]
+                        if dependencies & failed:
+                            results_dict['patch']['fail'] += 1
+                        else:
+                            patches[executor.submit(self.patch_file, uuid, related_files[uuid])] = uuid
+
+            for future in concurrent.futures.as_completed(posts):
+                k, uuid = posts[future]
+                success = future.result()
+                results_dict['post'][k]['success' if success else 'fail'] += 1
+                (posted if success else failed).add(uuid)
+                submit_ready_patches()
+            for future in concurrent.futures.as_completed(patches):
+                results_dict['patch']['success' if future.result() else 'fail'] += 1
         print(f'fastq files: {results_dict["post"]["file_fastq"]["success"]} success, '
               f'{results_dict["post"]["file_fastq"]["fail"]} fail')
         print(f'cram files: {results_dict["post"]["file_processed"]["success"]} success, '
               f'{results_dict["post"]["file_processed"]["fail"]} fail')
-
-        # Patching file relations
-        print('Patching file relations...')
-        for k, v in related_files.items():
-            try:
-                resp = ff_utils.patch_metadata(v, k, key=self.new_env_key)
-            except Exception:
-                results_dict['patch']['fail'] += 1
-            else:
-                if resp['status'] == 'success':
-                    results_dict['patch']['success'] += 1
-                else:
-                    results_dict['patch']['fail'] += 1
         print(f'file relation patching: {results_dict["patch"]["success"]} success, '
               f'{results_dict["patch"]["fail"]} fail')
+        self.report_rate('posted and patched', len(related_files), started)
+        return results_dict
 
 
 def main():
@@ -138,6 +233,13 @@ def main():
                         help="Name of key in keyfile that files will be fetched from")
     parser.add_argument('--keyname-to', default=None,
                         help="Name of key in keyfile that file metadata will be posted to, required with --post")
+    parser.add_argument('--workers', default=FastqFetcher.DEFAULT_WORKERS, type=int,
+                        help=f"Number of concurrent requests (default {FastqFetcher.DEFAULT_WORKERS})")
+    parser.add_argument('--journal', default=None,
+                        help="Journal file of the posts and patches done"
+                             " (default fetch-file-items-<accession>.journal)")
+    parser.add_argument('--resume', default=False, action="store_true",
+                        help="If true, skip the posts and patches the journal records as done by a failed run")
     args = parser.parse_args()
 
     if args.post and not args.keyname_to:
@@ -152,7 +254,8 @@ def main():
         else:
             new_env_key = None
 
-    FastqFetcher(args.accession, old_env_key, new_env_key, outfile=args.outfile)
+    FastqFetcher(args.accession, old_env_key, new_env_key, outfile=args.outfile, workers=args.workers,
+                 journal_file=args.journal, resume=args.resume)
 
 
 if __name__ == '__main__':
@@ -1,13 +1,18 @@
 import argparse
 import boto3
+import concurrent.futures
+import functools
 import io
 import json
+import requests
 import sys
+import time
 from botocore.exceptions import ClientError
-from typing import List, Union
-from ..base import ConfigManager
-from ..base import Settings
+from typing import Callable, List, Optional, Union
+from ..constants import DeploymentParadigm, Settings
 from ..exceptions import IdentitySwapSetupError
+from .search_warmup import SearchWarmup, percentile, read_search_queries
+from .traffic_shift import TrafficShift, parse_schedule
 from dcicutils.lang_utils import conjoined_list
 from dcicutils.ecs_utils import ECSUtils
 from dcicutils.command_utils import yes_or_no
@@ -16,32 +21,41 @@ from dcicutils.env_base import EnvBase
 from dcicutils.s3_utils import s3Utils
 
 
+def get_app_kind() -> str:
+    """ Returns the app kind of the custom config. src.base is imported only here (and in main), as it requires
+        the custom config as soon as it is imported; the swap logic of this module does not.
+    """
+    from ..base import ConfigManager
+    return ConfigManager.get_config_setting(Settings.APP_KIND)
+
+
 def print_json(data, file=None, indent=2, default=str):
     file = file or sys.stdout
     PRINT(json.dumps(data, indent=indent, default=default), file=file)
 
 
-def download_config(*, bucket, key):
-    """ Downloads a config file from s3 """
+def download_config(*, bucket, key, session=None):
+    """ Downloads a config file from s3, using the given explicit boto3 session if any """
     stream = io.BytesIO()
-    s3 = boto3.client('s3')
+    s3 = (session or boto3).client('s3')
     s3.download_fileobj(Fileobj=stream, Bucket=bucket, Key=key)
     return json.loads(stream.getvalue())
 
 
-def upload_config(*, bucket, key, data: Union[str, dict], query=True, kms_key=None):
-    """ Uploads config intended for GLOBAL_ENV_BUCKET
+def upload_config(*, bucket, key, data: Union[str, dict], query=True, kms_key=None, session=None):
+    """ Uploads config intended for GLOBAL_ENV_BUCKET, using the given explicit boto3 session if any
         Note that this does not support S3_ENCRYPT_KEY_ID at the moment
+        Returns True if uploaded, or False if not (i.e. not confirmed)
     """
     heading(f"{key} in bucket {bucket} (OLD - ALREADY INSTALLED - REFORMATTED FOR DISPLAY)")
-    print_json(download_config(bucket=bucket, key=key))
+    print_json(download_config(bucket=bucket, key=key, session=session))
     heading(f"{key} in bucket {bucket} (NEW - TO BE UPLOADED)")
     print_json(data)
     if not query or yes_or_no(f"OK to upload?"):
         if isinstance(data, dict):
             data = json.dumps(data, indent=2, default=str) + "\n"
         stream = io.BytesIO(data.encode('utf-8'))
-        s3 = boto3.client('s3')
+        s3 = (session or boto3).client('s3')
         if not kms_key:
             s3.upload_fileobj(Fileobj=stream, Bucket=bucket, Key=key)
         else:
@@ -50,8 +64,16 @@ def upload_config(*, bucket, key, data: Union[str, dict], query=True, kms_key=No
                               ExtraArgs={'ServerSideEncryption': 'aws:kms',
                                           'SSEKMSKeyId': kms_key})
         PRINT("Uploaded.")
+        return True
     else:
         PRINT("NOT uploaded.")
+        return False
+
+
+def read_warmup_paths(filename: str) -> List[str]:
+    """ Reads warm-up request paths (e.g. /search/?type=File), one per line, ignoring blank and # comment lines """
+    with io.open(filename) as fp:
+        return [line.strip() for line in fp if line.strip() and not line.strip().startswith('#')]
 
 
 def heading(text=None, wid=120):
@@ -61,6 +83,126 @@ def heading(text=None, wid=120):
     PRINT("=" * wid)
 
 
+class SwapStep:
+    """ A single step of an identity swap plan, e.g. an ECS service update, run once the steps it depends on are done.
+        The estimate (in seconds) is only used to compute the critical path of the plan for review.
+    """
+    def __init__(self, name: str, function: Callable, depends_on: List[str], estimate: float) -> None:
+        self.name = name
+        self.function = function
+        self.depends_on = depends_on
+        self.estimate = estimate
+        self.started = None
+        self.duration = None
+        self.status = 'pending'
+        self.error = None
+
+
+class SwapPlanExecutor:
+    """ Runs the steps of an identity swap plan as a DAG: each step runs (in a thread pool) as soon as all the steps
+        it depends on are done, so independent steps (e.g. updates to services in different clusters, or to the
+        autoscaling of different services) run concurrently, rather than one after another. A step which fails is
+        reported rather than raised, and the steps depending on it are skipped. Usage like this:
+
+            executor = SwapPlanExecutor()
+            executor.add('update service A', update_a, estimate=2)
+            executor.add('update service B', update_b, estimate=2)
+            executor.add('wait for services stable', wait, depends_on=['update service A', 'update service B'])
+            executor.print_plan()
+            if executor.execute():
+                ...
+            executor.print_timings()
+    """
+    def __init__(self, max_workers: int = 8) -> None:
+        self.max_workers = max_workers
+        self.steps = {}
+        self.results = {}
+        self.duration = None
+
+    def add(self, name: str, function: Callable, depends_on: Optional[List[str]] = None, estimate: float = 1) -> str:
+        """ Adds the given named step function (called with no arguments), depending on the given (already added)
+            step names, if any; returns the step name.
+        """
+        if name in self.steps:
+            raise IdentitySwapSetupError(f'Duplicate swap step: {name}')
+        for dependency in depends_on or []:
+            if dependency not in self.steps:
+                raise IdentitySwapSetupError(f'Unknown dependency for swap step {name}: {dependency}')
+        self.steps[name] = SwapStep(name, function, list(depends_on or []), estimate)
+        return name
+
+    def critical_path(self) -> (float, List[str]):
+        """ Returns the estimated duration (in seconds) of the plan, run concurrently, and its critical path,
+            i.e. the chain of dependent steps whose estimates add up to this.
+        """
+        finishes = {}
+        for step in self.steps.values():  # steps are added after their dependencies, so this is a topological order
+            before = max((finishes[dependency] for dependency in step.depends_on),
+                         key=lambda finish: finish[0], default=(0, []))
+            finishes[step.name] = (before[0] + step.estimate, before[1] + [step.name])
+        return max(finishes.values(), key=lambda finish: finish[0], default=(0, []))
+
+    def print_plan(self) -> None:
+        """ Prints the steps of the plan, with their dependencies and estimates, and its critical path. """
+        PRINT(f'Swap plan steps ({len(self.steps)}):')
+        for step in self.steps.values():
+            depends_on = f' (after: {", ".join(step.depends_on)})' if step.depends_on else ''
+            PRINT(f'    [~{step.estimate:g}s] {step.name}{depends_on}')
+        duration, path = self.critical_path()
+        total = sum(step.estimate for step in self.steps.values())
+        PRINT(f'Critical path (estimated {duration:g}s, vs {total:g}s one step after another):'
+              f' {" -> ".join(path)}')
+
+    def _run(self, step: SwapStep, started: float):
+        step.started = time.time() - started
+        try:
+            return step.function()
+        finally:
+            step.duration = time.time() - started - step.started
+
+    def execute(self) -> bool:
+        """ Runs all the steps of the plan, concurrently, each as soon as all of its dependencies are done.
+            Returns True if all steps succeeded, otherwise False (see print_timings for which did not).
+        """
+        started = time.time()
+        remaining = dict(self.steps)
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while remaining or running:
+                for step in list(remaining.values()):
+                    if any(self.steps[dependency].status in ('failed', 'skipped') for dependency in step.depends_on):
+                        step.status = 'skipped'
+                        del remaining[step.name]
+                    elif all(self.steps[dependency].status == 'done' for dependency in step.depends_on):
+                        step.status = 'running'
+                        running[executor.submit(self._run, step, started)] = step
+                        del remaining[step.name]
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        self.results[step.name] = future.result()
+                        step.status = 'done'
+                    except Exception as e:
+                        step.error = f'{type(e).__name__}: {e}'
+                        step.status = 'failed'
+        self.duration = time.time() - started
+        return all(step.status == 'done' for step in self.steps.values())
+
+    def print_timings(self) -> None:
+        """ Prints the start offsets, durations and statuses of the steps run by execute. """
+        PRINT(f'Swap plan step timings:')
+        for step in sorted(self.steps.values(),
+                           key=lambda step: step.started if step.started is not None else float('inf')):
+            timing = f'{step.started:.1f}s +{step.duration:.1f}s' if step.started is not None else '-'
+            status = f'{step.status}: {step.error}' if step.error else step.status
+            PRINT(f'    [{timing}] {step.name} ({status})')
+        total = sum(step.duration for step in self.steps.values() if step.duration is not None)
+        PRINT(f'Swap plan took {self.duration or 0:.1f}s (one step after another would be about {total:.1f}s).')
+
+
 FF_DATA_URL = 'https://data.4dnucleome.org'
 FF_STAGING_URL = 'https://staging.4dnucleome.org'
 
@@ -76,6 +218,21 @@ class C4IdentitySwap:
     GREEN_ECOSYSTEM = 'green.ecosystem'
     SCALE_OUT_COUNT = 32
     SCALE_IN_COUNT = 8
+    # rough estimates (in seconds) of how long swap plan steps take, used only for the critical path estimate
+    UPDATE_SERVICE_SECONDS = 2
+    UPDATE_AUTOSCALING_SECONDS = 3
+    SERVICES_STABLE_SECONDS = 300
+    HEALTHY_TARGETS_SECONDS = 30
+    WARMUP_SECONDS = 30
+    SEARCH_WARMUP_SECONDS = 120
+    MAX_WAITER_SERVICES = 10  # the maximum number of services describe_services (and so its waiters) accepts
+    # pre-warm: requests replayed against the (load balancer of the) portal before the switch, each round after
+    # the first (warming caches) of which must meet the p95 latency threshold and maximum error rate given here
+    WARMUP_PATHS = ['/health?format=json', '/']
+    WARMUP_ROUNDS = 3
+    WARMUP_P95_SECONDS = 2.0
+    WARMUP_MAX_ERROR_RATE = 0.05
+    WARMUP_TIMEOUT_SECONDS = 30
 
     @staticmethod
     def unseparate(identifier: str) -> str:
@@ -118,15 +275,346 @@ class C4IdentitySwap:
         return result
 
     @staticmethod
-    def update_service(ecs, cluster, service, new_task_definition):
-        """ Updates the given service configuration to utilize the new task definition """
+    def update_service(ecs, cluster, service, new_task_definition, desired_count=None):
+        """ Updates the given service configuration to utilize the new task definition
+            (and the given desired count of tasks, if any)
+        """
+        # TODO: refactor into dcicutils.ecs_utils
+        return ecs.client.update_service(
+            cluster=cluster,
+            service=service,
+            taskDefinition=new_task_definition,
+            **({'desiredCount': desired_count} if desired_count is not None else {})
+        )
+
+    @staticmethod
+    def scale_service(ecs, cluster, service, desired_count):
+        """ Updates the given service configuration to run the given desired count of tasks """
         # TODO: refactor into dcicutils.ecs_utils
         return ecs.client.update_service(
             cluster=cluster,
             service=service,
-            taskDefinition=new_task_definition
+            desiredCount=desired_count
         )
 
+    @staticmethod
+    def short_name(arn: str) -> str:
+        """ Returns the short name of the given ECS service, cluster or task definition ARN """
+        return arn.split('/')[-1]
+
+    @staticmethod
+    def _is_blue_service(service: str) -> bool:
+        """ Returns True if the given service ARN is that of a service in the blue cluster """
+        return 'blue' in service
+
+    @classmethod
+    def wait_for_services_stable(cls, ecs, cluster: str, services: List[str], delay: int = 15,
+                                 max_attempts: int = 60) -> None:
+        """ Waits for the given services of the given cluster to be stable, i.e. running just their desired count of
+            tasks of their current task definition, with a single services_stable waiter for all of them
+            (well, one per 10 services, as describe_services, which it polls, allows no more than this)
+        """
+        # TODO: refactor into dcicutils.ecs_utils
+        waiter = ecs.client.get_waiter('services_stable')
+        for i in range(0, len(services), cls.MAX_WAITER_SERVICES):
+            waiter.wait(cluster=cluster, services=services[i:i + cls.MAX_WAITER_SERVICES],
+                        WaiterConfig={'Delay': delay, 'MaxAttempts': max_attempts})
+
+    @classmethod
+    def _add_swap_plan_steps(cls, executor: SwapPlanExecutor, ecs, blue_cluster: str, green_cluster: str,
+                             swap_plan: dict, depends_on: Optional[List[str]] = None) -> dict:
+        """ Adds to the given executor the steps to execute the swap plan, i.e. to update each service to its new
+            task definition (all concurrently, once the given depends_on steps are done), and then to wait for the
+            services of each cluster to be stable.
+            Returns the names of the (last) steps waiting for the services to be stable, by cluster ARN.
+        """
+        cluster_updates = {}
+        for service, new_task_definition in swap_plan.items():
+            cluster = blue_cluster if cls._is_blue_service(service) else green_cluster
+            cluster_updates.setdefault(cluster, {})[service] = executor.add(
+                f'update service {cls.short_name(service)}',
+                functools.partial(cls.update_service, ecs, cluster, service, new_task_definition),
+                depends_on=depends_on, estimate=cls.UPDATE_SERVICE_SECONDS)
+        return {cluster: executor.add(f'wait for services stable in {cls.short_name(cluster)}',
+                                      functools.partial(cls.wait_for_services_stable, ecs, cluster, list(updates)),
+                                      depends_on=list(updates.values()), estimate=cls.SERVICES_STABLE_SECONDS)
+                for cluster, updates in cluster_updates.items()}
+
+    @classmethod
+    def _describe_all_services(cls, ecs, blue_cluster: str, blue_services: List[str], green_cluster: str,
+                               green_services: List[str]) -> dict:
+        """ Returns the (describe_services) descriptions of all the given services, by service ARN """
+        descriptions = {}
+        for cluster, services in ((blue_cluster, blue_services), (green_cluster, green_services)):
+            for i in range(0, len(services), cls.MAX_WAITER_SERVICES):
+                for service in cls.describe_services(ecs, cluster, services[i:i + cls.MAX_WAITER_SERVICES])['services']:
+                    descriptions[service['serviceArn']] = service
+        return descriptions
+
+    @classmethod
+    def _determine_prewarm_counts(cls, service_descriptions: dict) -> (dict, dict):
+        """ Determines, for each portal service, i.e. those taking traffic, the desired count of tasks to pre-warm it
+            to when swapping, namely the larger of its own desired count and the running count of its counterpart
+            (the portal service of the other color) whose identity, and so traffic, it is taking over; and the
+            desired count to scale it (back) down to after the switch, namely the desired count of that counterpart.
+            Returns a tuple of these pre-warm and scale-down desired counts, each by service ARN, for just those
+            services whose counts change.
+        """
+        portals = {service: description for service, description in service_descriptions.items()
+                   if cls._determine_service_type(service) == cls.PORTAL}
+        prewarm_counts, scale_down_counts = {}, {}
+        for service, description in portals.items():
+            is_blue = cls._is_blue_service(service)
+            counterpart = find_association(list(portals.values()),
+                                           serviceArn=lambda arn: cls._is_blue_service(arn) != is_blue)
+            if not counterpart:
+                continue
+            prewarm_count = max(description['desiredCount'], counterpart['runningCount'])
+            if prewarm_count != description['desiredCount']:
+                prewarm_counts[service] = prewarm_count
+            if counterpart['desiredCount'] != prewarm_count:
+                scale_down_counts[service] = counterpart['desiredCount']
+        return prewarm_counts, scale_down_counts
+
+    @staticmethod
+    def wait_for_healthy_targets(elbv2, target_group_arn: str, delay: int = 15, max_attempts: int = 40) -> None:
+        """ Waits for all the targets (i.e. tasks) registered with the given target group to be healthy (in service) """
+        elbv2.get_waiter('target_in_service').wait(TargetGroupArn=target_group_arn,
+                                                   WaiterConfig={'Delay': delay, 'MaxAttempts': max_attempts})
+
+    @staticmethod
+    def get_target_group_url(elbv2, target_group_arn: str) -> str:
+        """ Returns the (HTTP) URL of the load balancer forwarding to the given target group """
+        [target_group] = elbv2.describe_target_groups(TargetGroupArns=[target_group_arn])['TargetGroups']
+        load_balancer = elbv2.describe_load_balancers(
+            LoadBalancerArns=target_group['LoadBalancerArns'][:1])['LoadBalancers'][0]
+        return f'http://{load_balancer["DNSName"]}'
+
+    @classmethod
+    def warm_up(cls, elbv2, target_group_arn: str, paths: List[str], rounds: Optional[int] = None,
+                p95_seconds: Optional[float] = None, max_workers: int = 8) -> dict:
+        """ Replays the given warm-up request paths (e.g. top URLs, search queries), concurrently, in the given number
+            of rounds, one after another, against the load balancer for the given target group. The first round warms
+            (e.g. caches); the p95 latency of each round after that must be no more than p95_seconds, and its error
+            (5xx or no response) rate no more than WARMUP_MAX_ERROR_RATE, else IdentitySwapSetupError is raised.
+            Returns the p95 latency and error count of the last round.
+        """
+        rounds = rounds or cls.WARMUP_ROUNDS
+        p95_seconds = p95_seconds or cls.WARMUP_P95_SECONDS
+        url = cls.get_target_group_url(elbv2, target_group_arn)
+
+        def request(path: str) -> (float, bool):
+            started = time.time()
+            try:
+                succeeded = requests.get(f'{url}{path}', timeout=cls.WARMUP_TIMEOUT_SECONDS).status_code < 500
+            except Exception:
+                succeeded = False
+            return time.time() - started, succeeded
+
+        result = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+            for i in range(rounds):
+                latencies, successes = zip(*executor.map(request, paths))
+                result = {'p95': percentile(latencies, 95), 'errors': successes.count(False)}
+                PRINT(f'Warm-up round {i + 1} of {rounds} for {url}: p95 {result["p95"]:.3f}s,'
+                      f' {result["errors"]} errors of {len(paths)} requests')
+                if i > 0 and (result['p95'] > p95_seconds or
+                              result['errors'] > cls.WARMUP_MAX_ERROR_RATE * len(paths)):
+                    raise IdentitySwapSetupError(f'Warm-up of {url} failed: p95 {result["p95"]:.3f}s'
+                                                 f' (threshold {p95_seconds}s), {result["errors"]} errors'
+                                                 f' of {len(paths)} requests')
+        return result
+
+    @classmethod
+    def _add_prewarm_steps(cls, executor: SwapPlanExecutor, ecs, elbv2, service_descriptions: dict,
+                           prewarm_counts: dict, blue_cluster: str, green_cluster: str,
+                           warmup_paths: Optional[List[str]] = None,
+                           warmup_p95_seconds: Optional[float] = None) -> List[str]:
+        """ Adds to the given executor the steps to pre-warm the portal services before any service is updated:
+            to scale those in the given prewarm_counts (by service ARN, i.e. the incoming portal) up to serve the
+            current traffic, and wait for them to be stable; and then, for each portal, to wait for all the targets
+            of its target group to be healthy, and to replay the warm-up requests against it (see warm_up).
+            Returns the names of these (last, warm-up) steps, for the swap to depend on, so that it is gated on them.
+        """
+        cluster_scales = {}
+        for service, desired_count in prewarm_counts.items():
+            cluster = blue_cluster if cls._is_blue_service(service) else green_cluster
+            cluster_scales.setdefault(cluster, {})[service] = executor.add(
+                f'scale service {cls.short_name(service)} (desired count {desired_count})',
+                functools.partial(cls.scale_service, ecs, cluster, service, desired_count),
+                estimate=cls.UPDATE_SERVICE_SECONDS)
+        scaled_steps = {cluster: executor.add(f'wait for scaled services stable in {cls.short_name(cluster)}',
+                                              functools.partial(cls.wait_for_services_stable, ecs, cluster,
+                                                                list(scales)),
+                                              depends_on=list(scales.values()), estimate=cls.SERVICES_STABLE_SECONDS)
+                        for cluster, scales in cluster_scales.items()}
+        warmup_steps = []
+        for service, description in service_descriptions.items():
+            if cls._determine_service_type(service) != cls.PORTAL or not description.get('loadBalancers'):
+                continue
+            cluster = blue_cluster if cls._is_blue_service(service) else green_cluster
+            target_group_arn = description['loadBalancers'][0]['targetGroupArn']
+            healthy_step = executor.add(f'wait for healthy targets {cls.short_name(service)}',
+                                        functools.partial(cls.wait_for_healthy_targets, elbv2, target_group_arn),
+                                        depends_on=[scaled_steps[cluster]] if cluster in scaled_steps else None,
+                                        estimate=cls.HEALTHY_TARGETS_SECONDS)
+            warmup_steps.append(executor.add(f'warm up {cls.short_name(service)}',
+                                             functools.partial(cls.warm_up, elbv2, target_group_arn,
+                                                               warmup_paths or cls.WARMUP_PATHS,
+                                                               p95_seconds=warmup_p95_seconds),
+                                             depends_on=[healthy_step], estimate=cls.WARMUP_SECONDS))
+        return warmup_steps
+
+    @staticmethod
+    def get_task_definition_identity(ecs, task_definition: str) -> Optional[str]:
+        """ Returns the identity (GAC secret name), i.e. IDENTITY environment variable, of the given task definition """
+        response = ecs.client.describe_task_definition(taskDefinition=task_definition)
+        for container in response['taskDefinition']['containerDefinitions']:
+            for variable in container.get('environment') or []:
+                if variable['name'] == 'IDENTITY':
+                    return variable['value']
+        return None
+
+    @staticmethod
+    def warm_up_search(identity: str, search_queries: List[dict], warn_only: bool = False) -> dict:
+        """ Warms up the OpenSearch indices the given identity (GAC) points at (see SearchWarmup) """
+        return SearchWarmup.for_identity(identity, search_queries).warm_up(warn_only=warn_only)
+
+    @classmethod
+    def _add_search_warmup_steps(cls, executor: SwapPlanExecutor, ecs, swap_plan: dict, search_queries: List[dict],
+                                 warn_only: bool = False) -> List[str]:
+        """ Adds to the given executor the steps to warm up the OpenSearch indices that the identities (GACs) of the
+            new portal task definitions point at (known from the swap plan, before any service is updated), by
+            replaying the given search queries until their latencies converge. Returns the names of these steps,
+            for the service updates to depend on; so that, unless warn_only, cold indices gate the swap, rather
+            than being warmed up by the traffic the new portal tasks are already serving.
+        """
+        identities = []
+        for service, new_task_definition in swap_plan.items():
+            if cls._determine_service_type(service) != cls.PORTAL:
+                continue
+            identity = cls.get_task_definition_identity(ecs, new_task_definition)
+            if identity and identity not in identities:
+                identities.append(identity)
+        return [executor.add(f'warm up search {identity}',
+                             functools.partial(cls.warm_up_search, identity, search_queries, warn_only),
+                             estimate=cls.SEARCH_WARMUP_SECONDS)
+                for identity in identities]
+
+    @classmethod
+    def _add_traffic_shift_steps(cls, executor: SwapPlanExecutor, ecs, blue_cluster: str, green_cluster: str,
+                                 swap_plan: dict, traffic_shift: TrafficShift, live_color: str, schedule: List[int],
+                                 depends_on: Optional[List[str]] = None) -> (dict, str):
+        """ Adds to the given executor the steps to execute the swap plan shifting traffic gradually (see
+            TrafficShift), rather than all at once: once the given depends_on steps are done (e.g. pre-warming the
+            portal of the other, incoming, color), the traffic of the load balancer of the given live color is
+            shifted, through the given schedule of percentages, to that incoming portal; then the services of the
+            live color are updated,
+            and once they are stable all of its traffic is shifted back to them; and only then are the services of
+            the incoming color updated. Returns the names of the steps waiting for the services to be stable,
+            by cluster ARN, and the name of the (final) step shifting the traffic back.
+        """
+        live_cluster = blue_cluster if live_color == DeploymentParadigm.BLUE else green_cluster
+        live_plan = {service: new_task_definition for service, new_task_definition in swap_plan.items()
+                     if (blue_cluster if cls._is_blue_service(service) else green_cluster) == live_cluster}
+        incoming_plan = {service: new_task_definition for service, new_task_definition in swap_plan.items()
+                         if service not in live_plan}
+        previous = list(depends_on or [])
+        for percent in schedule:
+            previous = [executor.add(f'shift {percent}% of {live_color} traffic',
+                                     functools.partial(traffic_shift.shift_step, percent),
+                                     depends_on=previous, estimate=traffic_shift.bake_seconds)]
+        wait_steps = cls._add_swap_plan_steps(executor, ecs, blue_cluster, green_cluster, live_plan,
+                                              depends_on=previous)
+        shift_back_step = executor.add(f'shift all {live_color} traffic back', traffic_shift.rollback,
+                                       depends_on=[wait_steps[live_cluster]], estimate=cls.UPDATE_SERVICE_SECONDS)
+        wait_steps.update(cls._add_swap_plan_steps(executor, ecs, blue_cluster, green_cluster, incoming_plan,
+                                                   depends_on=[shift_back_step]))
+        return wait_steps, shift_back_step
+
+    @classmethod
+    def _add_service_steps(cls, executor: SwapPlanExecutor, ecs, elbv2, blue_cluster: str, blue_services: List[str],
+                           green_cluster: str, green_services: List[str], swap_plan: dict, prewarm: bool = False,
+                           warmup_paths: Optional[List[str]] = None, warmup_p95_seconds: Optional[float] = None,
+                           search_queries: Optional[List[dict]] = None, search_warmup_warn_only: bool = False,
+                           traffic_shift: Optional[TrafficShift] = None, live_color: Optional[str] = None,
+                           traffic_shift_schedule: Optional[List[int]] = None) -> (dict, List[str]):
+        """ Adds to the given executor the steps (if pre-warming) to first scale the incoming portal up to serve the
+            current traffic, and wait for the portals to be healthy and warmed up, and (if search_queries are given)
+            to warm up the search indices of the new identities, gating the swap on these; then to update the
+            services per the swap plan (all at once, or shifting traffic gradually if a traffic_shift is given) and
+            to wait for them to be stable.
+            Returns the desired counts to scale the portals down to after the switch, by service ARN; and the names
+            of the steps after which the services are swapped, i.e. waiting for them to be stable (and shifting the
+            traffic back, if shifting traffic), for any further steps to depend on.
+        """
+        scale_down_counts, gate_steps = {}, []
+        if search_queries:
+            gate_steps += cls._add_search_warmup_steps(executor, ecs, swap_plan, search_queries,
+                                                       warn_only=search_warmup_warn_only)
+        if prewarm:
+            service_descriptions = cls._describe_all_services(ecs, blue_cluster, blue_services,
+                                                              green_cluster, green_services)
+            prewarm_counts, scale_down_counts = cls._determine_prewarm_counts(service_descriptions)
+            gate_steps += cls._add_prewarm_steps(executor, ecs, elbv2, service_descriptions, prewarm_counts,
+                                                 blue_cluster, green_cluster, warmup_paths, warmup_p95_seconds)
+        if traffic_shift:
+            wait_steps, shift_back_step = cls._add_traffic_shift_steps(executor, ecs, blue_cluster, green_cluster,
+                                                                       swap_plan, traffic_shift, live_color,
+                                                                       traffic_shift_schedule,
+                                                                       depends_on=gate_steps)
+            swapped_steps = list(wait_steps.values()) + [shift_back_step]
+        else:
+            wait_steps = cls._add_swap_plan_steps(executor, ecs, blue_cluster, green_cluster, swap_plan,
+                                                  depends_on=gate_steps)
+            swapped_steps = list(wait_steps.values())
+        return scale_down_counts, swapped_steps
+
+    @staticmethod
+    def _get_traffic_shift(elbv2, cloudwatch, live_color: Optional[str],
+                           traffic_shift_schedule: Optional[List[int]]) -> Optional[TrafficShift]:
+        """ Returns the TrafficShift for the load balancer of the given live color, if shifting traffic """
+        if not traffic_shift_schedule:
+            return None
+        if live_color not in (DeploymentParadigm.BLUE, DeploymentParadigm.GREEN):
+            raise IdentitySwapSetupError(f'The live color (blue or green) must be given to shift traffic')
+        return TrafficShift.for_color(elbv2, cloudwatch, live_color)
+
+    @staticmethod
+    def _report_traffic_shift(traffic_shift: Optional[TrafficShift], live_color: Optional[str]) -> None:
+        """ Reports the traffic of the given live color left shifted, if any, by a swap plan not fully executed
+            (e.g. if its services failed to update once all of its traffic was shifted), and how to shift it back.
+            It is not shifted back automatically, as the services of the live color may not be able to serve it.
+        """
+        if not traffic_shift or not traffic_shift.percent:
+            return
+        PRINT(f'{traffic_shift.percent}% of the {live_color} traffic is STILL shifted to'
+              f' {traffic_shift.metric_dimension(traffic_shift.shift_target_group_arn)}'
+              f' ({100 - traffic_shift.percent}% to {traffic_shift.metric_dimension(traffic_shift.target_group_arn)})'
+              f' by listener {traffic_shift.listener_arn}')
+        PRINT(f'Once the {live_color} services are healthy, shift it back with: traffic-shift {live_color} --rollback')
+
+    @classmethod
+    def _scale_down_services(cls, ecs, blue_cluster: str, green_cluster: str, scale_down_counts: dict) -> bool:
+        """ Scales the given services down to the given desired counts (by service ARN) after the switch,
+            concurrently. Returns True if all succeeded, otherwise False.
+        """
+        executor = SwapPlanExecutor()
+        for service, desired_count in scale_down_counts.items():
+            cluster = blue_cluster if cls._is_blue_service(service) else green_cluster
+            executor.add(f'scale service {cls.short_name(service)} (desired count {desired_count})',
+                         functools.partial(cls.scale_service, ecs, cluster, service, desired_count),
+                         estimate=cls.UPDATE_SERVICE_SECONDS)
+        succeeded = executor.execute()
+        executor.print_timings()
+        return succeeded
+
+    @classmethod
+    def _print_scale_down_plan(cls, scale_down_counts: dict) -> None:
+        """ Prints the services to be scaled down (see _determine_prewarm_counts) after the switch """
+        for service, desired_count in scale_down_counts.items():
+            PRINT(f'After the switch: scale service {cls.short_name(service)} (desired count {desired_count})')
+
     @classmethod
     def _resolve_target_service_type(cls, current_task_definition: str) -> str:
         """ Helper that determines the 'type' of the service (WRT our application)
@@ -322,21 +810,16 @@ class SMaHTIdentitySwap(C4IdentitySwap):
             swap_plan[service] = opposing_task
         return swap_plan
 
-    @classmethod
-    def _execute_swap_plan(cls, ecs, blue_cluster, green_cluster, swap_plan):
-        """ Executes the swap plan by issuing service updates to the various services. """
-        for service, new_task_definition in swap_plan.items():
-            if 'smahtblue' in service.lower():
-                cluster = blue_cluster
-            else:
-                cluster = green_cluster
-            cls.update_service(ecs, cluster, service, new_task_definition)
+    @staticmethod
+    def _is_blue_service(service: str) -> bool:
+        """ Returns True if the given service ARN is that of a service in the (SMaHT) blue cluster """
+        return 'smahtblue' in service.lower()
 
     @classmethod
-    def _update_foursight(cls) -> None:
+    def _update_foursight(cls) -> bool:
         """ Updates foursight by replacing main.ecosystem with the opposing ecosystem
             ie: if main.ecosystem contains blue.ecosystem, change to green.ecosystem
-            and visa versa """
+            and visa versa. Returns True if updated, otherwise False. """
         with EnvBase.global_env_bucket_named(cls.GLOBAL_ENV_BUCKET):
 
             heading("WARNING")
@@ -347,7 +830,7 @@ class SMaHTIdentitySwap(C4IdentitySwap):
                 PRINT("OK, continuing.")
             else:
                 PRINT("Aborting.")
-                return
+                return False
 
             # Get the current prod env name
             current_main = download_config(bucket=cls.GLOBAL_ENV_BUCKET, key=cls.MAIN_ECOSYSTEM)
@@ -359,15 +842,17 @@ class SMaHTIdentitySwap(C4IdentitySwap):
             swapped_data = {
                 'ecosystem': new_ecosystem
             }
-            upload_config(bucket=cls.GLOBAL_ENV_BUCKET, key=cls.MAIN_ECOSYSTEM, data=swapped_data,
-                          kms_key=cls.SMAHT_KMS_KEY_ID)
+            return upload_config(bucket=cls.GLOBAL_ENV_BUCKET, key=cls.MAIN_ECOSYSTEM, data=swapped_data,
+                                 kms_key=cls.SMAHT_KMS_KEY_ID)
 
     @classmethod
-    def _update_autoscaling(cls, autoscaling_client: boto3.client, cloudwatch_client: boto3.client,
-                            swap_plan: dict) -> None:
-        """ Updates the Indexer worker autoscaling configuration to point to the correct CW Alarms
-            This function assumes the hard coded alarms already exist.
-            It first deletes then re-creates the scaling policies on the applicable services
+    def _add_autoscaling_steps(cls, executor: SwapPlanExecutor, autoscaling_client: boto3.client,
+                               cloudwatch_client: boto3.client, swap_plan: dict,
+                               depends_on: Optional[List[str]] = None) -> None:
+        """ Adds to the given executor the steps to update the Indexer worker autoscaling configuration to point to
+            the correct CW Alarms. This function assumes the hard coded alarms already exist.
+            For each indexer service (concurrently, once the given depends_on steps are done, i.e. the services are
+            swapped) it first deletes then re-creates the scaling policies.
         """
         blue_indexer_service_arn = list(filter(lambda k: cls.INDEXER in k and 'smahtblue' in k.lower(), swap_plan.keys()))[0]
         green_indexer_service_arn = list(filter(lambda k: cls.INDEXER in k and 'smahtgreen' in k.lower(), swap_plan.keys()))[0]
@@ -375,45 +860,53 @@ class SMaHTIdentitySwap(C4IdentitySwap):
         green_indexer_service_resource_id = cls.extract_resource_id_from_arn(green_indexer_service_arn)
         mirror_state = cls._is_mirror_state(swap_plan)  # if True, we just went from green --> blue
 
-        # Ensure indexer services are registered as scalable targets
-        # Should only run once, but may need to rerun if you want to
-        cls._register_scalable_target(autoscaling_client, blue_indexer_service_resource_id)
-        cls._register_scalable_target(autoscaling_client, green_indexer_service_resource_id)
-
-        # Delete all scaling policies from the indexer services, since we will be replacing them
-        cls._delete_scaling_policies(autoscaling_client, blue_indexer_service_resource_id)
-        cls._delete_scaling_policies(autoscaling_client, green_indexer_service_resource_id)
-
         # if in mirror state, prod is blue, so the green services point to blue tasks, so should point to blue alarms
         if mirror_state:
-            cls.update_autoscaling_action(autoscaling_client, cloudwatch_client, 'DataIndexerScaleOut',
-                                          green_indexer_service_resource_id, cls.SCALE_OUT_COUNT, cls.BLUE_SCALE_OUT_ALARM)
-            cls.update_autoscaling_action(autoscaling_client, cloudwatch_client, 'DataIndexerScaleIn',
-                                          green_indexer_service_resource_id, cls.SCALE_IN_COUNT, cls.BLUE_SCALE_IN_ALARM)
-            cls.update_autoscaling_action(autoscaling_client, cloudwatch_client, 'StagingIndexerScaleOut',
-                                          blue_indexer_service_resource_id, cls.SCALE_OUT_COUNT, cls.GREEN_SCALE_OUT_ALARM)
-            cls.update_autoscaling_action(autoscaling_client, cloudwatch_client, 'StagingIndexerScaleIn',
-                                          blue_indexer_service_resource_id, cls.SCALE_IN_COUNT, cls.GREEN_SCALE_IN_ALARM)
+            data_scale_out_alarm, data_scale_in_alarm = cls.BLUE_SCALE_OUT_ALARM, cls.BLUE_SCALE_IN_ALARM
+            staging_scale_out_alarm, staging_scale_in_alarm = cls.GREEN_SCALE_OUT_ALARM, cls.GREEN_SCALE_IN_ALARM
 
         # if we are not in mirror state, then green services point to green tasks and we want to track
         # green queues
         else:
-            cls.update_autoscaling_action(autoscaling_client, cloudwatch_client, 'DataIndexerScaleOut',
-                                          green_indexer_service_resource_id, cls.SCALE_OUT_COUNT, cls.GREEN_SCALE_OUT_ALARM)
-            cls.update_autoscaling_action(autoscaling_client, cloudwatch_client, 'DataIndexerScaleIn',
-                                          green_indexer_service_resource_id, cls.SCALE_IN_COUNT, cls.GREEN_SCALE_IN_ALARM)
-            cls.update_autoscaling_action(autoscaling_client, cloudwatch_client, 'StagingIndexerScaleOut',
-                                          blue_indexer_service_resource_id, cls.SCALE_OUT_COUNT, cls.BLUE_SCALE_OUT_ALARM)
-            cls.update_autoscaling_action(autoscaling_client, cloudwatch_client, 'StagingIndexerScaleIn',
-                                          blue_indexer_service_resource_id, cls.SCALE_IN_COUNT, cls.BLUE_SCALE_IN_ALARM)
+            data_scale_out_alarm, data_scale_in_alarm = cls.GREEN_SCALE_OUT_ALARM, cls.GREEN_SCALE_IN_ALARM
+            staging_scale_out_alarm, staging_scale_in_alarm = cls.BLUE_SCALE_OUT_ALARM, cls.BLUE_SCALE_IN_ALARM
+
+        for resource_id, policy_prefix, scale_out_alarm, scale_in_alarm in [
+                (green_indexer_service_resource_id, 'DataIndexer', data_scale_out_alarm, data_scale_in_alarm),
+                (blue_indexer_service_resource_id, 'StagingIndexer', staging_scale_out_alarm, staging_scale_in_alarm)]:
+            service_name = cls.short_name(resource_id)
+
+            # Ensure indexer service is registered as scalable target
+            # Should only run once, but may need to rerun if you want to
+            register_step = executor.add(f'register scalable target {service_name}',
+                                         functools.partial(cls._register_scalable_target,
+                                                           autoscaling_client, resource_id),
+                                         depends_on=depends_on, estimate=cls.UPDATE_AUTOSCALING_SECONDS)
+
+            # Delete all scaling policies from the indexer service, since we will be replacing them
+            delete_step = executor.add(f'delete scaling policies {service_name}',
+                                       functools.partial(cls._delete_scaling_policies, autoscaling_client, resource_id),
+                                       depends_on=[register_step], estimate=cls.UPDATE_AUTOSCALING_SECONDS)
+
+            for policy_name, scaling_adjustment, alarm_arn in [
+                    (f'{policy_prefix}ScaleOut', cls.SCALE_OUT_COUNT, scale_out_alarm),
+                    (f'{policy_prefix}ScaleIn', cls.SCALE_IN_COUNT, scale_in_alarm)]:
+                executor.add(f'update autoscaling {policy_name} {service_name}',
+                             functools.partial(cls.update_autoscaling_action, autoscaling_client, cloudwatch_client,
+                                               policy_name, resource_id, scaling_adjustment, alarm_arn),
+                             depends_on=[delete_step], estimate=cls.UPDATE_AUTOSCALING_SECONDS)
 
     @classmethod
-    def identity_swap(cls, *, blue: str, green: str) -> None:
+    def identity_swap(cls, *, blue: str, green: str, dry_run: bool = False, prewarm: bool = False,
+                      warmup_paths: Optional[List[str]] = None, warmup_p95_seconds: Optional[float] = None,
+                      search_queries: Optional[List[dict]] = None, search_warmup_warn_only: bool = False,
+                      live_color: Optional[str] = None, traffic_shift_schedule: Optional[List[int]] = None) -> None:
         """ Top level execution of the identity swap """
         ecs = ECSUtils()
         autoscaling = boto3.client('application-autoscaling')
         cw = boto3.client('cloudwatch')
-        app_kind = ConfigManager.get_config_setting(Settings.APP_KIND)
+        elbv2 = boto3.client('elbv2')
+        app_kind = get_app_kind()
         if app_kind != 'smaht':
             raise IdentitySwapSetupError(f'{app_kind} is not supported - must be smaht')
         available_clusters = ecs.list_ecs_clusters()
@@ -424,18 +917,40 @@ class SMaHTIdentitySwap(C4IdentitySwap):
         swap_plan = cls._determine_swap_plan(ecs=ecs, blue_cluster=blue_cluster_arn, blue_services=blue_services,
                                              green_cluster=green_cluster_arn, green_services=green_services)
         cls._pretty_print_swap_plan(swap_plan)
+
+        # If pre-warming, the incoming portal is first scaled up to serve the current traffic, and the portals must
+        # be healthy and warmed up (as must the search indices of the new identities, if search queries are given)
+        # before any service is updated. The services of each cluster are then updated
+        # concurrently, and we wait (once) for all of them to be stable. The indexer task autoscaling trigger updates
+        # follow (concurrently) once the services are swapped, so that the scaling policies never point at the alarms
+        # of the queues of the other identity while the old tasks are still running (nor at all if the swap fails).
+        executor = SwapPlanExecutor()
+        traffic_shift = cls._get_traffic_shift(elbv2, cw, live_color, traffic_shift_schedule)
+        scale_down_counts, swapped_steps = cls._add_service_steps(
+            executor, ecs, elbv2, blue_cluster_arn, blue_services, green_cluster_arn, green_services, swap_plan,
+            prewarm=prewarm, warmup_paths=warmup_paths, warmup_p95_seconds=warmup_p95_seconds,
+            search_queries=search_queries, search_warmup_warn_only=search_warmup_warn_only,
+            traffic_shift=traffic_shift, live_color=live_color, traffic_shift_schedule=traffic_shift_schedule)
+        cls._add_autoscaling_steps(executor, autoscaling, cw, swap_plan, depends_on=swapped_steps)
+        executor.print_plan()
+        cls._print_scale_down_plan(scale_down_counts)
+        if dry_run:
+            PRINT(f'Dry run - swap plan NOT executed (GLOBAL_ENV_BUCKET would then be updated)')
+            return
         confirm = input(f'Please confirm the above swap plan is correct. (yes|no) ').strip().lower() == 'yes'
 
         if confirm:
-            cls._execute_swap_plan(ecs, blue_cluster_arn, green_cluster_arn, swap_plan)
-            PRINT(f'Swap plan executed - new tasks should reflect within 5 minutes')
-
-            # update GLOBAL_ENV_BUCKET
-            cls._update_foursight()
+            succeeded = executor.execute()
+            executor.print_timings()
+            if not succeeded:
+                PRINT(f'Swap plan NOT fully executed - see failed steps above; GLOBAL_ENV_BUCKET NOT updated')
+                cls._report_traffic_shift(traffic_shift, live_color)
+                return
+            PRINT(f'Swap plan executed - new tasks are running and services are stable')
 
-            # Update indexer task autoscaling triggers
-            PRINT(f'Updating indexer autoscaling to reflect new state')
-            cls._update_autoscaling(autoscaling, cw, swap_plan)
+            # update GLOBAL_ENV_BUCKET, and only then scale down the portals pre-warmed for the switch
+            if cls._update_foursight() and scale_down_counts:
+                cls._scale_down_services(ecs, blue_cluster_arn, green_cluster_arn, scale_down_counts)
 
         else:
             PRINT(f'Swap plan NOT executed - exiting with no further action')
@@ -564,18 +1079,9 @@ class FFIdentitySwap(C4IdentitySwap):
             return cls._determine_prod_swap_plan(service_mapping, standard_definitions)
 
     @classmethod
-    def _execute_swap_plan(cls, ecs, blue_cluster, green_cluster, swap_plan):
-        """ Executes the swap plan by issuing service updates to the various services. """
-        for service, new_task_definition in swap_plan.items():
-            if 'blue' in service:
-                cluster = blue_cluster
-            else:
-                cluster = green_cluster
-            cls.update_service(ecs, cluster, service, new_task_definition)
-
-    @classmethod
-    def _update_foursight(cls, assure_prod_color=None, do_legacy=False) -> None:
-        """ Triggers foursight update by updating data/staging env entries in GLOBAL_ENV_BUCKET. """
+    def _update_foursight(cls, assure_prod_color=None, do_legacy=False) -> bool:
+        """ Triggers foursight update by updating data/staging env entries in GLOBAL_ENV_BUCKET.
+            Returns True if main.ecosystem was updated, otherwise False. """
         with EnvBase.global_env_bucket_named('foursight-prod-envs'):
 
             heading("WARNING")
@@ -586,7 +1092,7 @@ class FFIdentitySwap(C4IdentitySwap):
                 PRINT("OK, continuing.")
             else:
                 PRINT("Aborting.")
-                return
+                return False
 
             if assure_prod_color is None:  # i.e., if we're just flipping and not trying to force a specific color
                 main_ecosystem = "main.ecosystem"
@@ -597,7 +1103,7 @@ class FFIdentitySwap(C4IdentitySwap):
                 swapped_color = {'blue': 'green', 'green': 'blue'}[old_color]
                 swapped_ecosystem_file = f"{swapped_color}.ecosystem"
                 swapped_data = download_config(bucket='foursight-prod-envs', key=swapped_ecosystem_file)
-                upload_config(bucket='foursight-prod-envs', key=main_ecosystem, data=swapped_data)
+                switched = upload_config(bucket='foursight-prod-envs', key=main_ecosystem, data=swapped_data)
             else:
                 raise NotImplementedError("need to add support for forcing a specific color")
 
@@ -678,12 +1184,20 @@ class FFIdentitySwap(C4IdentitySwap):
                 upload_config(bucket='foursight-envs', key=blue_env, data=blue)
                 upload_config(bucket='foursight-envs', key='main.ecosystem', data=main)
 
+            return switched
+
     @classmethod
-    def identity_swap(cls, *, blue: str, green: str, mirror: bool, do_legacy: bool) -> None:
+    def identity_swap(cls, *, blue: str, green: str, mirror: bool, do_legacy: bool, dry_run: bool = False,
+                      prewarm: bool = False, warmup_paths: Optional[List[str]] = None,
+                      warmup_p95_seconds: Optional[float] = None, search_queries: Optional[List[dict]] = None,
+                      search_warmup_warn_only: bool = False, live_color: Optional[str] = None,
+                      traffic_shift_schedule: Optional[List[int]] = None) -> None:
         """ Triggers an ECS Service update for the blue and green clusters,
             swapping their tasks. """
         ecs = ECSUtils()
-        app_kind = ConfigManager.get_config_setting(Settings.APP_KIND)
+        elbv2 = boto3.client('elbv2')
+        cw = boto3.client('cloudwatch')
+        app_kind = get_app_kind()
         if app_kind != 'ff':
             raise IdentitySwapSetupError(f'{app_kind} is not supported - must be ff')
         available_clusters = ecs.list_ecs_clusters()
@@ -697,13 +1211,31 @@ class FFIdentitySwap(C4IdentitySwap):
                                              green_cluster=green_cluster_arn, green_services=green_services,
                                              mirror=mirror)
         cls._pretty_print_swap_plan(swap_plan)
+        executor = SwapPlanExecutor()
+        traffic_shift = cls._get_traffic_shift(elbv2, cw, live_color, traffic_shift_schedule)
+        scale_down_counts, _ = cls._add_service_steps(
+            executor, ecs, elbv2, blue_cluster_arn, blue_services, green_cluster_arn, green_services, swap_plan,
+            prewarm=prewarm, warmup_paths=warmup_paths, warmup_p95_seconds=warmup_p95_seconds,
+            search_queries=search_queries, search_warmup_warn_only=search_warmup_warn_only,
+            traffic_shift=traffic_shift, live_color=live_color, traffic_shift_schedule=traffic_shift_schedule)
+        executor.print_plan()
+        cls._print_scale_down_plan(scale_down_counts)
+        if dry_run:
+            PRINT(f'Dry run - swap plan NOT executed (GLOBAL_ENV_BUCKET would then be updated)')
+            return
         confirm = input(f'Please confirm the above swap plan is correct. (yes|no) ').strip().lower() == 'yes'
         if confirm:
-            cls._execute_swap_plan(ecs, blue_cluster_arn, green_cluster_arn, swap_plan)
-            PRINT(f'Swap plan executed - new tasks should reflect within 5 minutes')
+            succeeded = executor.execute()
+            executor.print_timings()
+            if not succeeded:
+                PRINT(f'Swap plan NOT fully executed - see failed steps above; GLOBAL_ENV_BUCKET NOT updated')
+                cls._report_traffic_shift(traffic_shift, live_color)
+                return
+            PRINT(f'Swap plan executed - new tasks are running and services are stable')
 
-        # update GLOBAL_ENV_BUCKET
-        cls._update_foursight(do_legacy=do_legacy)
+        # update GLOBAL_ENV_BUCKET, and only then scale down the portals pre-warmed for the switch
+        if cls._update_foursight(do_legacy=do_legacy) and confirm and scale_down_counts:
+            cls._scale_down_services(ecs, blue_cluster_arn, green_cluster_arn, scale_down_counts)
 
 
 def main():
@@ -715,14 +1247,48 @@ def main():
                         action='store_true', default=False)
     parser.add_argument('--do-legacy', help='Specify this to make changes to the legacy foursight-envs'
                                             ' bucket (should be unused)', action='store_true', default=False)
+    parser.add_argument('--dry-run', help='Print the swap plan steps and estimated duration, but do not execute them.',
+                        action='store_true', default=False)
+    parser.add_argument('--prewarm', help='Scale up, health check and warm up the portals before the switch.',
+                        action='store_true', default=False)
+    parser.add_argument('--warmup-requests', help='File of request paths (e.g. top URLs, search queries), one per line,'
+                                                  ' to warm up the portals with before the switch.',
+                        type=str, default=None)
+    parser.add_argument('--warmup-p95-seconds', help=f'Maximum p95 latency of the warm-up requests for the switch'
+                                                     f' to proceed (default {C4IdentitySwap.WARMUP_P95_SECONDS}).',
+                        type=float, default=None)
+    parser.add_argument('--search-warmup-queries', help='JSON file of recorded search queries to replay against the'
+                                                        ' OpenSearch indices of the new identities, until their'
+                                                        ' latencies converge, before any service is updated.',
+                        type=str, default=None)
+    parser.add_argument('--search-warmup-warn-only', help='Only warn (rather than not switch) if the search latencies'
+                                                          ' do not converge.', action='store_true', default=False)
+    parser.add_argument('--traffic-shift', help='Shift the traffic of the live color to the other color gradually,'
+                                                ' through these comma separated percentages (e.g. 5,25,50,100),'
+                                                ' rolling back if the 5xx rate or response time thresholds are'
+                                                ' breached; requires --live-color.', type=str, default=None)
+    parser.add_argument('--live-color', help='Color (blue or green) whose load balancer serves the live traffic.',
+                        choices=[DeploymentParadigm.BLUE, DeploymentParadigm.GREEN], default=None)
     args = parser.parse_args()
+    traffic_shift_schedule = parse_schedule(args.traffic_shift) if args.traffic_shift else None
+    warmup_paths = read_warmup_paths(args.warmup_requests) if args.warmup_requests else None
+    search_queries = read_search_queries(args.search_warmup_queries) if args.search_warmup_queries else None
 
-    app_kind = ConfigManager.get_config_setting(Settings.APP_KIND)
+    from ..base import ConfigManager  # (see get_app_kind)
+    app_kind = get_app_kind()
     with ConfigManager.validate_and_source_configuration():
         if app_kind == 'ff':
-            FFIdentitySwap.identity_swap(blue=args.blue, green=args.green, mirror=args.mirror, do_legacy=args.do_legacy)
+            FFIdentitySwap.identity_swap(blue=args.blue, green=args.green, mirror=args.mirror, do_legacy=args.do_legacy,
+                                         dry_run=args.dry_run, prewarm=args.prewarm, warmup_paths=warmup_paths,
+                                         warmup_p95_seconds=args.warmup_p95_seconds, search_queries=search_queries,
+                                         search_warmup_warn_only=args.search_warmup_warn_only,
+                                         live_color=args.live_color, traffic_shift_schedule=traffic_shift_schedule)
         else:
-            SMaHTIdentitySwap.identity_swap(blue=args.blue, green=args.green)
+            SMaHTIdentitySwap.identity_swap(blue=args.blue, green=args.green, dry_run=args.dry_run,
+                                            prewarm=args.prewarm, warmup_paths=warmup_paths,
+                                            warmup_p95_seconds=args.warmup_p95_seconds, search_queries=search_queries,
+                                            search_warmup_warn_only=args.search_warmup_warn_only,
+                                            live_color=args.live_color, traffic_shift_schedule=traffic_shift_schedule)
 
 
 if __name__ == '__main__':
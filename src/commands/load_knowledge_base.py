@@ -1,28 +1,296 @@
 import argparse
+import concurrent.futures
+import contextlib
 import glob
 import io
+import itertools
 import json
 import os
+import random
 import requests
-import subprocess
+import threading
+import time
+import zipfile
 
-from dcicutils import ff_utils
+from typing import Iterable, Iterator, Optional, TextIO
 from dcicutils.command_utils import y_or_n
 from dcicutils.lang_utils import conjoined_list, disjoined_list, there_are, string_pluralize
-from dcicutils.misc_utils import PRINT, snake_case_to_camel_case, find_association, find_associations
+from dcicutils.misc_utils import PRINT, find_association, find_associations
 from tqdm import tqdm
-from ..base import ENV_NAME as DEFAULT_ENV_NAME
 
 
 EPILOG = __doc__
 
 
+def default_env_name():
+    """ Returns the ENV_NAME of the custom config. src.base is imported only here, as it requires the custom config
+        as soon as it is imported; the loading logic of this module does not.
+    """
+    from ..base import ENV_NAME
+    return ENV_NAME
+
+
 def maybe_plural(n, thing):  # move to dcicutils.lang_utils
     if not isinstance(n, int):
         n = len(n)
     return thing if n == 1 else string_pluralize(thing)
 
 
+def iter_json_array(fp: TextIO, chunk_size: int = 64 * 1024) -> Iterator:
+    """ Yields the elements of the JSON array read from the given text stream one at a time, parsing them
+        incrementally (reading chunk_size characters at a time), so no more than one element (and one chunk)
+        is held in memory at once, however large the array.
+    """
+    decoder = json.JSONDecoder()
+    buffer, eof = "", False
+
+    def fill():
+        nonlocal buffer, eof
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+    def skip(separators):
+        """ Skips whitespace and (at most one of) the given separators, returning the separator skipped, if any """
+        nonlocal buffer
+        while True:
+            buffer = buffer.lstrip()
+            if buffer or eof:
+                break
+            fill()
+        if buffer[:1] and buffer[0] in separators:
+            separator, buffer = buffer[0], buffer[1:]
+            return separator
+        return None
+
+    if skip("[") != "[":
+        raise ValueError("Expected a JSON array.")
+    if skip("]") == "]":
+        return
+    while True:
+        try:
+            element, end = decoder.raw_decode(buffer)
+            # an element not (yet) followed by a delimiter may be truncated, e.g. the number 1.5 of 1.5e3
+            if not eof and (end == len(buffer) or buffer[end] not in " \t\n\r,]"):
+                raise ValueError("Element may be truncated.")
+        except ValueError:
+            if eof:
+                raise ValueError("Truncated JSON array.")
+            fill()
+            continue
+        buffer = buffer[end:]
+        yield element
+        separator = skip(",]")
+        if separator == "]":
+            return
+        elif separator is None:
+            raise ValueError("Expected , or ] after a JSON array element.")
+        skip("")
+
+
+class KnowledgeBaseLoader:
+    """ Posts knowledge base items to a portal with a bounded pool of concurrent workers.
+        Transient failures (connection errors, timeouts, 429 and 5xx responses) are retried with exponential
+        backoff; this is idempotent since every item has its uuid, so a retried post of an item that did get
+        created (but whose response was lost) gets a 409 conflict, which counts as loaded.
+        Alternatively, items can be bulk loaded, in large batches, through the portal's bulk load endpoint
+        (see bulk_load_items), which saves the request overhead of each item.
+        The uuids of the items loaded are appended to a local journal file, so that a resumed load skips
+        exactly those items.
+    """
+
+    DEFAULT_WORKERS = 8
+    DEFAULT_MAX_ATTEMPTS = 5
+    DEFAULT_BACKOFF_SECONDS = 1.0
+    MAX_BACKOFF_SECONDS = 30.0
+    DEFAULT_TIMEOUT = 60
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    DEFAULT_BATCH_SIZE = 500
+    LOAD_DATA_PATH = "/load_data"  # the portal's (loadxl) bulk load endpoint
+
+    def __init__(self, server, creds, journal_file=None, resume=False, workers=DEFAULT_WORKERS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_seconds=DEFAULT_BACKOFF_SECONDS, timeout=DEFAULT_TIMEOUT):
+        self.server = server.rstrip("/")
+        self.auth = (creds["key"], creds["secret"]) if creds.get("key") else None
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.journal_file = journal_file
+        self.journal = set()
+        self.journal_lock = threading.Lock()
+        if journal_file and resume and os.path.exists(journal_file):
+            with io.open(journal_file) as fp:
+                self.journal = {line.strip() for line in fp if line.strip()}
+        elif journal_file:
+            io.open(journal_file, "w").close()
+
+    def record(self, uuid):
+        """ Records the given uuid as loaded, in the journal (if any). """
+        with self.journal_lock:
+            self.journal.add(uuid)
+            if self.journal_file:
+                with io.open(self.journal_file, "a") as fp:
+                    fp.write(f"{uuid}\n")
+
+    def request(self, method, url, data, ok_statuses=()):
+        """ Sends the given data (as JSON) to the given URL with the given method (POST or PATCH), retrying
+            transient failures with backoff. Returns the response, if successful or of one of the given
+            ok_statuses; raises otherwise.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = self.session.request(method, url, json=data, auth=self.auth, timeout=self.timeout,
+                                                headers={"Accept": "application/json"})
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code < 400 or response.status_code in ok_statuses:
+                    return response
+                error = RuntimeError(f"Bad status code {response.status_code} for {method} {url}: {response.text}")
+                if response.status_code not in self.RETRY_STATUSES:
+                    raise error
+            if attempt < self.max_attempts:
+                delay = min(self.backoff_seconds * 2 ** (attempt - 1), self.MAX_BACKOFF_SECONDS)
+                time.sleep(delay * random.uniform(0.5, 1.0))  # jittered, so that workers do not retry in lockstep
+        raise error
+
+    def post_item(self, item, collection):
+        """ Posts the given item to the given collection (e.g. Gene), retrying transient failures with backoff.
+            Returns "loaded", or "existing" if it was already there (a 409 conflict); raises if it cannot be posted.
+        """
+        response = self.request("POST", f"{self.server}/{collection}", item, ok_statuses={409})
+        if item.get("uuid"):
+            self.record(item["uuid"])
+        return "loaded" if response.status_code < 400 else "existing"
+
+    def patch_item(self, item):
+        """ Patches the given item (by uuid) with all its properties, as loadxl's second pass does, retrying
+            transient failures with backoff; for an item posted by a bulk load which stopped (at an error) before
+            patching it. Returns "loaded"; raises if it cannot be patched.
+        """
+        self.request("PATCH", f"{self.server}/{item['uuid']}", item)
+        self.record(item["uuid"])
+        return "loaded"
+
+    def bulk_load_batch(self, items, item_type):
+        """ Submits the given items, of the given (snake case) item type, to the portal's bulk load endpoint
+            (loadxl's load_data) in one request. Returns the uuids it reports loaded (or skipped, as already
+            there), those it reports only posted, and the errors it reports; loadxl stops at the first error, so
+            any other items it does not report are not loaded either. An item reported only as posted (by loadxl's
+            first pass) is not loaded until its second pass patches it, so it only counts once that is reported,
+            or once the whole response is without errors; otherwise it is left to be patched (see load_items).
+        """
+        response = self.request("POST", f"{self.server}{self.LOAD_DATA_PATH}",
+                                {"store": {item_type: items}, "itype": [item_type], "overwrite": False,
+                                 "iter_response": True})
+        posted, loaded, errors = set(), set(), []
+        # e.g. "POST: <uuid>", then (loadxl's second pass) "PATCH: <uuid>", or "SKIP: <uuid>", or "ERROR: <message>"
+        for line in response.text.splitlines():
+            action, _, detail = line.partition(": ")
+            if action == "POST":
+                posted.add(detail.strip())
+            elif action in ("PATCH", "SKIP"):
+                loaded.add(detail.strip())
+            elif action == "ERROR":
+                errors.append(detail.strip())
+        if not errors:
+            loaded |= posted
+        return loaded, posted - loaded, errors
+
+    def bulk_load_items(self, items: Iterable[dict], item_type, collection,
+                        batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+        """ Loads the given items (any iterable, consumed a batch at a time) of the given (snake case) item type
+            in batches of batch_size (see bulk_load_batch), skipping those already in the journal; the items of
+            a batch not loaded are then loaded one by one (see load_items): posted to the given collection, or
+            patched if the bulk load posted them but stopped before patching them.
+            Returns the counts of the items bulk loaded, loaded one by one, existing, skipped and failed, and the
+            seconds it took.
+        """
+        counts = {"bulk loaded": 0, "loaded": 0, "existing": 0, "skipped": 0, "failed": 0}
+        started = time.time()
+        batches = 0
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                break
+            batches += 1
+            counts["skipped"] += sum(1 for item in batch if item.get("uuid") in self.journal)
+            batch = [item for item in batch if item.get("uuid") not in self.journal]
+            if not batch:
+                continue
+            try:
+                loaded, posted, errors = self.bulk_load_batch(batch, item_type)
+            except Exception as e:
+                loaded, posted, errors = set(), set(), [str(e)]
+            for error in errors:
+                PRINT(f"Bulk load of {item_type} batch {batches} reported: {error}")
+            for uuid in loaded:
+                self.record(uuid)
+            counts["bulk loaded"] += len(loaded)
+            unloaded = [item for item in batch if item.get("uuid") not in loaded]
+            if unloaded:
+                PRINT(f"Loading the {len(unloaded)} {collection} items of batch {batches} not bulk loaded"
+                      f" one by one ({len(posted)} posted but not patched).")
+                fallback_counts = self.load_items(unloaded, collection, total=len(unloaded), posted=posted)
+                for key in ("loaded", "existing", "failed"):
+                    counts[key] += fallback_counts[key]
+        counts["seconds"] = time.time() - started
+        loaded = counts["bulk loaded"] + counts["loaded"] + counts["existing"] + counts["failed"]
+        PRINT(f"Bulk loaded {counts['bulk loaded']} {collection} items in {batches} batches ({counts['loaded']}"
+              f" loaded one by one, {counts['existing']} already there, {counts['skipped']} skipped as already"
+              f" loaded, {counts['failed']} failed) in {counts['seconds']:.1f}s"
+              f" ({loaded / max(counts['seconds'], 1e-6):.1f} items/s).")
+        return counts
+
+    def load_items(self, items: Iterable[dict], collection, total: Optional[int] = None, posted=()) -> dict:
+        """ Posts the given items (any iterable, consumed no further ahead than the workers need) to the given
+            collection concurrently, skipping those already in the journal, and patching (see patch_item) rather
+            than posting those whose uuids are in posted. Failures are reported, not raised.
+            Returns the counts of the items loaded, existing, skipped and failed, and the seconds it took.
+        """
+        counts = {"loaded": 0, "existing": 0, "skipped": 0, "failed": 0}
+        started = time.time()
+        futures = {}
+
+        def collect(done):
+            for future in done:
+                uuid = futures.pop(future)
+                try:
+                    counts[future.result()] += 1
+                except Exception as e:
+                    counts["failed"] += 1
+                    PRINT(f"Failed to load {collection} item {uuid}: {e}")
+                progress.update()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                tqdm(total=total) as progress:
+            for item in items:
+                if item.get("uuid") in self.journal:
+                    counts["skipped"] += 1
+                    progress.update()
+                    continue
+                if len(futures) >= 2 * self.workers:
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                if item.get("uuid") in posted:
+                    futures[executor.submit(self.patch_item, item)] = item["uuid"]
+                else:
+                    futures[executor.submit(self.post_item, item, collection)] = item.get("uuid")
+            collect(concurrent.futures.wait(futures).done)
+        counts["seconds"] = time.time() - started
+        posted = counts["loaded"] + counts["existing"] + counts["failed"]
+        PRINT(f"Loaded {counts['loaded']} {collection} items ({counts['existing']} already there,"
+              f" {counts['skipped']} skipped as already loaded, {counts['failed']} failed) in"
+              f" {counts['seconds']:.1f}s ({posted / max(counts['seconds'], 1e-6):.1f} items/s).")
+        return counts
+
+
 class KnowledgeBase:
 
     CREDS_PATH = os.path.expanduser('~/.cgap-keys.json')
@@ -32,6 +300,9 @@ class KnowledgeBase:
     KB_ZIP_FILE = 'knowledge_base.zip'
     KB_ZIP_PATH = os.path.join(KNOWLEDGE_BASE_PATH, KB_ZIP_FILE)
     DEFAULT_INCLUDE = 'all'
+    # knowledge base types in dependency order (as in the portal's loadxl ORDER), e.g. so that the phenotypes
+    # and disorders are loaded before the evidence linking them; other types are loaded after these
+    TYPE_ORDER = ['gene', 'phenotype', 'disorder', 'evidence_dis_pheno']
 
     TEST_DATA_INSERTS = None
     TEST_DATA_TYPES = None
@@ -40,17 +311,16 @@ class KnowledgeBase:
     @classmethod
     def initialize(cls):
 
-        if not os.path.exists(cls.KB_INSERTS_PATH) and os.path.exists(cls.KB_ZIP_PATH):
-            PRINT(f"Unzipping {cls.KB_ZIP_PATH}...")
-            subprocess.run(f"pushd {cls.KNOWLEDGE_BASE_PATH};"
-                           f" unzip {cls.KB_ZIP_FILE};"
-                           f" ls -dal {cls.KB_INSERTS_DIRNAME};"
-                           f" popd",
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, executable='/bin/bash')
-            cls.initialize()  # Need to look again at available types
-            PRINT(f"Done unzipping {cls.KB_ZIP_PATH}.")
-
-        cls.TEST_DATA_INSERTS = sorted(glob.glob(os.path.join(cls.KB_INSERTS_PATH, "*")))
+        if os.path.exists(cls.KB_INSERTS_PATH):
+            cls.TEST_DATA_INSERTS = sorted(glob.glob(os.path.join(cls.KB_INSERTS_PATH, "*")))
+        elif os.path.exists(cls.KB_ZIP_PATH):
+            # The inserts are read straight out of the zip (see open_inserts), rather than extracted to disk.
+            with zipfile.ZipFile(cls.KB_ZIP_PATH) as kb_zip:
+                cls.TEST_DATA_INSERTS = sorted(name for name in kb_zip.namelist()
+                                               if os.path.dirname(name) == cls.KB_INSERTS_DIRNAME
+                                               and not name.endswith("/"))
+        else:
+            cls.TEST_DATA_INSERTS = []
         cls.TEST_DATA_TYPES = [
             os.path.splitext(os.path.basename(file))[0]
             for file in cls.TEST_DATA_INSERTS
@@ -65,10 +335,34 @@ class KnowledgeBase:
         ]
 
     @classmethod
-    def resume_point(cls, file, server):
-        item_kind = os.path.splitext(os.path.basename(file))[0]
-        item_key = snake_case_to_camel_case(item_kind)
-        return int(requests.get(f"{server}/counts?format=json").json()['db_es_compare'][item_key].split()[1])
+    def inserts_source(cls):
+        """ Returns where the inserts are read from, the inserts directory or, if there is none, the zip file. """
+        return cls.KB_INSERTS_PATH if os.path.exists(cls.KB_INSERTS_PATH) else cls.KB_ZIP_PATH
+
+    @classmethod
+    @contextlib.contextmanager
+    def open_inserts(cls, inserts_file):
+        """ Opens the given inserts file, from the inserts directory or, if there is none, streamed from its
+            member of the zip file.
+        """
+        if os.path.exists(cls.KB_INSERTS_PATH):
+            with io.open(os.path.join(cls.KB_INSERTS_PATH, inserts_file)) as fp:
+                yield fp
+        else:
+            with zipfile.ZipFile(cls.KB_ZIP_PATH) as kb_zip:
+                with kb_zip.open(f"{cls.KB_INSERTS_DIRNAME}/{inserts_file}") as member:
+                    yield io.TextIOWrapper(member, encoding="utf-8")
+
+    @classmethod
+    def type_order_key(cls, inserts_file):
+        """ Returns the key to sort inserts files in dependency order by (see TYPE_ORDER). """
+        item_type = os.path.splitext(os.path.basename(inserts_file))[0]
+        return cls.TYPE_ORDER.index(item_type) if item_type in cls.TYPE_ORDER else len(cls.TYPE_ORDER)
+
+    @classmethod
+    def journal_path(cls, env_name):
+        """ Returns the path of the journal of the items loaded to the given environment. """
+        return os.path.join(cls.KNOWLEDGE_BASE_PATH, f"load-journal-{env_name}.txt")
 
     @classmethod
     def resolve_env_name_server_creds(cls, env_name, server):
@@ -79,7 +373,7 @@ class KnowledgeBase:
             all_creds = json.load(keyfile)
 
         if env_name is None and server is None:
-            env_name = DEFAULT_ENV_NAME
+            env_name = default_env_name()
 
         if env_name:
             env_creds = all_creds.get(env_name)
@@ -105,11 +399,13 @@ class KnowledgeBase:
         return env_name, env_server, env_creds
 
     @classmethod
-    def load(cls, env_name=None, include=None, confirm=True, start=0, resume=False, server=None, show_list=False):
+    def load(cls, env_name=None, include=None, confirm=True, start=0, resume=False, server=None, show_list=False,
+             workers=KnowledgeBaseLoader.DEFAULT_WORKERS, bulk=False,
+             batch_size=KnowledgeBaseLoader.DEFAULT_BATCH_SIZE):
         """ Must be invoked from top level - reads the 3 knowledge base files (provided in zip). """
 
         if show_list:
-            PRINT(f"Known types (from in {cls.KB_INSERTS_PATH}) are:")
+            PRINT(f"Known types (from in {cls.inserts_source()}) are:")
             col1_wid = max([len(entry['type']) for entry in cls.TEST_DATA_TYPE_TO_INSERTS_MAPPINGS])
             for entry in cls.TEST_DATA_TYPE_TO_INSERTS_MAPPINGS:
                 print(f"{entry['type'].ljust(col1_wid)} => {entry['inserts_file']}")
@@ -126,7 +422,7 @@ class KnowledgeBase:
                 return
 
         include = cls.DEFAULT_INCLUDE if include is None else include
-        env_name = env_name or DEFAULT_ENV_NAME
+        env_name = env_name or default_env_name()
         if include == 'all':
             include = ",".join(cls.TEST_DATA_TYPES)
         if not include:
@@ -160,7 +456,7 @@ class KnowledgeBase:
             seen_types.add(include_type)
         if unknown_types:
             PRINT(there_are(unknown_types, kind="unknown include type", punctuate=True))
-            PRINT(f"Known types are {conjoined_list(cls.TEST_DATA_TYPES)}. See {cls.KB_INSERTS_PATH}.")
+            PRINT(f"Known types are {conjoined_list(cls.TEST_DATA_TYPES)}. See {cls.inserts_source()}.")
             # Will return farther down
         if duplicate_types:
             PRINT(there_are(duplicate_types, kind="duplicated include type", punctuate=True))
@@ -184,24 +480,28 @@ class KnowledgeBase:
             PRINT("Aborted.")
             return
 
-        if not os.path.exists(cls.KB_INSERTS_PATH):
-            PRINT(f"Missing inserts path: {cls.KB_INSERTS_PATH}")
+        if not os.path.exists(cls.KB_INSERTS_PATH) and not os.path.exists(cls.KB_ZIP_PATH):
+            PRINT(f"Missing inserts path: {cls.KB_INSERTS_PATH} (or zip file {cls.KB_ZIP_PATH})")
             return
 
-        for included_file in included_files:
-            with io.open(os.path.join(cls.KB_INSERTS_PATH, included_file)) as collection_meta:
-                items = json.load(collection_meta)
-                if resume:
-                    start = cls.resume_point(included_file, server=server)
-                    PRINT(f"Resuming load of {included_file} from inferred position {start}.")
-                elif start > 0:
+        loader = KnowledgeBaseLoader(server, creds, journal_file=cls.journal_path(env_name), resume=resume,
+                                     workers=workers)
+        if resume:
+            PRINT(f"Resuming load, skipping the {len(loader.journal)} items in {loader.journal_file}.")
+        # Each type is loaded (concurrently) only once the types it depends on are loaded.
+        for included_file in sorted(included_files, key=cls.type_order_key):
+            # The items are streamed (see iter_json_array) straight into the loader, so posting starts at once.
+            with cls.open_inserts(included_file) as collection_meta:
+                items = iter_json_array(collection_meta)
+                if start > 0:
                     PRINT(f"Resuming load of {included_file} from specified position {start}.")
-                items = items[start:]
-                for item in tqdm(items):
-                    try:
-                        ff_utils.post_metadata(item, included_file.split('.')[0].title().replace('_', ''), key=creds)
-                    except Exception as e:
-                        print(e)
+                items = itertools.islice(items, start, None)
+                item_type = included_file.split('.')[0]
+                collection = item_type.title().replace('_', '')
+                if bulk:
+                    loader.bulk_load_items(items, item_type, collection, batch_size=batch_size)
+                else:
+                    loader.load_items(items, collection)
             start = 0
 
     @classmethod
@@ -212,7 +512,7 @@ class KnowledgeBase:
             epilog=EPILOG, formatter_class=argparse.RawDescriptionHelpFormatter,
         )
         parser.add_argument("--env-name", dest="env_name", default=None,
-                            help=f"name of environment to load args into (default {DEFAULT_ENV_NAME}"
+                            help=f"name of environment to load args into (default {default_env_name()}"
                                  f" unless --server given)")
         parser.add_argument("--list", dest="show_list", default=False, action="store_true",
                             help="Whether to just list available types rather than load them (default False).")
@@ -221,7 +521,17 @@ class KnowledgeBase:
         parser.add_argument("--start", default=None, type=int,
                             help=f"insert position to start at, for error recovery only (default 0)")
         parser.add_argument("--resume", default=False, action="store_true",
-                            help="whether to resume from last known position (default if omitted is to start from 0)")
+                            help="whether to resume, skipping the items the journal of the last load records as"
+                                 " loaded (default if omitted is to start from 0)")
+        parser.add_argument("--workers", default=KnowledgeBaseLoader.DEFAULT_WORKERS, type=int,
+                            help=f"number of items to post concurrently"
+                                 f" (default {KnowledgeBaseLoader.DEFAULT_WORKERS})")
+        parser.add_argument("--bulk", default=False, action="store_true",
+                            help="whether to load items in batches through the portal's bulk load endpoint, posting"
+                                 " only the items that fail to load that way one by one (default False)")
+        parser.add_argument("--batch-size", dest="batch_size", default=KnowledgeBaseLoader.DEFAULT_BATCH_SIZE,
+                            type=int, help=f"number of items per bulk load batch"
+                                           f" (default {KnowledgeBaseLoader.DEFAULT_BATCH_SIZE})")
         parser.add_argument("--include", default=cls.DEFAULT_INCLUDE,
                             help=(f"comma-separated name(s) of test data groups to include"
                                   f" ({disjoined_list(cls.TEST_DATA_TYPES, conjunction='and/or')},"
@@ -232,7 +542,8 @@ class KnowledgeBase:
         args = parser.parse_args(args=simulated_args)
 
         KnowledgeBase.load(env_name=args.env_name, confirm=not args.no_confirm, include=args.include,
-                           start=args.start, resume=args.resume, server=args.server, show_list=args.show_list)
+                           start=args.start, resume=args.resume, server=args.server, show_list=args.show_list,
+                           workers=args.workers, bulk=args.bulk, batch_size=args.batch_size)
 
 
 def main(simulated_args=None):
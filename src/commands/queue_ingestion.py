@@ -1,6 +1,12 @@
+import argparse
+import boto3
 import io
 import os
 import json
+import threading
+import time
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from dcicutils import ff_utils
 
 
@@ -9,27 +15,158 @@ PATH_TO_CREDS = os.path.expanduser('~/.cgap-keys.json')
 PATH_TO_VCF_META = 'test_data/na_12879/file_processed.json'
 SERVER = 'http://c4ecstrialalphacgapmastertest-273357903.us-east-1.elb.amazonaws.com'
 
+# MUST MATCH cgap-portal/src/encoded/ingestion/queue_utils.py (and src/parts/datastore.py)
+INGESTION_QUEUE_SUFFIX = '-ingestion-queue'
+SQS_BATCH_SIZE = 10  # the most send_message_batch takes
+DEFAULT_WORKERS = 4
+MAX_ATTEMPTS = 3
+BACKOFF_SECONDS = 1.0
 
-def main():
-    with io.open(PATH_TO_CREDS) as keyfile:
-        creds = json.load(keyfile)
 
-    keys = None
-    server_to_find = SERVER.rstrip('/')
+def find_keys(creds_path, server):
+    """ Returns the keys of the given server from the given creds file """
+    with io.open(creds_path) as keyfile:
+        creds = json.load(keyfile)
+    server_to_find = server.rstrip('/')
     for keydict in creds.values():
         if keydict['server'].rstrip('/') == server_to_find:
-            keys = keydict
+            return keydict
+    raise Exception('Did not locate specified server, check creds file.')
+
+
+def read_uuids(path):
+    """ Reads the uuids, one per line, from the given file, skipping blank lines and # comments """
+    with io.open(path) as uuids_file:
+        return [line.strip() for line in uuids_file if line.strip() and not line.lstrip().startswith('#')]
+
+
+def search_ingestion_types(query, key, default=None):
+    """ Returns the ingestion types, by uuid, of the items (submissions) found by the given search query
+        (e.g. /search/?type=IngestionSubmission): each their own, or the given default if they have none
+    """
+    return {item['uuid']: item.get('ingestion_type') or default for item in ff_utils.search_metadata(query, key=key)}
+
+
+class Throttle:
+    """ Spaces out the sends of messages (by however many threads) to at most rate messages per second """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_send = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self, count):
+        """ Waits for the turn to send count messages """
+        with self.lock:
+            send = max(self.next_send, time.time())
+            self.next_send = send + count * self.interval
+        time.sleep(max(0.0, send - time.time()))
+
+
+def send_batch(sqs, queue_url, ingestion_types):
+    """ Sends messages for (up to SQS_BATCH_SIZE) uuids, each with its ingestion type (given by uuid), to the
+        ingestion queue in one call, retrying those that fail other than by the fault of the sender (including
+        the whole call failing, e.g. with an EndpointConnectionError). Returns {uuid: reason} of those failing.
+    """
+    pending, failed = list(ingestion_types), {}
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        entries = [{'Id': str(i), 'MessageBody': json.dumps({'uuid': uuid, 'ingestion_type': ingestion_types[uuid]})}
+                   for i, uuid in enumerate(pending)]
+        try:
+            response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        except Exception as e:
+            code = e.response['Error']['Code'] if isinstance(e, ClientError) else type(e).__name__
+            response = {'Failed': [{'Id': entry['Id'], 'SenderFault': False, 'Code': code, 'Message': str(e)}
+                                   for entry in entries]}
+        retry = []
+        for failure in response.get('Failed', []):
+            uuid = pending[int(failure['Id'])]
+            failed[uuid] = f'{failure["Code"]}: {failure.get("Message", "")}'
+            if not failure['SenderFault']:
+                retry.append(uuid)
+        if not retry or attempt == MAX_ATTEMPTS:
             break
-    if keys is None:
-        raise Exception('Did not locate specified server, check creds file.')
+        for uuid in retry:
+            del failed[uuid]
+        pending = retry
+        time.sleep(BACKOFF_SECONDS * 2 ** (attempt - 1))
+    return failed
+
+
+def queue_uuids(sqs, queue_url, ingestion_types, workers=DEFAULT_WORKERS, rate=None):
+    """ Sends messages for the given uuids, each with its ingestion type (given by uuid), to the ingestion queue,
+        in batches of SQS_BATCH_SIZE sent across a pool of workers, at most rate messages per second if given.
+        Reports and returns {uuid: reason} of those failing.
+    """
+    uuids = list(ingestion_types)
+    batches = [uuids[i:i + SQS_BATCH_SIZE] for i in range(0, len(uuids), SQS_BATCH_SIZE)]
+    throttle = Throttle(rate) if rate else None
+
+    def send(batch):
+        if throttle:
+            throttle.wait(len(batch))
+        return send_batch(sqs, queue_url, {uuid: ingestion_types[uuid] for uuid in batch})
+
+    started = time.time()
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_failed in executor.map(send, batches):
+            failed.update(batch_failed)
+    elapsed = time.time() - started
+    queued = len(uuids) - len(failed)
+    print(f'Queued {queued} of {len(uuids)} uuids for ingestion in {elapsed:.2f}s'
+          f' ({queued / elapsed if elapsed else 0:.1f} messages/s), {len(failed)} failed.')
+    for uuid, reason in failed.items():
+        print(f'Failed to queue {uuid}: {reason}')
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Queues submissions for ingestion: by default the one of PATH_TO_VCF_META through the portal,'
+                    ' or (with --uuids-file or --search) many, sent straight to the ingestion queue.')
+    parser.add_argument('--keyfile', default=PATH_TO_CREDS, help='path to keyfile')
+    parser.add_argument('--server', default=SERVER, help='server of the keys in the keyfile to use')
+    parser.add_argument('--uuids-file', help='file of the uuids to queue, one per line')
+    parser.add_argument('--search', help='search query of the items to queue, e.g.'
+                                         ' "/search/?type=IngestionSubmission&processing_status.state=created"')
+    parser.add_argument('--env', help='name of the environment, whose ingestion queue to send to (bulk only)')
+    parser.add_argument('--ingestion-type', help='ingestion type of the messages for the --uuids-file (required),'
+                                                 ' and for any items found by --search without their own')
+    parser.add_argument('--workers', help=f'Number of batches to send in parallel (default {DEFAULT_WORKERS})',
+                        type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--rate', help='Most messages to send per second (default unlimited)', type=float)
+    args = parser.parse_args()
+    if args.uuids_file and not args.ingestion_type:
+        parser.error('--ingestion-type is required with --uuids-file')
+
+    keys = find_keys(args.keyfile, args.server)
+
+    if not (args.uuids_file or args.search):
+        with io.open(PATH_TO_VCF_META) as item_meta:
+            uuid = json.load(item_meta)['uuid']
 
-    with io.open(PATH_TO_VCF_META) as item_meta:
-        uuid = json.load(item_meta)['uuid']
+        response = ff_utils.post_metadata({
+            'uuids': [uuid]
+        }, 'queue_ingestion', key=keys)
+        print(response)
+        return
 
-    response = ff_utils.post_metadata({
-        'uuids': [uuid]
-    }, 'queue_ingestion', key=keys)
-    print(response)
+    if not args.env:
+        parser.error('--env is required with --uuids-file or --search')
+    ingestion_types = {}
+    if args.uuids_file:
+        ingestion_types.update(dict.fromkeys(read_uuids(args.uuids_file), args.ingestion_type))
+    if args.search:
+        ingestion_types.update(search_ingestion_types(args.search, keys, default=args.ingestion_type))
+    untyped = [uuid for uuid, ingestion_type in ingestion_types.items() if not ingestion_type]
+    if untyped:
+        parser.error(f'{len(untyped)} items found by --search have no ingestion_type (e.g. {untyped[0]});'
+                     f' give --ingestion-type for them')
+    sqs = boto3.client('sqs')
+    queue_url = sqs.get_queue_url(QueueName=args.env + INGESTION_QUEUE_SUFFIX)['QueueUrl']
+    failed = queue_uuids(sqs, queue_url, ingestion_types, workers=args.workers, rate=args.rate)
+    exit(1 if failed else 0)
 
 
 if __name__ == '__main__':
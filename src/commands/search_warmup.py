@@ -0,0 +1,171 @@
+import argparse
+import boto3
+import concurrent.futures
+import io
+import json
+import math
+import time
+
+from typing import List, Optional
+from dcicutils.es_utils import create_es_client
+from dcicutils.misc_utils import PRINT
+from ..exceptions import SearchWarmupError
+
+
+DEFAULT_WORKERS = 8
+# a round is considered converged when its p95 latency is within this fraction of that of the previous round
+DEFAULT_TOLERANCE = 0.1
+DEFAULT_MAX_ROUNDS = 6
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """ Returns the given (nearest rank) percentile of the given values """
+    values = sorted(values)
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)] if values else 0.0
+
+
+def read_search_queries(filename: str) -> List[dict]:
+    """ Reads the recorded search queries to replay from the given JSON file, a list of objects each with the
+        (unprefixed) index to search, e.g. "file_processed" (or none, for all the indices of the namespace),
+        and the search request body, e.g.
+
+            [{"index": "file_processed", "body": {"query": {"match": {"status": "released"}}, "size": 25}},
+             {"body": {"query": {"query_string": {"query": "liver"}}, "aggs": {"type": {"terms": {"field": "type"}}}}}]
+    """
+    with io.open(filename) as fp:
+        queries = json.load(fp)
+    if not isinstance(queries, list) or not queries or not all(isinstance(query, dict) for query in queries):
+        raise SearchWarmupError(f'Search queries file {filename} must contain a (non-empty) list of objects')
+    return queries
+
+
+class SearchWarmup:
+    """ Warms up the OpenSearch indices of an environment, i.e. those with its (snovault) index namespace prefix,
+        before it takes live traffic: an idle cluster has cold filesystem caches and unloaded fielddata, so the
+        first real searches against it are slow. The recorded search queries are replayed concurrently, in rounds,
+        until the p95 latency of a round is within tolerance of that of the previous round (and, if given, no more
+        than p95_seconds), i.e. has converged; which it must do within max_rounds.
+    """
+
+    def __init__(self, es, namespace: str, queries: List[dict], workers: int = DEFAULT_WORKERS,
+                 max_rounds: int = DEFAULT_MAX_ROUNDS, tolerance: float = DEFAULT_TOLERANCE,
+                 p95_seconds: Optional[float] = None):
+        self.es = es
+        self.namespace = namespace
+        self.queries = queries
+        self.workers = workers
+        self.max_rounds = max_rounds
+        self.tolerance = tolerance
+        self.p95_seconds = p95_seconds
+        self.rounds = []
+
+    @staticmethod
+    def get_identity_search_settings(identity: str, secretsmanager=None) -> (str, str):
+        """ Returns the OpenSearch server URL and index namespace from the given identity (GAC) secret """
+        secretsmanager = secretsmanager or boto3.client('secretsmanager')
+        gac = json.loads(secretsmanager.get_secret_value(SecretId=identity)['SecretString'])
+        es_server = gac['ENCODED_ES_SERVER']
+        es_url = es_server if '://' in es_server else f'https://{es_server}'
+        # snovault defaults the index namespace to the env name
+        return es_url, gac.get('ENCODED_ES_NAMESPACE') or gac['ENV_NAME']
+
+    @classmethod
+    def for_identity(cls, identity: str, queries: List[dict], secretsmanager=None, **kwargs) -> 'SearchWarmup':
+        """ Returns a SearchWarmup for the indices the given identity (GAC) secret points at """
+        es_url, namespace = cls.get_identity_search_settings(identity, secretsmanager=secretsmanager)
+        return cls(create_es_client(es_url, use_aws_auth=True), namespace, queries, **kwargs)
+
+    def get_indices(self) -> List[str]:
+        """ Returns the names of the indices of our namespace """
+        return sorted(entry['index'] for entry in self.es.cat.indices(index=f'{self.namespace}*', format='json'))
+
+    def _search(self, query: dict) -> (float, bool):
+        index = f'{self.namespace}{query["index"]}' if query.get('index') else f'{self.namespace}*'
+        started = time.time()
+        try:
+            self.es.search(index=index, body=query.get('body') or {'query': {'match_all': {}}})
+            succeeded = True
+        except Exception:
+            succeeded = False
+        return time.time() - started, succeeded
+
+    def run_round(self, executor: concurrent.futures.Executor) -> dict:
+        """ Replays all the queries (concurrently) once, returning the latency percentiles and error count """
+        latencies, successes = zip(*executor.map(self._search, self.queries))
+        result = {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'max': max(latencies),
+                  'errors': successes.count(False)}
+        self.rounds.append(result)
+        return result
+
+    def is_converged(self) -> bool:
+        """ Returns True if the last round had no errors, and its p95 latency is within tolerance of that
+            of the round before it, and no more than p95_seconds (if given)
+        """
+        if len(self.rounds) < 2 or self.rounds[-1]['errors']:
+            return False
+        previous, last = self.rounds[-2]['p95'], self.rounds[-1]['p95']
+        if self.p95_seconds is not None and last > self.p95_seconds:
+            return False
+        return abs(last - previous) <= self.tolerance * max(previous, last)
+
+    def run(self) -> bool:
+        """ Replays the queries in rounds until converged, or max_rounds. Returns True if converged. """
+        if not self.queries:
+            # nothing would be warmed up, so there are no latencies to converge
+            raise SearchWarmupError(f'No search queries to warm up namespace {self.namespace} with')
+        indices = self.get_indices()
+        if not indices:
+            raise SearchWarmupError(f'No indices found for namespace {self.namespace}')
+        PRINT(f'Warming up {len(indices)} indices for namespace {self.namespace}'
+              f' with {len(self.queries)} search queries.')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(self.workers, len(self.queries)), 1)) \
+                as executor:
+            while len(self.rounds) < self.max_rounds:
+                result = self.run_round(executor)
+                PRINT(f'Search warm-up round {len(self.rounds)} for namespace {self.namespace}:'
+                      f' p50 {result["p50"]:.3f}s, p95 {result["p95"]:.3f}s, max {result["max"]:.3f}s,'
+                      f' {result["errors"]} errors of {len(self.queries)} queries')
+                if self.is_converged():
+                    PRINT(f'Search latencies for namespace {self.namespace} converged'
+                          f' after {len(self.rounds)} rounds.')
+                    return True
+        return False
+
+    def warm_up(self, warn_only: bool = False) -> dict:
+        """ Runs the warm-up; if the latencies do not converge raises SearchWarmupError, or just warns
+            if warn_only (but raises it regardless if there are no queries). Returns the latency percentiles and
+            error count of the last round.
+        """
+        if not self.run():
+            message = (f'Search latencies for namespace {self.namespace} did not converge'
+                       f' after {len(self.rounds)} rounds (p95s: '
+                       f'{", ".join(format(result["p95"], ".3f") for result in self.rounds)})')
+            if not warn_only:
+                raise SearchWarmupError(message)
+            PRINT(f'WARNING: {message}')
+        return self.rounds[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Warms up the OpenSearch indices of the given identity (GAC) by replaying recorded search'
+                    ' queries until their latencies converge.')
+    parser.add_argument('identity', help='Identity (GAC secret name) whose indices to warm up', type=str)
+    parser.add_argument('queries', help='JSON file of the recorded search queries to replay', type=str)
+    parser.add_argument('--max-rounds', help=f'Maximum number of rounds (default {DEFAULT_MAX_ROUNDS})',
+                        type=int, default=DEFAULT_MAX_ROUNDS)
+    parser.add_argument('--tolerance', help=f'Fractional p95 latency change between rounds considered converged'
+                                            f' (default {DEFAULT_TOLERANCE})', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--p95-seconds', help='Maximum p95 latency considered converged', type=float, default=None)
+    parser.add_argument('--workers', help=f'Number of concurrent queries (default {DEFAULT_WORKERS})',
+                        type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--warn-only', help='Only warn (rather than fail) if the latencies do not converge',
+                        action='store_true', default=False)
+    args = parser.parse_args()
+    SearchWarmup.for_identity(args.identity, read_search_queries(args.queries), workers=args.workers,
+                              max_rounds=args.max_rounds, tolerance=args.tolerance,
+                              p95_seconds=args.p95_seconds).warm_up(warn_only=args.warn_only)
+
+
+if __name__ == '__main__':
+    main()
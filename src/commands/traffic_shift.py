@@ -0,0 +1,191 @@
+import argparse
+import boto3
+import datetime
+import time
+
+from typing import List, Optional
+from dcicutils.misc_utils import PRINT, find_association, remove_prefix
+from ..constants import DeploymentParadigm
+from ..exceptions import TrafficShiftError
+
+
+DEFAULT_SCHEDULE = [5, 25, 50, 100]
+DEFAULT_BAKE_SECONDS = 300
+DEFAULT_POLL_SECONDS = 60
+DEFAULT_MAX_5XX_RATE = 0.01
+DEFAULT_MAX_P95_SECONDS = 2.0
+# the (finest standard) period of the load balancer CloudWatch metrics
+METRIC_PERIOD = 60
+
+
+def parse_schedule(schedule: str) -> List[int]:
+    """ Parses a traffic shift schedule of comma separated, increasing, percentages, e.g. 5,25,50,100 """
+    try:
+        percentages = [int(percent) for percent in schedule.split(',')]
+    except ValueError:
+        raise TrafficShiftError(f'Invalid traffic shift schedule {schedule} - must be comma separated percentages')
+    if not percentages or percentages != sorted(set(percentages)) or not 0 < percentages[0] <= percentages[-1] <= 100:
+        raise TrafficShiftError(f'Invalid traffic shift schedule {schedule} - must be increasing percentages'
+                                f' between 1 and 100')
+    return percentages
+
+
+class TrafficShift:
+    """ Shifts the traffic of the load balancer listener of one (blue/green) color gradually from the target group
+        of that color to the shift target group of the other color (see DeploymentParadigm), i.e. to the portal tasks of
+        the other color, by changing the weights of its forward action, step by step through a schedule of
+        percentages, e.g. 5, 25, 50, 100. After each step the target 5xx rate and p95 target response time of the
+        shifted traffic (from CloudWatch) are watched for bake_seconds; if either exceeds its threshold all traffic
+        is shifted back, i.e. rolled back, and TrafficShiftError raised.
+    """
+
+    def __init__(self, elbv2, cloudwatch, listener_arn: str, load_balancer_arn: str, target_group_arn: str,
+                 shift_target_group_arn: str, bake_seconds: float = DEFAULT_BAKE_SECONDS,
+                 poll_seconds: float = DEFAULT_POLL_SECONDS, max_5xx_rate: float = DEFAULT_MAX_5XX_RATE,
+                 max_p95_seconds: float = DEFAULT_MAX_P95_SECONDS):
+        self.elbv2 = elbv2
+        self.cloudwatch = cloudwatch
+        self.listener_arn = listener_arn
+        self.load_balancer_arn = load_balancer_arn
+        self.target_group_arn = target_group_arn
+        self.shift_target_group_arn = shift_target_group_arn
+        self.bake_seconds = bake_seconds
+        self.poll_seconds = poll_seconds
+        self.max_5xx_rate = max_5xx_rate
+        self.max_p95_seconds = max_p95_seconds
+        self.percent = None
+
+    @classmethod
+    def for_color(cls, elbv2, cloudwatch, color: str, **kwargs) -> 'TrafficShift':
+        """ Returns a TrafficShift for the listener of the given color (blue or green), shifting its traffic
+            to the other color; the target groups, load balancer and listener are found by the target group names.
+        """
+        other_color = DeploymentParadigm.other_color(color)
+        target_group_name = DeploymentParadigm.TARGET_GROUP_NAME.format(color=color.capitalize())
+        shift_target_group_name = DeploymentParadigm.SHIFT_TARGET_GROUP_NAME.format(color=other_color.capitalize())
+        target_groups = elbv2.describe_target_groups(Names=[target_group_name, shift_target_group_name])['TargetGroups']
+        target_group = find_association(target_groups, TargetGroupName=target_group_name)
+        shift_target_group = find_association(target_groups, TargetGroupName=shift_target_group_name)
+        if not target_group or not shift_target_group or not target_group.get('LoadBalancerArns'):
+            raise TrafficShiftError(f'Cannot find target groups {target_group_name} and {shift_target_group_name}'
+                                    f' (with a load balancer) - is the blue/green stack up to date?')
+        load_balancer_arn = target_group['LoadBalancerArns'][0]
+        listener = find_association(elbv2.describe_listeners(LoadBalancerArn=load_balancer_arn)['Listeners'],
+                                    Port=80)
+        if not listener:
+            raise TrafficShiftError(f'Cannot find the listener of load balancer {load_balancer_arn}')
+        return cls(elbv2, cloudwatch, listener['ListenerArn'], load_balancer_arn, target_group['TargetGroupArn'],
+                   shift_target_group['TargetGroupArn'], **kwargs)
+
+    def set_weight(self, percent: int) -> None:
+        """ Forwards the given percentage of the listener's traffic to the shift target group, the rest to its own """
+        self.elbv2.modify_listener(ListenerArn=self.listener_arn, DefaultActions=[{
+            'Type': 'forward',
+            'ForwardConfig': {'TargetGroups': [{'TargetGroupArn': self.target_group_arn, 'Weight': 100 - percent},
+                                               {'TargetGroupArn': self.shift_target_group_arn, 'Weight': percent}]}
+        }])
+        self.percent = percent
+
+    @staticmethod
+    def metric_dimension(arn: str) -> str:
+        """ Returns the CloudWatch dimension value for the given load balancer or target group ARN,
+            i.e. app/<name>/<id> or targetgroup/<name>/<id> respectively
+        """
+        return remove_prefix('loadbalancer/', arn.split(':')[-1], required=False)
+
+    def get_metrics(self, start: datetime.datetime, end: datetime.datetime) -> dict:
+        """ Returns the request count, target 5xx count and p95 target response time of the shifted traffic
+            (i.e. that of the shift target group through our load balancer) between the given times
+        """
+        dimensions = [{'Name': 'LoadBalancer', 'Value': self.metric_dimension(self.load_balancer_arn)},
+                      {'Name': 'TargetGroup', 'Value': self.metric_dimension(self.shift_target_group_arn)}]
+        queries = [{'Id': query_id, 'ReturnData': True,
+                    'MetricStat': {'Metric': {'Namespace': 'AWS/ApplicationELB', 'MetricName': metric_name,
+                                              'Dimensions': dimensions},
+                                   'Period': METRIC_PERIOD, 'Stat': stat}}
+                   for query_id, metric_name, stat in (('requests', 'RequestCount', 'Sum'),
+                                                       ('errors', 'HTTPCode_Target_5XX_Count', 'Sum'),
+                                                       ('p95', 'TargetResponseTime', 'p95'))]
+        response = self.cloudwatch.get_metric_data(MetricDataQueries=queries, StartTime=start, EndTime=end)
+        values = {result['Id']: result.get('Values') or [] for result in response['MetricDataResults']}
+        return {'requests': sum(values.get('requests', [])), 'errors': sum(values.get('errors', [])),
+                'p95': max(values.get('p95', []), default=0.0)}
+
+    def check(self, metrics: dict) -> Optional[str]:
+        """ Returns the reason the given metrics breach the thresholds, if they do, otherwise None """
+        if metrics['requests'] and metrics['errors'] / metrics['requests'] > self.max_5xx_rate:
+            return (f'5xx rate {metrics["errors"] / metrics["requests"]:.2%} exceeds {self.max_5xx_rate:.2%}'
+                    f' ({metrics["errors"]:.0f} of {metrics["requests"]:.0f} requests)')
+        if metrics['p95'] > self.max_p95_seconds:
+            return f'p95 target response time {metrics["p95"]:.3f}s exceeds {self.max_p95_seconds}s'
+        return None
+
+    def bake(self) -> dict:
+        """ Watches the metrics of the shifted traffic, every poll_seconds, for bake_seconds (at least once),
+            raising TrafficShiftError if they breach the thresholds. Returns the last metrics.
+        """
+        # the metrics are per METRIC_PERIOD, so include the period in which this step started
+        started = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=METRIC_PERIOD)
+        deadline = time.time() + self.bake_seconds
+        while True:
+            time.sleep(min(self.poll_seconds, max(deadline - time.time(), 0)))
+            metrics = self.get_metrics(started, datetime.datetime.now(datetime.timezone.utc))
+            breach = self.check(metrics)
+            if breach:
+                raise TrafficShiftError(f'Traffic shift at {self.percent}% breached thresholds: {breach}')
+            if time.time() >= deadline:
+                return metrics
+
+    def shift_step(self, percent: int) -> dict:
+        """ Shifts the given percentage of traffic and watches it (see bake), rolling back if it breaches """
+        self.set_weight(percent)
+        PRINT(f'Shifted {percent}% of traffic to {self.metric_dimension(self.shift_target_group_arn)}')
+        try:
+            return self.bake()
+        except Exception:
+            self.rollback()
+            raise
+
+    def rollback(self) -> None:
+        """ Shifts all traffic back to the listener's own target group """
+        self.set_weight(0)
+        PRINT(f'Shifted all traffic back to {self.metric_dimension(self.target_group_arn)}')
+
+    def shift(self, schedule: Optional[List[int]] = None) -> None:
+        """ Shifts traffic through the given schedule of percentages (see shift_step) """
+        for percent in schedule or DEFAULT_SCHEDULE:
+            metrics = self.shift_step(percent)
+            PRINT(f'Traffic shift at {percent}% OK: {metrics["requests"]:.0f} requests,'
+                  f' {metrics["errors"]:.0f} 5xx, p95 {metrics["p95"]:.3f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Gradually shifts the traffic of the load balancer of the given (blue/green) color to the portal'
+                    ' of the other color, rolling back if the 5xx rate or response time thresholds are breached.')
+    parser.add_argument('color', help='Color whose load balancer traffic to shift',
+                        choices=[DeploymentParadigm.BLUE, DeploymentParadigm.GREEN])
+    parser.add_argument('--schedule', help=f'Comma separated percentages to shift through'
+                                           f' (default {",".join(map(str, DEFAULT_SCHEDULE))})',
+                        type=str, default=None)
+    parser.add_argument('--bake-seconds', help=f'Seconds to watch each step (default {DEFAULT_BAKE_SECONDS})',
+                        type=float, default=DEFAULT_BAKE_SECONDS)
+    parser.add_argument('--max-5xx-rate', help=f'Maximum target 5xx rate (default {DEFAULT_MAX_5XX_RATE})',
+                        type=float, default=DEFAULT_MAX_5XX_RATE)
+    parser.add_argument('--max-p95-seconds', help=f'Maximum p95 target response time'
+                                                  f' (default {DEFAULT_MAX_P95_SECONDS})',
+                        type=float, default=DEFAULT_MAX_P95_SECONDS)
+    parser.add_argument('--rollback', help='Shift all traffic back to the color\'s own portal, and exit',
+                        action='store_true', default=False)
+    args = parser.parse_args()
+    traffic_shift = TrafficShift.for_color(boto3.client('elbv2'), boto3.client('cloudwatch'), args.color,
+                                           bake_seconds=args.bake_seconds, max_5xx_rate=args.max_5xx_rate,
+                                           max_p95_seconds=args.max_p95_seconds)
+    if args.rollback:
+        traffic_shift.rollback()
+    else:
+        traffic_shift.shift(parse_schedule(args.schedule) if args.schedule else DEFAULT_SCHEDULE)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,16 @@ class DeploymentParadigm:
     BLUE_GREEN = 'blue/green'
     BLUE = 'blue'
     GREEN = 'green'
+    # The portal service of each color registers with its own target group, forwarded to by the listener of its
+    # own load balancer, and with a "shift" target group, forwarded to (by weight, initially 0) by the listener of
+    # the load balancer of the other color; so that traffic can be shifted gradually between the colors.
+    TARGET_GROUP_NAME = 'TargetGroupApplication{color}'
+    SHIFT_TARGET_GROUP_NAME = 'TargetGroupApplication{color}Shift'
+
+    @staticmethod
+    def other_color(color: str) -> str:
+        """ Returns the other color, i.e. blue for green and green for blue """
+        return DeploymentParadigm.GREEN if color == DeploymentParadigm.BLUE else DeploymentParadigm.BLUE
 
 
 class Settings:
@@ -20,3 +20,19 @@ class C4ApplicationException(Exception):
 
 class IdentitySwapSetupError(Exception):
     pass
+
+
+class SearchWarmupError(Exception):
+    pass
+
+
+class TrafficShiftError(Exception):
+    pass
+
+
+class RollingDeployError(Exception):
+    pass
+
+
+class FileObjectCopyError(Exception):
+    pass
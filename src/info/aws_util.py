@@ -1,6 +1,7 @@
 import boto3
 import concurrent.futures
 import csv
+import functools
 import logging
 import sys
 
@@ -44,20 +45,30 @@ class AWSUtil:
     # The string to be printed in a tsv when describing the value of a tag that has not been assigned for a resource
     TAG_STRING_FOR_UNASSIGNED_TAG = '-'
 
+    def __init__(self, session=None):
+        """ Takes an optional explicit boto3 session (e.g. from AwsContext.establish_credentials) to authenticate
+            with; otherwise uses the boto3 default session and so local creds."""
+        self.session = session
+
+    @property
+    def boto3(self):
+        """ Return the explicit boto3 session if given, else the boto3 module (i.e. its default session)"""
+        return self.session or boto3
+
     @property
     def cloudwatch_client(self):
         """ Return an open cloudwatch resource, authenticated with boto3+local creds"""
-        return boto3.client('cloudwatch')
+        return self.boto3.client('cloudwatch')
 
     @property
     def s3_resource(self):
         """ Return an open s3 resource, authenticated with boto3+local creds"""
-        return boto3.resource('s3')
+        return self.boto3.resource('s3')
 
     @property
     def s3_client(self):
         """ Return an open s3 client, authenticated with boto3+local creds"""
-        return boto3.client('s3')
+        return self.boto3.client('s3')
 
     def get_tag_optional(self, tags, t):
         """ Returns the tag t in the dictionary tag_set with an default value if missing"""
@@ -115,6 +126,45 @@ class AWSUtil:
             response = client.list_object_versions(Bucket=bucket)
             return response
 
+    @staticmethod
+    def iter_object_version_pages(client, bucket, prefix=None):
+        """ Given an s3 client and a bucket, lazily requests pages of object versions (and delete markers),
+            following the next markers until the listing is exhausted. Pages are yielded as they arrive so
+            callers can process arbitrarily large buckets without holding the full listing in memory."""
+        request = {'Bucket': bucket}
+        if prefix:
+            request['Prefix'] = prefix
+        while True:
+            response = client.list_object_versions(**request)
+            yield response
+            if not response.get('IsTruncated'):
+                return
+            request['KeyMarker'] = response['NextKeyMarker']
+            request['VersionIdMarker'] = response['NextVersionIdMarker']
+
+    def iter_object_versions(self, bucket, prefix=None, client=None):
+        """ Streams every object version in the given bucket (optionally restricted to prefix), one
+            'Versions' entry at a time. Delete markers are skipped since they hold no content."""
+        client = client or self.s3_client
+        for response in self.iter_object_version_pages(client, bucket, prefix=prefix):
+            for version in response.get('Versions', []):
+                yield version
+
+    def iter_objects(self, bucket, prefix=None, client=None):
+        """ Streams every current object in the given bucket (optionally restricted to prefix), one
+            list_objects_v2 'Contents' entry at a time, following continuation tokens."""
+        client = client or self.s3_client
+        request = {'Bucket': bucket}
+        if prefix:
+            request['Prefix'] = prefix
+        while True:
+            response = client.list_objects_v2(**request)
+            for obj in response.get('Contents', []):
+                yield obj
+            if not response.get('IsTruncated'):
+                return
+            request['ContinuationToken'] = response['NextContinuationToken']
+
     def generate_versioned_files_summary_tsvs(self):
         """ Generates summary spreadsheets for 1) deleted objects and 2) multi-versioned objects
             in S3 buckets with versioning enabled."""
@@ -135,8 +185,17 @@ class AWSUtil:
             'jupyterhub-fourfront-notebooks',
             'jupyterhub-fourfront-templates'
         ]
-        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-            executor.map(self.generate_versioned_files_summary_tsv_for_bucket, versioned_buckets, chunksize=4)
+        # boto3 sessions cannot be pickled over to worker processes, nor create clients safely from multiple
+        # threads; so with a session use threads sharing one client created up front (clients are thread-safe)
+        if self.session:
+            executor_class = concurrent.futures.ThreadPoolExecutor
+            generate_tsv = functools.partial(self.generate_versioned_files_summary_tsv_for_bucket,
+                                             client=self.s3_client)
+        else:
+            executor_class = concurrent.futures.ProcessPoolExecutor
+            generate_tsv = self.generate_versioned_files_summary_tsv_for_bucket
+        with executor_class(max_workers=4) as executor:
+            executor.map(generate_tsv, versioned_buckets, chunksize=4)
         print('Generated all tsvs.')
 
     def aggregate_version_data(self, total_response):
@@ -210,9 +269,10 @@ class AWSUtil:
         return actionable_data
 
     def generate_versioned_files_summary_tsv_for_bucket(self, bucket='elasticbeanstalk-fourfront-webprod-wfoutput',
-                                                        complete_run=True):
+                                                        complete_run=True, client=None):
         """ Takes a versioned bucket name, and writes a tsv for all versions of the bucket
             complete_run will run the full bucket, otherwise it'll only run for the first ~1000 versions.
+            client is the S3 client to use, defaulting to a new one from our session (or boto3).
 
             TODO perhaps make complete_run configurable elsewhere
         """
@@ -221,7 +281,7 @@ class AWSUtil:
                             format='%(asctime)-15s %(levelname)-8s %(message)s')
         logging.info('Starting run for {}'.format(bucket))
 
-        client = self.s3_client
+        client = client or self.s3_client
         filename = self.VERSION_SUMMARY_FILENAME_FORMAT.format(bucket)
         # Excel cares about the filename for import, GSheets doesn't care
 
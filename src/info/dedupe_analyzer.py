@@ -0,0 +1,192 @@
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+import zlib
+
+from .aws_util import AWSUtil
+from .pricing_calculator import PricingCalculator
+
+
+class DuplicateGroup:
+    """ A set of S3 object versions believed to hold byte-identical content, i.e. sharing (ETag, Size).
+
+        Note that a multipart ETag (one with a '-N' suffix) is an MD5 of the part MD5s, not of the content,
+        so two such ETags only match if the same content was uploaded with the same part layout. A multipart
+        and a single-part upload of the same bytes will never group together; we report what we can prove.
+    """
+
+    def __init__(self, etag, size, copies=0, locations=None):
+        self.etag = etag
+        self.size = size
+        self.copies = copies
+        self.locations = locations or []
+
+    @property
+    def is_multipart(self):
+        return '-' in self.etag
+
+    @property
+    def part_count(self):
+        """ Returns the number of parts encoded in a multipart ETag, or 1 for a single-part upload. """
+        return int(self.etag.rsplit('-', 1)[1]) if self.is_multipart else 1
+
+    @property
+    def reclaimable_bytes(self):
+        """ Bytes that would be freed by keeping exactly one copy. """
+        return self.size * (self.copies - 1)
+
+    def add(self, location, max_locations):
+        self.copies += 1
+        if len(self.locations) < max_locations:
+            self.locations.append(location)
+
+    def merge(self, copies, locations, max_locations):
+        self.copies += copies
+        self.locations.extend(locations[:max(0, max_locations - len(self.locations))])
+
+
+class DuplicateContentAnalyzer:
+    """ Finds byte-identical objects stored under different keys and/or versions of an S3 bucket.
+
+        Objects are grouped by (ETag, Size) from a streaming version listing. Grouping happens in memory until
+        more than max_in_memory_groups distinct groups have been seen, after which all state is spilled to
+        on-disk partitions (by a stable hash of the group key) and each partition is grouped independently,
+        so memory stays bounded by the size of the largest partition rather than by the size of the bucket.
+    """
+    DEDUPE_SUMMARY_FILENAME_FORMAT = 'out/duplicate_content_{}.tsv'
+    DEDUPE_SUMMARY_HEADER = [
+        'etag',
+        'size in bytes',
+        'readable size',
+        'copies',
+        'reclaimable bytes',
+        'readable reclaimable size',
+        'estimated monthly savings',
+        'multipart parts',
+        'locations'
+    ]
+    DEFAULT_MAX_IN_MEMORY_GROUPS = 1_000_000
+    DEFAULT_SPILL_PARTITIONS = 64
+    DEFAULT_MAX_LOCATIONS_PER_GROUP = 10
+
+    def __init__(self, aws_util=None, max_in_memory_groups=DEFAULT_MAX_IN_MEMORY_GROUPS,
+                 spill_partitions=DEFAULT_SPILL_PARTITIONS, max_locations_per_group=DEFAULT_MAX_LOCATIONS_PER_GROUP,
+                 min_size=1, spill_dir=None):
+        self.aws_util = aws_util or AWSUtil()
+        self.max_in_memory_groups = max_in_memory_groups
+        self.spill_partitions = spill_partitions
+        self.max_locations_per_group = max_locations_per_group
+        self.min_size = min_size  # zero-byte objects all share an ETag but reclaim nothing
+        self.spill_dir = spill_dir
+        self.spilled = False
+
+    @staticmethod
+    def normalize_etag(etag):
+        """ S3 returns ETags wrapped in double quotes; strip them so equal ETags compare equal. """
+        return etag.strip('"').lower()
+
+    @staticmethod
+    def format_location(version):
+        """ Returns a printable key/version for an entry from list_object_versions. """
+        version_id = version.get('VersionId')
+        if version_id and version_id != 'null':
+            return '{}?versionId={}'.format(version['Key'], version_id)
+        return version['Key']
+
+    def _partition_for(self, etag, size):
+        return zlib.crc32('{}:{}'.format(etag, size).encode('utf-8')) % self.spill_partitions
+
+    def _group_key(self, version):
+        return self.normalize_etag(version['ETag']), int(version['Size'])
+
+    def find_duplicates(self, versions):
+        """ Consumes an iterable of list_object_versions 'Versions' entries and returns the list of
+            DuplicateGroups with more than one copy, ranked by reclaimable bytes (largest first).
+        """
+        self.spilled = False
+        groups = {}
+        with tempfile.TemporaryDirectory(dir=self.spill_dir) as tmpdir:
+            writers = None
+            files = []
+            try:
+                for version in versions:
+                    etag, size = self._group_key(version)
+                    if size < self.min_size:
+                        continue
+                    location = self.format_location(version)
+                    if writers is not None:
+                        writers[self._partition_for(etag, size)].writerow([etag, size, 1, json.dumps([location])])
+                        continue
+                    group = groups.get((etag, size))
+                    if group is None:
+                        groups[(etag, size)] = group = DuplicateGroup(etag, size)
+                    group.add(location, self.max_locations_per_group)
+                    if len(groups) > self.max_in_memory_groups:
+                        logging.info('More than {} distinct objects seen, spilling to {} partitions in {}'.format(
+                            self.max_in_memory_groups, self.spill_partitions, tmpdir))
+                        files = [io.open(os.path.join(tmpdir, 'partition-{}.tsv'.format(n)), 'w', newline='')
+                                 for n in range(self.spill_partitions)]
+                        writers = [csv.writer(f, delimiter='\t') for f in files]
+                        for group in groups.values():
+                            writers[self._partition_for(group.etag, group.size)].writerow(
+                                [group.etag, group.size, group.copies, json.dumps(group.locations)])
+                        groups = {}
+                        self.spilled = True
+            finally:
+                for f in files:
+                    f.close()
+            if not self.spilled:
+                duplicates = [group for group in groups.values() if group.copies > 1]
+            else:
+                duplicates = []
+                for n in range(self.spill_partitions):
+                    duplicates.extend(self._reduce_partition(os.path.join(tmpdir, 'partition-{}.tsv'.format(n))))
+        return sorted(duplicates, key=lambda g: (g.reclaimable_bytes, g.copies), reverse=True)
+
+    def _reduce_partition(self, filename):
+        """ Groups one spilled partition in memory, returning its duplicate groups. """
+        groups = {}
+        with io.open(filename, newline='') as f:
+            for etag, size, copies, locations in csv.reader(f, delimiter='\t'):
+                size = int(size)
+                group = groups.get((etag, size))
+                if group is None:
+                    groups[(etag, size)] = group = DuplicateGroup(etag, size)
+                group.merge(int(copies), json.loads(locations), self.max_locations_per_group)
+        return [group for group in groups.values() if group.copies > 1]
+
+    def analyze_bucket(self, bucket, prefix=None):
+        """ Streams the full version listing of the given bucket and returns its ranked duplicate groups. """
+        logging.info('Scanning {} for duplicate content...'.format(bucket))
+        return self.find_duplicates(self.aws_util.iter_object_versions(bucket, prefix=prefix))
+
+    def write_duplicates_tsv(self, duplicates, filename):
+        """ Writes the given ranked duplicate groups to filename as a tsv. """
+        with io.open(filename, 'w', newline='') as tsvfile:
+            writer = csv.writer(tsvfile, delimiter='\t', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(self.DEDUPE_SUMMARY_HEADER)
+            for group in duplicates:
+                writer.writerow([
+                    group.etag,
+                    group.size,
+                    PricingCalculator.bytes_to_readable(group.size),
+                    group.copies,
+                    group.reclaimable_bytes,
+                    PricingCalculator.bytes_to_readable(group.reclaimable_bytes),
+                    PricingCalculator.float_to_usd(PricingCalculator.bytes_to_cost_tier_1(group.reclaimable_bytes)),
+                    group.part_count if group.is_multipart else '',
+                    ' '.join(group.locations)
+                ])
+
+    def generate_duplicate_content_tsv(self, bucket, prefix=None, filename=None):
+        """ Scans the given bucket and writes its ranked duplicate groups to a tsv, returning the filename. """
+        filename = filename or self.DEDUPE_SUMMARY_FILENAME_FORMAT.format(bucket)
+        duplicates = self.analyze_bucket(bucket, prefix=prefix)
+        self.write_duplicates_tsv(duplicates, filename)
+        total = sum(group.reclaimable_bytes for group in duplicates)
+        logging.info('Found {} duplicate groups in {}, {} reclaimable. Wrote {}'.format(
+            len(duplicates), bucket, PricingCalculator.bytes_to_readable(total), filename))
+        return filename
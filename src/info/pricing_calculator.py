@@ -131,6 +131,70 @@ class PricingCalculator(object):
             raise Exception()
         return PricingCalculator.float_to_usd(p)
 
+    @staticmethod
+    def storage_class_pricing():
+        """ Returns dictionary of the S3 storage classes we consider for lifecycle transitions, with:
+                cost: storage cost per GiB-month
+                transition_cost: lifecycle transition request cost per 1,000 objects
+                min_size: minimum billable object size in bytes
+                overhead_standard: per-object metadata bytes billed at STANDARD rates
+                overhead_class: per-object metadata bytes billed at this class's rates
+            STANDARD uses the tier 1 cost, so projected savings are for the marginal (first tier) byte.
+            TODO load via boto3 pricing as well
+        """
+        return {
+            'STANDARD': {
+                'cost': 0.023,
+                'transition_cost': 0.0,
+                'min_size': 0,
+                'overhead_standard': 0,
+                'overhead_class': 0
+            },
+            'STANDARD_IA': {
+                'cost': 0.0125,
+                'transition_cost': 0.01,
+                'min_size': 128 * 2 ** 10,
+                'overhead_standard': 0,
+                'overhead_class': 0
+            },
+            'GLACIER': {
+                'cost': 0.0036,
+                'transition_cost': 0.03,
+                'min_size': 0,
+                'overhead_standard': 8 * 2 ** 10,
+                'overhead_class': 32 * 2 ** 10
+            },
+            'DEEP_ARCHIVE': {
+                'cost': 0.00099,
+                'transition_cost': 0.05,
+                'min_size': 0,
+                'overhead_standard': 8 * 2 ** 10,
+                'overhead_class': 32 * 2 ** 10
+            }
+        }
+
+    @staticmethod
+    def monthly_cost_for_storage_class(b, n, storage_class):
+        """ Takes a number of bytes b held in n objects and a storage class name, and returns the monthly
+            cost in USD (as a float) of storing them in that class, including minimum billable sizes and
+            per-object metadata overhead."""
+        pricing = PricingCalculator.storage_class_pricing()
+        standard = pricing['STANDARD']
+        target = pricing[storage_class]
+        billable = max(b, n * target['min_size']) + n * target['overhead_class']
+        return (PricingCalculator.bytes_to_unit(billable, 'GiB') * target['cost'] +
+                PricingCalculator.bytes_to_unit(n * target['overhead_standard'], 'GiB') * standard['cost'])
+
+    @staticmethod
+    def transition_cost_for_storage_class(n, storage_class):
+        """ Returns the one-time lifecycle transition request cost in USD of moving n objects to storage_class """
+        return n / 1000.0 * PricingCalculator.storage_class_pricing()[storage_class]['transition_cost']
+
+    @staticmethod
+    def kms_requests_to_cost(n):
+        """ Takes a number of KMS API requests n and returns their cost in USD as a float ($0.03 per 10,000) """
+        return n / 10000.0 * 0.03
+
     @staticmethod
     def readable_sizes():
         """ Returns dictionary where the keys are readable size units and the values are their sizes in bytes"""
@@ -144,7 +208,7 @@ class PricingCalculator(object):
     @staticmethod
     def bytes_to_readable(b):
         """ Takes a float of bytes b and returns a readable string of size in TB/GB/MB/KB/Bytes"""
-        for size_unit, size_bytes in PricingCalculator.readable_sizes.items():
+        for size_unit, size_bytes in PricingCalculator.readable_sizes().items():
             if b >= size_bytes:
                 return '{} {}'.format(round(b / size_bytes, 2), size_unit)
         return '{} Bytes'.format(round(b, 2))
@@ -0,0 +1,274 @@
+import csv
+import gzip
+import io
+import logging
+
+from bisect import bisect_right
+from datetime import date, datetime, timezone
+from urllib.parse import unquote_plus
+
+from .aws_util import AWSUtil
+from .pricing_calculator import PricingCalculator
+
+
+class TransitionRule:
+    """ A candidate lifecycle rule: transition objects at least min_age_days old and at least min_size bytes
+        large from STANDARD to storage_class. """
+
+    def __init__(self, name, storage_class, min_age_days, min_size=0):
+        if storage_class not in PricingCalculator.storage_class_pricing():
+            raise ValueError('No pricing for storage class {}'.format(storage_class))
+        self.name = name
+        self.storage_class = storage_class
+        self.min_age_days = min_age_days
+        self.min_size = min_size
+
+
+class StorageDistributionAnalyzer:
+    """ Builds object size and age histograms per top-level prefix of an S3 bucket, and projects the savings of
+        candidate lifecycle transition rules from them.
+
+        Sizes are bucketed by powers of two (bucket k holds sizes in [2^(k-1), 2^k), bucket 0 holds empty objects)
+        and ages by AGE_BUCKET_DAYS, plus the min_age_days of every candidate rule, so that rule projections are
+        computed exactly from the histogram cells rather than by re-reading the listing. Objects are consumed as a
+        stream, so memory is bounded by the number of (prefix, size bucket, age bucket) cells, not by object count.
+        Projections assume the objects are currently in STANDARD; objects listed in other classes are tallied
+        separately and left out of the histograms.
+    """
+    DISTRIBUTION_FILENAME_FORMAT = 'out/storage_distribution_{}.tsv'
+    DISTRIBUTION_HEADER = ['prefix', 'size bucket', 'age bucket', 'objects', 'size in bytes', 'readable size']
+    SAVINGS_FILENAME_FORMAT = 'out/transition_savings_{}.tsv'
+    SAVINGS_HEADER = [
+        'rule',
+        'storage class',
+        'min age days',
+        'min size',
+        'prefix',
+        'objects',
+        'size in bytes',
+        'readable size',
+        'current monthly cost',
+        'projected monthly cost',
+        'estimated monthly savings',
+        'one-time transition cost',
+        'break-even months'
+    ]
+    ROOT_PREFIX = '(root)'
+    ALL_PREFIXES = '*'
+    AGE_BUCKET_DAYS = [0, 30, 90, 180, 365, 730, 1825]
+    DEFAULT_TRANSITION_RULES = [
+        TransitionRule('ia-30d-128k', 'STANDARD_IA', 30, min_size=128 * 2 ** 10),
+        TransitionRule('ia-90d-128k', 'STANDARD_IA', 90, min_size=128 * 2 ** 10),
+        TransitionRule('glacier-90d-1m', 'GLACIER', 90, min_size=2 ** 20),
+        TransitionRule('glacier-180d-1m', 'GLACIER', 180, min_size=2 ** 20),
+        TransitionRule('deep-archive-365d-1m', 'DEEP_ARCHIVE', 365, min_size=2 ** 20),
+    ]
+
+    def __init__(self, aws_util=None, rules=None, now=None):
+        self.aws_util = aws_util or AWSUtil()
+        self.rules = self.DEFAULT_TRANSITION_RULES if rules is None else rules
+        self.age_bucket_days = sorted(set(self.AGE_BUCKET_DAYS) | {rule.min_age_days for rule in self.rules})
+        self.now = now or datetime.now(timezone.utc)
+        self.histograms = {}  # prefix -> {(size bucket, age bucket): [objects, bytes]}
+        self.other_storage_classes = {}  # storage class -> [objects, bytes], for objects not in STANDARD
+
+    @classmethod
+    def top_level_prefix(cls, key):
+        head, sep, _ = key.partition('/')
+        return head + sep if sep else cls.ROOT_PREFIX
+
+    @staticmethod
+    def size_bucket_lower_bound(k):
+        return 0 if k == 0 else 2 ** (k - 1)
+
+    @staticmethod
+    def size_bucket_label(k):
+        """ Returns a readable label for power-of-two size bucket k, e.g. '64 KiB-128 KiB' """
+        if k == 0:
+            return '0 B'
+        labels = []
+        for b in (2 ** (k - 1), 2 ** k):
+            for unit in ('TiB', 'GiB', 'MiB', 'KiB'):
+                if b >= PricingCalculator.unit_to_bytes(unit):
+                    labels.append('{:g} {}'.format(PricingCalculator.bytes_to_unit(b, unit), unit))
+                    break
+            else:
+                labels.append('{} B'.format(b))
+        return '-'.join(labels)
+
+    def age_bucket_label(self, i):
+        """ Returns a readable label for age bucket i, e.g. '30-90d' """
+        lower = self.age_bucket_days[i - 1]
+        if i == len(self.age_bucket_days):
+            return '{}d+'.format(lower)
+        return '{}-{}d'.format(lower, self.age_bucket_days[i])
+
+    def add_many(self, objects):
+        """ Consumes an iterable of (key, size in bytes, age in days) tuples into the histograms. This is the hot
+            loop for large buckets, so it avoids per-object method calls. """
+        histograms = self.histograms
+        age_bucket_days = self.age_bucket_days
+        top_level_prefix = self.top_level_prefix
+        last_head = last_cells = None
+        n = 0
+        for key, size, age_days in objects:
+            head = key[:key.find('/') + 1] or key
+            if head != last_head:  # listings are key-ordered, so consecutive keys usually share a prefix
+                prefix = top_level_prefix(key)
+                last_cells = histograms.get(prefix)
+                if last_cells is None:
+                    last_cells = histograms[prefix] = {}
+                last_head = head
+            # objects modified after now (uploaded during the scan, or clock skew) count as 0 days old
+            cell_key = (size.bit_length(), bisect_right(age_bucket_days, age_days) or 1)
+            cell = last_cells.get(cell_key)
+            if cell is None:
+                last_cells[cell_key] = [1, size]
+            else:
+                cell[0] += 1
+                cell[1] += size
+            n += 1
+        return n
+
+    def _tally_other_storage_class(self, storage_class, size):
+        tally = self.other_storage_classes.setdefault(storage_class, [0, 0])
+        tally[0] += 1
+        tally[1] += size
+
+    def _iter_listing_entries(self, objects):
+        now = self.now
+        for obj in objects:
+            storage_class = obj.get('StorageClass', 'STANDARD')
+            if storage_class != 'STANDARD':
+                self._tally_other_storage_class(storage_class, obj['Size'])
+                continue
+            yield obj['Key'], obj['Size'], (now - obj['LastModified']).total_seconds() / 86400
+
+    def add_objects(self, objects):
+        """ Consumes an iterable of list_objects_v2 'Contents' entries, returning the number of objects added. """
+        return self.add_many(self._iter_listing_entries(objects))
+
+    def _iter_inventory_entries(self, rows, key_column, size_column, last_modified_column, storage_class_column):
+        today = self.now.date()
+        ages = {}  # inventory dates repeat heavily, so parse each distinct day once
+        for row in rows:
+            size = int(row[size_column] or 0)
+            if storage_class_column is not None and row[storage_class_column] not in ('STANDARD', ''):
+                self._tally_other_storage_class(row[storage_class_column], size)
+                continue
+            day = row[last_modified_column][:10]
+            age_days = ages.get(day)
+            if age_days is None:
+                age_days = ages[day] = (today - date.fromisoformat(day)).days
+            yield unquote_plus(row[key_column]), size, age_days
+
+    def add_inventory_csv(self, filename, key_column=1, size_column=2, last_modified_column=3,
+                          storage_class_column=None):
+        """ Consumes an S3 Inventory CSV data file (optionally gzipped), returning the number of objects added.
+            Inventory CSVs have no header; the default columns are for an inventory configured with
+            Size and LastModifiedDate as its first optional fields (Bucket, Key, Size, LastModifiedDate, ...).
+            Ages are computed to day granularity. """
+        opener = gzip.open if filename.endswith('.gz') else io.open
+        with opener(filename, 'rt', newline='') as f:
+            return self.add_many(self._iter_inventory_entries(
+                csv.reader(f), key_column, size_column, last_modified_column, storage_class_column))
+
+    def analyze_bucket(self, bucket, prefix=None):
+        """ Streams the current object listing of the given bucket into the histograms. """
+        logging.info('Scanning {} for object size and age distribution...'.format(bucket))
+        return self.add_objects(self.aws_util.iter_objects(bucket, prefix=prefix))
+
+    def project_savings(self, rules=None):
+        """ Returns a list of per-rule projections, one row per (rule, prefix) with any matching objects plus a
+            total row per rule under ALL_PREFIXES, each a dict with objects, bytes, current_cost, projected_cost,
+            monthly_savings, transition_cost and break_even_months. Sorted by total monthly savings per rule. """
+        results = []
+        for rule in rules or self.rules:
+            rule_rows = []
+            totals = [0, 0]
+            for prefix, cells in self.histograms.items():
+                objects = size = 0
+                for (size_bucket, age_bucket), (count, total_bytes) in cells.items():
+                    if (self.age_bucket_days[age_bucket - 1] >= rule.min_age_days and
+                            self.size_bucket_lower_bound(size_bucket) >= rule.min_size):
+                        objects += count
+                        size += total_bytes
+                if objects:
+                    rule_rows.append(self._projection(rule, prefix, objects, size))
+                    totals[0] += objects
+                    totals[1] += size
+            rule_rows.sort(key=lambda r: r['monthly_savings'], reverse=True)
+            results.append([self._projection(rule, self.ALL_PREFIXES, *totals)] + rule_rows)
+        results.sort(key=lambda rows: rows[0]['monthly_savings'], reverse=True)
+        return [row for rows in results for row in rows]
+
+    @staticmethod
+    def _projection(rule, prefix, objects, size):
+        current_cost = PricingCalculator.monthly_cost_for_storage_class(size, objects, 'STANDARD')
+        projected_cost = PricingCalculator.monthly_cost_for_storage_class(size, objects, rule.storage_class)
+        monthly_savings = current_cost - projected_cost
+        transition_cost = PricingCalculator.transition_cost_for_storage_class(objects, rule.storage_class)
+        return {
+            'rule': rule,
+            'prefix': prefix,
+            'objects': objects,
+            'bytes': size,
+            'current_cost': current_cost,
+            'projected_cost': projected_cost,
+            'monthly_savings': monthly_savings,
+            'transition_cost': transition_cost,
+            'break_even_months': transition_cost / monthly_savings if monthly_savings > 0 else None
+        }
+
+    def write_distribution_tsv(self, filename):
+        """ Writes the size and age histograms to filename as a tsv, one row per non-empty cell. """
+        with io.open(filename, 'w', newline='') as tsvfile:
+            writer = csv.writer(tsvfile, delimiter='\t', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(self.DISTRIBUTION_HEADER)
+            for prefix in sorted(self.histograms):
+                cells = self.histograms[prefix]
+                for size_bucket, age_bucket in sorted(cells):
+                    count, size = cells[(size_bucket, age_bucket)]
+                    writer.writerow([prefix, self.size_bucket_label(size_bucket), self.age_bucket_label(age_bucket),
+                                     count, size, PricingCalculator.bytes_to_readable(size)])
+
+    def write_savings_tsv(self, savings, filename):
+        """ Writes the given project_savings rows to filename as a tsv. """
+        with io.open(filename, 'w', newline='') as tsvfile:
+            writer = csv.writer(tsvfile, delimiter='\t', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(self.SAVINGS_HEADER)
+            for row in savings:
+                rule = row['rule']
+                writer.writerow([
+                    rule.name,
+                    rule.storage_class,
+                    rule.min_age_days,
+                    PricingCalculator.bytes_to_readable(rule.min_size),
+                    row['prefix'],
+                    row['objects'],
+                    row['bytes'],
+                    PricingCalculator.bytes_to_readable(row['bytes']),
+                    PricingCalculator.float_to_usd(row['current_cost']),
+                    PricingCalculator.float_to_usd(row['projected_cost']),
+                    PricingCalculator.float_to_usd(row['monthly_savings']),
+                    PricingCalculator.float_to_usd(row['transition_cost']),
+                    '' if row['break_even_months'] is None else round(row['break_even_months'], 2)
+                ])
+
+    def generate_storage_distribution_tsvs(self, bucket, prefix=None, inventory_files=None):
+        """ Builds the histograms for the given bucket, from its S3 Inventory CSV files if given or else from a
+            streaming listing, and writes the distribution and transition savings tsvs, returning their filenames. """
+        if inventory_files:
+            n = sum(self.add_inventory_csv(filename) for filename in inventory_files)
+        else:
+            n = self.analyze_bucket(bucket, prefix=prefix)
+        for storage_class, (count, size) in sorted(self.other_storage_classes.items()):
+            logging.info('Skipped {} objects ({}) already in {}'.format(
+                count, PricingCalculator.bytes_to_readable(size), storage_class))
+        distribution_filename = self.DISTRIBUTION_FILENAME_FORMAT.format(bucket)
+        savings_filename = self.SAVINGS_FILENAME_FORMAT.format(bucket)
+        self.write_distribution_tsv(distribution_filename)
+        self.write_savings_tsv(self.project_savings(), savings_filename)
+        logging.info('Analyzed {} objects in {} prefixes of {}. Wrote {} and {}'.format(
+            n, len(self.histograms), bucket, distribution_filename, savings_filename))
+        return distribution_filename, savings_filename
@@ -333,10 +333,14 @@ class C4Datastore(C4DatastoreBase, C4Part):
 
     @staticmethod
     def build_s3_bucket_encryption(s3_key_id) -> BucketEncryption:
-        """ Builds a bucket encryption option for our s3 buckets using the created KMS key """
+        """ Builds a bucket encryption option for our s3 buckets using the created KMS key.
+            S3 Bucket Keys are enabled so that S3 uses a short-lived bucket-level data key rather than calling
+            KMS for every object GET/PUT, which keeps us clear of KMS request quotas and cuts KMS request costs.
+        """
         return BucketEncryption(
             ServerSideEncryptionConfiguration=[
                 ServerSideEncryptionRule(
+                    BucketKeyEnabled=True,
                     ServerSideEncryptionByDefault=ServerSideEncryptionByDefault(
                         KMSMasterKeyID=s3_key_id,
                         SSEAlgorithm="aws:kms",
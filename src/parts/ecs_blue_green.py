@@ -34,6 +34,9 @@ class ECSBlueGreen(C4ECSApplication):
     PORTAL_CONTAINER_DEFINITION = 'Portal'
     INDEXER_CONTAINER_DEFINITION = 'Indexer'
     DEPLOYMENT_CONTAINER_DEFINITION = 'DeploymentAction'
+    # See DeploymentParadigm for the target groups (and "shift" target groups) of the portal service of each color.
+    TARGET_GROUP_NAME = DeploymentParadigm.TARGET_GROUP_NAME
+    SHIFT_TARGET_GROUP_NAME = DeploymentParadigm.SHIFT_TARGET_GROUP_NAME
 
     SHARING = 'ecosystem'
 
@@ -87,29 +90,34 @@ class ECSBlueGreen(C4ECSApplication):
         target_group_blue = self.ecs_lbv2_target_group_blue()
         template.add_resource(target_group_green)
         template.add_resource(target_group_blue)
+        shift_target_group_green = self.ecs_lbv2_shift_target_group(DeploymentParadigm.GREEN)
+        shift_target_group_blue = self.ecs_lbv2_shift_target_group(DeploymentParadigm.BLUE)
+        template.add_resource(shift_target_group_green)
+        template.add_resource(shift_target_group_blue)
 
         # ECS Tasks/Services
         # This dictionary structure just collects all necessary components for building the
         # symmetric blue/green cleanly - core components include:
         #   * ECS Cluster
-        #   * Target Group
+        #   * Target Group (and shift Target Group)
         #   * Identity (GAC)
         #   * Log Group
         tags = {
-            DeploymentParadigm.BLUE: (blue_cluster, target_group_blue,
+            DeploymentParadigm.BLUE: (blue_cluster, target_group_blue, shift_target_group_blue,
                                       ConfigManager.get_config_setting(Settings.BLUE_IDENTITY),
                                       C4LoggingExports.APPLICATION_LOG_GROUP_BLUE),
-            DeploymentParadigm.GREEN: (green_cluster, target_group_green,
+            DeploymentParadigm.GREEN: (green_cluster, target_group_green, shift_target_group_green,
                                        ConfigManager.get_config_setting(Settings.GREEN_IDENTITY),
                                        C4LoggingExports.APPLICATION_LOG_GROUP_GREEN)
         }
-        for tag, (cluster, target_group, identity, log_export) in tags.items():
+        for tag, (cluster, target_group, shift_target_group, identity, log_export) in tags.items():
             # Portal task/service
             portal_task = self.ecs_portal_task(image_tag=tag, log_group_export=log_export, identity=identity)
             template.add_resource(portal_task)
             portal_service = self.ecs_portal_service(cluster_ref=Ref(cluster),
                                                      target_group_ref=Ref(target_group), image_tag=tag,
-                                                     task_definition=Ref(portal_task))
+                                                     task_definition=Ref(portal_task),
+                                                     shift_target_group_ref=Ref(shift_target_group))
             template.add_resource(portal_service)
 
             # Indexer task/service
@@ -139,15 +147,19 @@ class ECSBlueGreen(C4ECSApplication):
         template.add_resource(blue_lb)
         green_lb = self.ecs_application_load_balancer(deployment_type=DeploymentParadigm.GREEN)
         template.add_resource(green_lb)
+        # Each listener forwards to the target group of its own color, and (with weight 0, until traffic is shifted,
+        # see src/commands/traffic_shift.py) to the shift target group of the other color
         template.add_resource(
             self.ecs_application_load_balancer_listener(target_group_blue,
                                                         logical_id=f'LBListener{DeploymentParadigm.BLUE}',
-                                                        lb_ref=Ref(blue_lb))
+                                                        lb_ref=Ref(blue_lb),
+                                                        shift_target_group=shift_target_group_green)
         )
         template.add_resource(
             self.ecs_application_load_balancer_listener(target_group_green,
                                                         logical_id=f'LBListener{DeploymentParadigm.GREEN}',
-                                                        lb_ref=Ref(green_lb))
+                                                        lb_ref=Ref(green_lb),
+                                                        shift_target_group=shift_target_group_blue)
         )
 
         # Add indexing Cloudwatch Alarms
@@ -196,23 +208,39 @@ class ECSBlueGreen(C4ECSApplication):
         )
 
     def ecs_application_load_balancer_listener(self, target_group: elbv2.TargetGroup,
-                                               logical_id=None, lb_ref=None):
-        """ Load balancer listener, forwards traffic to portal tasks """
+                                               logical_id=None, lb_ref=None,
+                                               shift_target_group: elbv2.TargetGroup = None):
+        """ Load balancer listener, forwards traffic to portal tasks
+            If a shift target group is given, forwards by weight, all to the given target group and none to the
+            shift target group; the weights are then changed to shift traffic (see src/commands/traffic_shift.py).
+        """
+        if shift_target_group:
+            action = elbv2.Action(Type='forward', ForwardConfig=elbv2.ForwardConfig(TargetGroups=[
+                elbv2.TargetGroupTuple(TargetGroupArn=Ref(target_group), Weight=100),
+                elbv2.TargetGroupTuple(TargetGroupArn=Ref(shift_target_group), Weight=0)
+            ]))
+        else:
+            action = elbv2.Action(Type='forward', TargetGroupArn=Ref(target_group))
         return elbv2.Listener(
             self.name.logical_id(logical_id) if logical_id else self.name.logical_id('LBListener'),
             Port=80,
             Protocol='HTTP',
             LoadBalancerArn=lb_ref or Ref(self.ecs_application_load_balancer()),
-            DefaultActions=[
-                elbv2.Action(Type='forward', TargetGroupArn=Ref(target_group))
-            ]
+            DefaultActions=[action]
         )
 
     def ecs_lbv2_target_group_blue(self) -> elbv2.TargetGroup:
-        return self.ecs_lbv2_target_group(name=f'TargetGroupApplication{DeploymentParadigm.BLUE.capitalize()}')
+        return self.ecs_lbv2_target_group(name=self.TARGET_GROUP_NAME.format(
+            color=DeploymentParadigm.BLUE.capitalize()))
 
     def ecs_lbv2_target_group_green(self) -> elbv2.TargetGroup:
-        return self.ecs_lbv2_target_group(name=f'TargetGroupApplication{DeploymentParadigm.GREEN.capitalize()}')
+        return self.ecs_lbv2_target_group(name=self.TARGET_GROUP_NAME.format(
+            color=DeploymentParadigm.GREEN.capitalize()))
+
+    def ecs_lbv2_shift_target_group(self, deployment_type: str) -> elbv2.TargetGroup:
+        """ Target group for the portal tasks of the given color, forwarded to by the listener of the other color """
+        return self.ecs_lbv2_target_group(name=self.SHIFT_TARGET_GROUP_NAME.format(
+            color=deployment_type.capitalize()))
 
     def ecs_portal_task(self, cpu='4096', mem='8192', image_tag='',
                         log_group_export=None, identity=None, mirror=False) -> TaskDefinition:
@@ -280,7 +308,7 @@ class ECSBlueGreen(C4ECSApplication):
         )
 
     def ecs_portal_service(self, cluster_ref=None, target_group_ref=None, image_tag='',
-                           task_definition=None, concurrency=8) -> Service:
+                           task_definition=None, concurrency=8, shift_target_group_ref=None) -> Service:
         """ Defines the portal service (manages portal Tasks)
             Note dependencies: https://stackoverflow.com/questions/53971873/the-target-group-does-not-have-an-associated-load-balancer
 
@@ -292,18 +320,29 @@ class ECSBlueGreen(C4ECSApplication):
             :param task_definition: reference to task definition to use
             :param concurrency: # of concurrent tasks to run - since this setup is intended for use with
                                 production, this value is 8, approximately matching our current resources.
+            :param shift_target_group_ref: reference to the shift target group (of the other color's listener),
+                                           to also register with, if any
         """  # noQA - ignore line length issues
+        load_balancers = [
+            LoadBalancer(
+                # this must match Name in TaskDefinition (ContainerDefinition)
+                ContainerName=self.PORTAL_CONTAINER_DEFINITION,
+                ContainerPort=Ref(self.ecs_web_worker_port()),
+                TargetGroupArn=Ref(self.ecs_lbv2_target_group()) if not target_group_ref else target_group_ref)
+        ]
+        depends_on = [self.name.logical_id(f'LBListener{image_tag}')]
+        if shift_target_group_ref:
+            load_balancers.append(LoadBalancer(ContainerName=self.PORTAL_CONTAINER_DEFINITION,
+                                               ContainerPort=Ref(self.ecs_web_worker_port()),
+                                               TargetGroupArn=shift_target_group_ref))
+            # the shift target group is forwarded to by the listener of the other color
+            depends_on.append(self.name.logical_id(f'LBListener{DeploymentParadigm.other_color(image_tag)}'))
         return Service(
             f'{APP_KIND.capitalize()}{image_tag}PortalService',
             Cluster=Ref(self.ecs_cluster()) if not cluster_ref else cluster_ref,
-            DependsOn=[self.name.logical_id(f'LBListener{image_tag}')],
+            DependsOn=depends_on,
             DesiredCount=ConfigManager.get_config_setting(Settings.ECS_WSGI_COUNT, concurrency),
-            LoadBalancers=[
-                LoadBalancer(
-                    ContainerName=self.PORTAL_CONTAINER_DEFINITION,  # this must match Name in TaskDefinition (ContainerDefinition)
-                    ContainerPort=Ref(self.ecs_web_worker_port()),
-                    TargetGroupArn=Ref(self.ecs_lbv2_target_group()) if not target_group_ref else target_group_ref)
-            ],
+            LoadBalancers=load_balancers,
             # Run portal service on Fargate Spot
             CapacityProviderStrategy=[
                 CapacityProviderStrategyItem(
@@ -1,4 +1,5 @@
 import io
+import json
 import mock
 import os
 import tempfile
@@ -85,3 +86,37 @@ def test_aws_context_with_credentials_dir() -> None:
                                     TestData.aws_secret_access_key, TestData.aws_region) as aws_credentials_dir:
         _test_aws_context(aws_credentials_dir, None, None, None, False)
         _test_aws_context(aws_credentials_dir, None, None, None, True)
+
+
+def _session_for_credentials_dir(aws_credentials_dir: str):
+    """ Returns the (real) boto3 session AwsContext.establish_credentials creates for the given directory """
+    aws_object = aws.Aws(aws_credentials_dir)
+    return aws_object._create_session(aws_object._session_kwargs())
+
+
+def test_aws_context_with_credentials_dir_resolves_credentials_from_dir_only() -> None:
+    with tempfile.TemporaryDirectory() as aws_credentials_dir, \
+            mock.patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "UNUSED_AWS_ACCESS_KEY_ID",
+                                         "AWS_SECRET_ACCESS_KEY": "UNUSED_AWS_SECRET_ACCESS_KEY",
+                                         "AWS_PROFILE": "unused"}):
+        # A profile with no static keys, here using credential_process, still resolves from the directory.
+        process_output_file = os.path.join(aws_credentials_dir, "process_output.json")
+        with io.open(process_output_file, "w") as process_output_fp:
+            json.dump({"Version": 1, "AccessKeyId": TestData.aws_access_key_id,
+                       "SecretAccessKey": TestData.aws_secret_access_key}, process_output_fp)
+        aws_config_file = os.path.join(aws_credentials_dir, "config")
+        with io.open(aws_config_file, "w") as aws_config_fp:
+            aws_config_fp.write(f"[profile {TestData.aws_credentials_name}]\n")
+            aws_config_fp.write(f"region={TestData.aws_region}\n")
+            aws_config_fp.write(f"credential_process=cat {process_output_file}\n")
+        session = _session_for_credentials_dir(aws_credentials_dir)
+        assert session.get_credentials().access_key == TestData.aws_access_key_id
+        assert session.region_name == TestData.aws_region
+        # And one yielding no credentials yields none, rather than those of the environment.
+        with io.open(aws_config_file, "w") as aws_config_fp:
+            aws_config_fp.write(f"[default]\nregion={TestData.aws_region}\n")
+        assert _session_for_credentials_dir(aws_credentials_dir).get_credentials() is None
+        os.remove(aws_config_file)
+        with io.open(os.path.join(aws_credentials_dir, "credentials"), "w"):
+            pass
+        assert _session_for_credentials_dir(aws_credentials_dir).get_credentials() is None
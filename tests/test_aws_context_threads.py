@@ -0,0 +1,127 @@
+import concurrent.futures
+import contextlib
+import mock
+import os
+from dcicutils.qa_utils import MockBoto3
+from src.auto.utils import aws, aws_context
+from src.auto.utils.aws_context import AwsSessionCache
+from src.info.aws_util import AWSUtil
+from .testing_utils import temporary_aws_credentials_dir_for_testing
+
+
+class TestData:
+    aws_account_number = "1234567890"
+    aws_user_arn = f"arn:aws:iam::{aws_account_number}:user/user.for.testing"
+    accounts = 16
+    threads = 32
+    iterations = 20
+
+
+def _account_keys(account: int) -> (str, str, str):
+    region = "us-east-1" if account % 2 else "us-west-2"
+    return f"AWS-ACCESS-KEY-ID-{account}", f"AWS-SECRET-ACCESS-KEY-{account}", region
+
+
+def _aws_environ() -> dict:
+    return {key: value for key, value in os.environ.items() if key.startswith("AWS_")}
+
+
+def test_aws_context_concurrent_sessions_are_isolated() -> None:
+    AwsSessionCache.clear()
+    mocked_boto = MockBoto3()
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    environ_before = _aws_environ()
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(aws_context, "boto3", mocked_boto))
+        credentials_dirs = [stack.enter_context(temporary_aws_credentials_dir_for_testing(*_account_keys(account)))
+                            for account in range(TestData.accounts)]
+
+        def use_account(task: int) -> int:
+            account = task % TestData.accounts
+            aws_access_key_id, aws_secret_access_key, aws_region = _account_keys(account)
+            for iteration in range(TestData.iterations):
+                # Alternate between credentials directories and explicit keys, and cached and uncached sessions.
+                if (task + iteration) % 2:
+                    aws_object = aws.Aws(credentials_dirs[account], use_session_cache=bool(iteration % 3))
+                else:
+                    aws_object = aws.Aws(aws_access_key_id=aws_access_key_id,
+                                         aws_secret_access_key=aws_secret_access_key,
+                                         aws_region=aws_region)
+                with aws_object.establish_credentials() as credentials:
+                    assert credentials.access_key_id == aws_access_key_id
+                    assert credentials.secret_access_key == aws_secret_access_key
+                    assert credentials.region == aws_region
+                    assert credentials.account_number == TestData.aws_account_number
+                    assert aws_object.session.get_credentials().access_key == aws_access_key_id
+                    assert aws_object.client("kms") is aws_object.client("kms")
+                    assert _aws_environ() == environ_before
+            return task
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=TestData.threads) as executor:
+            assert sorted(executor.map(use_account, range(TestData.threads * 2))) == list(range(TestData.threads * 2))
+    assert _aws_environ() == environ_before
+
+
+def test_aws_context_set_environ_compatibility_shim() -> None:
+    AwsSessionCache.clear()
+    mocked_boto = MockBoto3()
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    aws_access_key_id, aws_secret_access_key, aws_region = _account_keys(1)
+    environ_before = _aws_environ()
+    with temporary_aws_credentials_dir_for_testing(aws_access_key_id, aws_secret_access_key,
+                                                   aws_region) as aws_credentials_dir, \
+            mock.patch.object(aws_context, "boto3", mocked_boto):
+        with aws.Aws(aws_credentials_dir).establish_credentials(set_environ=True):
+            assert os.environ["AWS_ACCESS_KEY_ID"] == aws_access_key_id
+            assert os.environ["AWS_SECRET_ACCESS_KEY"] == aws_secret_access_key
+            assert os.environ["AWS_DEFAULT_REGION"] == aws_region
+            assert os.environ["AWS_REGION"] == aws_region
+            assert "AWS_SESSION_TOKEN" not in os.environ
+            assert os.environ.get("AWS_SHARED_CREDENTIALS_FILE") == environ_before.get("AWS_SHARED_CREDENTIALS_FILE")
+            assert os.environ.get("AWS_CONFIG_FILE") == environ_before.get("AWS_CONFIG_FILE")
+        with aws.Aws(aws_credentials_dir).establish_credentials():
+            assert _aws_environ() == environ_before
+    assert _aws_environ() == environ_before
+
+
+def test_aws_context_set_environ_compatibility_shim_exports_resolved_credentials() -> None:
+    # E.g. a role, SSO or credential_process profile, whose (temporary) credentials are
+    # resolved by the session rather than read from the credentials file or given explicitly.
+    AwsSessionCache.clear()
+    mocked_boto = MockBoto3()
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    aws_access_key_id, aws_secret_access_key, aws_region = _account_keys(1)
+    resolved_credentials = mock.MagicMock()
+    resolved_credentials.get_frozen_credentials.return_value = mock.MagicMock(access_key="ASIA-RESOLVED-KEY-ID",
+                                                                              secret_key="RESOLVED-SECRET",
+                                                                              token="RESOLVED-SESSION-TOKEN")
+    environ_before = _aws_environ()
+    with temporary_aws_credentials_dir_for_testing(aws_access_key_id, aws_secret_access_key,
+                                                   aws_region) as aws_credentials_dir, \
+            mock.patch.object(aws_context, "boto3", mocked_boto), \
+            mock.patch.dict(os.environ, {"AWS_PROFILE": "some-role-profile"}):
+        aws_object = aws.Aws(aws_credentials_dir, use_session_cache=False)
+        with aws_object.establish_credentials():
+            session = aws_object.session
+        with mock.patch.object(session, "get_credentials", return_value=resolved_credentials), \
+                mock.patch.object(aws_object, "_create_session", return_value=session):
+            with aws_object.establish_credentials(set_environ=True):
+                assert os.environ["AWS_ACCESS_KEY_ID"] == "ASIA-RESOLVED-KEY-ID"
+                assert os.environ["AWS_SECRET_ACCESS_KEY"] == "RESOLVED-SECRET"
+                assert os.environ["AWS_SESSION_TOKEN"] == "RESOLVED-SESSION-TOKEN"
+                assert os.environ["AWS_DEFAULT_REGION"] == aws_region
+                assert "AWS_PROFILE" not in os.environ
+        assert os.environ["AWS_PROFILE"] == "some-role-profile"
+    assert _aws_environ() == environ_before
+
+
+def test_aws_util_threads_share_client_created_up_front() -> None:
+    # Creating clients from one (shared) boto3 session is not thread-safe, so the threads must not do so.
+    session = mock.MagicMock()
+    aws_util = AWSUtil(session=session)
+    clients = []
+    with mock.patch.object(AWSUtil, "generate_versioned_files_summary_tsv_for_bucket",
+                           lambda self, bucket, client=None: clients.append(client)):
+        aws_util.generate_versioned_files_summary_tsvs()
+    session.client.assert_called_once_with("s3")
+    assert len(clients) == 14 and set(map(id, clients)) == {id(session.client.return_value)}
@@ -0,0 +1,135 @@
+import collections
+import mock
+import pytest
+import time
+from dcicutils.qa_utils import MockBoto3
+from src.auto.utils import aws, aws_context
+from src.auto.utils.aws_context import AwsSessionCache
+from .testing_utils import temporary_aws_credentials_dir_for_testing
+
+
+class TestData:
+    aws_access_key_id = "AWS-ACCESS-KEY-ID-FOR-TESTING"
+    aws_secret_access_key = "AWS-SECRET-ACCESS-KEY-FOR-TESTING"
+    aws_account_number = "1234567890"
+    aws_region = "us-west-2"
+    aws_user_arn = f"arn:aws:iam::{aws_account_number}:user/user.for.testing"
+    iterations = 25
+
+
+class CountingMockBoto3(MockBoto3):
+    """ MockBoto3 counting its client constructions (by kind) and STS get_caller_identity calls. """
+
+    # Simulated real-world time for these (see SlowMockBoto3).
+    client_construction_seconds = 0
+    sts_latency_seconds = 0
+
+    def __init__(self):
+        super().__init__()
+        self.clients_created = collections.Counter()
+        self.sts_calls = 0
+
+    def client(self, kind, **kwargs):
+        time.sleep(self.client_construction_seconds)
+        self.clients_created[kind] += 1
+        client = super().client(kind, **kwargs)
+        if kind == "sts":
+            get_caller_identity = client.get_caller_identity
+
+            def counted_get_caller_identity():
+                time.sleep(self.sts_latency_seconds)
+                self.sts_calls += 1
+                return get_caller_identity()
+            client.get_caller_identity = counted_get_caller_identity
+        return client
+
+
+class SlowMockBoto3(CountingMockBoto3):
+    """ CountingMockBoto3 whose client construction and STS get_caller_identity take (simulated) real-world time. """
+
+    # Stand-ins for botocore client construction, which is dominated by service model loading, and an STS round trip.
+    client_construction_seconds = 0.01
+    sts_latency_seconds = 0.02
+
+
+def _repeated_contexts(aws_credentials_dir: str, use_session_cache: bool,
+                       boto3_class: type = CountingMockBoto3) -> CountingMockBoto3:
+    AwsSessionCache.clear()
+    mocked_boto = boto3_class()
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    mocked_boto.clients_created.clear()
+    with mock.patch.object(aws_context, "boto3", mocked_boto):
+        for _ in range(TestData.iterations):
+            # A fresh Aws object each time, as the auto/* tools and helpers do.
+            aws_object = aws.Aws(aws_credentials_dir, use_session_cache=use_session_cache)
+            with aws_object.establish_credentials() as credentials:
+                assert credentials.account_number == TestData.aws_account_number
+                assert credentials.user_arn == TestData.aws_user_arn
+                aws_object.client("kms")
+                aws_object.client("ec2")
+        return mocked_boto
+
+
+def test_aws_session_cache_reuses_identity_and_clients() -> None:
+    with temporary_aws_credentials_dir_for_testing(TestData.aws_access_key_id,
+                                                   TestData.aws_secret_access_key,
+                                                   TestData.aws_region) as aws_credentials_dir:
+        uncached_boto = _repeated_contexts(aws_credentials_dir, use_session_cache=False)
+        cached_boto = _repeated_contexts(aws_credentials_dir, use_session_cache=True)
+    assert uncached_boto.sts_calls == TestData.iterations
+    assert uncached_boto.clients_created == {"sts": TestData.iterations, "kms": TestData.iterations,
+                                             "ec2": TestData.iterations}
+    assert cached_boto.sts_calls == 1
+    assert cached_boto.clients_created == {"sts": 1, "kms": 1, "ec2": 1}
+    assert AwsSessionCache.hits == TestData.iterations - 1
+
+
+@pytest.mark.integratedx
+def test_aws_session_cache_benchmark() -> None:
+    """ Benchmarks repeated contexts with a stubbed (slow) STS and client construction, uncached and cached,
+        reporting (rather than asserting, see test_aws_session_cache_reuses_identity_and_clients) their timings.
+    """
+    seconds = {}
+    with temporary_aws_credentials_dir_for_testing(TestData.aws_access_key_id,
+                                                   TestData.aws_secret_access_key,
+                                                   TestData.aws_region) as aws_credentials_dir:
+        for use_session_cache in (False, True):
+            started = time.time()
+            mocked_boto = _repeated_contexts(aws_credentials_dir, use_session_cache, boto3_class=SlowMockBoto3)
+            seconds[use_session_cache] = time.time() - started
+            assert mocked_boto.sts_calls == (1 if use_session_cache else TestData.iterations)
+    print(f"\n{TestData.iterations} contexts: uncached {seconds[False]:.3f}s, cached {seconds[True]:.3f}s")
+
+
+def test_aws_session_cache_is_keyed_by_credentials() -> None:
+    AwsSessionCache.clear()
+    mocked_boto = CountingMockBoto3()
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    with temporary_aws_credentials_dir_for_testing(TestData.aws_access_key_id,
+                                                   TestData.aws_secret_access_key,
+                                                   TestData.aws_region) as aws_credentials_dir, \
+         mock.patch.object(aws_context, "boto3", mocked_boto):
+        with aws.Aws(aws_credentials_dir).establish_credentials():
+            pass
+        with aws.Aws(aws_credentials_dir, aws_region="us-east-1").establish_credentials():
+            pass
+        with aws.Aws(aws_credentials_dir).establish_credentials():
+            pass
+        assert mocked_boto.sts_calls == 2
+        # A different boto3 (e.g. a fresh mock) must not see clients cached for the previous one.
+        with mock.patch.object(aws_context, "boto3", CountingMockBoto3()) as other_mocked_boto:
+            other_mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number,
+                                                                            TestData.aws_user_arn)
+            with aws.Aws(aws_credentials_dir).establish_credentials():
+                pass
+            assert other_mocked_boto.sts_calls == 1
+
+
+def test_aws_context_client_requires_established_credentials() -> None:
+    aws_object = aws.Aws("/no/such/dir")
+    try:
+        aws_object.client("kms")
+    except Exception as e:
+        assert "not established" in str(e)
+    else:
+        raise AssertionError("Expected an exception.")
@@ -0,0 +1,57 @@
+import threading
+import time
+from dcicutils.qa_utils import printed_output as mock_print
+from src.auto.utils.concurrent_resolver import ConcurrentResolver
+
+
+class InFlight:
+    """ Counts the (slow) lookups running at once, recording the most of them there have been. """
+    count = 0
+    max_count = 0
+    lock = threading.Lock()
+
+
+def _slow(value, seconds: float = 0.1):
+    with InFlight.lock:
+        InFlight.count += 1
+        InFlight.max_count = max(InFlight.max_count, InFlight.count)
+    time.sleep(seconds)
+    with InFlight.lock:
+        InFlight.count -= 1
+    return value
+
+
+def _fail():
+    raise Exception("Lookup failed.")
+
+
+def test_concurrent_resolver() -> None:
+    resolver = ConcurrentResolver()
+    resolver.add("a", lambda: _slow(1))
+    resolver.add("b", lambda: _slow(2))
+    resolver.add("c", lambda a, b: _slow(a + b), depends_on=["a", "b"])
+    resolver.add("d", _fail)
+    resolver.add("e", lambda d, a: d + a, depends_on=["d", "a"])
+    resolver.add("f", lambda e: e, depends_on=["e"])
+    InFlight.max_count = 0
+    results = resolver.resolve()
+    assert results == {"a": 1, "b": 2, "c": 3}
+    assert resolver.errors == {"d": "Exception: Lookup failed."}
+    # The a and b lookups run concurrently, then c; rather than one after another (i.e. two lookups' time, not three).
+    assert InFlight.max_count == 2
+    with mock_print() as mocked_print:
+        resolver.print_latency_report()
+    assert any("Resolved 3 of 6 lookups" in line for line in mocked_print.lines)
+    assert any("skipped" in line and line.lstrip("| ").startswith("f") for line in mocked_print.lines)
+
+
+def test_concurrent_resolver_requires_known_dependencies() -> None:
+    resolver = ConcurrentResolver()
+    resolver.add("a", lambda: 1)
+    for name, depends_on in (("a", None), ("b", ["c"])):
+        try:
+            resolver.add(name, lambda: 2, depends_on=depends_on)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected ValueError.")
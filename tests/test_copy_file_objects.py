@@ -0,0 +1,317 @@
+import base64
+import hashlib
+import itertools
+import mock
+import os
+import threading
+import uuid as uuid_module
+
+from botocore.exceptions import ClientError
+from dcicutils.qa_utils import printed_output as mock_print
+from src.commands import copy_file_objects
+from src.commands.copy_file_objects import CopyStatus, FileObjectCopier, SOURCE_ETAG_METADATA, resolve_file_objects
+from .testing_utils import find_matching_line
+
+
+SOURCE, DESTINATION = 'cgap-wolf-files', 'cgap-test-files'
+
+
+def _error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+def _sha256(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+class FakeS3:
+    """ Thread-safe stand-in for the s3 client calls made by FileObjectCopier, holding the content of the
+        objects (and parts), and giving them ETags as S3 does: the MD5 of their content, or for objects uploaded
+        in parts that of the MD5s of their parts, or (in the kms_buckets) some other value, but for the number
+        of parts; and, for those put with one, SHA256 checksums likewise (of their content, or of their parts').
+        Lists the parts of objects (as get_object_attributes does) only for those put with checksums, recording
+        each listing, and the heads of parts, in part_requests. The upload_part_copy of the (key, part number)s
+        of part_failures fail with the given errors.
+    """
+
+    def __init__(self, kms_buckets=(), part_failures=None):
+        self.objects = {}
+        self.uploads = {}
+        self.kms_buckets = set(kms_buckets)
+        self.part_failures = dict(part_failures or {})
+        self.calls = []
+        self.part_requests = []
+        self.clock = itertools.count()
+        self.lock = threading.Lock()
+
+    def _etag(self, bucket, parts):
+        if bucket in self.kms_buckets:
+            return f'"{uuid_module.uuid4().hex}"' if len(parts) == 1 else f'"{uuid_module.uuid4().hex}-{len(parts)}"'
+        if len(parts) == 1:
+            return f'"{hashlib.md5(parts[0]).hexdigest()}"'
+        digest = hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts))
+        return f'"{digest.hexdigest()}-{len(parts)}"'
+
+    @staticmethod
+    def _checksum(parts):
+        if len(parts) == 1:
+            return _sha256(parts[0])
+        return f'{_sha256(b"".join(base64.b64decode(_sha256(part)) for part in parts))}-{len(parts)}'
+
+    def put(self, bucket, key, data, part_size=None, checksum=False, **head):
+        parts = [data[i:i + part_size] for i in range(0, len(data), part_size)] if part_size else [data]
+        self.objects[bucket, key] = dict(head, data=data, parts=parts, ETag=self._etag(bucket, parts),
+                                         ServerSideEncryption='aws:kms' if bucket in self.kms_buckets else 'AES256',
+                                         LastModified=next(self.clock),
+                                         **({'ChecksumSHA256': self._checksum(parts)} if checksum else {}))
+
+    def head_object(self, Bucket, Key, ChecksumMode, PartNumber=None):  # noQA - boto3 case
+        assert ChecksumMode == 'ENABLED'
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise _error('404', 'HeadObject')
+        if PartNumber:
+            with self.lock:
+                self.part_requests.append(('head_object', Key, PartNumber))
+        head = {field: value for field, value in obj.items() if field not in ('data', 'parts')}
+        head['ContentLength'] = len(obj['parts'][PartNumber - 1] if PartNumber else obj['data'])
+        return head
+
+    def get_object_attributes(self, Bucket, Key, ObjectAttributes, MaxParts, PartNumberMarker):  # noQA
+        assert ObjectAttributes == ['ObjectParts']
+        obj = self.objects[Bucket, Key]
+        with self.lock:
+            self.part_requests.append(('get_object_attributes', Key, PartNumberMarker))
+        if 'ChecksumSHA256' not in obj:
+            return {'ObjectParts': {'TotalPartsCount': len(obj['parts'])}}
+        part_numbers = range(PartNumberMarker + 1, min(PartNumberMarker + MaxParts, len(obj['parts'])) + 1)
+        return {'ObjectParts': {'TotalPartsCount': len(obj['parts']),
+                                'IsTruncated': part_numbers.stop <= len(obj['parts']),
+                                'NextPartNumberMarker': part_numbers.stop - 1,
+                                'Parts': [{'PartNumber': part_number, 'Size': len(obj['parts'][part_number - 1])}
+                                          for part_number in part_numbers]}}
+
+    def _source(self, CopySource, CopySourceIfMatch):  # noQA - boto3 case
+        source = self.objects[CopySource['Bucket'], CopySource['Key']]
+        if source['ETag'] != CopySourceIfMatch:
+            raise _error('PreconditionFailed', 'CopyObject')
+        return source
+
+    def copy_object(self, Bucket, Key, CopySource, CopySourceIfMatch, MetadataDirective, Metadata,  # noQA
+                    ChecksumAlgorithm, **head):
+        with self.lock:
+            self.calls.append(('copy_object', Key))
+            assert MetadataDirective == 'REPLACE' and ChecksumAlgorithm == 'SHA256'
+            self.put(Bucket, Key, self._source(CopySource, CopySourceIfMatch)['data'], checksum=True,
+                     Metadata=Metadata, **head)
+            return {'CopyObjectResult': {'ETag': self.objects[Bucket, Key]['ETag']}}
+
+    def create_multipart_upload(self, Bucket, Key, ChecksumAlgorithm, **head):  # noQA - boto3 case
+        with self.lock:
+            assert ChecksumAlgorithm == 'SHA256'
+            upload_id = uuid_module.uuid4().hex
+            self.uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'head': head, 'parts': {},
+                                       'Initiated': next(self.clock)}
+            return {'UploadId': upload_id}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange,  # noQA
+                         CopySourceIfMatch):
+        with self.lock:
+            self.calls.append(('upload_part_copy', Key, PartNumber))
+            if self.part_failures.get((Key, PartNumber)):
+                code, count = self.part_failures[Key, PartNumber]
+                self.part_failures[Key, PartNumber] = (code, count - 1) if count > 1 else None
+                raise _error(code, 'UploadPartCopy')
+            source = self._source(CopySource, CopySourceIfMatch)
+            start, end = map(int, CopySourceRange[len('bytes='):].split('-'))
+            data = source['data'][start:end + 1]
+            etag = f'"{hashlib.md5(data).hexdigest()}"'
+            self.uploads[UploadId]['parts'][PartNumber] = (data, etag)
+            return {'CopyPartResult': {'ETag': etag, 'ChecksumSHA256': _sha256(data)}}
+
+    def list_multipart_uploads(self, Bucket, Prefix):  # noQA - boto3 case
+        return {'Uploads': [{'Key': upload['Key'], 'UploadId': upload_id, 'Initiated': upload['Initiated']}
+                            for upload_id, upload in self.uploads.items()
+                            if upload['Bucket'] == Bucket and upload['Key'].startswith(Prefix)]}
+
+    def list_parts(self, Bucket, Key, UploadId):  # noQA - boto3 case
+        return {'Parts': [{'PartNumber': part_number, 'ETag': etag, 'ChecksumSHA256': _sha256(data),
+                           'Size': len(data)}
+                          for part_number, (data, etag) in sorted(self.uploads[UploadId]['parts'].items())]}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):  # noQA - boto3 case
+        with self.lock:
+            self.calls.append(('abort_multipart_upload', Key))
+            del self.uploads[UploadId]
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):  # noQA - boto3 case
+        with self.lock:
+            upload = self.uploads.pop(UploadId)
+            assert [part['PartNumber'] for part in MultipartUpload['Parts']] == sorted(upload['parts'])
+            parts = [upload['parts'][part['PartNumber']][0] for part in MultipartUpload['Parts']]
+            assert [part['ChecksumSHA256'] for part in MultipartUpload['Parts']] == [_sha256(part) for part in parts]
+            self.objects[Bucket, Key] = dict(upload['head'], data=b''.join(parts), parts=parts,
+                                             ETag=self._etag(Bucket, parts), LastModified=next(self.clock),
+                                             ChecksumSHA256=self._checksum(parts))
+            return {'ETag': self.objects[Bucket, Key]['ETag']}
+
+
+def _populate(s3):
+    """ Puts a small object and a larger one (uploaded in one go), and one uploaded in parts of 7 bytes; all but
+        the larger one with SHA256 checksums
+    """
+    s3.put(SOURCE, 'small', os.urandom(10), checksum=True, ContentType='text/plain', Metadata={'owner': 'cgap'})
+    s3.put(SOURCE, 'large', os.urandom(50), ContentType='application/gzip')
+    s3.put(SOURCE, 'parts', os.urandom(40), part_size=7, checksum=True)
+    return [(SOURCE, key, DESTINATION) for key in ('small', 'large', 'parts')]
+
+
+def _copier(s3):
+    return FileObjectCopier(s3, workers=4, part_workers=4)
+
+
+def test_copy_file_objects() -> None:
+    s3 = FakeS3(part_failures={('parts', 2): ('SlowDown', 2)})
+    objects = _populate(s3)
+    with mock.patch.object(copy_file_objects, 'BACKOFF_SECONDS', 0), mock_print() as mocked_print:
+        assert _copier(s3).copy_all(objects) == {CopyStatus.COPIED: 3, CopyStatus.UNVERIFIED: 0,
+                                                 CopyStatus.ALREADY_COPIED: 0, CopyStatus.FAILED: 0}
+        assert find_matching_line(mocked_print.lines, r'Copied 3 objects \(0.00 GiB\) in [0-9.]+s \([0-9.]+ MiB/s\),'
+                                                      r' 0 not verified, 0 already copied, 0 failed.')
+    for _, key, _ in objects:
+        source, copied = s3.objects[SOURCE, key], s3.objects[DESTINATION, key]
+        assert copied['data'] == source['data']
+        assert copied['Metadata'] == dict(source.get('Metadata', {}), **{SOURCE_ETAG_METADATA:
+                                                                         source['ETag'].strip('"')})
+        assert copied.get('ContentType') == source.get('ContentType')
+        assert copied['ETag'] == source['ETag']
+    # The objects uploaded in one go copied in one go, and the one uploaded in parts in the same parts (one
+    # retried), so with the same checksum.
+    assert sorted(call for call in s3.calls if call[0] == 'copy_object') == [('copy_object', 'large'),
+                                                                             ('copy_object', 'small')]
+    assert s3.calls.count(('upload_part_copy', 'parts', 2)) == 3
+    assert s3.objects[DESTINATION, 'parts']['ChecksumSHA256'] == s3.objects[SOURCE, 'parts']['ChecksumSHA256']
+    assert [len(part) for part in s3.objects[DESTINATION, 'parts']['parts']] == [7] * 5 + [5]
+    # Copying them again does nothing.
+    s3.calls.clear()
+    with mock_print():
+        assert _copier(s3).copy_all(objects)[CopyStatus.ALREADY_COPIED] == 3
+    assert s3.calls == []
+
+
+def test_copy_file_objects_part_sizes() -> None:
+    """ The sizes of the parts of objects uploaded with checksums are listed, a thousand (here 4) at a time;
+        those of other objects (or if not permitted) got from the heads of the parts, in parallel.
+    """
+    s3 = FakeS3()
+    s3.put(SOURCE, 'parts', os.urandom(40), part_size=7, checksum=True)
+    s3.put(SOURCE, 'unlisted', os.urandom(40), part_size=7)
+    objects = [(SOURCE, key, DESTINATION) for key in ('parts', 'unlisted')]
+    with mock.patch.object(copy_file_objects, 'MAX_LISTED_PARTS', 4), mock_print():
+        assert _copier(s3).copy_all(objects)[CopyStatus.COPIED] == 2
+    assert sorted(request for request in s3.part_requests if request[1] == 'parts') == [
+        ('get_object_attributes', 'parts', 0), ('get_object_attributes', 'parts', 4)]
+    assert sorted(request for request in s3.part_requests if request[1] == 'unlisted') == (
+        [('get_object_attributes', 'unlisted', 0)] + [('head_object', 'unlisted', part_number)
+                                                      for part_number in range(1, 7)])
+    s3 = FakeS3()
+    s3.put(SOURCE, 'parts', os.urandom(40), part_size=7, checksum=True)
+    s3.get_object_attributes = mock.Mock(side_effect=_error('AccessDenied', 'GetObjectAttributes'))
+    with mock_print() as mocked_print:
+        assert _copier(s3).copy_all(objects[:1])[CopyStatus.COPIED] == 1
+        assert find_matching_line(mocked_print.lines, f'Cannot list the parts of s3://{SOURCE}/parts, getting their'
+                                                      f' heads instead: .*AccessDenied.*')
+    assert sorted(s3.part_requests) == [('head_object', 'parts', part_number) for part_number in range(1, 7)]
+    assert [len(part) for part in s3.objects[DESTINATION, 'parts']['parts']] == [7] * 5 + [5]
+
+
+def test_copy_file_objects_resumes() -> None:
+    s3 = FakeS3(part_failures={('parts', 3): ('AccessDenied', 1)})
+    objects = _populate(s3)
+    with mock_print() as mocked_print:
+        assert _copier(s3).copy_all(objects)[CopyStatus.FAILED] == 1
+        assert find_matching_line(mocked_print.lines, f'Failed to copy s3://{SOURCE}/parts to'
+                                                      f' s3://{DESTINATION}/parts: .*AccessDenied.*')
+    assert (DESTINATION, 'parts') not in s3.objects
+    s3.calls.clear()
+    with mock_print():
+        assert _copier(s3).copy_all(objects) == {CopyStatus.COPIED: 1, CopyStatus.UNVERIFIED: 0,
+                                                 CopyStatus.ALREADY_COPIED: 2, CopyStatus.FAILED: 0}
+    # Only the failed part copied, the others reused from the upload left in progress.
+    assert s3.calls == [('upload_part_copy', 'parts', 3)]
+    assert s3.objects[DESTINATION, 'parts']['data'] == s3.objects[SOURCE, 'parts']['data']
+
+
+def test_copy_file_objects_does_not_resume_upload_of_modified_source() -> None:
+    s3 = FakeS3(part_failures={('parts', 3): ('AccessDenied', 1)})
+    objects = _populate(s3)
+    with mock_print():
+        assert _copier(s3).copy_all(objects)[CopyStatus.FAILED] == 1
+    # The source modified since (with parts of the same sizes), so the parts already copied are stale.
+    s3.put(SOURCE, 'parts', os.urandom(40), part_size=7, checksum=True)
+    s3.calls.clear()
+    with mock_print():
+        assert _copier(s3).copy_all(objects)[CopyStatus.COPIED] == 1
+    assert sorted(s3.calls) == [('abort_multipart_upload', 'parts')] + [('upload_part_copy', 'parts', part_number)
+                                                                        for part_number in range(1, 7)]
+    assert s3.objects[DESTINATION, 'parts']['data'] == s3.objects[SOURCE, 'parts']['data']
+
+
+def test_copy_file_objects_kms() -> None:
+    """ The ETags of SSE-KMS objects are not MD5s, so copies of them are verified by their checksums, or if they
+        have none, by their size only.
+    """
+    s3 = FakeS3(kms_buckets=[SOURCE, DESTINATION])
+    objects = _populate(s3)
+    with mock_print() as mocked_print:
+        assert _copier(s3).copy_all(objects) == {CopyStatus.COPIED: 2, CopyStatus.UNVERIFIED: 1,
+                                                 CopyStatus.ALREADY_COPIED: 0, CopyStatus.FAILED: 0}
+        assert find_matching_line(mocked_print.lines, f'Copied s3://{SOURCE}/large to s3://{DESTINATION}/large'
+                                                      f' verifying only its size: .*')
+        assert find_matching_line(mocked_print.lines, r'Copied 3 objects .*, 1 not verified, .*')
+        assert _copier(s3).copy_all(objects)[CopyStatus.ALREADY_COPIED] == 3
+    for _, key, _ in objects:
+        assert s3.objects[DESTINATION, key]['data'] == s3.objects[SOURCE, key]['data']
+
+
+def test_copy_file_objects_verifies() -> None:
+    s3 = FakeS3()
+    objects = _populate(s3)
+    copy_object, complete_multipart_upload = s3.copy_object, s3.complete_multipart_upload
+
+    def corrupting(fn, field):
+        def corrupt(**kwargs):
+            result = fn(**kwargs)
+            s3.objects[kwargs['Bucket'], kwargs['Key']][field] = 'corrupt'
+            return result
+        return corrupt
+
+    # Corrupting the ETag of the copy of an object without a checksum, and the checksums of the others.
+    s3.copy_object = lambda **kwargs: corrupting(copy_object, 'ETag' if kwargs['Key'] == 'large'
+                                                 else 'ChecksumSHA256')(**kwargs)
+    s3.complete_multipart_upload = corrupting(complete_multipart_upload, 'ChecksumSHA256')
+    with mock_print() as mocked_print:
+        assert _copier(s3).copy_all(objects) == {CopyStatus.COPIED: 0, CopyStatus.UNVERIFIED: 0,
+                                                 CopyStatus.ALREADY_COPIED: 0, CopyStatus.FAILED: 3}
+        assert find_matching_line(mocked_print.lines, f'Failed to copy s3://{SOURCE}/large .* does not verify'
+                                                      f' \\(ETag corrupt, expected .*\\)')
+        assert find_matching_line(mocked_print.lines, f'Failed to copy s3://{SOURCE}/parts .* does not verify'
+                                                      f' \\(SHA256 checksum corrupt, expected .*-6\\)')
+
+
+def test_resolve_file_objects() -> None:
+    files = {'file_fastq': [{'uuid': 'u1', 'accession': 'GAPFIFASTQ01', 'file_format': 'fastq-format'}],
+             'file_processed': [{'uuid': 'u2', 'accession': 'GAPFICRAM001', 'file_format': 'cram-format',
+                                 'extra_files': [{'file_format': 'crai-format'}]}]}
+    source_key, destination_key = {'server': 'https://cgap-wolf'}, {'server': 'https://cgap-test'}
+    health = {'https://cgap-wolf': {'file_upload_bucket': 'wolf-files', 'processed_file_bucket': 'wolf-wfoutput'},
+              'https://cgap-test': {'file_upload_bucket': 'test-files', 'processed_file_bucket': 'test-wfoutput'}}
+    extensions = {'fastq-format': 'fastq.gz', 'cram-format': 'cram', 'crai-format': 'cram.crai'}
+    with mock.patch.object(copy_file_objects.ff_utils, 'get_health_page',
+                           side_effect=lambda key: health[key['server']]), \
+            mock.patch.object(copy_file_objects.ff_utils, 'get_metadata',
+                              side_effect=lambda obj_id, key: {'standard_file_extension': extensions[obj_id]}):
+        assert resolve_file_objects(files, source_key, destination_key) == [
+            ('wolf-files', 'u1/GAPFIFASTQ01.fastq.gz', 'test-files'),
+            ('wolf-wfoutput', 'u2/GAPFICRAM001.cram', 'test-wfoutput'),
+            ('wolf-wfoutput', 'u2/GAPFICRAM001.cram.crai', 'test-wfoutput')]
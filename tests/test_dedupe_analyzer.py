@@ -0,0 +1,85 @@
+import csv
+import io
+import os
+import tempfile
+from src.info.aws_util import AWSUtil
+from src.info.dedupe_analyzer import DuplicateContentAnalyzer
+
+
+class FakeS3Client:
+    """ Serves list_object_versions from a fixed list of versions, page_size at a time. """
+
+    def __init__(self, versions, page_size=2):
+        self.versions = versions
+        self.page_size = page_size
+        self.calls = 0
+
+    def list_object_versions(self, Bucket, KeyMarker=None, VersionIdMarker=None, Prefix=None):  # noQA - boto3 case
+        self.calls += 1
+        start = int(KeyMarker) if KeyMarker else 0
+        page = self.versions[start:start + self.page_size]
+        next_start = start + self.page_size
+        response = {'Versions': page, 'IsTruncated': next_start < len(self.versions)}
+        if response['IsTruncated']:
+            response['NextKeyMarker'] = str(next_start)
+            response['NextVersionIdMarker'] = 'v'
+        return response
+
+
+def _version(key, etag, size, version_id='null'):
+    return {'Key': key, 'ETag': f'"{etag}"', 'Size': size, 'VersionId': version_id, 'IsLatest': True}
+
+
+VERSIONS = [
+    _version('a/one.fastq.gz', 'aaaa', 1000),
+    _version('b/copy-of-one.fastq.gz', 'aaaa', 1000),
+    _version('a/one.fastq.gz', 'aaaa', 1000, version_id='v2'),
+    _version('big/part.bam', 'bbbb-4', 50000),
+    _version('big/copy.bam', 'bbbb-4', 50000),
+    _version('big/reupload.bam', 'cccc', 50000),  # same bytes, different (single-part) upload: not provable
+    _version('unique.txt', 'dddd', 10),
+    _version('empty1', 'd41d8cd98f00b204e9800998ecf8427e', 0),
+    _version('empty2', 'd41d8cd98f00b204e9800998ecf8427e', 0),
+]
+
+
+def _check_duplicates(duplicates):
+    assert [(g.etag, g.copies) for g in duplicates] == [('bbbb-4', 2), ('aaaa', 3)]
+    assert duplicates[0].is_multipart and duplicates[0].part_count == 4
+    assert duplicates[0].reclaimable_bytes == 50000
+    assert duplicates[1].reclaimable_bytes == 2000
+
+
+def test_iter_object_versions_follows_markers():
+    client = FakeS3Client(VERSIONS, page_size=2)
+    assert list(AWSUtil().iter_object_versions('bucket', client=client)) == VERSIONS
+    assert client.calls == 5
+
+
+def test_find_duplicates_in_memory():
+    analyzer = DuplicateContentAnalyzer(aws_util=AWSUtil())
+    duplicates = analyzer.find_duplicates(VERSIONS)
+    assert not analyzer.spilled
+    _check_duplicates(duplicates)
+    assert 'a/one.fastq.gz?versionId=v2' in duplicates[1].locations
+
+
+def test_find_duplicates_with_spill():
+    analyzer = DuplicateContentAnalyzer(aws_util=AWSUtil(), max_in_memory_groups=1, spill_partitions=3,
+                                        max_locations_per_group=2)
+    duplicates = analyzer.find_duplicates(VERSIONS)
+    assert analyzer.spilled
+    _check_duplicates(duplicates)
+    assert all(len(g.locations) <= 2 for g in duplicates)
+
+
+def test_write_duplicates_tsv():
+    analyzer = DuplicateContentAnalyzer(aws_util=AWSUtil())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'dupes.tsv')
+        analyzer.write_duplicates_tsv(analyzer.find_duplicates(VERSIONS), filename)
+        with io.open(filename, newline='') as f:
+            rows = list(csv.reader(f, delimiter='\t', quotechar='|'))
+    assert rows[0] == DuplicateContentAnalyzer.DEDUPE_SUMMARY_HEADER
+    assert [row[0] for row in rows[1:]] == ['bbbb-4', 'aaaa']
+    assert rows[1][7] == '4' and rows[2][7] == ''
@@ -0,0 +1,110 @@
+import pytest
+import threading
+import time
+
+from botocore.exceptions import WaiterError
+from dcicutils.qa_utils import printed_output as mock_print
+from src.commands.deploy_ecs import group_into_waves, kick_cluster_update, list_services, parse_waves
+from src.exceptions import RollingDeployError
+from .testing_utils import find_matching_line
+
+
+CLUSTER = 'arn:aws:ecs:us-east-1:123456789012:cluster/c4-ecs-smaht-production-stack-SmahtCluster'
+SERVICE_PREFIX = 'arn:aws:ecs:us-east-1:123456789012:service/c4-ecs-smaht-production-stack-SmahtCluster/'
+INDEXERS = [f'{SERVICE_PREFIX}c4-ecs-smaht-production-stack-smahtindexerService{n}' for n in range(12)]
+INGESTER = f'{SERVICE_PREFIX}c4-ecs-smaht-production-stack-smahtingesterService'
+PORTAL = f'{SERVICE_PREFIX}c4-ecs-smaht-production-stack-smahtportalService'
+DEPLOYMENT = f'{SERVICE_PREFIX}c4-ecs-smaht-production-stack-smahtdeploymentService'
+SERVICES = [PORTAL, DEPLOYMENT, INGESTER] + INDEXERS
+
+
+class FakePaginator:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return iter(self.pages)
+
+
+class FakeWaiter:
+
+    def __init__(self, ecs):
+        self.ecs = ecs
+
+    def wait(self, cluster, services, WaiterConfig):  # noQA - boto3 case
+        assert cluster == CLUSTER and len(services) <= 10
+        self.ecs.waited.append(list(services))
+        if set(services) & self.ecs.unstable:
+            raise WaiterError(name='ServicesStable', reason='Max attempts exceeded', last_response={})
+
+
+class FakeECS:
+    """ Lists SERVICES in pages of 10 (as list_services does), records the service updates (and the most of them
+        in flight at once), and the waits for services stable, failing those for any of the unstable services.
+    """
+
+    def __init__(self, unstable=(), update_seconds=0.0):
+        self.unstable = set(unstable)
+        self.update_seconds = update_seconds
+        self.updates = []
+        self.waited = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get_paginator(self, operation):
+        assert operation == 'list_services'
+        return FakePaginator([{'serviceArns': SERVICES[i:i + 10]} for i in range(0, len(SERVICES), 10)])
+
+    def get_waiter(self, name):
+        assert name == 'services_stable'
+        return FakeWaiter(self)
+
+    def update_service(self, cluster, service, forceNewDeployment):  # noQA - boto3 case
+        assert cluster == CLUSTER and forceNewDeployment
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.update_seconds)
+        with self.lock:
+            self.in_flight -= 1
+            self.updates.append(service)
+
+
+def test_parse_waves() -> None:
+    assert parse_waves('indexer,ingester;portal') == [['indexer', 'ingester'], ['portal']]
+    assert parse_waves('Portal') == [['portal']]
+    for waves in ('', 'indexer;;portal', 'indexer;,'):
+        with pytest.raises(RollingDeployError):
+            parse_waves(waves)
+
+
+def test_group_into_waves() -> None:
+    assert group_into_waves(SERVICES) == [[INGESTER] + INDEXERS, [PORTAL], [DEPLOYMENT]]
+    assert group_into_waves(SERVICES, [['portal'], ['nonesuch']]) == [[PORTAL], [DEPLOYMENT, INGESTER] + INDEXERS]
+
+
+def test_kick_cluster_update() -> None:
+    ecs = FakeECS(update_seconds=0.05)
+    # All the services, not just the first page of them.
+    assert list_services(ecs, CLUSTER) == SERVICES
+    with mock_print() as mocked_print:
+        durations = kick_cluster_update(ecs, CLUSTER)
+        # The updates of each wave are concurrent, as many at once as there are workers (but not the whole cluster).
+        assert ecs.max_in_flight == 8
+        assert len(durations) == 3
+        assert find_matching_line(mocked_print.lines, r'Wave 1 of 3 in .* stable after [0-9.]+s.')
+        assert find_matching_line(mocked_print.lines, r'Redeployed 15 services in .* in 3 waves \([0-9.]+s\).')
+    assert sorted(ecs.updates) == sorted(SERVICES)
+    assert set(ecs.updates[:13]) == {INGESTER} | set(INDEXERS) and ecs.updates[13:] == [PORTAL, DEPLOYMENT]
+    # Each wave waited for (in at most 10 services at a time) before the next.
+    assert ecs.waited == [[INGESTER] + INDEXERS[:9], INDEXERS[9:], [PORTAL], [DEPLOYMENT]]
+
+
+def test_kick_cluster_update_stops_on_failed_wave() -> None:
+    ecs = FakeECS(unstable=[INDEXERS[3]])
+    with mock_print(), pytest.raises(RollingDeployError, match=r'Wave 1 of 3 in .* failed after [0-9.]+s'
+                                                               r' - not redeploying later waves'):
+        kick_cluster_update(ecs, CLUSTER)
+    assert sorted(ecs.updates) == sorted([INGESTER] + INDEXERS)
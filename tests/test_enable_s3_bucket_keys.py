@@ -0,0 +1,121 @@
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from src.commands.enable_s3_bucket_keys import (
+    BucketKeyMigration, ObjectStatus, estimate_kms_requests, MAX_COPY_OBJECT_SIZE
+)
+
+
+KMS_RULE = {'ApplyServerSideEncryptionByDefault': {'SSEAlgorithm': 'aws:kms', 'KMSMasterKeyID': 'key-id'}}
+
+
+class FakeS3Client:
+    """ Minimal thread-safe stand-in for the s3 client calls made by BucketKeyMigration. """
+
+    def __init__(self, heads, rule=KMS_RULE, copy_delay=0.01):
+        self.heads = heads
+        self.rule = dict(rule)
+        self.copy_delay = copy_delay
+        self.copied = []
+        self.multipart_copied = []
+        self.put_rules = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get_bucket_encryption(self, Bucket):  # noQA - boto3 case
+        return {'ServerSideEncryptionConfiguration': {'Rules': [self.rule]}}
+
+    def put_bucket_encryption(self, Bucket, ServerSideEncryptionConfiguration):  # noQA - boto3 case
+        self.put_rules.extend(ServerSideEncryptionConfiguration['Rules'])
+
+    def list_objects_v2(self, Bucket, Prefix=None, ContinuationToken=None):  # noQA - boto3 case
+        return {'Contents': [{'Key': key} for key in sorted(self.heads)], 'IsTruncated': False}
+
+    def head_object(self, Bucket, Key):  # noQA - boto3 case
+        head = self.heads[Key]
+        if head is None:
+            raise ClientError({'Error': {'Code': '403'}}, 'HeadObject')
+        return head
+
+    def _copying(self, record, item):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.copy_delay)
+        with self.lock:
+            self.in_flight -= 1
+            record.append(item)
+
+    def copy_object(self, **kwargs):
+        self._copying(self.copied, kwargs)
+
+    def copy(self, copy_source, bucket, key, ExtraArgs=None):  # noQA - boto3 case
+        self._copying(self.multipart_copied, (key, ExtraArgs))
+
+
+def _head(size=100, bucket_key=False, sse='aws:kms', storage_class=None):
+    head = {'ContentLength': size, 'ServerSideEncryption': sse, 'ContentType': 'text/plain'}
+    if bucket_key:
+        head['BucketKeyEnabled'] = True
+    if storage_class:
+        head['StorageClass'] = storage_class
+    return head
+
+
+def _heads():
+    heads = {'obj{:03d}'.format(i): _head() for i in range(40)}
+    heads.update({
+        'done': _head(bucket_key=True),
+        'sse-s3': _head(sse='AES256'),
+        'ia': _head(storage_class='STANDARD_IA'),
+        'cold': _head(storage_class='GLACIER'),
+        'huge': _head(size=MAX_COPY_OBJECT_SIZE + 1),
+        'forbidden': None,
+    })
+    return heads
+
+
+def test_migrate_bucket_dry_run_copies_nothing():
+    s3 = FakeS3Client(_heads())
+    migration = BucketKeyMigration(s3=s3, workers=4, dry_run=True)
+    counts = migration.migrate_bucket('bucket')
+    assert counts == {ObjectStatus.WOULD_MIGRATE: 43, ObjectStatus.ALREADY_ENABLED: 1,
+                      ObjectStatus.ARCHIVED: 1, ObjectStatus.FAILED: 1}
+    assert s3.copied == [] and s3.multipart_copied == [] and s3.put_rules == []
+    assert [key for _, key, _ in migration.failures] == ['forbidden']
+
+
+def test_migrate_bucket_copies_with_bounded_concurrency():
+    s3 = FakeS3Client(_heads())
+    migration = BucketKeyMigration(s3=s3, workers=4, dry_run=False)
+    counts = migration.migrate_bucket('bucket')
+    assert counts[ObjectStatus.MIGRATED] == 43
+    assert s3.put_rules == [dict(KMS_RULE, BucketKeyEnabled=True)]
+    assert 1 < s3.max_in_flight <= 4
+    copied = {kwargs['Key']: kwargs for kwargs in s3.copied}
+    assert len(copied) == 42 and 'done' not in copied and 'cold' not in copied
+    assert copied['ia']['StorageClass'] == 'STANDARD_IA'
+    assert all(kwargs['BucketKeyEnabled'] and kwargs['SSEKMSKeyId'] == 'key-id' and
+               kwargs['CopySource'] == {'Bucket': 'bucket', 'Key': key} for key, kwargs in copied.items())
+    [(key, extra_args)] = s3.multipart_copied
+    assert key == 'huge' and extra_args['ContentType'] == 'text/plain' and extra_args['SSEKMSKeyId'] == 'key-id'
+
+
+def test_migrate_bucket_skips_buckets_without_kms_default():
+    s3 = FakeS3Client(_heads(), rule={'ApplyServerSideEncryptionByDefault': {'SSEAlgorithm': 'AES256'}})
+    assert BucketKeyMigration(s3=s3, dry_run=False).migrate_bucket('bucket') is None
+    assert s3.copied == []
+
+
+def test_estimate_kms_requests():
+    # 1M objects read once a month by 5 principals: one call per object before, ~ 5 * 730 hourly refreshes after
+    assert estimate_kms_requests(1_000_000, requesters=5) == (1_000_000, 5 * 730)
+    before, after = estimate_kms_requests(1_000_000, bucket_key_object_count=400_000, requesters=5,
+                                          writes_per_object=1.0)
+    assert before == 600_000 * 2 + 2 * 5 * 730
+    assert after == 2 * 5 * 730
+    # never estimates more calls with a bucket key than without
+    assert estimate_kms_requests(10, requesters=5) == (10, 10)
+    assert estimate_kms_requests(0) == (0, 0)
@@ -0,0 +1,112 @@
+import contextlib
+import http.server
+import io
+import json
+import threading
+import time
+
+from dcicutils.qa_utils import printed_output as mock_print
+from src.commands.env_status import echo_fleet_status, get_fleet_status, get_global_env_bucket_envs
+from .testing_utils import find_matching_line
+
+
+HEALTH = {
+    'smaht-productionblue': {'project_version': '0.41.0', 'identity': 'C4AppConfigSmahtBlue',
+                             'namespace': 'smaht-production-blue'},
+    'smaht-productiongreen': {'project_version': '0.42.0', 'identity': 'C4AppConfigSmahtGreen',
+                              'namespace': 'smaht-production-green'},
+}
+COUNTS = {'db_es_total': 'DB: 1234 ES: 1230 < ES has 4 fewer items >'}
+INDEXING_STATUS = {'primary_waiting': 5, 'primary_inflight': 2, 'secondary_waiting': 10, 'dlq_waiting': 1,
+                   'status': 'Success'}
+SLOW_SECONDS = 0.3
+
+
+class StubPortalHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves, at /<env>/health etc., the pages of the environments of HEALTH, after a delay for those of the
+        environment named slow (which time out), and records the paths and authorization headers requested, and
+        the most of the slow requests in flight at once.
+    """
+
+    def do_GET(self):  # noQA - http.server case
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers.get('Authorization')))
+        _, env, page = self.path.split('/')
+        if env == 'slow':
+            with self.server.lock:
+                self.server.in_flight += 1
+                self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            time.sleep(SLOW_SECONDS)
+            with self.server.lock:
+                self.server.in_flight -= 1
+        data = {'health': HEALTH.get(env), 'counts': COUNTS, 'indexing_status': INDEXING_STATUS}.get(page)
+        if data is None:
+            self.send_error(404)
+            return
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def stub_portals():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubPortalHandler)
+    server.requests, server.lock = [], threading.Lock()
+    server.in_flight = server.max_in_flight = 0
+    server.handle_error = lambda request, client_address: None  # the slow responses go to timed out clients
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}', server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_get_fleet_status() -> None:
+    with stub_portals() as (url, server):
+        envs = {env: {'server': f'{url}/{env}', 'key': 'key', 'secret': 'secret'} for env in HEALTH}
+        # Only the slow environment gets a short timeout, the others the (generous) default, e.g. on a loaded runner.
+        envs['smaht-staging'] = {'server': f'{url}/slow', 'timeout': SLOW_SECONDS / 3}
+        rows = get_fleet_status(envs)
+        assert len(server.requests) == 9
+        # The pages are fetched concurrently: the slow ones all at once, so a hung environment costs one timeout
+        # rather than one per page (and none for the others).
+        assert server.max_in_flight == 3
+        assert {authorization is not None for path, authorization in server.requests
+                if not path.startswith('/slow/')} == {True}
+    blue, green, staging = rows
+    assert {key: value for key, value in green.items() if key not in ('response', 'errors')} == {
+        'env': 'smaht-productiongreen', 'version': '0.42.0', 'color': 'green', 'es index': 'smaht-production-green',
+        'queue': '18', 'db/es counts': '1234/1230'}
+    assert blue['color'] == 'blue' and not blue['errors'] and green['response'].endswith('s')
+    assert staging['response'] == 'DOWN' and staging['version'] == '-'
+    assert len(staging['errors']) == 3 and staging['errors'][0].startswith('/health: ')
+
+
+def test_echo_fleet_status() -> None:
+    with stub_portals() as (url, _), mock_print() as mocked_print:
+        echo_fleet_status({env: {'server': f'{url}/{env}'} for env in HEALTH})
+        assert find_matching_line(mocked_print.lines, r'env +version +color +es index +queue +db/es counts +response')
+        assert find_matching_line(mocked_print.lines, r'smaht-productionblue +0.41.0 +blue +smaht-production-blue'
+                                                      r' +18 +1234/1230 +[0-9.]+s')
+
+
+class FakeS3:
+
+    def get_object(self, Bucket, Key):  # noQA - boto3 case
+        assert (Bucket, Key) == ('smaht-production-foursight-envs', 'main.ecosystem')
+        return {'Body': io.BytesIO(json.dumps({'public_url_table': [
+            {'name': 'smaht-production', 'url': 'https://data.smaht.org', 'environment': 'smaht-production'}]
+        }).encode())}
+
+
+def test_get_global_env_bucket_envs() -> None:
+    assert get_global_env_bucket_envs('smaht-production-foursight-envs', s3=FakeS3()) == {
+        'smaht-production': {'server': 'https://data.smaht.org'}}
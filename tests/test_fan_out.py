@@ -0,0 +1,136 @@
+import io
+import json
+import mock
+import os
+import pytest
+import sys
+import tempfile
+import threading
+import time
+from dcicutils.qa_utils import MockBoto3
+from src.auto.fan_out import cli as fan_out_cli
+from src.auto.utils import aws_context
+from src.auto.utils.aws_context import AwsSessionCache
+from src.auto.utils.fan_out import (
+    command_task, fan_out, merge_fan_out_results, resolve_fan_out_targets
+)
+
+
+class TestData:
+    aws_account_number = "1234567890"
+    aws_user_arn = f"arn:aws:iam::{aws_account_number}:user/user.for.testing"
+    accounts = ["cgap-alpha", "cgap-beta", "fourfront-gamma", "smaht-delta"]
+    task_seconds = 0.2
+
+
+class InFlight:
+    """ Counts the (slow) tasks running at once, recording the most of them there have been. """
+    count = 0
+    max_count = 0
+    lock = threading.Lock()
+
+
+def _write_fake_aws_credentials_dirs(tmp_dir: str) -> str:
+    aws_dir = os.path.join(tmp_dir, ".aws_test")
+    for account in TestData.accounts:
+        aws_credentials_dir = f"{aws_dir}.{account}"
+        os.makedirs(aws_credentials_dir)
+        with io.open(os.path.join(aws_credentials_dir, "credentials"), "w") as fp:
+            fp.write(f"[default]\naws_access_key_id=KEY-{account}\naws_secret_access_key=SECRET-{account}\n")
+        with io.open(os.path.join(aws_credentials_dir, "config"), "w") as fp:
+            fp.write(f"[default]\nregion=us-east-1\n")
+    return aws_dir
+
+
+def _slow_task(aws_object, credentials) -> list:
+    if credentials.access_key_id == "KEY-fourfront-gamma":
+        raise Exception("Access denied.")
+    with InFlight.lock:
+        InFlight.count += 1
+        InFlight.max_count = max(InFlight.max_count, InFlight.count)
+    time.sleep(TestData.task_seconds)
+    with InFlight.lock:
+        InFlight.count -= 1
+    # Clients are per session, so each target must see only its own credentials.
+    kms = aws_object.client("kms")
+    assert aws_object.session.get_credentials().access_key == credentials.access_key_id
+    assert kms is aws_object.client("kms")
+    return [{"key": credentials.access_key_id, "index": index} for index in range(2)]
+
+
+def test_fan_out_runs_concurrently_and_merges_results() -> None:
+    AwsSessionCache.clear()
+    mocked_boto = MockBoto3()
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            mock.patch.object(aws_context, "boto3", mocked_boto):
+        aws_dir = _write_fake_aws_credentials_dirs(tmp_dir)
+        targets = resolve_fan_out_targets([], aws_dir)
+        assert [target.name for target in targets] == TestData.accounts
+        # May also give explicit directories, and names without any directory.
+        [explicit, missing] = resolve_fan_out_targets([f"{aws_dir}.cgap-beta", "no-such-account"], aws_dir)
+        assert explicit.name == "cgap-beta" and explicit.aws_credentials_dir == f"{aws_dir}.cgap-beta"
+        assert missing.aws_credentials_dir == f"{aws_dir}.no-such-account"
+        InFlight.max_count = 0
+        results = fan_out(targets + [missing], _slow_task)
+
+    # The tasks of the three targets which get so far all run at once, rather than one account after another;
+    # each still takes its own (per-account) duration, checked below.
+    assert InFlight.max_count == 3
+    assert [result.target.name for result in results] == TestData.accounts + ["no-such-account"]
+    alpha, beta, gamma, delta, no_such_account = results
+    assert alpha.rows == [{"key": "KEY-cgap-alpha", "index": 0}, {"key": "KEY-cgap-alpha", "index": 1}]
+    assert alpha.account_number == TestData.aws_account_number and not alpha.error
+    assert alpha.duration >= TestData.task_seconds
+    assert gamma.error == "Exception: Access denied." and not gamma.rows
+    assert "AWS credentials directory not found" in no_such_account.error
+    assert no_such_account.account_number is None
+
+    columns, rows = merge_fan_out_results(results)
+    assert columns == ["name", "account", "seconds", "error", "key", "index"]
+    assert len(rows) == 2 + 2 + 1 + 2 + 1
+    assert rows[0][:2] == ["cgap-alpha", TestData.aws_account_number] and rows[0][4:] == ["KEY-cgap-alpha", 0]
+    assert rows[4][0] == "fourfront-gamma" and rows[4][3] == "Exception: Access denied." and rows[4][4:] == ["", ""]
+
+
+def test_fan_out_command_task_isolates_environment() -> None:
+    AwsSessionCache.clear()
+    mocked_boto = MockBoto3()
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    script = ("import json, os; print(json.dumps({'credentials_file': os.environ['AWS_SHARED_CREDENTIALS_FILE'],"
+              " 'access_key_id': os.environ.get('AWS_ACCESS_KEY_ID')}))")
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            mock.patch.object(aws_context, "boto3", mocked_boto), \
+            mock.patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "SOME-OTHER-KEY"}):
+        aws_dir = _write_fake_aws_credentials_dirs(tmp_dir)
+        targets = resolve_fan_out_targets(TestData.accounts[:2], aws_dir)
+        results = fan_out(targets + resolve_fan_out_targets([TestData.accounts[2]], aws_dir),
+                          command_task([sys.executable, "-c", script]))
+        [failed] = fan_out(targets[:1], command_task([sys.executable, "-c", "import sys; sys.exit('Oops.')"]))
+        [plain] = fan_out(targets[:1], command_task([sys.executable, "-c", "print('one'); print('two')"]))
+        scalars = fan_out(targets[:2], command_task([sys.executable, "-c", "import sys; print(sys.argv[1])", "42"]))
+        scalars += fan_out(targets[:1], command_task([sys.executable, "-c", "print(chr(34) + 'done' + chr(34))"]))
+    for result, account in zip(results, TestData.accounts):
+        assert result.rows == [{"credentials_file": f"{aws_dir}.{account}/credentials", "access_key_id": None}]
+    assert failed.error == "Exception: Exit code 1: Oops." and not failed.rows
+    assert plain.rows == [{"exit_code": 0, "output": "two"}]
+    assert [result.rows for result in scalars] == [[{"value": 42}], [{"value": 42}], [{"value": "done"}]]
+    assert json.dumps(merge_fan_out_results(results))
+
+
+def test_fan_out_cli(capsys) -> None:
+    AwsSessionCache.clear()
+    mocked_boto = MockBoto3()
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(aws_context, "boto3", mocked_boto):
+        aws_dir = _write_fake_aws_credentials_dirs(tmp_dir)
+        with pytest.raises(SystemExit) as exit_info:
+            fan_out_cli.main(["--aws-dir", aws_dir, "--task", "identity"])
+        assert exit_info.value.code == 0
+        with pytest.raises(SystemExit) as exit_info:
+            fan_out_cli.main(["--aws-dir", aws_dir, "cgap-alpha", "--", sys.executable, "-c", "print('hello')"])
+        assert exit_info.value.code == 0
+    output = capsys.readouterr().out
+    assert all(account in output for account in TestData.accounts)
+    assert TestData.aws_user_arn in output and "hello" in output
+    assert "Ran against 4 target(s)" in output and "Ran against 1 target(s)" in output
@@ -0,0 +1,129 @@
+import mock
+import threading
+import time
+
+from src.commands import fetch_file_items
+from src.commands.fetch_file_items import FastqFetcher
+from .testing_utils import find_matching_line
+
+
+OLD_KEY = {'key': 'old', 'secret': 'old', 'server': 'https://cgap-wolf.hms.harvard.edu'}
+NEW_KEY = {'key': 'new', 'secret': 'new', 'server': 'https://cgap-test.hms.harvard.edu'}
+FASTQS = [f'/files-fastq/GAPFIFASTQ{n:02d}/' for n in range(8)]
+CRAMS = ['/files-processed/GAPFICRAM001/', '/files-processed/GAPFICRAM002/']
+REQUEST_SECONDS = 0.05
+
+
+def _uuid(file_id):
+    return f'uuid-{file_id.split("/")[2]}'
+
+
+class FakePortals:
+    """ Stands in for ff_utils (get_metadata from the old environment, post_metadata and patch_metadata to the
+        new one), taking REQUEST_SECONDS per request (recording the most of them in flight at once), and first
+        failing (as ff_utils does) the posts of the uuids in post_failures as many times as given there, with the
+        given status.
+    """
+
+    def __init__(self, post_failures=None, status=503):
+        self.post_failures = dict(post_failures or {})
+        self.status = status
+        self.posted = {}
+        self.patched = {}
+        self.events = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _request(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(REQUEST_SECONDS)
+        with self.lock:
+            self.in_flight -= 1
+
+    def get_metadata(self, obj_id, key):
+        assert key == OLD_KEY
+        self._request()
+        path = obj_id.split('?')[0]
+        if path.startswith('/samples/'):
+            return {'files': FASTQS[:4] if path == '/samples/S1/' else FASTQS[4:],
+                    'cram_files': [CRAMS[0]] if path == '/samples/S1/' else [CRAMS[1]]}
+        related = ([{'relationship_type': 'paired with', 'file': _uuid(FASTQS[FASTQS.index(path) ^ 1])}]
+                   if path in FASTQS else None)
+        return {'uuid': _uuid(path), 'accession': path.split('/')[2], 'schema_version': '1',
+                'related_files': related}
+
+    def post_metadata(self, post_body, schema_name, key):
+        assert key == NEW_KEY and 'related_files' not in post_body and 'schema_version' not in post_body
+        self._request()
+        with self.lock:
+            self.events.append(('post', post_body['uuid']))
+            if self.post_failures.get(post_body['uuid']):
+                self.post_failures[post_body['uuid']] -= 1
+                raise Exception(f'Bad status code for POST request for {key["server"]}/{schema_name}:'
+                                f' {self.status}. Reason: error')
+            self.posted[post_body['uuid']] = schema_name
+        return {'status': 'success'}
+
+    def patch_metadata(self, patch_body, obj_id, key):
+        assert key == NEW_KEY and set(patch_body) == {'related_files'}
+        self._request()
+        with self.lock:
+            self.events.append(('patch', obj_id))
+            self.patched[obj_id] = patch_body
+        return {'status': 'success'}
+
+
+def _fetch(portals, **kwargs):
+    case = {'sample_processing': {'samples': [{'@id': '/samples/S1/'}, {'@id': '/samples/S2/'}]}}
+    with mock.patch.object(fetch_file_items.ff_utils, 'get_metadata',
+                           side_effect=lambda obj_id, key: case if obj_id.startswith('/cases/')
+                           else portals.get_metadata(obj_id, key)), \
+            mock.patch.object(fetch_file_items.ff_utils, 'post_metadata', side_effect=portals.post_metadata), \
+            mock.patch.object(fetch_file_items.ff_utils, 'patch_metadata', side_effect=portals.patch_metadata), \
+            mock.patch.object(FastqFetcher, 'BACKOFF_SECONDS', 0.01):
+        return FastqFetcher('GAPCAKQB9FPJ', OLD_KEY, NEW_KEY, write=False, **kwargs)
+
+
+def test_fastq_fetcher(tmp_path, capsys) -> None:
+    portals = FakePortals(post_failures={_uuid(FASTQS[2]): 2})
+    fetcher = _fetch(portals, journal_file=str(tmp_path / 'journal'))
+    # 10 gets, 10 posts and 10 patches, concurrently (though no more at once than there are workers, as the portal
+    # is shared); the items/s are reported below.
+    assert 1 < portals.max_in_flight <= FastqFetcher.DEFAULT_WORKERS
+    lines = capsys.readouterr().out.splitlines()
+    assert find_matching_line(lines, 'Found 8 fastq files, 2 cram files')
+    assert find_matching_line(lines, 'fastq files: 8 success, 0 fail')
+    assert find_matching_line(lines, 'file relation patching: 10 success, 0 fail')
+    assert find_matching_line(lines, r'10 files posted and patched in [0-9.]+s \([0-9.]+ items/s\)')
+    assert [item['accession'] for item in fetcher.json_out['file_fastq']] == [fastq.split('/')[2] for fastq in FASTQS]
+    assert portals.posted == {**{_uuid(fastq): 'file_fastq' for fastq in FASTQS},
+                              **{_uuid(cram): 'file_processed' for cram in CRAMS}}
+    # Each file patched after it and the file it is paired with are posted (the transient failures retried).
+    for fastq in FASTQS:
+        patch = portals.events.index(('patch', _uuid(fastq)))
+        paired = _uuid(FASTQS[FASTQS.index(fastq) ^ 1])
+        for posted in (_uuid(fastq), paired):
+            assert max(i for i, event in enumerate(portals.events) if event == ('post', posted)) < patch
+    assert portals.events.count(('post', _uuid(FASTQS[2]))) == 3
+
+
+def test_fastq_fetcher_resume(tmp_path, capsys) -> None:
+    journal = str(tmp_path / 'journal')
+    portals = FakePortals(post_failures={_uuid(FASTQS[2]): 10}, status=422)
+    _fetch(portals, journal_file=journal)
+    lines = capsys.readouterr().out.splitlines()
+    assert find_matching_line(lines, 'fastq files: 7 success, 1 fail')
+    # Neither it nor the file it is paired with are patched.
+    assert find_matching_line(lines, 'file relation patching: 8 success, 2 fail')
+    assert portals.events.count(('post', _uuid(FASTQS[2]))) == 1  # (not transient)
+    assert set(portals.patched) == {_uuid(file_id) for file_id in FASTQS + CRAMS} - {_uuid(FASTQS[2]),
+                                                                                     _uuid(FASTQS[3])}
+    portals.post_failures.clear()
+    portals.events.clear()
+    _fetch(portals, journal_file=journal, resume=True)
+    assert find_matching_line(capsys.readouterr().out.splitlines(), 'file relation patching: 10 success, 0 fail')
+    assert sorted(portals.events) == sorted([('post', _uuid(FASTQS[2])), ('patch', _uuid(FASTQS[2])),
+                                             ('patch', _uuid(FASTQS[3]))])
@@ -0,0 +1,89 @@
+import mock
+from dcicutils.qa_utils import MockBoto3
+from src.auto.utils import aws_context
+from src.auto.utils.aws import Aws
+from src.auto.utils.iam_index import IamIndex
+from .testing_utils import MockBoto3IamWithAuthorizationDetails, temporary_aws_credentials_dir_for_testing
+
+
+class TestData:
+    aws_account_number = "1234567890"
+    aws_user_arn = f"arn:aws:iam::{aws_account_number}:user/user.for.testing"
+    aws_iam_users = [
+        "c4-iam-main-stack-C4IAMMainApplicationS3Federator-ZFK91VU2DM1H",
+        "c4-iam-main-stack-SomeOtherUser-ABCDEFGHIJKL",
+        "david.michaels",
+        "some.other.user"
+    ]
+    aws_iam_roles = [
+        f"arn:aws:iam::{aws_account_number}:role/c4-foursight-cgap-supertest-stack-ApiHandlerRole-KU4H3AHIJLJ6",
+        f"arn:aws:iam::{aws_account_number}:role/c4-foursight-cgap-supertest-stack-CheckRunnerRole-15TKMDZVFQN2K",
+        f"arn:aws:iam::{aws_account_number}:role/c4-foursight-fourfront-stack-ApiHandlerRole-XYZZY",
+        f"arn:aws:iam::{aws_account_number}:role/tibanna_zebra_cgap-supertest_run_task"
+    ]
+    aws_policy_arn = f"arn:aws:iam::{aws_account_number}:policy/c4-sentieon-policy"
+
+
+def _mocked_boto() -> MockBoto3:
+    mocked_boto = MockBoto3(iam=MockBoto3IamWithAuthorizationDetails)
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    mocked_iam = mocked_boto.client("iam")
+    mocked_iam.put_users_for_testing(TestData.aws_iam_users)
+    mocked_iam.put_roles_for_testing(TestData.aws_iam_roles)
+    mocked_iam.put_tags_for_testing(TestData.aws_iam_roles[0], {"env": "cgap-supertest", "team": "cgap"})
+    mocked_iam.put_tags_for_testing(TestData.aws_iam_roles[1], {"env": "cgap-supertest"})
+    mocked_iam.put_tags_for_testing(TestData.aws_iam_roles[2], {"env": "fourfront", "team": "cgap"})
+    mocked_iam.put_attached_policy_for_testing(TestData.aws_iam_roles[3], TestData.aws_policy_arn)
+    mocked_iam.put_attached_policy_for_testing(mocked_iam._user_arn("david.michaels"), TestData.aws_policy_arn)
+    for user in mocked_iam.users.all():
+        if user.name == "david.michaels":
+            user.create_access_key_pair()
+    return mocked_boto
+
+
+def test_iam_index() -> None:
+    mocked_boto = _mocked_boto()
+    mocked_iam = mocked_boto.client("iam")
+    iam_index = IamIndex.build(mocked_iam)
+    # Four users and roles, two per page; the access keys are listed when needed.
+    assert mocked_iam.calls_for_testing() == {"get_account_authorization_details": 1}
+
+    assert iam_index.find_user_names(pattern=".*ApplicationS3Federator") == [TestData.aws_iam_users[0]]
+    assert iam_index.find_user_names(prefix="c4-iam-main-stack-") == TestData.aws_iam_users[:2]
+    assert iam_index.find_user_names(prefix="c4-iam-main-stack-", pattern=".*Other") == [TestData.aws_iam_users[1]]
+    assert iam_index.find_user_names(prefix="no-such-prefix") == []
+    assert iam_index.find_role_arns(arn_pattern=".*role/c4-foursight-.*") == TestData.aws_iam_roles[:3]
+    assert iam_index.find_role_arns(prefix="c4-foursight-", tags={"team": "cgap"}) == [
+        TestData.aws_iam_roles[0], TestData.aws_iam_roles[2]]
+    assert iam_index.find_role_arns(tags={"env": "cgap-supertest", "team": "cgap"}) == [TestData.aws_iam_roles[0]]
+    assert iam_index.find_role_arns(tags={"env": "no-such-env"}) == []
+    assert iam_index.get_role("tibanna_zebra_cgap-supertest_run_task")["Arn"] == TestData.aws_iam_roles[3]
+    assert iam_index.get_user("no.such.user") is None
+
+    [access_key] = iam_index.get_access_keys("david.michaels")
+    assert iam_index.get_access_keys("david.michaels") == [access_key]
+    assert mocked_iam.calls_for_testing()["list_access_keys"] == 1
+    assert iam_index.find_access_key_user_name(access_key["AccessKeyId"]) == "david.michaels"
+    assert iam_index.find_access_key_user_name("no-such-access-key-id") is None
+    assert iam_index.get_access_keys("some.other.user") == []
+    assert iam_index.get_access_keys("no.such.user") == []
+    # Those of the other users listed (once) to find the owner of an access key.
+    assert mocked_iam.calls_for_testing()["list_access_keys"] == 4
+    assert sorted(iam_index.find_policy_principal_arns(TestData.aws_policy_arn)) == sorted([
+        TestData.aws_iam_roles[3], f"arn:aws:iam::{TestData.aws_account_number}:user/david.michaels"])
+
+
+def test_aws_iam_index_is_built_once_per_session() -> None:
+    mocked_boto = _mocked_boto()
+    mocked_iam = mocked_boto.client("iam")
+    with temporary_aws_credentials_dir_for_testing("AWS-ACCESS-KEY-ID-FOR-TESTING",
+                                                   "AWS-SECRET-ACCESS-KEY-FOR-TESTING",
+                                                   "us-east-1") as aws_credentials_dir, \
+            mock.patch.object(aws_context, "boto3", mocked_boto):
+        assert Aws(aws_credentials_dir).find_iam_user_name(".*S3Federator.*") == TestData.aws_iam_users[0]
+        assert Aws(aws_credentials_dir).find_iam_user_name(".*no-such-user.*") is None
+        assert Aws(aws_credentials_dir).find_iam_role_arns(".*ApiHandlerRole.*") == [TestData.aws_iam_roles[0],
+                                                                                     TestData.aws_iam_roles[2]]
+        assert mocked_iam.calls_for_testing()["get_account_authorization_details"] == 1
+        assert Aws(aws_credentials_dir).get_iam_index(refresh=True)
+        assert mocked_iam.calls_for_testing()["get_account_authorization_details"] == 2
@@ -0,0 +1,356 @@
+import mock
+import pytest
+import threading
+import time
+
+from dcicutils.qa_utils import printed_output as mock_print
+from src.commands import identity_swap
+from src.commands.identity_swap import SMaHTIdentitySwap, SwapPlanExecutor
+from src.exceptions import SearchWarmupError
+from .testing_utils import find_matching_line
+
+
+BLUE_CLUSTER = 'arn:aws:ecs:us-east-1:123456789012:cluster/c4-ecs-smaht-production-blue-ClusterSmahtproductionblue'
+GREEN_CLUSTER = 'arn:aws:ecs:us-east-1:123456789012:cluster/c4-ecs-smaht-production-green-ClusterSmahtproductiongreen'
+BLUE_SERVICES = [f'arn:aws:ecs:us-east-1:123456789012:service/ClusterSmahtproductionblue/{service_type}Smahtblue'
+                 for service_type in SMaHTIdentitySwap.SERVICE_TYPES]
+GREEN_SERVICES = [f'arn:aws:ecs:us-east-1:123456789012:service/ClusterSmahtproductiongreen/{service_type}Smahtgreen'
+                  for service_type in SMaHTIdentitySwap.SERVICE_TYPES]
+BLUE_PORTAL, GREEN_PORTAL = (f'arn:aws:ecs:us-east-1:123456789012:service/ClusterSmahtproduction{color}'
+                             f'/PortalSmaht{color}' for color in ('blue', 'green'))
+# The blue portal is currently live (data), so running more tasks than the green (staging) one.
+DESIRED_COUNTS = {BLUE_PORTAL: 4, GREEN_PORTAL: 1}
+
+
+class FakeEcsClient:
+    """ Minimal thread-safe stand-in for the ecs client calls made by the identity swap, recording the most calls
+        (of any client) in flight at once; the waits for the services of the unstable clusters to be stable fail.
+    """
+
+    def __init__(self, delay=0.1, unstable_clusters=()):
+        self.delay = delay
+        self.unstable_clusters = set(unstable_clusters)
+        self.task_definitions = {}
+        for services, color in ((BLUE_SERVICES, 'Blue'), (GREEN_SERVICES, 'Green')):
+            for service in services:
+                service_type = SMaHTIdentitySwap._determine_service_type(service)
+                self.task_definitions[service] = f'arn:aws:ecs:task-definition/{service_type}Smaht{color}:1'
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _call(self, *call):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+            self.calls.append(call)
+
+    def describe_services(self, cluster, services):
+        return {'services': [{'serviceArn': service, 'taskDefinition': self.task_definitions[service],
+                              'desiredCount': DESIRED_COUNTS.get(service, 1),
+                              'runningCount': DESIRED_COUNTS.get(service, 1),
+                              'loadBalancers': [{'targetGroupArn': f'tg-{SMaHTIdentitySwap.short_name(service)}'}]}
+                             for service in services]}
+
+    def describe_task_definition(self, taskDefinition):  # noQA - boto3 case
+        color = 'Blue' if 'Blue' in taskDefinition else 'Green'
+        return {'taskDefinition': {'containerDefinitions': [
+            {'environment': [{'name': 'IDENTITY', 'value': f'C4AppConfigSmaht{color}'}]}]}}
+
+    def update_service(self, cluster, service, taskDefinition=None, desiredCount=None):  # noQA - boto3 case
+        self._call('update_service', service, taskDefinition, desiredCount)
+
+    def get_waiter(self, name):
+        assert name == 'services_stable'
+        fake_ecs = self
+
+        class FakeWaiter:
+            def wait(self, cluster, services, WaiterConfig):  # noQA - boto3 case
+                fake_ecs._call('wait', cluster, tuple(services))
+                if cluster in fake_ecs.unstable_clusters:
+                    raise RuntimeError(f'Services of {cluster} not stable')
+        return FakeWaiter()
+
+
+class FakeEcs:
+    def __init__(self, client):
+        self.client = client
+
+    def list_ecs_clusters(self):
+        return [BLUE_CLUSTER, GREEN_CLUSTER]
+
+    def list_ecs_services(self, cluster_name):
+        return BLUE_SERVICES if cluster_name == BLUE_CLUSTER else GREEN_SERVICES
+
+
+class FakeAwsClient:
+    """ Stand-in for the application-autoscaling and cloudwatch clients, recording their calls. """
+
+    def __init__(self, ecs_client):
+        self.ecs_client = ecs_client
+
+    def get_waiter(self, name):
+        assert name == 'target_in_service'
+        return mock.Mock(wait=lambda TargetGroupArn, WaiterConfig: self.ecs_client._call(name, TargetGroupArn))
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.ecs_client._call(name, kwargs.get('ResourceId') or kwargs.get('AlarmName') or kwargs.get('AlarmNames')
+                                  or kwargs.get('TargetGroupArns') or kwargs.get('LoadBalancerArns'))
+            if name == 'describe_scaling_policies':
+                return {'ScalingPolicies': []}
+            if name == 'describe_alarms':
+                return {'MetricAlarms': [{'MetricName': 'm', 'Namespace': 'n', 'Statistic': 's', 'Period': 60,
+                                          'EvaluationPeriods': 1, 'Threshold': 1, 'Dimensions': []}]}
+            if name == 'put_scaling_policy':
+                return {'PolicyARN': f'policy-{kwargs["PolicyName"]}'}
+            if name == 'describe_target_groups' and 'Names' in kwargs:
+                return {'TargetGroups': [{'TargetGroupName': name, 'TargetGroupArn': f'tg-{name}',
+                                          'LoadBalancerArns': ['lb-blue']} for name in kwargs['Names']]}
+            if name == 'describe_target_groups':
+                return {'TargetGroups': [{'LoadBalancerArns': [f'lb-{kwargs["TargetGroupArns"][0]}']}]}
+            if name == 'describe_listeners':
+                return {'Listeners': [{'ListenerArn': 'listener-blue', 'Port': 80}]}
+            if name == 'modify_listener':
+                [action] = kwargs['DefaultActions']
+                self.ecs_client._call('shift', action['ForwardConfig']['TargetGroups'][1]['Weight'])
+            if name == 'describe_load_balancers':
+                return {'LoadBalancers': [{'DNSName': f'{kwargs["LoadBalancerArns"][0]}.elb.amazonaws.com'}]}
+        return call
+
+
+def test_swap_plan_executor() -> None:
+    executor = SwapPlanExecutor()
+    running = []
+    max_running = []
+
+    def step(name, fail=False):
+        def run():
+            running.append(name)
+            max_running.append(len(running))
+            time.sleep(0.1)
+            running.remove(name)
+            if fail:
+                raise RuntimeError(f'{name} failed')
+            return name
+        return run
+
+    executor.add('a', step('a'), estimate=2)
+    executor.add('b', step('b'), estimate=3)
+    executor.add('c', step('c'), depends_on=['a', 'b'], estimate=10)
+    executor.add('d', step('d', fail=True), estimate=1)
+    executor.add('e', step('e'), depends_on=['d'], estimate=100)
+    assert executor.critical_path() == (101, ['d', 'e'])
+    assert executor.execute() is False
+    # The independent a, b and d run at once, rather than one after another; so a swap takes (about) its critical
+    # path, rather than the sum of its steps.
+    assert max(max_running) == 3
+    assert executor.results == {'a': 'a', 'b': 'b', 'c': 'c'}
+    assert {name: step.status for name, step in executor.steps.items()} == {
+        'a': 'done', 'b': 'done', 'c': 'done', 'd': 'failed', 'e': 'skipped'}
+    assert executor.steps['d'].error == 'RuntimeError: d failed'
+
+
+def _smaht_identity_swap(dry_run: bool, ecs_client: FakeEcsClient, warmup_latency: float = 0.01,
+                         requested_urls: list = None, **kwargs):
+
+    def fake_get(url, timeout):
+        time.sleep(warmup_latency)
+        (requested_urls if requested_urls is not None else []).append(url)
+        return mock.Mock(status_code=200)
+
+    with mock.patch.object(identity_swap, 'ECSUtils', lambda: FakeEcs(ecs_client)), \
+         mock.patch.object(identity_swap.boto3, 'client', lambda service_name: FakeAwsClient(ecs_client)), \
+         mock.patch.object(identity_swap, 'get_app_kind', lambda: 'smaht'), \
+         mock.patch.object(identity_swap.requests, 'get', fake_get), \
+         mock.patch.object(SMaHTIdentitySwap, '_update_foursight') as mocked_update_foursight, \
+         mock.patch('builtins.input', lambda prompt: 'yes'), \
+         mock_print() as mocked_print:
+        SMaHTIdentitySwap.identity_swap(blue='smaht-production-blue', green='smaht-production-green', dry_run=dry_run,
+                                        **kwargs)
+        return mocked_update_foursight, mocked_print
+
+
+def test_smaht_identity_swap_dry_run() -> None:
+    ecs_client = FakeEcsClient()
+    mocked_update_foursight, mocked_print = _smaht_identity_swap(True, ecs_client, prewarm=True)
+    assert ecs_client.calls == []
+    assert not mocked_update_foursight.called
+    assert find_matching_line(mocked_print.lines, r'Critical path \(estimated 673s, vs 1058s one step after another\):'
+                                                  r' scale service PortalSmahtgreen \(desired count 4\)'
+                                                  r' -> wait for scaled services stable in .*'
+                                                  r' -> wait for healthy targets PortalSmahtgreen'
+                                                  r' -> warm up PortalSmahtgreen -> update service .*')
+    # The green (staging) portal is scaled up to the running count of the live one, and both portals warmed up,
+    # before any service is updated; and the blue one (taking over as staging) scaled down after the switch.
+    assert find_matching_line(mocked_print.lines, r'.* scale service PortalSmahtgreen \(desired count 4\)')
+    assert find_matching_line(mocked_print.lines, r'.* update service PortalSmahtgreen'
+                                                  r' \(after: warm up PortalSmahtblue, warm up PortalSmahtgreen\)')
+    assert find_matching_line(mocked_print.lines,
+                              r'After the switch: scale service PortalSmahtblue \(desired count 1\)')
+    assert find_matching_line(mocked_print.lines, 'Dry run - swap plan NOT executed.*')
+
+
+def test_smaht_identity_swap_dry_run_without_prewarm() -> None:
+    ecs_client = FakeEcsClient()
+    mocked_update_foursight, mocked_print = _smaht_identity_swap(True, ecs_client)
+    assert find_matching_line(mocked_print.lines,
+                              r'Critical path \(estimated 311s, vs 636s one step after another\):'
+                              r' .* -> wait for services stable in .* -> register scalable target .*'
+                              r' -> delete scaling policies .* -> update autoscaling .*')
+    assert not any('desired count' in line or 'warm up' in line for line in mocked_print.lines)
+
+
+def test_smaht_identity_swap_dry_run_with_search_warmup() -> None:
+    ecs_client = FakeEcsClient()
+    mocked_update_foursight, mocked_print = _smaht_identity_swap(True, ecs_client, search_queries=[{'body': {}}])
+    # The indices of the identities of the new portal task definitions, before any service is updated.
+    for color in ('Green', 'Blue'):
+        assert find_matching_line(mocked_print.lines, rf'    \[~120s\] warm up search C4AppConfigSmaht{color}$')
+    for service in BLUE_SERVICES + GREEN_SERVICES:
+        assert find_matching_line(mocked_print.lines, rf'.* update service {SMaHTIdentitySwap.short_name(service)}'
+                                                      rf' \(after: warm up search C4AppConfigSmahtGreen,'
+                                                      rf' warm up search C4AppConfigSmahtBlue\)')
+    assert find_matching_line(mocked_print.lines, r'Critical path \(estimated 431s, .*\): warm up search .*'
+                                                  r' -> update service .*')
+
+
+@pytest.mark.parametrize('search_warmup_fails', [False, True])
+def test_smaht_identity_swap_gated_on_search_warmup(search_warmup_fails) -> None:
+    ecs_client = FakeEcsClient(delay=0.01)
+
+    def warm_up_search(identity, search_queries, warn_only=False):
+        ecs_client._call('warm_up_search', identity)
+        if search_warmup_fails:
+            raise SearchWarmupError(f'Search latencies for {identity} did not converge')
+        return {}
+
+    with mock.patch.object(SMaHTIdentitySwap, 'warm_up_search', warm_up_search):
+        mocked_update_foursight, mocked_print = _smaht_identity_swap(False, ecs_client, search_queries=[{'body': {}}])
+    calls = [call[:3] for call in ecs_client.calls]
+    warmups = [call for call in calls if call[0] == 'warm_up_search']
+    updates = [call for call in calls if call[0] == 'update_service']
+    assert sorted(warmups) == [('warm_up_search', 'C4AppConfigSmahtBlue'), ('warm_up_search', 'C4AppConfigSmahtGreen')]
+    if search_warmup_fails:
+        # Cold indices gate the swap: no service updated.
+        assert updates == []
+        assert find_matching_line(mocked_print.lines, 'Swap plan NOT fully executed.*')
+        assert not mocked_update_foursight.called
+    else:
+        # The new identities' indices warmed up before any service is updated, i.e. serves traffic with them.
+        assert len(updates) == 6
+        assert max(calls.index(warmup) for warmup in warmups) < min(calls.index(update) for update in updates)
+        assert mocked_update_foursight.called
+
+
+def test_smaht_identity_swap_runs_independent_steps_concurrently() -> None:
+    ecs_client = FakeEcsClient()
+    mocked_update_foursight, mocked_print = _smaht_identity_swap(False, ecs_client, prewarm=True)
+    updates = [call[:3] for call in ecs_client.calls if call[0] == 'update_service' and call[2]]
+    waits = [call for call in ecs_client.calls if call[0] == 'wait' and len(call[2]) > 1]
+    assert sorted(updates) == sorted(('update_service', service, ecs_client.task_definitions[service]
+                                      .replace('Blue', 'Other').replace('Green', 'Blue').replace('Other', 'Green'))
+                                     for service in BLUE_SERVICES + GREEN_SERVICES)
+    # A single waiter for all the services of each cluster, once all of their updates are done.
+    assert sorted(waits) == [('wait', BLUE_CLUSTER, tuple(BLUE_SERVICES)),
+                             ('wait', GREEN_CLUSTER, tuple(GREEN_SERVICES))]
+    calls = [call[:3] for call in ecs_client.calls]
+    assert all(calls.index(wait) > calls.index(update) for wait in waits for update in updates
+               if (wait[1] == BLUE_CLUSTER) == ('Smahtblue' in update[1]))
+    assert len([call for call in ecs_client.calls if call[0] == 'put_metric_alarm']) == 4
+    # The autoscaling is only repointed once the services of both clusters are stable.
+    assert min(calls.index(call) for call in calls if call[0] == 'register_scalable_target') \
+        > max(calls.index(wait) for wait in waits)
+    # 1 scale up + 1 wait + 2 * (wait for healthy targets + describe target group/load balancer) + 6 service
+    # updates + 2 waits + 2 * (register + describe policies + 2 * (put policy + describe/put alarm)) + 1 scale down.
+    assert len(ecs_client.calls) == 33
+    # The 6 service updates (in both clusters) at once.
+    assert ecs_client.max_in_flight >= 6
+    assert mocked_update_foursight.called
+    assert find_matching_line(mocked_print.lines, 'Swap plan executed.*')
+    # The incoming (green) portal is scaled up, and the portals are warmed up once healthy, before any service is
+    # updated; and the old (blue) live portal scaled down after the switch.
+    assert calls.index(('update_service', GREEN_PORTAL, None)) \
+        < calls.index(('wait', GREEN_CLUSTER, (GREEN_PORTAL,))) \
+        < calls.index(('target_in_service', 'tg-PortalSmahtgreen'))
+    assert max(calls.index(call) for call in calls if call[0] == 'describe_load_balancers') \
+        < min(calls.index(update) for update in updates)
+    assert ecs_client.calls[-1] == ('update_service', BLUE_PORTAL, None, 1)
+
+
+def test_smaht_identity_swap_shifting_traffic() -> None:
+    ecs_client = FakeEcsClient()
+    with mock.patch.object(identity_swap.TrafficShift, 'bake', lambda self: {'requests': 0, 'errors': 0, 'p95': 0}):
+        mocked_update_foursight, mocked_print = _smaht_identity_swap(False, ecs_client, prewarm=True, live_color='blue',
+                                                                     traffic_shift_schedule=[50, 100])
+    assert mocked_update_foursight.called
+    calls = [call[:3] for call in ecs_client.calls]
+    shifts = [call for call in calls if call[0] == 'shift']
+    assert shifts == [('shift', 50), ('shift', 100), ('shift', 0)]
+    blue_updates = [call for call in calls if call[0] == 'update_service' and call[1] in BLUE_SERVICES and call[2]]
+    green_updates = [call for call in calls if call[0] == 'update_service' and call[1] in GREEN_SERVICES and call[2]]
+    # The incoming (green) portal is scaled up first; then the live (blue) traffic shifted to it; then the blue
+    # services updated, and once they are stable the traffic shifted back to them; then the green services updated.
+    assert calls.index(('update_service', GREEN_PORTAL, None)) < calls.index(('shift', 50))
+    assert calls.index(('shift', 100)) < min(calls.index(update) for update in blue_updates)
+    assert calls.index(('wait', BLUE_CLUSTER, tuple(BLUE_SERVICES))) < calls.index(('shift', 0))
+    assert calls.index(('shift', 0)) < min(calls.index(update) for update in green_updates)
+    assert len(blue_updates) == len(green_updates) == 3
+    # The autoscaling is only repointed once the traffic is shifted back and the services of both clusters stable.
+    assert min(calls.index(call) for call in calls if call[0] == 'register_scalable_target') \
+        > max(calls.index(('shift', 0)), calls.index(('wait', GREEN_CLUSTER, tuple(GREEN_SERVICES))))
+
+
+def test_smaht_identity_swap_shifting_traffic_reports_traffic_left_shifted() -> None:
+    # The live (blue) services fail to become stable once all of the blue traffic is shifted to the green portal.
+    ecs_client = FakeEcsClient(delay=0, unstable_clusters=[BLUE_CLUSTER])
+    with mock.patch.object(identity_swap.TrafficShift, 'bake', lambda self: {'requests': 0, 'errors': 0, 'p95': 0}):
+        mocked_update_foursight, mocked_print = _smaht_identity_swap(False, ecs_client, live_color='blue',
+                                                                     traffic_shift_schedule=[50, 100])
+    assert not mocked_update_foursight.called
+    # The traffic is not shifted back to the blue services, nor the green services updated.
+    assert [call for call in ecs_client.calls if call[0] == 'shift'] == [('shift', 50), ('shift', 100)]
+    assert not [call for call in ecs_client.calls if call[0] == 'update_service' and call[1] in GREEN_SERVICES]
+    assert find_matching_line(mocked_print.lines, 'Swap plan NOT fully executed.*')
+    assert find_matching_line(mocked_print.lines, r'100% of the blue traffic is STILL shifted to'
+                                                  r' tg-TargetGroupApplicationGreenShift \(0% to'
+                                                  r' tg-TargetGroupApplicationBlue\) by listener listener-blue')
+    assert find_matching_line(mocked_print.lines, 'Once the blue services are healthy, shift it back with:'
+                                                  ' traffic-shift blue --rollback')
+
+
+def test_smaht_identity_swap_gated_on_warmup_latency(tmp_path) -> None:
+    ecs_client = FakeEcsClient(delay=0)
+    warmup_requests = tmp_path / 'warmup.txt'
+    warmup_requests.write_text('# top URLs\n/\n\n/search/?type=File\n')
+    requested_urls = []
+    mocked_update_foursight, mocked_print = _smaht_identity_swap(
+        False, ecs_client, prewarm=True, warmup_latency=0.1, requested_urls=requested_urls,
+        warmup_paths=identity_swap.read_warmup_paths(str(warmup_requests)), warmup_p95_seconds=0.05)
+    # Each warm-up path requested in each round, for each portal, until the (second) round over the threshold.
+    assert sorted(requested_urls) == sorted(f'http://lb-tg-PortalSmaht{color}.elb.amazonaws.com{path}'
+                                            for color in ('blue', 'green') for path in ('/', '/search/?type=File')
+                                            for _ in range(2))
+    assert find_matching_line(mocked_print.lines, r'.*warm up PortalSmahtblue \(failed: IdentitySwapSetupError:'
+                                                  r' Warm-up of .* failed: p95 0\.1.*s \(threshold 0\.05s\).*')
+    assert find_matching_line(mocked_print.lines, 'Swap plan NOT fully executed.*')
+    assert not mocked_update_foursight.called
+    # The incoming (green) portal scaled up, but no service updated, nor anything scaled down.
+    assert [call for call in ecs_client.calls if call[0] == 'update_service'] == [
+        ('update_service', GREEN_PORTAL, None, 4)]
+
+
+@pytest.mark.parametrize('running_counts, expected', [
+    ({BLUE_PORTAL: 4, GREEN_PORTAL: 1}, ({GREEN_PORTAL: 4}, {BLUE_PORTAL: 1})),
+    ({BLUE_PORTAL: 2, GREEN_PORTAL: 2}, ({}, {})),
+    ({BLUE_PORTAL: 1, GREEN_PORTAL: 3}, ({BLUE_PORTAL: 3}, {GREEN_PORTAL: 1})),
+])
+def test_determine_prewarm_counts(running_counts, expected) -> None:
+    service_descriptions = {service: {'serviceArn': service, 'desiredCount': count, 'runningCount': count}
+                            for service, count in running_counts.items()}
+    service_descriptions[BLUE_SERVICES[1]] = {'serviceArn': BLUE_SERVICES[1], 'desiredCount': 8, 'runningCount': 8}
+    assert SMaHTIdentitySwap._determine_prewarm_counts(service_descriptions) == expected
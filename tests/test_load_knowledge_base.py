@@ -0,0 +1,318 @@
+import contextlib
+import http.server
+import io
+import json
+import mock
+import pytest
+import threading
+import time
+import zipfile
+
+from dcicutils.qa_utils import printed_output as mock_print
+from src.commands.load_knowledge_base import KnowledgeBase, KnowledgeBaseLoader, iter_json_array
+from .testing_utils import find_matching_line
+
+
+CREDS = {'key': 'key', 'secret': 'secret'}
+ITEMS = [{'uuid': f'00000000-0000-0000-0000-{n:012d}', 'gene_symbol': f'GENE{n}'} for n in range(200)]
+POST_SECONDS = 0.01
+
+
+class StubPortal(http.server.ThreadingHTTPServer):
+    """ Stub portal creating posted items after POST_SECONDS: with a 409 conflict for items it already has, and
+        first failing the posts of the uuids in failures with 503s, as many times as given there.
+        Its (loadxl style) bulk load endpoint, after POST_SECONDS, first posts the items of a batch (just their
+        uuids), then patches them (with all their properties), reporting each; but stops with an error at any of
+        the uuids in bulk_errors, before any are patched. Items are also patched by uuid.
+        Records the most requests it has handled at once.
+    """
+
+    def __init__(self, existing=(), failures=None, bulk_errors=()):
+        super().__init__(('127.0.0.1', 0), StubPortalHandler)
+        self.items = {uuid: {} for uuid in existing}
+        self.failures = dict(failures or {})
+        self.bulk_errors = set(bulk_errors)
+        self.posts = []
+        self.patches = []
+        self.bulk_loads = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class StubPortalHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the portal
+    disable_nagle_algorithm = True
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _load_data(self, data):
+        lines = []
+        with self.server.lock:
+            [(item_type, items)] = data['store'].items()
+            self.server.bulk_loads.append((item_type, [item['uuid'] for item in items]))
+            posted = []
+            for item in items:
+                if item['uuid'] in self.server.bulk_errors:
+                    lines.append(f'ERROR: Failure loading {item_type} {item["uuid"]}')
+                    break
+                if item['uuid'] in self.server.items:
+                    lines.append(f'SKIP: {item["uuid"]}')
+                else:
+                    lines.append(f'POST: {item["uuid"]}')
+                    self.server.items[item['uuid']] = {'uuid': item['uuid']}
+                    posted.append(item)
+            else:
+                for item in posted:
+                    lines.append(f'PATCH: {item["uuid"]}')
+                    self.server.items[item['uuid']] = item
+        self._respond(200, ''.join(f'{line}\n' for line in lines).encode())
+
+    def _read_item(self):
+        item = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        time.sleep(POST_SECONDS)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        return item
+
+    def do_PATCH(self):  # noQA - http.server case
+        item = self._read_item()
+        with self.server.lock:
+            self.server.patches.append(self.path)
+            uuid = self.path.strip('/')
+            status = 200 if uuid in self.server.items else 404
+            if status == 200:
+                self.server.items[uuid] = item
+        self._respond(status, json.dumps({'status': 'success' if status == 200 else 'error'}).encode())
+
+    def do_POST(self):  # noQA - http.server case
+        item = self._read_item()
+        if self.path == '/load_data':
+            self._load_data(item)
+            return
+        with self.server.lock:
+            self.server.posts.append((self.path, item['uuid']))
+            if self.server.failures.get(item['uuid']):
+                self.server.failures[item['uuid']] -= 1
+                status = 503
+            elif item['uuid'] in self.server.items:
+                status = 409
+            else:
+                self.server.items[item['uuid']] = item
+                status = 201
+        self._respond(status, json.dumps({'status': 'success' if status == 201 else 'error'}).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def stub_portal(**kwargs):
+    server = StubPortal(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_knowledge_base_loader_retries_and_journals(tmp_path) -> None:
+    journal = str(tmp_path / 'journal.txt')
+    failures = {ITEMS[3]['uuid']: 2, ITEMS[4]['uuid']: 10}
+    with stub_portal(existing=[ITEMS[5]['uuid']], failures=failures) as server, mock_print() as mocked_print:
+        loader = KnowledgeBaseLoader(server.url, CREDS, journal_file=journal, max_attempts=3, backoff_seconds=0.01)
+        counts = loader.load_items(ITEMS[:10], 'Gene', total=10)
+        assert {key: value for key, value in counts.items() if key != 'seconds'} == {
+            'loaded': 8, 'existing': 1, 'skipped': 0, 'failed': 1}
+        assert find_matching_line(mocked_print.lines, f'Failed to load Gene item {ITEMS[4]["uuid"]}: Bad status code'
+                                                      f' 503 for POST {server.url}/Gene: .*')
+        assert find_matching_line(mocked_print.lines, r'Loaded 8 Gene items \(1 already there, 0 skipped as already'
+                                                      r' loaded, 1 failed\) in [0-9.]+s \([0-9.]+ items/s\).')
+        # Retried (with backoff) up to max_attempts.
+        assert [uuid for _, uuid in server.posts].count(ITEMS[3]['uuid']) == 3
+        assert [uuid for _, uuid in server.posts].count(ITEMS[4]['uuid']) == 3
+        with open(journal) as fp:
+            assert sorted(fp.read().split()) == sorted(item['uuid'] for item in ITEMS[:10] if item is not ITEMS[4])
+        # A resumed load posts exactly the items not journaled as loaded.
+        server.posts.clear()
+        server.failures.clear()
+        resumed = KnowledgeBaseLoader(server.url, CREDS, journal_file=journal, resume=True)
+        counts = resumed.load_items(ITEMS[:12], 'Gene')
+        assert (counts['loaded'], counts['skipped']) == (3, 9)
+        assert sorted(uuid for _, uuid in server.posts) == [ITEMS[n]['uuid'] for n in (4, 10, 11)]
+
+
+def test_knowledge_base_type_order() -> None:
+    assert sorted(['evidence_dis_pheno.json', 'variant_consequence.json', 'disorder.json', 'gene.json',
+                   'phenotype.json'], key=KnowledgeBase.type_order_key) == [
+        'gene.json', 'phenotype.json', 'disorder.json', 'evidence_dis_pheno.json', 'variant_consequence.json']
+
+
+def test_knowledge_base_loader_concurrency() -> None:
+    """ Checks the loader posts items to a stub portal one at a time with 1 worker, and several at once (but no
+        more than there are workers) with 8.
+    """
+    max_in_flight = {}
+    for workers in (1, 8):
+        with stub_portal() as server, mock_print():
+            counts = KnowledgeBaseLoader(server.url, CREDS, workers=workers).load_items(ITEMS, 'Gene')
+            assert counts['loaded'] == len(server.items) == len(ITEMS)
+            assert {path for path, _ in server.posts} == {'/Gene'}
+        max_in_flight[workers] = server.max_in_flight
+    assert max_in_flight[1] == 1
+    assert 1 < max_in_flight[8] <= 8
+
+
+@pytest.mark.integratedx
+def test_knowledge_base_loader_benchmark() -> None:
+    """ Benchmarks the throughput of the loader against a stub portal, sequentially and with 8 workers, reporting
+        (rather than asserting, see test_knowledge_base_loader_concurrency) the items per second of each.
+    """
+    throughputs = {}
+    for workers in (1, 8):
+        with stub_portal() as server, mock_print():
+            counts = KnowledgeBaseLoader(server.url, CREDS, workers=workers).load_items(ITEMS, 'Gene')
+            assert counts['loaded'] == len(server.items) == len(ITEMS)
+        throughputs[workers] = len(ITEMS) / counts['seconds']
+    print(f'Knowledge base loader throughput: {throughputs[1]:.1f} items/s sequentially,'
+          f' {throughputs[8]:.1f} items/s with 8 workers')
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64 * 1024])
+def test_iter_json_array(chunk_size) -> None:
+    elements = [{'uuid': 'a', 'aliases': ['x,y', '[z]'], 'note': 'say "hi" \\ \u00e9'}, 12345, -1.5e3, 'str,]',
+                [], {}, None, True, [1, [2, {'three': 3}]]]
+    for text in (json.dumps(elements), json.dumps(elements, indent=2), f'  \n{json.dumps(elements)}\n'):
+        assert list(iter_json_array(io.StringIO(text), chunk_size=chunk_size)) == elements
+    assert list(iter_json_array(io.StringIO(' [ ] '), chunk_size=chunk_size)) == []
+    assert list(iter_json_array(io.StringIO('[12345]'), chunk_size=chunk_size)) == [12345]
+    for text in ('', '{}', '[1, 2', '[1 2]', '[{"a": 1}'):
+        with pytest.raises(ValueError):
+            list(iter_json_array(io.StringIO(text), chunk_size=chunk_size))
+
+
+def test_iter_json_array_is_incremental() -> None:
+    """ The elements are yielded as soon as they are read, not once the whole array is. """
+    reads = []
+
+    class RecordingStream(io.StringIO):
+        def read(self, size=-1):
+            reads.append(size)
+            return super().read(size)
+
+    elements = iter_json_array(RecordingStream(json.dumps(ITEMS)), chunk_size=100)
+    assert next(elements) == ITEMS[0]
+    assert len(reads) == 1
+    assert list(elements) == ITEMS[1:]
+    assert len(reads) > len(json.dumps(ITEMS)) // 100
+
+
+def test_knowledge_base_load_from_zip(tmp_path) -> None:
+    """ The knowledge base is loaded straight out of its zip file, without extracting it. """
+    kb_path = tmp_path / 'knowledge_base'
+    kb_path.mkdir()
+    with zipfile.ZipFile(kb_path / 'knowledge_base.zip', 'w', compression=zipfile.ZIP_DEFLATED) as kb_zip:
+        kb_zip.writestr('temp-local-inserts/', '')
+        kb_zip.writestr('temp-local-inserts/gene.json', json.dumps(ITEMS[:150], indent=2))
+        kb_zip.writestr('temp-local-inserts/disorder.json', json.dumps(ITEMS[150:]))
+    with stub_portal() as server, mock_print() as mocked_print:
+        creds_path = tmp_path / 'keys.json'
+        creds_path.write_text(json.dumps({'smaht-test': dict(CREDS, server=server.url)}))
+        with mock.patch.object(KnowledgeBase, 'CREDS_PATH', str(creds_path)), \
+                mock.patch.object(KnowledgeBase, 'KNOWLEDGE_BASE_PATH', str(kb_path)), \
+                mock.patch.object(KnowledgeBase, 'KB_INSERTS_PATH', str(kb_path / 'temp-local-inserts')), \
+                mock.patch.object(KnowledgeBase, 'KB_ZIP_PATH', str(kb_path / 'knowledge_base.zip')):
+            KnowledgeBase.initialize()
+            assert KnowledgeBase.TEST_DATA_TYPES == ['disorder', 'gene']
+            KnowledgeBase.load(env_name='smaht-test', confirm=False, start=None)
+            KnowledgeBase.initialize()
+        assert find_matching_line(mocked_print.lines, r'Loaded 150 Gene items .*')
+        assert find_matching_line(mocked_print.lines, r'Loaded 50 Disorder items .*')
+        # All the genes first (see TYPE_ORDER).
+        assert {uuid for _, uuid in server.posts[:150]} == {item['uuid'] for item in ITEMS[:150]}
+        assert server.items == {item['uuid']: item for item in ITEMS}
+    assert sorted(path.name for path in kb_path.iterdir()) == ['knowledge_base.zip', 'load-journal-smaht-test.txt']
+
+
+def test_knowledge_base_bulk_load(tmp_path) -> None:
+    journal = str(tmp_path / 'journal.txt')
+    with stub_portal(existing=[ITEMS[1]['uuid']], bulk_errors=[ITEMS[25]['uuid']]) as server, \
+            mock_print() as mocked_print:
+        loader = KnowledgeBaseLoader(server.url, CREDS, journal_file=journal)
+        counts = loader.bulk_load_items(ITEMS[:50], 'gene', 'Gene', batch_size=20)
+        assert {key: value for key, value in counts.items() if key != 'seconds'} == {
+            'bulk loaded': 30, 'loaded': 20, 'existing': 0, 'skipped': 0, 'failed': 0}
+        assert server.items == {item['uuid']: item for item in ITEMS[:50] if item is not ITEMS[1]} | {
+            ITEMS[1]['uuid']: {}}
+        # Three batches, the second of which stopped at its error, its items being loaded one by one: those before
+        # the error were only posted, not (by loadxl's second pass) patched, so are patched (rather than posted,
+        # only to find them there, unpatched), and the rest posted.
+        assert [(item_type, len(uuids)) for item_type, uuids in server.bulk_loads] == [('gene', 20)] * 2 + [
+            ('gene', 10)]
+        assert sorted(server.patches) == [f'/{item["uuid"]}' for item in ITEMS[20:25]]
+        assert sorted(uuid for _, uuid in server.posts) == [item['uuid'] for item in ITEMS[25:40]]
+        assert find_matching_line(mocked_print.lines, f'Bulk load of gene batch 2 reported: Failure loading gene'
+                                                      f' {ITEMS[25]["uuid"]}')
+        assert find_matching_line(mocked_print.lines, r'Bulk loaded 30 Gene items in 3 batches \(20 loaded one by'
+                                                      r' one, 0 already there, .*\) in [0-9.]+s \([0-9.]+ items/s\).')
+        with open(journal) as fp:
+            assert sorted(fp.read().split()) == [item['uuid'] for item in ITEMS[:50]]
+        # Resuming skips the batches' items already loaded.
+        server.bulk_loads.clear()
+        counts = KnowledgeBaseLoader(server.url, CREDS, journal_file=journal, resume=True).bulk_load_items(
+            ITEMS[:60], 'gene', 'Gene', batch_size=20)
+        assert (counts['bulk loaded'], counts['skipped']) == (10, 50)
+        assert server.bulk_loads == [('gene', [item['uuid'] for item in ITEMS[50:60]])]
+
+
+def test_knowledge_base_bulk_load_requests() -> None:
+    """ Checks the loader makes a request of a stub portal per item posting items one by one, but only one per batch
+        bulk loading them.
+    """
+    for mode in ('per-item', 'bulk'):
+        with stub_portal() as server, mock_print():
+            loader = KnowledgeBaseLoader(server.url, CREDS, workers=8)
+            if mode == 'bulk':
+                counts = loader.bulk_load_items(ITEMS, 'gene', 'Gene', batch_size=100)
+                assert counts['bulk loaded'] == len(ITEMS)
+                assert [len(uuids) for _, uuids in server.bulk_loads] == [100, 100]
+                assert server.posts == []
+            else:
+                counts = loader.load_items(ITEMS, 'Gene')
+                assert counts['loaded'] == len(ITEMS)
+                assert server.bulk_loads == []
+                assert len(server.posts) == len(ITEMS)
+            assert len(server.items) == len(ITEMS)
+
+
+@pytest.mark.integratedx
+def test_knowledge_base_bulk_load_benchmark() -> None:
+    """ Benchmarks the throughput of the loader against a stub portal, posting items one by one (with 8 workers)
+        and bulk loading them, reporting (rather than asserting, see test_knowledge_base_bulk_load_requests) the
+        items per second of each.
+    """
+    throughputs = {}
+    for mode in ('per-item', 'bulk'):
+        with stub_portal() as server, mock_print():
+            loader = KnowledgeBaseLoader(server.url, CREDS, workers=8)
+            counts = (loader.bulk_load_items(ITEMS, 'gene', 'Gene', batch_size=100) if mode == 'bulk'
+                      else loader.load_items(ITEMS, 'Gene'))
+            assert len(server.items) == len(ITEMS)
+        throughputs[mode] = len(ITEMS) / counts['seconds']
+    print(f'Knowledge base loader throughput: {throughputs["per-item"]:.1f} items/s posting items one by one,'
+          f' {throughputs["bulk"]:.1f} items/s bulk loading them')
@@ -0,0 +1,120 @@
+import json
+import mock
+import pytest
+import sys
+import threading
+import time
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+from src.commands import queue_ingestion
+from src.commands.queue_ingestion import queue_uuids, read_uuids, search_ingestion_types
+from .testing_utils import find_matching_line
+
+
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/123456789012/cgap-test-ingestion-queue'
+
+
+class FakeSQS:
+    """ Records the messages sent by send_message_batch, failing those of the uuids in failures (with whether
+        the fault is the sender's, as many times as given), and the whole calls including a uuid in throttled
+        (once), or in unreachable (always, as if SQS could not be connected to).
+    """
+
+    def __init__(self, failures=None, throttled=(), unreachable=()):
+        self.failures = dict(failures or {})
+        self.throttled = set(throttled)
+        self.unreachable = set(unreachable)
+        self.calls = []
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):  # noQA - boto3 case
+        assert QueueUrl == QUEUE_URL and 1 <= len(Entries) <= 10
+        with self.lock:
+            self.calls.append((time.time(), len(Entries)))
+            bodies = {entry['Id']: json.loads(entry['MessageBody']) for entry in Entries}
+            if self.unreachable & {body['uuid'] for body in bodies.values()}:
+                raise EndpointConnectionError(endpoint_url=QUEUE_URL)
+            if self.throttled & {body['uuid'] for body in bodies.values()}:
+                self.throttled -= {body['uuid'] for body in bodies.values()}
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}},
+                                  'SendMessageBatch')
+            failed = []
+            for entry_id, body in bodies.items():
+                sender_fault, count = self.failures.get(body['uuid'], (False, 0))
+                if count:
+                    self.failures[body['uuid']] = (sender_fault, count - 1)
+                    failed.append({'Id': entry_id, 'SenderFault': sender_fault, 'Code': 'InternalError',
+                                   'Message': 'failed'})
+                else:
+                    self.sent.append(body)
+            return {'Successful': [{'Id': entry_id} for entry_id in bodies
+                                   if entry_id not in {failure['Id'] for failure in failed}],
+                    'Failed': failed}
+
+
+UUIDS = [f'uuid-{n:02d}' for n in range(25)]
+INGESTION_TYPES = {uuid: 'vcf' if n % 2 else 'metadata_bundle' for n, uuid in enumerate(UUIDS)}
+
+
+def test_queue_uuids(capsys) -> None:
+    sqs = FakeSQS(failures={'uuid-03': (False, 1), 'uuid-17': (True, 1)}, throttled={'uuid-21'})
+    with mock.patch.object(queue_ingestion, 'BACKOFF_SECONDS', 0):
+        failed = queue_uuids(sqs, QUEUE_URL, INGESTION_TYPES)
+    # Sent in batches of 10, each with its own ingestion type, the transient failures retried, and that of the
+    # sender not.
+    assert sorted(body['uuid'] for body in sqs.sent) == [uuid for uuid in UUIDS if uuid != 'uuid-17']
+    assert all(body['ingestion_type'] == INGESTION_TYPES[body['uuid']] for body in sqs.sent)
+    assert sorted(count for _, count in sqs.calls) == [1, 5, 5, 10, 10]
+    assert list(failed) == ['uuid-17']
+    lines = capsys.readouterr().out.splitlines()
+    assert find_matching_line(lines, r'Queued 24 of 25 uuids for ingestion in [0-9.]+s \([0-9.]+ messages/s\),'
+                                     r' 1 failed.')
+    assert find_matching_line(lines, 'Failed to queue uuid-17: InternalError: failed')
+
+
+def test_queue_uuids_unreachable(capsys) -> None:
+    sqs = FakeSQS(unreachable={'uuid-05'})
+    with mock.patch.object(queue_ingestion, 'BACKOFF_SECONDS', 0):
+        failed = queue_uuids(sqs, QUEUE_URL, INGESTION_TYPES)
+    # The batch which cannot be sent (after its retries) reported failed, rather than the others abandoned.
+    assert sorted(failed) == UUIDS[:10]
+    assert sorted(body['uuid'] for body in sqs.sent) == UUIDS[10:]
+    assert find_matching_line(capsys.readouterr().out.splitlines(),
+                              f'Failed to queue uuid-05: EndpointConnectionError: Could not connect to the endpoint'
+                              f' URL: "{QUEUE_URL}"')
+
+
+def test_queue_uuids_throttled(capsys) -> None:
+    sqs = FakeSQS()
+    started = time.time()
+    assert queue_uuids(sqs, QUEUE_URL, dict.fromkeys(UUIDS[:20], 'vcf'), workers=4, rate=100) == {}
+    # The second batch of 10 waits for its turn, 0.1s after the first.
+    assert time.time() - started >= 0.09
+    assert len(sqs.sent) == 20
+    first, second = sorted(sent for sent, _ in sqs.calls)
+    assert second - first >= 0.09
+
+
+def test_search_ingestion_types() -> None:
+    items = [{'uuid': 'uuid-01', 'ingestion_type': 'metadata_bundle'}, {'uuid': 'uuid-02'}]
+    with mock.patch.object(queue_ingestion.ff_utils, 'search_metadata', return_value=items) as search_metadata:
+        assert search_ingestion_types('/search/?type=IngestionSubmission', key={}, default='vcf') == {
+            'uuid-01': 'metadata_bundle', 'uuid-02': 'vcf'}
+        assert search_metadata.call_args == mock.call('/search/?type=IngestionSubmission', key={})
+
+
+def test_main_requires_ingestion_type_with_uuids_file(tmp_path, capsys) -> None:
+    uuids_file = tmp_path / 'uuids'
+    uuids_file.write_text('uuid-01\n')
+    with mock.patch.object(sys, 'argv', ['queue-ingestion', '--uuids-file', str(uuids_file), '--env', 'cgap-test']):
+        with pytest.raises(SystemExit) as exit_info:
+            queue_ingestion.main()
+    assert exit_info.value.code == 2
+    assert '--ingestion-type is required with --uuids-file' in capsys.readouterr().err
+
+
+def test_read_uuids(tmp_path) -> None:
+    uuids_file = tmp_path / 'uuids'
+    uuids_file.write_text('# submissions to re-ingest\nuuid-01\n\n  uuid-02  \nuuid-01\n')
+    assert read_uuids(str(uuids_file)) == ['uuid-01', 'uuid-02', 'uuid-01']
@@ -0,0 +1,146 @@
+import contextlib
+import http.server
+import json
+import mock
+import pytest
+import threading
+import time
+
+from dcicutils.es_utils import create_es_client
+from dcicutils.qa_utils import printed_output as mock_print
+from src.commands.search_warmup import SearchWarmup, percentile, read_search_queries
+from src.exceptions import SearchWarmupError
+from .testing_utils import find_matching_line
+
+
+NAMESPACE = 'smaht-production-green'
+QUERIES = [{'index': 'file_processed', 'body': {'query': {'match': {'status': 'released'}}}},
+           {'index': 'donor', 'body': {'query': {'match_all': {}}, 'size': 25}},
+           {'body': {'query': {'query_string': {'query': 'liver'}}}}]
+
+
+class StubOpenSearch(http.server.ThreadingHTTPServer):
+    """ Stub HTTP server standing in for OpenSearch: lists the indices of NAMESPACE, and
+        answers searches after the latency returned by latency_for(round) for the (1-based) round of the searches,
+        recording the most of them in flight at once.
+    """
+
+    def __init__(self, latency_for):
+        super().__init__(('127.0.0.1', 0), StubOpenSearchHandler)
+        self.latency_for = latency_for
+        self.searches = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class StubOpenSearchHandler(http.server.BaseHTTPRequestHandler):
+
+    def _respond(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # noQA - http.server case
+        path = self.path.split('?')[0]
+        if path.startswith('/_cat/indices/'):
+            self._respond([{'index': f'{NAMESPACE}{item_type}'} for item_type in ('donor', 'file_processed')])
+        else:
+            self.do_POST()
+
+    def do_POST(self):  # noQA - http.server case
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.server.lock:
+            self.server.searches.append(self.path.split('?')[0])
+            search_round = (len(self.server.searches) - 1) // len(QUERIES) + 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        time.sleep(self.server.latency_for(search_round))
+        with self.server.lock:
+            self.server.in_flight -= 1
+        self._respond({'hits': {'total': {'value': 0}, 'hits': []}})
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def stub_opensearch(latency_for):
+    server = StubOpenSearch(latency_for)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_percentile() -> None:
+    assert percentile([], 95) == 0.0
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(list(range(1, 101)), 95) == 95
+
+
+def test_search_warmup_converges() -> None:
+    # Cold for the first round; then (near enough) the same latency.
+    with stub_opensearch(lambda search_round: 0.3 if search_round == 1 else 0.05) as server, \
+         mock_print() as mocked_print:
+        warmup = SearchWarmup(create_es_client(server.url, use_aws_auth=False), NAMESPACE, QUERIES, tolerance=0.5)
+        assert warmup.get_indices() == [f'{NAMESPACE}donor', f'{NAMESPACE}file_processed']
+        result = warmup.warm_up()
+        # The queries of each round are all in flight at once, as the replayed traffic; their latencies are the stub's.
+        assert server.max_in_flight == len(QUERIES)
+        assert len(warmup.rounds) == 3
+        assert result['errors'] == 0 and 0.05 <= result['p95'] < 0.3
+        assert sorted(server.searches[:len(QUERIES)]) == sorted(f'/{NAMESPACE}{index}/_search'
+                                                                for index in ('file_processed', 'donor', '*'))
+        assert find_matching_line(mocked_print.lines, f'Search latencies for namespace {NAMESPACE} converged'
+                                                      f' after 3 rounds.')
+
+
+def test_search_warmup_not_converged() -> None:
+    with stub_opensearch(lambda search_round: 0.01 * search_round ** 2) as server, mock_print() as mocked_print:
+        warmup = SearchWarmup(create_es_client(server.url, use_aws_auth=False), NAMESPACE, QUERIES,
+                              max_rounds=3, tolerance=0.1)
+        with pytest.raises(SearchWarmupError, match=f'Search latencies for namespace {NAMESPACE} did not converge'
+                                                    f' after 3 rounds'):
+            warmup.warm_up()
+        assert len(server.searches) == 3 * len(QUERIES)
+        warmup = SearchWarmup(create_es_client(server.url, use_aws_auth=False), NAMESPACE, QUERIES,
+                              max_rounds=2, tolerance=0.1)
+        warmup.warm_up(warn_only=True)
+        assert find_matching_line(mocked_print.lines, f'WARNING: Search latencies for namespace {NAMESPACE}'
+                                                      f' did not converge after 2 rounds .*')
+
+
+def test_search_warmup_without_queries() -> None:
+    with stub_opensearch(lambda search_round: 0.01) as server, mock_print():
+        warmup = SearchWarmup(create_es_client(server.url, use_aws_auth=False), NAMESPACE, [])
+        for warn_only in (False, True):
+            with pytest.raises(SearchWarmupError, match=f'No search queries to warm up namespace {NAMESPACE} with'):
+                warmup.warm_up(warn_only=warn_only)
+        assert server.searches == [] and warmup.rounds == []
+
+
+def test_search_warmup_for_identity(tmp_path) -> None:
+    queries_file = tmp_path / 'queries.json'
+    queries_file.write_text(json.dumps(QUERIES))
+    assert read_search_queries(str(queries_file)) == QUERIES
+    for not_queries in ({'body': {}}, []):
+        queries_file.write_text(json.dumps(not_queries))
+        with pytest.raises(SearchWarmupError, match='.* must contain a \\(non-empty\\) list of objects'):
+            read_search_queries(str(queries_file))
+    secretsmanager = mock.Mock()
+    secretsmanager.get_secret_value.return_value = {'SecretString': json.dumps({
+        'ENCODED_ES_SERVER': 'vpc-os-smaht-green.us-east-1.es.amazonaws.com:443', 'ENV_NAME': NAMESPACE})}
+    assert SearchWarmup.get_identity_search_settings('C4AppConfigSmahtGreen', secretsmanager=secretsmanager) == (
+        'https://vpc-os-smaht-green.us-east-1.es.amazonaws.com:443', NAMESPACE)
+    secretsmanager.get_secret_value.assert_called_once_with(SecretId='C4AppConfigSmahtGreen')
@@ -0,0 +1,103 @@
+import mock
+from dcicutils.qa_utils import MockBoto3, printed_output as mock_print
+from src.auto.utils import aws, aws_context
+from src.auto.utils.secrets_cache import SecretsCache
+from .testing_utils import (find_matching_line, MockBoto3VersionedSecretsManager,
+                            temporary_aws_credentials_dir_for_testing)
+
+
+class TestData:
+    aws_access_key_id = "AWS-ACCESS-KEY-ID-FOR-TESTING"
+    aws_secret_access_key = "AWS-SECRET-ACCESS-KEY-FOR-TESTING"
+    aws_region = "us-west-2"
+    aws_account_number = "1234567890"
+    aws_user_arn = f"arn:aws:iam::{aws_account_number}:user/user.for.testing"
+    gac_secret_name = "C4DatastoreCgapSupertestApplicationConfiguration"
+    rds_secret_name = "C4DatastoreCgapSupertestRDSSecret"
+    missing_secret_name = "C4DatastoreNoSuchSecret"
+
+
+class MockBoto3UnbatchedSecretsManager(MockBoto3VersionedSecretsManager):
+    batch_get_secret_value = None
+
+
+def _mocked_boto(secretsmanager=MockBoto3VersionedSecretsManager) -> MockBoto3:
+    mocked_boto = MockBoto3(secretsmanager=secretsmanager)
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    mocked_secretsmanager = mocked_boto.client("secretsmanager")
+    mocked_secretsmanager.put_secret_key_value_for_testing(TestData.gac_secret_name, "ENCODED_IDENTITY", "gac")
+    mocked_secretsmanager.put_secret_key_value_for_testing(TestData.gac_secret_name, "ACCOUNT_NUMBER", "1234")
+    mocked_secretsmanager.put_secret_key_value_for_testing(TestData.rds_secret_name, "host", "rds.host")
+    return mocked_boto
+
+
+def test_secrets_cache_fetches_each_secret_once_per_command() -> None:
+    mocked_boto = _mocked_boto()
+    mocked_secretsmanager = mocked_boto.client("secretsmanager")
+    with temporary_aws_credentials_dir_for_testing(TestData.aws_access_key_id,
+                                                   TestData.aws_secret_access_key,
+                                                   TestData.aws_region) as aws_credentials_dir, \
+         mock.patch.object(aws_context, "boto3", mocked_boto), \
+         mock_print() as mocked_print:
+        aws_object = aws.Aws(aws_credentials_dir)
+        secret_values = aws_object.get_secret_values([TestData.gac_secret_name, TestData.rds_secret_name,
+                                                      TestData.missing_secret_name])
+        assert secret_values == {TestData.gac_secret_name: {"ENCODED_IDENTITY": "gac", "ACCOUNT_NUMBER": "1234"},
+                                 TestData.rds_secret_name: {"host": "rds.host"}}
+        for _ in range(3):
+            assert aws_object.get_secret_value(TestData.gac_secret_name, "ENCODED_IDENTITY") == "gac"
+            assert aws_object.get_secret_value(TestData.gac_secret_name, "ACCOUNT_NUMBER") == "1234"
+            assert aws_object.get_secret_value(TestData.rds_secret_name, "host") == "rds.host"
+        # Another Aws object for the same credentials (e.g. in another part of the command) shares the cache.
+        assert aws.Aws(aws_credentials_dir).get_secret_value(TestData.rds_secret_name, "host") == "rds.host"
+        for secret_name in (TestData.gac_secret_name, TestData.rds_secret_name):
+            assert mocked_secretsmanager.calls_for_testing(secret_name) == {"batch_get_secret_value": 1}
+        secrets_cache = aws_object.get_secrets_cache()
+        assert secrets_cache.calls == {"batch_get_secret_value": 1}
+        assert (secrets_cache.hits, secrets_cache.misses) == (10, 3)
+        secrets_cache.print_report()
+        assert find_matching_line(mocked_print.lines, "Secrets cache: 10 hits, 3 misses \\(77% hit rate\\).*")
+
+
+def test_secrets_cache_revalidates_expired_secrets() -> None:
+    mocked_boto = _mocked_boto()
+    mocked_secretsmanager = mocked_boto.client("secretsmanager")
+    secrets_cache = SecretsCache(mocked_secretsmanager, ttl_seconds=0)
+    assert secrets_cache.get_entry(TestData.gac_secret_name).version_id == f"{TestData.gac_secret_name}-version-0"
+    # Expired but still the current version; so just describe_secret, no get_secret_value.
+    assert secrets_cache.get_entry(TestData.gac_secret_name).version_id == f"{TestData.gac_secret_name}-version-0"
+    assert secrets_cache.is_fresh(TestData.gac_secret_name)
+    assert mocked_secretsmanager.calls_for_testing(TestData.gac_secret_name) == {"get_secret_value": 1,
+                                                                                 "describe_secret": 2}
+    # Changed; so fetched again.
+    mocked_secretsmanager.change_version_for_testing(TestData.gac_secret_name)
+    assert not secrets_cache.is_fresh(TestData.gac_secret_name)
+    assert secrets_cache.get_entry(TestData.gac_secret_name).version_id.endswith("-changed")
+    assert mocked_secretsmanager.calls_for_testing(TestData.gac_secret_name)["get_secret_value"] == 2
+    assert secrets_cache.revalidations == 4
+    # Not expired; so neither describe_secret nor get_secret_value.
+    secrets_cache = SecretsCache(mocked_secretsmanager, ttl_seconds=60)
+    secrets_cache.get_entry(TestData.rds_secret_name)
+    secrets_cache.get_entry(TestData.rds_secret_name)
+    assert mocked_secretsmanager.calls_for_testing(TestData.rds_secret_name) == {"get_secret_value": 1}
+    secrets_cache.invalidate(TestData.rds_secret_name)
+    secrets_cache.get_entry(TestData.rds_secret_name)
+    assert mocked_secretsmanager.calls_for_testing(TestData.rds_secret_name) == {"get_secret_value": 2}
+
+
+def test_secrets_cache_without_batch_get_secret_value() -> None:
+    mocked_boto = _mocked_boto(secretsmanager=MockBoto3UnbatchedSecretsManager)
+    mocked_secretsmanager = mocked_boto.client("secretsmanager")
+    secrets_cache = SecretsCache(mocked_secretsmanager)
+    secret_ids = [TestData.gac_secret_name, TestData.rds_secret_name, TestData.missing_secret_name]
+    assert sorted(secrets_cache.get_entries(secret_ids)) == sorted(secret_ids[:2])
+    assert sorted(secrets_cache.get_entries(secret_ids)) == sorted(secret_ids[:2])
+    for secret_name in secret_ids[:2]:
+        assert mocked_secretsmanager.calls_for_testing(secret_name) == {"get_secret_value": 1}
+    # Failures are not cached.
+    assert mocked_secretsmanager.calls_for_testing(TestData.missing_secret_name) == {"get_secret_value": 2}
+    try:
+        secrets_cache.get_entry(TestData.missing_secret_name)
+        assert False, "Expected exception for missing secret."
+    except KeyError:
+        pass
@@ -1,13 +1,19 @@
+import collections
 import mock
 import re
+import threading
+import time
 from typing import Optional
-from src.auto.setup_remaining_secrets.cli import main
+from src.auto.setup_remaining_secrets.cli import gather_secrets_to_update, main
 from dcicutils.cloudformation_utils import camelize, DEFAULT_ECOSYSTEM
-from dcicutils.qa_utils import printed_output as mock_print, MockBoto3
+from dcicutils.qa_utils import (printed_output as mock_print,
+                                MockBoto3, MockBoto3Kms, MockBoto3OpenSearch)
 from src.names import Names
 from src.auto.setup_remaining_secrets.defs import GacSecretKeyName, RdsSecretKeyName
 from src.auto.utils import aws, aws_context
 from .testing_utils import (find_matching_line,
+                            MockBoto3IamWithAuthorizationDetails,
+                            MockBoto3VersionedSecretsManager,
                             temporary_aws_credentials_dir_for_testing,
                             temporary_custom_dir_for_testing)
 
@@ -39,7 +45,7 @@ class TestData:
     rds_host = "rds.host.for.testing"
     rds_password = "rds-password-for-testing"
 
-    gac_secret_name = f"C4Datastore{camelize(aws_credentials_name)}ApplicationConfiguration"
+    gac_secret_name = Names.application_configuration_secret(aws_credentials_name)
     rds_secret_name = f"C4Datastore{camelize(aws_credentials_name)}RDSSecret"
 
 
@@ -92,7 +98,8 @@ def test_get_federated_user_name_pattern() -> None:
 def do_test_setup_remaining_secrets(overwrite_secrets: bool = True,
                                     create_access_key_pair: bool = True,
                                     encryption_enabled: bool = True) -> None:
-    mocked_boto = MockBoto3()
+    mocked_boto = MockBoto3(iam=MockBoto3IamWithAuthorizationDetails,
+                            secretsmanager=MockBoto3VersionedSecretsManager)
 
     mocked_boto.client("iam").put_users_for_testing(TestData.aws_iam_users)
     mocked_boto.client("iam").put_roles_for_testing(TestData.aws_iam_roles)
@@ -128,7 +135,7 @@ def do_test_setup_remaining_secrets(overwrite_secrets: bool = True,
             TestData.aws_credentials_name,
             TestData.aws_account_number,
             encryption_enabled) as custom_dir, \
-         mock.patch.object(aws_context, "boto3", mocked_boto), mock.patch.object(aws, "boto3", mocked_boto), \
+         mock.patch.object(aws_context, "boto3", mocked_boto), \
          mock_print() as mocked_print:
 
         def find_created_aws_access_key_id_from_output() -> Optional[str]:
@@ -203,6 +210,16 @@ def do_test_setup_remaining_secrets(overwrite_secrets: bool = True,
 
             main(["--aws-credentials-dir", aws_credentials_dir, "--custom-dir", custom_dir, "--show"])
 
+            # All the secret key values are updated with a single read and (at most) a single new version.
+            # And the GAC and RDS secrets are read with a single batched call.
+            gac_secret_calls = mocked_secretsmanager.calls_for_testing(TestData.gac_secret_name)
+            assert gac_secret_calls["batch_get_secret_value"] == 1
+            assert gac_secret_calls["get_secret_value"] == 0
+            assert mocked_secretsmanager.calls_for_testing(TestData.rds_secret_name) == {"batch_get_secret_value": 1}
+            assert gac_secret_calls["update_secret"] == 0
+            assert gac_secret_calls["put_secret_value"] == (1 if overwrite_secrets else 0)
+            assert gac_secret_calls["update_secret_version_stage"] == (2 if overwrite_secrets else 0)
+
             if not overwrite_secrets:
 
                 assert (OldSecret.ACCOUNT_NUMBER
@@ -260,3 +277,145 @@ def do_test_setup_remaining_secrets(overwrite_secrets: bool = True,
             assert_secret_from_output(GacSecretKeyName.S3_AWS_ACCESS_KEY_ID, OldSecret.S3_AWS_ACCESS_KEY_ID)
             assert_secret_from_output(GacSecretKeyName.S3_AWS_SECRET_ACCESS_KEY, OldSecret.S3_AWS_SECRET_ACCESS_KEY)
             assert_secret_from_output(GacSecretKeyName.ENCODED_S3_ENCRYPT_KEY_ID, OldSecret.ENCODED_S3_ENCRYPT_KEY_ID)
+
+
+def test_update_secret_key_values_does_not_overwrite_concurrent_change() -> None:
+    mocked_boto = MockBoto3(iam=MockBoto3IamWithAuthorizationDetails,
+                            secretsmanager=MockBoto3VersionedSecretsManager)
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    mocked_secretsmanager = mocked_boto.client("secretsmanager")
+    mocked_secretsmanager.put_secret_key_value_for_testing(TestData.gac_secret_name, "a", "old-a")
+    mocked_secretsmanager.put_secret_key_value_for_testing(TestData.gac_secret_name, "b", "old-b")
+
+    def mocked_yes_or_no_with_concurrent_change(arg: str) -> bool:
+        # Simulate someone else changing the secret while we are prompting for confirmation.
+        mocked_secretsmanager.change_version_for_testing(TestData.gac_secret_name)
+        return True
+
+    with temporary_aws_credentials_dir_for_testing(TestData.aws_access_key_id,
+                                                   TestData.aws_secret_access_key,
+                                                   TestData.aws_region) as aws_credentials_dir, \
+         mock.patch.object(aws_context, "boto3", mocked_boto), \
+         mock_print() as mocked_print:
+        aws_object = aws.Aws(aws_credentials_dir)
+        with mock.patch("src.auto.utils.aws.yes_or_no", lambda arg: True):
+            changes = aws_object.update_secret_key_values(TestData.gac_secret_name,
+                                                          {"a": "new-a", "b": None, "c": "new-c"}, show=True)
+        assert changes == [{"key": "a", "action": "update", "old": "old-a", "new": "new-a"},
+                           {"key": "b", "action": "deactivate", "old": "old-b", "new": deactivated_secret("old-b")},
+                           {"key": "c", "action": "create", "old": None, "new": "new-c"}]
+        assert mocked_secretsmanager.get_secret_key_value_for_testing(TestData.gac_secret_name, "b") == \
+               deactivated_secret("old-b")
+        assert mocked_secretsmanager.calls_for_testing(TestData.gac_secret_name) == {
+            "get_secret_value": 1, "put_secret_value": 1, "update_secret_version_stage": 2}
+        assert find_matching_line(mocked_print.lines, ".*Updated AWS secret.*3 change.*")
+
+        with mock.patch("src.auto.utils.aws.yes_or_no", mocked_yes_or_no_with_concurrent_change):
+            assert aws_object.update_secret_key_values(TestData.gac_secret_name, {"a": "newer-a"}) == []
+        assert mocked_secretsmanager.get_secret_key_value_for_testing(TestData.gac_secret_name, "a") == "new-a"
+        assert find_matching_line(mocked_print.lines, ".*changed since it was read.*NOT updated.*")
+        # Neither the version made current nor the one not is left with a staging label of ours (nor AWSPENDING).
+        version_stages = mocked_secretsmanager.version_stages_for_testing(TestData.gac_secret_name)
+        assert len(version_stages) == 2 and all(stages == set() for stages in version_stages.values())
+
+
+class SlowMockBoto3Calls:
+    """ Stand-in latency for, and counts of, the AWS listings/lookups done by gather_secrets_to_update,
+        recording the most of them in flight at once.
+    """
+    latency_seconds = 0.2
+    counts = collections.Counter()
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def call(cls, name: str, function, *args, **kwargs):
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(cls.latency_seconds)
+        with cls.lock:
+            cls.in_flight -= 1
+            cls.counts[name] += 1
+        return function(*args, **kwargs)
+
+
+class SlowMockBoto3Iam(MockBoto3IamWithAuthorizationDetails):
+    def get_paginator(self, operation_name: str):
+        paginator = super().get_paginator(operation_name)
+
+        class SlowPaginator:
+            def paginate(self, **kwargs):
+                return SlowMockBoto3Calls.call(f"iam.{operation_name}", lambda: list(paginator.paginate(**kwargs)))
+        return SlowPaginator()
+
+
+class SlowMockBoto3OpenSearch(MockBoto3OpenSearch):
+    def list_domain_names(self):
+        return SlowMockBoto3Calls.call("opensearch.list_domain_names", super().list_domain_names)
+
+
+class SlowMockBoto3Kms(MockBoto3Kms):
+    def list_keys(self):
+        return SlowMockBoto3Calls.call("kms.list_keys", super().list_keys)
+
+
+class SlowMockBoto3SecretsManager(MockBoto3VersionedSecretsManager):
+    def get_secret_value(self, SecretId):  # noQA - Argument names must be compatible with AWS
+        return SlowMockBoto3Calls.call("secretsmanager.get_secret_value", super().get_secret_value, SecretId)
+
+    def batch_get_secret_value(self, SecretIdList: list, NextToken: Optional[str] = None) -> dict:  # noQA - AWS names
+        return SlowMockBoto3Calls.call("secretsmanager.batch_get_secret_value", super().batch_get_secret_value,
+                                       SecretIdList, NextToken)
+
+
+def test_gather_secrets_to_update_does_lookups_concurrently_and_once() -> None:
+    SlowMockBoto3Calls.counts.clear()
+    SlowMockBoto3Calls.max_in_flight = 0
+    mocked_boto = MockBoto3(iam=SlowMockBoto3Iam, opensearch=SlowMockBoto3OpenSearch, kms=SlowMockBoto3Kms,
+                            secretsmanager=SlowMockBoto3SecretsManager)
+    mocked_boto.client("iam").put_users_for_testing(TestData.aws_iam_users)
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    mocked_boto.client("opensearch").put_domain_for_testing(TestData.opensearch_name,
+                                                            TestData.opensearch_host,
+                                                            TestData.opensearch_https)
+    mocked_boto.client("kms").put_key_for_testing(TestData.aws_kms_key)
+    mocked_secretsmanager = mocked_boto.client("secretsmanager")
+    mocked_secretsmanager.put_secret_key_value_for_testing(TestData.rds_secret_name,
+                                                           RdsSecretKeyName.RDS_HOSTNAME, TestData.rds_host)
+    mocked_secretsmanager.put_secret_key_value_for_testing(TestData.rds_secret_name,
+                                                           RdsSecretKeyName.RDS_PASSWORD, TestData.rds_password)
+
+    with temporary_aws_credentials_dir_for_testing(TestData.aws_access_key_id,
+                                                   TestData.aws_secret_access_key,
+                                                   TestData.aws_region) as aws_credentials_dir, \
+         temporary_custom_dir_for_testing(TestData.aws_credentials_name,
+                                          TestData.aws_account_number,
+                                          encryption_enabled=True) as custom_dir, \
+         mock.patch.object(aws_context, "boto3", mocked_boto), \
+         mock.patch("src.auto.utils.aws.yes_or_no", lambda arg: True), \
+         mock_print() as mocked_print:
+        gac_secret_name, secrets_to_update, _ = gather_secrets_to_update(
+            None, None, aws_credentials_dir, None, None, None, None, custom_dir,
+            None, None, None, None, None, None, None, None, None, True)
+
+    assert gac_secret_name == TestData.gac_secret_name
+    assert secrets_to_update[GacSecretKeyName.ENCODED_ES_SERVER] == TestData.opensearch_server
+    assert secrets_to_update[GacSecretKeyName.RDS_HOSTNAME] == TestData.rds_host
+    assert secrets_to_update[GacSecretKeyName.RDS_PASSWORD] == TestData.rds_password
+    assert secrets_to_update[GacSecretKeyName.ENCODED_S3_ENCRYPT_KEY_ID] == TestData.aws_kms_key
+    assert secrets_to_update[GacSecretKeyName.S3_AWS_ACCESS_KEY_ID]
+    # Each listing is done just once, though e.g. the IAM users are needed both to find the federated
+    # user and to create its access key (listing the access keys of that user only), and the RDS secret
+    # is needed for both its host and password (and is fetched in a single batch with the GAC secret,
+    # which is not there in this case).
+    assert SlowMockBoto3Calls.counts == {"iam.get_account_authorization_details": 1,
+                                         "opensearch.list_domain_names": 1, "kms.list_keys": 1,
+                                         "secretsmanager.batch_get_secret_value": 1}
+    assert mocked_boto.client("iam").calls_for_testing() == {"get_account_authorization_details": 1,
+                                                             "list_access_keys": 1, "create_access_key": 1}
+    # The four (independent) listings were done concurrently, rather than one after another; so the discovery takes
+    # about one listing's latency rather than four.
+    assert SlowMockBoto3Calls.max_in_flight == 4
+    assert find_matching_line(mocked_print.lines, "Resolved 5 of 5 lookups")
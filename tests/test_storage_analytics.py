@@ -0,0 +1,171 @@
+import csv
+import gzip
+import io
+import os
+import pytest
+import tempfile
+import time
+
+from datetime import datetime, timedelta, timezone
+from src.info.aws_util import AWSUtil
+from src.info.pricing_calculator import PricingCalculator
+from src.info.storage_analytics import StorageDistributionAnalyzer, TransitionRule
+
+
+NOW = datetime(2023, 6, 1, tzinfo=timezone.utc)
+MiB = 2 ** 20
+
+
+class FakeS3Client:
+    """ Serves list_objects_v2 from a fixed list of objects, page_size at a time. """
+
+    def __init__(self, objects, page_size=2):
+        self.objects = objects
+        self.page_size = page_size
+        self.calls = 0
+
+    def list_objects_v2(self, Bucket, ContinuationToken=None, Prefix=None):  # noQA - boto3 case
+        self.calls += 1
+        start = int(ContinuationToken) if ContinuationToken else 0
+        next_start = start + self.page_size
+        response = {'Contents': self.objects[start:next_start], 'IsTruncated': next_start < len(self.objects)}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(next_start)
+        return response
+
+
+def _object(key, size, age_days, storage_class='STANDARD'):
+    return {'Key': key, 'Size': size, 'LastModified': NOW - timedelta(days=age_days), 'StorageClass': storage_class}
+
+
+OBJECTS = [
+    _object('a/new.bam', 10 * MiB, 5),
+    _object('a/old.bam', 10 * MiB, 400),
+    _object('a/old-small.txt', 1000, 400),
+    _object('b/x/y.fastq.gz', 3 * MiB, 100),
+    _object('root.txt', 0, 1000),
+    _object('b/archived.bam', 10 * MiB, 1000, storage_class='GLACIER'),
+]
+
+
+def test_iter_objects_follows_continuation_tokens():
+    client = FakeS3Client(OBJECTS, page_size=4)
+    assert list(AWSUtil().iter_objects('bucket', client=client)) == OBJECTS
+    assert client.calls == 2
+
+
+def test_histograms_by_top_level_prefix():
+    analyzer = StorageDistributionAnalyzer(aws_util=AWSUtil(), now=NOW)
+    assert analyzer.add_objects(OBJECTS) == 5
+    assert set(analyzer.histograms) == {'a/', 'b/', StorageDistributionAnalyzer.ROOT_PREFIX}
+    a = analyzer.histograms['a/']
+    assert sum(count for count, _ in a.values()) == 3
+    assert a[((10 * MiB).bit_length(), analyzer.age_bucket_days.index(365) + 1)] == [1, 10 * MiB]
+    assert analyzer.size_bucket_label((10 * MiB).bit_length()) == '8 MiB-16 MiB'
+    assert analyzer.size_bucket_label(0) == '0 B'
+    assert analyzer.age_bucket_label(len(analyzer.age_bucket_days)) == '1825d+'
+    assert analyzer.other_storage_classes == {'GLACIER': [1, 10 * MiB]}
+
+
+def test_project_savings():
+    rule = TransitionRule('glacier-90d-1m', 'GLACIER', 90, min_size=MiB)
+    analyzer = StorageDistributionAnalyzer(aws_util=AWSUtil(), rules=[rule], now=NOW)
+    analyzer.add_objects(OBJECTS)
+    savings = analyzer.project_savings()
+    total, first, second = savings
+    assert total['prefix'] == StorageDistributionAnalyzer.ALL_PREFIXES
+    assert (total['objects'], total['bytes']) == (2, 13 * MiB)
+    assert [(row['prefix'], row['bytes']) for row in (first, second)] == [('a/', 10 * MiB), ('b/', 3 * MiB)]
+    expected = (PricingCalculator.monthly_cost_for_storage_class(10 * MiB, 1, 'STANDARD') -
+                PricingCalculator.monthly_cost_for_storage_class(10 * MiB, 1, 'GLACIER'))
+    assert abs(first['monthly_savings'] - expected) < 1e-12
+    assert first['monthly_savings'] > 0
+    assert first['transition_cost'] == PricingCalculator.transition_cost_for_storage_class(1, 'GLACIER')
+
+
+def test_rule_ages_become_bucket_boundaries():
+    analyzer = StorageDistributionAnalyzer(aws_util=AWSUtil(), rules=[TransitionRule('ia', 'STANDARD_IA', 45)],
+                                           now=NOW)
+    assert 45 in analyzer.age_bucket_days
+    analyzer.add_many([('p/a', 2 ** 20, 44), ('p/b', 2 ** 20, 46)])
+    [total, row] = analyzer.project_savings()
+    assert total['objects'] == row['objects'] == 1
+
+
+def test_objects_modified_after_now_are_new():
+    analyzer = StorageDistributionAnalyzer(aws_util=AWSUtil(), now=NOW)
+    analyzer.add_objects([_object('a/uploaded-during-scan.bam', 10 * MiB, -1)])
+    assert analyzer.histograms['a/'] == {((10 * MiB).bit_length(), 1): [1, 10 * MiB]}
+    assert analyzer.age_bucket_label(1) == '0-30d'
+    # so no rule applies to it
+    assert {row['objects'] for row in analyzer.project_savings()} == {0}
+
+
+def test_inventory_csv_and_tsv_output():
+    analyzer = StorageDistributionAnalyzer(aws_util=AWSUtil(), now=NOW)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inventory = os.path.join(tmpdir, 'inventory.csv.gz')
+        with gzip.open(inventory, 'wt', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['bucket', 'a/with+space.bam', str(10 * MiB), '2022-01-01T00:00:00.000Z'])
+            writer.writerow(['bucket', 'a/new.bam', str(MiB), '2023-05-31T10:00:00.000Z'])
+        assert analyzer.add_inventory_csv(inventory) == 2
+        distribution = os.path.join(tmpdir, 'distribution.tsv')
+        savings = os.path.join(tmpdir, 'savings.tsv')
+        analyzer.write_distribution_tsv(distribution)
+        analyzer.write_savings_tsv(analyzer.project_savings(), savings)
+        with io.open(distribution, newline='') as f:
+            rows = list(csv.reader(f, delimiter='\t', quotechar='|'))
+        assert rows[0] == StorageDistributionAnalyzer.DISTRIBUTION_HEADER
+        assert [row[:4] for row in rows[1:]] == [['a/', '1 MiB-2 MiB', '0-30d', '1'],
+                                                 ['a/', '8 MiB-16 MiB', '365-730d', '1']]
+        with io.open(savings, newline='') as f:
+            rows = list(csv.reader(f, delimiter='\t', quotechar='|'))
+        assert rows[0] == StorageDistributionAnalyzer.SAVINGS_HEADER
+        assert len(rows) == 1 + 2 * len(StorageDistributionAnalyzer.DEFAULT_TRANSITION_RULES)
+
+
+class SyntheticS3Client:
+    """ Serves list_objects_v2 for a synthetic bucket of n objects, in pages of 1000 (the most S3 returns),
+        made on request.
+    """
+    page_size = 1000
+    prefixes = ['files/', 'wfoutput/', 'blobs/', 'system/', 'metadata/']
+
+    def __init__(self, n):
+        self.n = n
+        self.calls = 0
+        self.last_modified = [NOW - timedelta(days=age_days) for age_days in range(1900)]
+
+    def list_objects_v2(self, Bucket, ContinuationToken=None, Prefix=None):  # noQA - boto3 case
+        self.calls += 1
+        start = int(ContinuationToken) if ContinuationToken else 0
+        next_start = min(start + self.page_size, self.n)
+        # cheap deterministic spread over ~40 size buckets and ~5 years of ages
+        response = {'Contents': [{'Key': self.prefixes[(i >> 16) % 5] + 'k',
+                                  'Size': (i * 2654435761) % (1 << ((i % 40) + 1)),
+                                  'LastModified': self.last_modified[(i * 40503) % 1900]}
+                                 for i in range(start, next_start)],
+                    'IsTruncated': next_start < self.n}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(next_start)
+        return response
+
+
+@pytest.mark.integratedx
+def test_synthetic_million_object_listing():
+    """ Streams a synthetic million object listing into the histograms, page by page, reporting (rather than
+        asserting) how long that takes.
+    """
+    n = 1_000_000
+    client = SyntheticS3Client(n)
+    analyzer = StorageDistributionAnalyzer(aws_util=AWSUtil(), now=NOW)
+    start = time.time()
+    assert analyzer.add_objects(AWSUtil().iter_objects('bucket', client=client)) == n
+    savings = analyzer.project_savings()
+    elapsed = time.time() - start
+    print(f'\nAnalyzed {n} objects in {client.calls} pages in {elapsed:.1f}s ({n / elapsed:.0f} objects/s)')
+    assert client.calls == n // SyntheticS3Client.page_size
+    assert sum(count for cells in analyzer.histograms.values() for count, _ in cells.values()) == n
+    assert set(analyzer.histograms) == set(SyntheticS3Client.prefixes)
+    assert all(row['objects'] <= n for row in savings)
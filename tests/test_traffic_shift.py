@@ -0,0 +1,94 @@
+import pytest
+
+from dcicutils.qa_utils import printed_output as mock_print
+from src.commands.traffic_shift import TrafficShift, parse_schedule
+from src.exceptions import TrafficShiftError
+from .testing_utils import find_matching_line
+
+
+LOAD_BALANCER_ARN = 'arn:aws:elasticloadbalancing:us-east-1:123456789012:loadbalancer/app/smaht-productionblue/abc'
+TARGET_GROUP_ARN = 'arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/TargetGroupApplicationBlue/def'
+SHIFT_TARGET_GROUP_ARN = ('arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup'
+                          '/TargetGroupApplicationGreenShift/ghi')
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:us-east-1:123456789012:listener/app/smaht-productionblue/abc/jkl'
+
+
+class FakeElbv2:
+
+    def __init__(self):
+        self.weights = []
+
+    def describe_target_groups(self, Names):  # noQA - boto3 case
+        assert Names == ['TargetGroupApplicationBlue', 'TargetGroupApplicationGreenShift']
+        return {'TargetGroups': [
+            {'TargetGroupName': 'TargetGroupApplicationBlue', 'TargetGroupArn': TARGET_GROUP_ARN,
+             'LoadBalancerArns': [LOAD_BALANCER_ARN]},
+            {'TargetGroupName': 'TargetGroupApplicationGreenShift', 'TargetGroupArn': SHIFT_TARGET_GROUP_ARN,
+             'LoadBalancerArns': [LOAD_BALANCER_ARN]}]}
+
+    def describe_listeners(self, LoadBalancerArn):  # noQA - boto3 case
+        assert LoadBalancerArn == LOAD_BALANCER_ARN
+        return {'Listeners': [{'ListenerArn': LISTENER_ARN, 'Port': 80}]}
+
+    def modify_listener(self, ListenerArn, DefaultActions):  # noQA - boto3 case
+        assert ListenerArn == LISTENER_ARN
+        [action] = DefaultActions
+        self.weights.append({target_group['TargetGroupArn']: target_group['Weight']
+                             for target_group in action['ForwardConfig']['TargetGroups']})
+
+
+class FakeCloudWatch:
+    """ Returns, for each call, the next of the given (requests, 5xx, p95) metrics. """
+
+    def __init__(self, metrics):
+        self.metrics = list(metrics)
+        self.calls = []
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime):  # noQA - boto3 case
+        self.calls.append(MetricDataQueries)
+        requests, errors, p95 = self.metrics.pop(0)
+        return {'MetricDataResults': [{'Id': 'requests', 'Values': [requests]},
+                                      {'Id': 'errors', 'Values': [errors]},
+                                      {'Id': 'p95', 'Values': [p95] if p95 is not None else []}]}
+
+
+def _traffic_shift(metrics, **kwargs):
+    elbv2, cloudwatch = FakeElbv2(), FakeCloudWatch(metrics)
+    return TrafficShift.for_color(elbv2, cloudwatch, 'blue', bake_seconds=0, poll_seconds=0, **kwargs)
+
+
+def test_parse_schedule() -> None:
+    assert parse_schedule('5,25,50,100') == [5, 25, 50, 100]
+    assert parse_schedule('100') == [100]
+    for schedule in ('', '5,x', '50,25', '0,100', '5,5,100', '50,150'):
+        with pytest.raises(TrafficShiftError):
+            parse_schedule(schedule)
+
+
+def test_traffic_shift() -> None:
+    traffic_shift = _traffic_shift([(100, 0, 0.2), (500, 1, 0.3), (1000, 5, 0.3), (2000, 10, None)])
+    assert (traffic_shift.listener_arn, traffic_shift.target_group_arn, traffic_shift.shift_target_group_arn) == (
+        LISTENER_ARN, TARGET_GROUP_ARN, SHIFT_TARGET_GROUP_ARN)
+    with mock_print() as mocked_print:
+        traffic_shift.shift([5, 25, 50, 100])
+        assert find_matching_line(mocked_print.lines, r'Traffic shift at 100% OK: 2000 requests, 10 5xx, p95 0.000s')
+    assert traffic_shift.elbv2.weights == [{TARGET_GROUP_ARN: 100 - percent, SHIFT_TARGET_GROUP_ARN: percent}
+                                           for percent in (5, 25, 50, 100)]
+    # The metrics watched are those of the shifted traffic, i.e. of the shift target group through our load balancer.
+    dimensions = traffic_shift.cloudwatch.calls[0][0]['MetricStat']['Metric']['Dimensions']
+    assert dimensions == [{'Name': 'LoadBalancer', 'Value': 'app/smaht-productionblue/abc'},
+                          {'Name': 'TargetGroup', 'Value': 'targetgroup/TargetGroupApplicationGreenShift/ghi'}]
+
+
+@pytest.mark.parametrize('metrics, breach', [
+    ((500, 10, 0.3), r'5xx rate 2.00% exceeds 1.00% \(10 of 500 requests\)'),
+    ((500, 0, 2.5), r'p95 target response time 2.500s exceeds 2.0s'),
+])
+def test_traffic_shift_rolls_back(metrics, breach) -> None:
+    traffic_shift = _traffic_shift([(100, 0, 0.2), metrics])
+    with mock_print(), pytest.raises(TrafficShiftError, match=f'Traffic shift at 25% breached thresholds: {breach}'):
+        traffic_shift.shift([5, 25, 50, 100])
+    # Shifted back (all traffic to the listener's own target group) and not shifted any further.
+    assert traffic_shift.elbv2.weights == [{TARGET_GROUP_ARN: 95, SHIFT_TARGET_GROUP_ARN: 5},
+                                           {TARGET_GROUP_ARN: 75, SHIFT_TARGET_GROUP_ARN: 25},
+                                           {TARGET_GROUP_ARN: 100, SHIFT_TARGET_GROUP_ARN: 0}]
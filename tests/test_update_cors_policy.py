@@ -0,0 +1,127 @@
+import json
+import mock
+import os
+import pytest
+import tempfile
+from dcicutils.qa_utils import MockBoto3, printed_output as mock_print
+from src.auto.update_cors_policy.cli import main
+from src.auto.utils import aws_context
+from src.auto.utils.cors_reconciler import canonicalize_cors_rules, get_desired_cors_rules
+from .testing_utils import (find_matching_line,
+                            MockBoto3S3WithBuckets,
+                            temporary_aws_credentials_dir_for_testing,
+                            temporary_custom_dir_for_testing)
+
+
+class TestData:
+    aws_credentials_name = "cgap-unit-test"
+    aws_access_key_id = "AWS-ACCESS-KEY-ID-FOR-TESTING"
+    aws_secret_access_key = "AWS-SECRET-ACCESS-KEY-FOR-TESTING"
+    aws_region = "us-east-1"
+    aws_account_number = "1234567890"
+    aws_user_arn = f"arn:aws:iam::{aws_account_number}:user/user.for.testing"
+    url = "https://cgap-unit-test.hms.harvard.edu"
+    other_url = "https://some-other.hms.harvard.edu"
+    get_rule = {"AllowedMethods": ["GET"], "AllowedHeaders": ["*"], "AllowedOrigins": [other_url]}
+    put_rule = {"AllowedMethods": ["PUT", "POST"], "AllowedHeaders": ["Authorization"], "AllowedOrigins": [url]}
+    buckets = {
+        # Needs the URL added to its existing relevant (GET) rule.
+        "cgap-unit-test-application-files": [get_rule, put_rule],
+        # Already has the URL, in a rule with more headers, and in a different order; no change.
+        "cgap-unit-test-application-wfoutput": [put_rule, {"AllowedMethods": ["HEAD", "GET"],
+                                                           "AllowedHeaders": ["Range", "*"],
+                                                           "AllowedOrigins": [url, other_url]}],
+        # Has no CORS rules at all; needs the (new) rule.
+        "cgap-unit-test-application-blobs": None,
+        # Not selected by the prefix.
+        "cgap-other-test-application-files": [get_rule],
+    }
+
+
+def _mocked_boto() -> MockBoto3:
+    mocked_boto = MockBoto3(s3=MockBoto3S3WithBuckets)
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    for bucket_name, cors_rules in TestData.buckets.items():
+        mocked_boto.client("s3").put_bucket_for_testing(bucket_name, cors_rules,
+                                                        {"env": bucket_name.split("-application")[0]})
+    return mocked_boto
+
+
+def _run_main(mocked_boto: MockBoto3, argv: list) -> (int, list):
+    with temporary_aws_credentials_dir_for_testing(TestData.aws_access_key_id,
+                                                   TestData.aws_secret_access_key,
+                                                   TestData.aws_region) as aws_credentials_dir, \
+         temporary_custom_dir_for_testing(TestData.aws_credentials_name,
+                                          TestData.aws_account_number) as custom_dir, \
+         mock.patch.object(aws_context, "boto3", mocked_boto), \
+         mock_print() as mocked_print:
+        with pytest.raises(SystemExit) as exit_info:
+            main(["--custom-dir", custom_dir, "--aws-credentials-dir", aws_credentials_dir] + argv)
+            exit(0)
+        return exit_info.value.code, mocked_print.lines
+
+
+def _puts(mocked_boto: MockBoto3) -> list:
+    return sorted(bucket_name for bucket_name in TestData.buckets
+                  if mocked_boto.client("s3").calls_for_testing(bucket_name)["put_bucket_cors"])
+
+
+def test_update_cors_policy_dry_run() -> None:
+    mocked_boto = _mocked_boto()
+    exit_code, lines = _run_main(mocked_boto, ["--url", TestData.url, "--bucket-prefix", "cgap-unit-test-",
+                                               "--dry-run"])
+    assert exit_code == 0
+    assert _puts(mocked_boto) == []
+    assert find_matching_line(lines, f".*cgap-unit-test-application-files.*update.*GET {TestData.url}")
+    assert find_matching_line(lines, ".*cgap-unit-test-application-wfoutput.*unchanged")
+    assert find_matching_line(lines, "S3 buckets: 3 .unchanged: 1, update: 2.")
+    assert not find_matching_line(lines, ".*cgap-other-test-application-files")
+
+
+def test_update_cors_policy_updates_only_differing_buckets() -> None:
+    mocked_boto = _mocked_boto()
+    exit_code, lines = _run_main(mocked_boto, ["--url", TestData.url, "--bucket-prefix", "cgap-unit-test-",
+                                               "--no-confirm"])
+    assert exit_code == 0
+    assert _puts(mocked_boto) == ["cgap-unit-test-application-blobs", "cgap-unit-test-application-files"]
+    assert find_matching_line(lines, "S3 buckets: 3 .unchanged: 1, updated: 2.")
+    s3 = mocked_boto.client("s3")
+    assert s3.get_bucket_cors(Bucket="cgap-unit-test-application-blobs")["CORSRules"] == [
+        {"AllowedMethods": ["GET"], "AllowedHeaders": ["*"], "AllowedOrigins": [TestData.url]}]
+    assert s3.get_bucket_cors(Bucket="cgap-unit-test-application-files")["CORSRules"] == [
+        dict(TestData.get_rule, AllowedOrigins=[TestData.other_url, TestData.url]), TestData.put_rule]
+
+    # Running again there is nothing to do.
+    exit_code, lines = _run_main(mocked_boto, ["--url", TestData.url, "--bucket-prefix", "cgap-unit-test-",
+                                               "--no-confirm"])
+    assert exit_code == 1 and find_matching_line(lines, "Nothing to do.")
+    assert _puts(mocked_boto) == ["cgap-unit-test-application-blobs", "cgap-unit-test-application-files"]
+
+
+def test_update_cors_policy_by_tag_with_cors_rules_file() -> None:
+    mocked_boto = _mocked_boto()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cors_rules_file = os.path.join(tmp_dir, "cors.json")
+        with open(cors_rules_file, "w") as f:
+            json.dump({"CORSRules": [TestData.put_rule]}, f)
+        exit_code, lines = _run_main(mocked_boto, ["--cors-rules", cors_rules_file,
+                                                   "--bucket-tag", "env=cgap-other-test", "--no-confirm"])
+    assert exit_code == 0
+    assert _puts(mocked_boto) == ["cgap-other-test-application-files"]
+    assert mocked_boto.client("s3").get_bucket_cors(Bucket="cgap-other-test-application-files")["CORSRules"] == [
+        TestData.get_rule, TestData.put_rule]
+
+
+def test_update_cors_policy_requires_bucket_selection() -> None:
+    mocked_boto = _mocked_boto()
+    exit_code, lines = _run_main(mocked_boto, ["--url", TestData.url, "--dry-run"])
+    assert exit_code == 1
+    assert find_matching_line(lines, "At least one of --bucket, --bucket-prefix, or --bucket-tag must be specified.")
+    assert _puts(mocked_boto) == []
+
+
+def test_canonicalize_cors_rules() -> None:
+    cors_rules = [TestData.put_rule, TestData.get_rule]
+    reordered_cors_rules = [TestData.get_rule, dict(TestData.put_rule, AllowedMethods=["POST", "PUT", "PUT"])]
+    assert canonicalize_cors_rules(cors_rules) == canonicalize_cors_rules(reordered_cors_rules)
+    assert get_desired_cors_rules(cors_rules, [TestData.put_rule]) == cors_rules
@@ -1,9 +1,15 @@
+import copy
 import mock
-from dcicutils.qa_utils import MockBoto3
+import pytest
+from dcicutils.qa_utils import MockBoto3, MockBoto3Kms, printed_output as mock_print
 from dcicutils.diff_utils import DiffManager
 from src.auto.update_kms_policy.cli import main
 from src.auto.utils import aws, aws_context
-from .testing_utils import temporary_aws_credentials_dir_for_testing, temporary_custom_dir_for_testing
+from src.auto.utils.kms_policy_reconciler import canonicalize_kms_key_policy, diff_kms_key_policies
+from .testing_utils import (find_matching_line,
+                            MockBoto3IamWithAuthorizationDetails,
+                            temporary_aws_credentials_dir_for_testing,
+                            temporary_custom_dir_for_testing)
 
 
 class TestData:
@@ -70,7 +76,7 @@ class TestData:
 
 def test_update_kms_policy() -> None:
 
-    mocked_boto = MockBoto3()
+    mocked_boto = MockBoto3(iam=MockBoto3IamWithAuthorizationDetails)
 
     mocked_boto.client("iam").put_roles_for_testing(TestData.aws_iam_roles)
     mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
@@ -84,7 +90,7 @@ def test_update_kms_policy() -> None:
          temporary_custom_dir_for_testing(
             TestData.aws_credentials_name,
             TestData.aws_account_number, True) as custom_dir, \
-         mock.patch.object(aws_context, "boto3", mocked_boto), mock.patch.object(aws, "boto3", mocked_boto), \
+         mock.patch.object(aws_context, "boto3", mocked_boto), \
          mock.patch("builtins.input") as mocked_input:
 
         mocked_input.return_value = "yes"
@@ -111,3 +117,126 @@ def test_update_kms_policy() -> None:
         del kms_key_policy_before["Statement"][1]["Principal"]["AWS"]
         del kms_key_policy_after["Statement"][1]["Principal"]["AWS"]
         assert DiffManager().comparison(kms_key_policy_before, kms_key_policy_after) == []
+
+
+class CountingMockBoto3Kms(MockBoto3Kms):
+    """ MockBoto3Kms recording the key IDs for which put_key_policy is called. """
+    def put_key_policy(self, KeyId: str, Policy: str, PolicyName: str) -> None:  # noQA - AWS argument names
+        self.boto3.shared_reality.setdefault("_PUT_KEY_POLICY_KEY_IDS", []).append(KeyId)
+        super().put_key_policy(KeyId=KeyId, Policy=Policy, PolicyName=PolicyName)
+
+    def put_key_policy_key_ids_for_testing(self) -> list:
+        return self.boto3.shared_reality.setdefault("_PUT_KEY_POLICY_KEY_IDS", [])
+
+
+class FailingMockBoto3Kms(CountingMockBoto3Kms):
+    """ CountingMockBoto3Kms failing put_key_policy for the key IDs put_failing_key_ids_for_testing. """
+    def put_key_policy(self, KeyId: str, Policy: str, PolicyName: str) -> None:  # noQA - AWS argument names
+        if KeyId in self.boto3.shared_reality.get("_FAILING_KEY_IDS", []):
+            raise Exception(f"AccessDeniedException: not allowed to put key policy for {KeyId}")
+        super().put_key_policy(KeyId=KeyId, Policy=Policy, PolicyName=PolicyName)
+
+    def put_failing_key_ids_for_testing(self, key_ids: list) -> None:
+        self.boto3.shared_reality["_FAILING_KEY_IDS"] = key_ids
+
+
+def _mocked_boto_with_kms_keys(kms_class) -> (MockBoto3, list, list):
+    mocked_boto = MockBoto3(iam=MockBoto3IamWithAuthorizationDetails, kms=kms_class)
+    mocked_boto.client("iam").put_roles_for_testing(TestData.aws_iam_roles)
+    mocked_boto.client("sts").put_caller_identity_for_testing(TestData.aws_account_number, TestData.aws_user_arn)
+    mocked_kms = mocked_boto.client("kms")
+
+    # Ten keys, only two of which (the ones with the "before" principals) need their policies updated;
+    # the others already have the Foursight roles, in whatever order, or have no matching statement.
+    kms_key_ids = [f"kms-key-id-{index}" for index in range(10)]
+    kms_key_ids_to_update = [kms_key_ids[3], kms_key_ids[7]]
+    for kms_key_id in kms_key_ids:
+        kms_key_policy = copy.deepcopy(TestData.aws_kms_key_policy)
+        if kms_key_id == kms_key_ids[9]:
+            kms_key_policy["Statement"] = kms_key_policy["Statement"][:1]
+        elif kms_key_id not in kms_key_ids_to_update:
+            kms_key_policy["Statement"][1]["Principal"]["AWS"] = list(reversed(TestData.aws_kms_key_policy_roles_after))
+        mocked_kms.put_key_for_testing(kms_key_id)
+        mocked_kms.put_key_policy_for_testing(kms_key_id, kms_key_policy)
+    mocked_kms.put_key_policy_key_ids_for_testing().clear()
+    return mocked_boto, kms_key_ids, kms_key_ids_to_update
+
+
+def test_update_kms_policy_all_keys_updates_only_differing_keys() -> None:
+
+    mocked_boto, kms_key_ids, kms_key_ids_to_update = _mocked_boto_with_kms_keys(CountingMockBoto3Kms)
+    mocked_kms = mocked_boto.client("kms")
+
+    with temporary_aws_credentials_dir_for_testing(
+            TestData.aws_access_key_id,
+            TestData.aws_secret_access_key,
+            TestData.aws_region) as aws_credentials_dir, \
+         temporary_custom_dir_for_testing(
+            TestData.aws_credentials_name,
+            TestData.aws_account_number, True) as custom_dir, \
+         mock.patch.object(aws_context, "boto3", mocked_boto), \
+         mock.patch("builtins.input") as mocked_input, mock_print() as mocked_print:
+
+        mocked_input.return_value = "yes"
+        main(["--custom-dir", custom_dir, "--aws-credentials-dir", aws_credentials_dir, "--all-keys"])
+
+        assert sorted(mocked_kms.put_key_policy_key_ids_for_testing()) == kms_key_ids_to_update
+        aws_object = aws.Aws(aws_credentials_dir)
+        for kms_key_id in kms_key_ids[:9]:
+            kms_key_policy_principals = aws_object.get_kms_key_policy(kms_key_id)["Statement"][1]["Principal"]["AWS"]
+            assert sorted(kms_key_policy_principals) == sorted(TestData.aws_kms_key_policy_roles_after)
+
+    # Just the two missing Foursight roles are shown as added, for just the two keys updated.
+    added = [line for line in mocked_print.lines if '"op": "add"' in line]
+    assert len(added) == 2 * 2
+    assert all('"path": "/Statement/1/Principal/AWS/-"' in line for line in added)
+    assert find_matching_line(mocked_print.lines, f"KMS key policy changes for: {kms_key_ids[3]}")
+    assert not find_matching_line(mocked_print.lines, f"KMS key policy changes for: {kms_key_ids[0]}")
+
+
+def test_update_kms_policy_all_keys_reports_keys_failing_to_update() -> None:
+
+    mocked_boto, kms_key_ids, kms_key_ids_to_update = _mocked_boto_with_kms_keys(FailingMockBoto3Kms)
+    mocked_kms = mocked_boto.client("kms")
+    mocked_kms.put_failing_key_ids_for_testing([kms_key_ids[3]])
+
+    with temporary_aws_credentials_dir_for_testing(
+            TestData.aws_access_key_id,
+            TestData.aws_secret_access_key,
+            TestData.aws_region) as aws_credentials_dir, \
+         temporary_custom_dir_for_testing(
+            TestData.aws_credentials_name,
+            TestData.aws_account_number, True) as custom_dir, \
+         mock.patch.object(aws_context, "boto3", mocked_boto), \
+         mock.patch("builtins.input") as mocked_input, mock_print() as mocked_print:
+
+        mocked_input.return_value = "yes"
+        with pytest.raises(SystemExit) as exit_info:
+            main(["--custom-dir", custom_dir, "--aws-credentials-dir", aws_credentials_dir, "--all-keys"])
+        assert exit_info.value.code == 1
+
+    # The failure to update the one key does not stop (nor hide) the update of the other.
+    assert mocked_kms.put_key_policy_key_ids_for_testing() == [kms_key_ids[7]]
+    assert find_matching_line(mocked_print.lines, f"Updated KMS key policy: {kms_key_ids[7]}")
+    assert find_matching_line(mocked_print.lines, f"ERROR: Cannot update policy for KMS key: {kms_key_ids[3]}")
+    assert find_matching_line(mocked_print.lines, f".*AccessDeniedException.*{kms_key_ids[3]}")
+    assert find_matching_line(mocked_print.lines, f"Updated 1 KMS key policies; failed to update: {kms_key_ids[3]}")
+
+
+def test_kms_key_policy_diff() -> None:
+    kms_key_policy = canonicalize_kms_key_policy(TestData.aws_kms_key_policy)
+    # A single principal is equivalent to a list of just that principal, and order does not matter.
+    assert kms_key_policy["Statement"][0]["Principal"]["AWS"] == ["arn:aws:iam::466564410312:user/david.michaels"]
+    assert diff_kms_key_policies(kms_key_policy, canonicalize_kms_key_policy(copy.deepcopy(kms_key_policy))) == []
+    desired_kms_key_policy = copy.deepcopy(kms_key_policy)
+    desired_kms_key_policy["Statement"][0]["Effect"] = "Deny"
+    del desired_kms_key_policy["Statement"][1]["Resource"]
+    desired_kms_key_policy["Statement"][1]["Principal"]["AWS"] = ["arn:new"] + \
+        desired_kms_key_policy["Statement"][1]["Principal"]["AWS"][1:]
+    removed_principal = kms_key_policy["Statement"][1]["Principal"]["AWS"][0]
+    assert diff_kms_key_policies(kms_key_policy, canonicalize_kms_key_policy(desired_kms_key_policy)) == [
+        {"op": "replace", "path": "/Statement/0/Effect", "value": "Deny"},
+        {"op": "remove", "path": "/Statement/1/Principal/AWS/0", "value": removed_principal},
+        {"op": "add", "path": "/Statement/1/Principal/AWS/-", "value": "arn:new"},
+        {"op": "remove", "path": "/Statement/1/Resource", "value": "*"}
+    ]
@@ -0,0 +1,115 @@
+import json
+import os
+import pytest
+import tempfile
+from dcicutils.qa_utils import MockBoto3, printed_output as mock_print
+from src.auto.update_security_group.cli import main
+from src.auto.utils import aws as aws_module
+from src.auto.utils.security_group_reconciler import get_security_group_rule_key, plan_security_group_changes
+from .testing_utils import (find_matching_line,
+                            MockBoto3Ec2WithBatchedRules,
+                            temporary_custom_and_aws_credentials_dirs_for_testing)
+
+
+class TestData:
+    aws_credentials_name = "cgap-supertest-xyzzy"
+    aws_access_key_id = "AWS-ACCESS-KEY-ID-FOR-TESTING"
+    aws_secret_access_key = "AWS-SECRET-ACCESS-KEY-FOR-TESTING"
+    aws_region = "us-west-2"
+    aws_account_number = "1234567890"
+    aws_user_arn = f"arn:aws:iam::{aws_account_number}:user/user.for.testing"
+
+    security_group_name = "C4NetworkMainDBSecurityGroup"
+    security_group_id = "sg-0123456789abcdef0"
+
+    existing_rules = [
+        # Desired and already present, though with a different description.
+        {"IsEgress": False, "IpProtocol": "tcp", "FromPort": 5432, "ToPort": 5432,
+         "CidrIpv4": "10.0.0.0/16", "Description": "old description"},
+        # Not desired.
+        {"IsEgress": False, "IpProtocol": "tcp", "FromPort": 22, "ToPort": 22,
+         "CidrIpv4": "0.0.0.0/0", "Description": "ssh from anywhere"},
+        {"IsEgress": False, "IpProtocol": "tcp", "FromPort": 80, "ToPort": 80,
+         "CidrIpv4": "0.0.0.0/0", "Description": "http from anywhere"},
+        # Desired and already present.
+        {"IsEgress": True, "IpProtocol": "-1", "FromPort": -1, "ToPort": -1,
+         "CidrIpv4": "0.0.0.0/0", "Description": ""},
+    ]
+    desired_rules = {
+        "Ingress": [
+            {"IpProtocol": "tcp", "FromPort": 5432, "ToPort": 5432,
+             "IpRanges": [{"CidrIp": "10.0.0.0/16", "Description": "postgres from vpc"},
+                          {"CidrIp": "10.1.0.0/16", "Description": "postgres from peered vpc"}]},
+            {"IpProtocol": "tcp", "FromPort": 443, "ToPort": 443,
+             "IpRanges": [{"CidrIp": "10.0.0.0/16"}]},
+        ],
+        "Egress": [
+            {"IpProtocol": "-1", "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
+        ]
+    }
+
+
+def _run_main(argv: list) -> (MockBoto3, aws_module.Aws, list):
+    mocked_boto = MockBoto3(ec2=MockBoto3Ec2WithBatchedRules)
+    mocked_ec2 = mocked_boto.client("ec2")
+    for rule in TestData.existing_rules:
+        mocked_ec2.put_security_group_rule_for_testing(TestData.security_group_name,
+                                                       dict(rule, GroupId=TestData.security_group_id))
+    with temporary_custom_and_aws_credentials_dirs_for_testing(mocked_boto, TestData) as (custom_dir,
+                                                                                          aws_credentials_dir), \
+            tempfile.TemporaryDirectory() as tmp_dir, mock_print() as mocked_print:
+        rules_file = os.path.join(tmp_dir, "rules.json")
+        with open(rules_file, "w") as f:
+            json.dump(TestData.desired_rules, f)
+        with pytest.raises(SystemExit) as exit_info:
+            main(["--custom-dir", custom_dir, "--aws-credentials-dir", aws_credentials_dir,
+                  "--security-group-name", TestData.security_group_name, "--rules", rules_file] + argv)
+            exit(0)
+        aws = aws_module.Aws(aws_credentials_dir)
+        rules = aws.get_security_group_rules(TestData.security_group_id)
+    return exit_info.value.code, mocked_ec2.calls_for_testing(), rules, mocked_print.lines
+
+
+def _rule_keys(rules: list) -> set:
+    return {get_security_group_rule_key(rule)[:4] + (rule.get("CidrIpv4"),) for rule in rules}
+
+
+def test_update_security_group_adds_missing_rules_in_one_batch() -> None:
+    exit_code, calls, rules, lines = _run_main(["--no-confirm"])
+    assert exit_code == 0
+    # Just one authorize call (for the two missing inbound rules); nothing revoked; egress already as desired.
+    assert calls == {"authorize_security_group_ingress": 1}
+    assert _rule_keys(rules) == _rule_keys(TestData.existing_rules) | {
+        (False, "tcp", 5432, 5432, "10.1.0.0/16"), (False, "tcp", 443, 443, "10.0.0.0/16")}
+    assert find_matching_line(lines, ".*Inbound.*rule.*already exists.*5432.*10.0.0.0/16")
+
+
+def test_update_security_group_prune_and_force() -> None:
+    exit_code, calls, rules, lines = _run_main(["--no-confirm", "--prune", "--force"])
+    assert exit_code == 0
+    # One revoke (the two undesired rules and the one with the changed description) and one authorize.
+    assert calls == {"revoke_security_group_ingress": 1, "authorize_security_group_ingress": 1}
+    assert _rule_keys(rules) == {(False, "tcp", 5432, 5432, "10.0.0.0/16"), (False, "tcp", 5432, 5432, "10.1.0.0/16"),
+                                 (False, "tcp", 443, 443, "10.0.0.0/16"), (True, "-1", -1, -1, "0.0.0.0/0")}
+    assert [rule["Description"] for rule in rules if rule.get("CidrIpv4") == "10.0.0.0/16"
+            and rule["FromPort"] == 5432] == ["postgres from vpc"]
+
+
+def test_update_security_group_dry_run() -> None:
+    exit_code, calls, rules, lines = _run_main(["--prune", "--dry-run"])
+    assert exit_code == 0
+    assert calls == {}
+    assert _rule_keys(rules) == _rule_keys(TestData.existing_rules)
+    assert len([line for line in lines if "to revoke" in line]) == 2
+    assert len([line for line in lines if "to add" in line]) == 2
+
+
+def test_plan_security_group_changes_prunes_only_given_directions() -> None:
+    existing_rules = [dict(rule, SecurityGroupRuleId=f"sgr-{index}")
+                      for index, rule in enumerate(TestData.existing_rules)]
+    changes = plan_security_group_changes(TestData.security_group_id, existing_rules, None,
+                                          [{"IpProtocol": "tcp", "FromPort": 443, "ToPort": 443,
+                                            "IpRanges": [{"CidrIp": "0.0.0.0/0"}]}], prune=True)
+    assert [rule["SecurityGroupRuleId"] for rule in changes.rules_to_revoke] == ["sgr-3"]
+    assert [rule["IsEgress"] for rule in changes.rules_to_add] == [True]
+    assert not plan_security_group_changes(TestData.security_group_id, existing_rules, None, None, prune=True)
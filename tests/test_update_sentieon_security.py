@@ -9,7 +9,7 @@ from src.auto.update_sentieon_security.cli import (
     main,
 )
 from src.auto.utils import aws as aws_module
-from .testing_utils import temporary_custom_and_aws_credentials_dirs_for_testing
+from .testing_utils import MockBoto3Ec2WithBatchedRules, temporary_custom_and_aws_credentials_dirs_for_testing
 
 
 class TestData:
@@ -38,7 +38,7 @@ class TestData:
 
 @contextmanager
 def _basic_setup_for_main():
-    mocked_boto = MockBoto3()
+    mocked_boto = MockBoto3(ec2=MockBoto3Ec2WithBatchedRules)
     mocked_boto_ec2 = mocked_boto.client("ec2")
     assert isinstance(mocked_boto_ec2, MockBoto3Ec2)
 
@@ -77,6 +77,16 @@ def test_update_sentieon_security_yes() -> None:
         for outbound_rule_to_define in outbound_rules_to_define:
             assert aws.find_outbound_security_group_rule(outbound_rules_defined, outbound_rule_to_define) is not None
 
+        # Make sure the rules were defined with a single (batched) call per direction.
+        assert aws.client("ec2").calls_for_testing() == {"authorize_security_group_ingress": 1,
+                                                         "authorize_security_group_egress": 1}
+
+        # And that running again there is nothing to do.
+        with pytest.raises(SystemExit):
+            main(["--custom-dir", custom_dir, "--aws-credentials-dir", aws_credentials_dir])
+        assert aws.client("ec2").calls_for_testing() == {"authorize_security_group_ingress": 1,
+                                                         "authorize_security_group_egress": 1}
+
 
 def test_update_sentieon_security_no() -> None:
 
@@ -1,3 +1,5 @@
+from botocore.exceptions import ClientError
+import collections
 from contextlib import contextmanager
 import io
 import json
@@ -7,7 +9,8 @@ import re
 import tempfile
 from typing import Callable, Optional
 from dcicutils import cloudformation_utils
-from src.auto.utils import aws, aws_context
+from dcicutils.qa_utils import MockBoto3Ec2, MockBoto3Iam, MockBoto3SecretsManager, MockBotoS3Client
+from src.auto.utils import aws_context
 
 
 @contextmanager
@@ -78,8 +81,7 @@ def temporary_custom_and_aws_credentials_dirs_for_testing(mocked_boto, test_data
             test_data.aws_credentials_name,
             test_data.aws_account_number, True) as custom_dir, \
          mock.patch.object(cloudformation_utils, "boto3", mocked_boto), \
-         mock.patch.object(aws_context, "boto3", mocked_boto), \
-         mock.patch.object(aws, "boto3", mocked_boto):
+         mock.patch.object(aws_context, "boto3", mocked_boto):
         yield custom_dir, aws_credentials_dir
 
 
@@ -117,3 +119,230 @@ def all_lines_match(lines: list, regular_expression: str, predicate: Callable) -
             if not predicate(value):
                 return False
     return True
+
+
+class MockBoto3VersionedSecretsManager(MockBoto3SecretsManager):
+    """
+    MockBoto3SecretsManager which also supports the secret versions (VersionId) and staging labels
+    used by Aws.update_secret_key_values, the batch_get_secret_value and describe_secret calls used
+    by SecretsCache, and counts the calls made to it per secret name.
+    Use like: MockBoto3(secretsmanager=MockBoto3VersionedSecretsManager)
+    """
+
+    _VERSIONS_MARKER = "_MOCKED_SECRET_VERSIONS"
+    _CALLS_MARKER = "_MOCKED_SECRET_CALLS"
+
+    def _mocked_versions(self) -> dict:
+        return self.boto3.shared_reality.setdefault(self._VERSIONS_MARKER, {})
+
+    def calls_for_testing(self, SecretId: str) -> collections.Counter:  # noQA - Argument names chosen for AWS consistency
+        calls = self.boto3.shared_reality.setdefault(self._CALLS_MARKER, {})
+        return calls.setdefault(SecretId, collections.Counter())
+
+    def _current_version_id(self, SecretId: str) -> str:  # noQA - Argument names chosen for AWS consistency
+        return self._mocked_versions().setdefault(SecretId, {}).setdefault("AWSCURRENT", f"{SecretId}-version-0")
+
+    def get_secret_value(self, SecretId):  # noQA - Argument names must be compatible with AWS
+        self.calls_for_testing(SecretId)["get_secret_value"] += 1
+        return dict(super().get_secret_value(SecretId), Name=SecretId, ARN=self._secret_arn(SecretId),
+                    VersionId=self._current_version_id(SecretId))
+
+    def _secret_arn(self, SecretId: str) -> str:  # noQA - Argument names chosen for AWS consistency
+        return f"arn:aws:secretsmanager:us-east-1:123456789012:secret:{SecretId}-AbCdEf"
+
+    def batch_get_secret_value(self, SecretIdList: list, NextToken: Optional[str] = None) -> dict:  # noQA - AWS names
+        assert 1 <= len(SecretIdList) <= 20 and NextToken is None
+        secret_values, errors = [], []
+        for secret_id in SecretIdList:
+            self.calls_for_testing(secret_id)["batch_get_secret_value"] += 1
+            if secret_id in self._mocked_secrets():
+                secret_values.append(dict(super().get_secret_value(secret_id), Name=secret_id,
+                                          ARN=self._secret_arn(secret_id),
+                                          VersionId=self._current_version_id(secret_id)))
+            else:
+                errors.append({"SecretId": secret_id, "ErrorCode": "ResourceNotFoundException",
+                               "Message": "Secrets Manager can't find the specified secret."})
+        return {"SecretValues": secret_values, "Errors": errors}
+
+    def describe_secret(self, SecretId: str) -> dict:  # noQA - Argument names chosen for AWS consistency
+        secret_name = SecretId.rsplit(":", 1)[-1].rsplit("-", 1)[0] if SecretId.startswith("arn:") else SecretId
+        self.calls_for_testing(secret_name)["describe_secret"] += 1
+        return {"Name": secret_name, "ARN": self._secret_arn(secret_name),
+                "VersionIdsToStages": {self._current_version_id(secret_name): ["AWSCURRENT"]}}
+
+    def update_secret(self, SecretId: str, SecretString: str) -> None:  # noQA - Argument names chosen for AWS consistency
+        self.calls_for_testing(SecretId)["update_secret"] += 1
+        super().update_secret(SecretId, SecretString)
+        self.change_version_for_testing(SecretId)
+
+    def change_version_for_testing(self, SecretId: str) -> None:  # noQA - Argument names chosen for AWS consistency
+        versions = self._mocked_versions().setdefault(SecretId, {})
+        versions["AWSCURRENT"] = f"{self._current_version_id(SecretId)}-changed"
+
+    def put_secret_value(self, SecretId: str, ClientRequestToken: str, SecretString: str,  # noQA - AWS names
+                         VersionStages: list) -> dict:  # noQA - Argument names chosen for AWS consistency
+        self.calls_for_testing(SecretId)["put_secret_value"] += 1
+        assert "AWSCURRENT" not in VersionStages
+        assert VersionStages
+        self._mocked_versions().setdefault(SecretId, {}).setdefault("pending", {})[ClientRequestToken] = SecretString
+        self.version_stages_for_testing(SecretId)[ClientRequestToken] = set(VersionStages)
+        return {"Name": SecretId, "VersionId": ClientRequestToken, "VersionStages": VersionStages}
+
+    def version_stages_for_testing(self, SecretId: str) -> dict:  # noQA - Argument names chosen for AWS consistency
+        """ Returns the (other than AWSCURRENT) staging labels of the versions written, by version ID. """
+        return self._mocked_versions().setdefault(SecretId, {}).setdefault("stages", {})
+
+    def update_secret_version_stage(self, SecretId: str, VersionStage: str,  # noQA - Argument names chosen for AWS
+                                    MoveToVersionId: Optional[str] = None,  # noQA - consistency
+                                    RemoveFromVersionId: Optional[str] = None) -> dict:  # noQA - consistency
+        self.calls_for_testing(SecretId)["update_secret_version_stage"] += 1
+        if VersionStage != "AWSCURRENT":
+            assert MoveToVersionId is None and VersionStage in self.version_stages_for_testing(SecretId).get(
+                RemoveFromVersionId, set())
+            self.version_stages_for_testing(SecretId)[RemoveFromVersionId].remove(VersionStage)
+            return {"Name": SecretId}
+        if RemoveFromVersionId != self._current_version_id(SecretId):
+            raise ClientError({"Error": {"Code": "InvalidParameterException",
+                                         "Message": f"The staging label is attached to a different version."}},
+                              "UpdateSecretVersionStage")
+        versions = self._mocked_versions()[SecretId]
+        self._mocked_secrets()[SecretId] = versions["pending"].pop(MoveToVersionId)
+        versions["AWSCURRENT"] = MoveToVersionId
+        return {"Name": SecretId}
+
+
+class MockBoto3IamWithAuthorizationDetails(MockBoto3Iam):
+    """
+    MockBoto3Iam which also supports the (paginated) get_account_authorization_details listing used by
+    IamIndex, built from the mocked users and roles, with any tags and attached managed policies put
+    for them for testing, and the create_access_key call, and counts the calls made to it.
+    Use like: MockBoto3(iam=MockBoto3IamWithAuthorizationDetails)
+    """
+
+    _DETAILS_MARKER = "_MOCKED_IAM_AUTHORIZATION_DETAILS"
+    PAGE_SIZE = 2
+
+    def _mocked_details(self, arn: str) -> dict:
+        details = self.boto3.shared_reality.setdefault(self._DETAILS_MARKER, {})
+        return details.setdefault(arn, {"Tags": [], "AttachedManagedPolicies": []})
+
+    def calls_for_testing(self) -> collections.Counter:
+        return self.boto3.shared_reality.setdefault(self._DETAILS_MARKER + "_CALLS", collections.Counter())
+
+    def _user_arn(self, user_name: str) -> str:
+        return f"arn:aws:iam::{self.boto3.client('sts').get_caller_identity().get('Account')}:user/{user_name}"
+
+    def put_tags_for_testing(self, arn: str, tags: dict) -> None:
+        self._mocked_details(arn)["Tags"].extend({"Key": key, "Value": value} for key, value in tags.items())
+
+    def put_attached_policy_for_testing(self, arn: str, policy_arn: str) -> None:
+        self._mocked_details(arn)["AttachedManagedPolicies"].append({"PolicyName": policy_arn.split("/")[-1],
+                                                                     "PolicyArn": policy_arn})
+
+    def list_access_keys(self, UserName: str):  # noQA - Argument names chosen for AWS consistency
+        self.calls_for_testing()["list_access_keys"] += 1
+        return super().list_access_keys(UserName=UserName)
+
+    def create_access_key(self, UserName: str) -> dict:  # noQA - Argument names chosen for AWS consistency
+        self.calls_for_testing()["create_access_key"] += 1
+        [user] = [user for user in self._mocked_users().all() if user.name == UserName]
+        access_key_pair = user.create_access_key_pair()
+        return {"AccessKey": {"UserName": UserName, "AccessKeyId": access_key_pair.id,
+                              "SecretAccessKey": access_key_pair.secret, "Status": "Active"}}
+
+    def get_paginator(self, operation_name: str):
+        assert operation_name == "get_account_authorization_details"
+        mocked_iam = self
+
+        class Paginator:
+            def paginate(self, Filter: list):  # noQA - Argument names chosen for AWS consistency
+                mocked_iam.calls_for_testing()["get_account_authorization_details"] += 1
+                users = [dict(mocked_iam._mocked_details(mocked_iam._user_arn(user.name)),
+                              UserName=user.name, Arn=mocked_iam._user_arn(user.name))
+                         for user in mocked_iam._mocked_users().all()] if "User" in Filter else []
+                roles = [dict(mocked_iam._mocked_details(role["Arn"]),
+                              RoleName=role["Arn"].split("/")[-1], Arn=role["Arn"])
+                         for role in mocked_iam._mocked_roles()["Roles"]] if "Role" in Filter else []
+                for index in range(0, max(len(users), len(roles), 1), mocked_iam.PAGE_SIZE):
+                    yield {"UserDetailList": users[index:index + mocked_iam.PAGE_SIZE],
+                           "RoleDetailList": roles[index:index + mocked_iam.PAGE_SIZE],
+                           "Policies": [], "IsTruncated": index + mocked_iam.PAGE_SIZE < max(len(users), len(roles))}
+        return Paginator()
+
+
+class MockBoto3S3WithBuckets(MockBotoS3Client):
+    """
+    MockBotoS3Client which also supports listing buckets, and getting/putting bucket CORS rules and tags,
+    and counts the (bucket) calls made to it per bucket name.
+    Use like: MockBoto3(s3=MockBoto3S3WithBuckets)
+    """
+
+    _BUCKETS_MARKER = "_MOCKED_S3_BUCKETS"
+
+    def _mocked_buckets(self) -> dict:
+        return self.boto3.shared_reality.setdefault(self._BUCKETS_MARKER, {})
+
+    def calls_for_testing(self, Bucket: str) -> collections.Counter:  # noQA - Argument names chosen for AWS consistency
+        return self._mocked_buckets().setdefault(Bucket, {}).setdefault("calls", collections.Counter())
+
+    def put_bucket_for_testing(self, Bucket: str, CORSRules: Optional[list] = None,  # noQA - AWS names
+                               Tags: Optional[dict] = None) -> None:  # noQA - Argument names chosen for AWS consistency
+        bucket = self._mocked_buckets().setdefault(Bucket, {})
+        bucket["cors_rules"] = CORSRules
+        bucket["tags"] = Tags
+        bucket["calls"] = collections.Counter()
+
+    def _mocked_bucket(self, Bucket: str, operation_name: str) -> dict:  # noQA - AWS names
+        bucket = self._mocked_buckets().get(Bucket)
+        if bucket is None or "cors_rules" not in bucket:
+            raise ClientError({"Error": {"Code": "NoSuchBucket", "Message": "The specified bucket does not exist"}},
+                              operation_name)
+        bucket["calls"][operation_name] += 1
+        return bucket
+
+    def list_buckets(self) -> dict:
+        return {"Buckets": [{"Name": name} for name, bucket in sorted(self._mocked_buckets().items())
+                            if "cors_rules" in bucket]}
+
+    def get_bucket_cors(self, Bucket: str) -> dict:  # noQA - Argument names chosen for AWS consistency
+        bucket = self._mocked_bucket(Bucket, "get_bucket_cors")
+        if not bucket["cors_rules"]:
+            raise ClientError({"Error": {"Code": "NoSuchCORSConfiguration"}}, "GetBucketCors")
+        return {"CORSRules": json.loads(json.dumps(bucket["cors_rules"]))}
+
+    def put_bucket_cors(self, Bucket: str, CORSConfiguration: dict) -> None:  # noQA - AWS argument names
+        self._mocked_bucket(Bucket, "put_bucket_cors")["cors_rules"] = CORSConfiguration["CORSRules"]
+
+    def get_bucket_tagging(self, Bucket: str) -> dict:  # noQA - Argument names chosen for AWS consistency
+        bucket = self._mocked_bucket(Bucket, "get_bucket_tagging")
+        if not bucket["tags"]:
+            raise ClientError({"Error": {"Code": "NoSuchTagSet"}}, "GetBucketTagging")
+        return {"TagSet": [{"Key": key, "Value": value} for key, value in bucket["tags"].items()]}
+
+
+class MockBoto3Ec2WithBatchedRules(MockBoto3Ec2):
+    """
+    MockBoto3Ec2 which also supports authorizing security group rules (IpPermissions) with any number
+    of IpRanges, and revoking any number of rules at once, and counts the authorize/revoke calls made.
+    Use like: MockBoto3(ec2=MockBoto3Ec2WithBatchedRules)
+    """
+
+    _CALLS_MARKER = "_MOCKED_EC2_CALLS"
+
+    def calls_for_testing(self) -> collections.Counter:
+        return self.boto3.shared_reality.setdefault(self._CALLS_MARKER, collections.Counter())
+
+    def _authorize_security_group(self, GroupId: str, IpPermissions: list, egress: bool) -> dict:  # noQA - AWS names
+        self.calls_for_testing()[f"authorize_security_group_{'egress' if egress else 'ingress'}"] += 1
+        ip_permissions = [dict(ip_permission, IpRanges=[ip_range])
+                          for ip_permission in IpPermissions for ip_range in ip_permission.get("IpRanges") or []]
+        return super()._authorize_security_group(GroupId, ip_permissions, egress)
+
+    def _revoke_security_group(self, GroupId: str, SecurityGroupRuleIds: list,  # noQA - AWS names
+                               egress: bool) -> None:
+        self.calls_for_testing()[f"revoke_security_group_{'egress' if egress else 'ingress'}"] += 1
+        for group in self._mocked_security_groups():
+            if group["id"] == GroupId:
+                group["rules"] = [rule for rule in group["rules"]
+                                  if rule.get("IsEgress") != egress
+                                  or rule["SecurityGroupRuleId"] not in SecurityGroupRuleIds]